@@ -0,0 +1,212 @@
+import os
+import copy
+import json
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+from prepro import find_facts
+from docfilter import DocFilter, predict_docs, ensemble_vote, COMPRESSION_FILE
+from pytorch_pretrained_bert import WEIGHTS_NAME
+
+# Offline compression of the document filter:
+#   1. importance of each attention head of BERT on a held-out split
+#      (sensitivity of the loss to the head mask, Michel et al. 2019,
+#      normalized per layer)
+#   2. pruning of the least important heads up to a budget (fraction of all
+#      the heads)
+#   3. dynamic int8 quantization of the linear layers (cpu only)
+# Reports recall@2 vs latency for each budget and saves one of them for
+# docfilter.py (--compressed_path)
+#
+#   python compress_docfilter.py --importance_name held_out.json \
+#       --eval_name dev.json --prune_ratios 0 0.2 0.4 0.5 --quantize \
+#       --device cpu --save_ratio 0.4 \
+#       --output_dir models/doc_filter_compressed
+
+
+def to_device(batch, device):
+    return tuple(t.to(device) if type(t) == torch.Tensor else t for t in batch)
+
+
+def compute_head_importance(model, dataloader, device):
+    '''
+    returns (num_layers, num_heads) importance of the heads of model.bert
+    '''
+    config = model.bert.config
+    head_mask = torch.ones(config.num_hidden_layers,
+                           config.num_attention_heads, device=device,
+                           requires_grad=True)
+    importance = torch.zeros(config.num_hidden_layers,
+                             config.num_attention_heads, device=device)
+    model.eval()
+    for batch in tqdm(dataloader):
+        batch = to_device(batch, device)
+        probs = model(input_ids=batch[0], segment_ids=batch[1],
+                      input_mask=batch[2], triplet=batch[4],
+                      triplet_mask=batch[5], head_mask=head_mask)
+        # pairwise labels (doc i more relevant than doc j), padded pairs are
+        # masked
+        triplet_mask = batch[5]
+        loss = F.binary_cross_entropy(probs.view(triplet_mask.shape),
+                                      batch[3], weight=triplet_mask,
+                                      reduction='sum') / triplet_mask.sum()
+        loss.backward()
+        importance += head_mask.grad.abs().detach()
+        head_mask.grad = None
+    norm = importance.norm(dim=1, keepdim=True).clamp(min=1e-20)
+    importance = importance / norm
+    return importance.cpu()
+
+
+def heads_to_prune(importance, prune_ratio):
+    '''
+    returns {layer: [heads]} with the least important heads, prune_ratio of all
+    the heads (at least one head is kept in each layer)
+    '''
+    num_layers, num_heads = importance.shape
+    num_prune = int(round(prune_ratio * num_layers * num_heads))
+    dict_layer2heads = {}
+    for idx in importance.view(-1).argsort().tolist():
+        if num_prune == 0:
+            break
+        layer, head = divmod(idx, num_heads)
+        if len(dict_layer2heads.get(layer, [])) == num_heads - 1:
+            continue
+        dict_layer2heads.setdefault(layer, []).append(head)
+        num_prune -= 1
+    return dict_layer2heads
+
+
+def recall_at_2(data, pred_gold_idx):
+    '''
+    fraction of the supporting documents among the 2 predicted docs of each
+    example
+    '''
+    found, total = 0, 0
+    for ex, pred in zip(data, pred_gold_idx):
+        gold = [doc_idx for (doc_idx, label) in find_facts(ex).values()
+                if label > 0]
+        found += len(set(gold).intersection(pred))
+        total += len(gold)
+    return found / max(total, 1)
+
+
+def evaluate(model, dataloader, data, device):
+    '''
+    returns recall@2 and the latency per question (ms)
+    '''
+    model.eval()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    t0 = time.perf_counter()
+    preds = predict_docs(model, dataloader, device)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    latency = 1000 * (time.perf_counter() - t0) / len(data)
+    return recall_at_2(data, ensemble_vote(preds[np.newaxis])), latency
+
+
+def compress(model, dict_layer2heads, quantize):
+    model = copy.deepcopy(model)
+    if len(dict_layer2heads) > 0:
+        model.prune_heads(dict_layer2heads)
+    if quantize:
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear},
+                                                    dtype=torch.qint8)
+    return model
+
+
+def save_compressed(model, output_dir, compression):
+    os.makedirs(output_dir, exist_ok=True)
+    model.config.save_pretrained(output_dir)
+    torch.save(model.state_dict(), os.path.join(output_dir, WEIGHTS_NAME))
+    with open(os.path.join(output_dir, COMPRESSION_FILE), 'w') as f:
+        json.dump(compression, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--importance_name', type=str, required=True,
+                        help='held-out hotpot json (with supporting facts) '
+                             'for the head importance')
+    parser.add_argument('--eval_name', type=str, required=True,
+                        help='hotpot json (with supporting facts) for '
+                             'recall@2')
+    parser.add_argument('--num_importance', type=int, default=500,
+                        help='examples of the held-out split used')
+    parser.add_argument('--num_eval', type=int, default=1000,
+                        help='examples of the eval split used')
+    parser.add_argument('--prune_ratios', type=float, nargs='+',
+                        default=[0, 0.2, 0.4, 0.5])
+    parser.add_argument('--quantize', action='store_true',
+                        help='also evaluate int8 versions (cpu only)')
+    parser.add_argument('--device', type=str, default='cuda')
+    parser.add_argument('--batch_size', type=int, default=20)
+    parser.add_argument('--importance_batch_size', type=int, default=2)
+    parser.add_argument('--save_ratio', type=float, default=None,
+                        help='budget of the saved checkpoint')
+    parser.add_argument('--save_quantized', action='store_true',
+                        help='save the int8 version')
+    parser.add_argument('--output_dir', type=str,
+                        default='models/doc_filter_compressed')
+    args = parser.parse_args()
+    if (args.quantize or args.save_quantized) and args.device != 'cpu':
+        parser.error(
+            'dynamic quantization only runs on the cpu (--device cpu)')
+
+    doc_filter = DocFilter(device=args.device,
+                           batch_size=args.importance_batch_size,
+                           num_workers=0)
+    if len(doc_filter.distributed_models) > 1:
+        # the first model of the ensemble is compressed
+        doc_filter.model.load_state_dict(doc_filter.distributed_models[0])
+    model = doc_filter.model.module
+    device = doc_filter.device
+
+    with open(args.importance_name, 'r') as f:
+        importance_data = json.load(f)[:args.num_importance]
+    importance = compute_head_importance(
+        model, doc_filter.get_dataloader(importance_data, with_labels=True),
+        device)
+    print('head importance (layer x head)')
+    print(np.array2string(importance.numpy(), precision=2, max_line_width=200))
+
+    with open(args.eval_name, 'r') as f:
+        eval_data = json.load(f)[:args.num_eval]
+    doc_filter.batch_size = args.batch_size
+    eval_dataloader = doc_filter.get_dataloader(eval_data)
+    results = []
+    for prune_ratio in args.prune_ratios:
+        dict_layer2heads = heads_to_prune(importance, prune_ratio)
+        for quantize in ([False, True] if args.quantize else [False]):
+            compressed = compress(model, dict_layer2heads, quantize)
+            recall, latency = evaluate(compressed, eval_dataloader, eval_data,
+                                       device)
+            results.append({'prune_ratio': prune_ratio,
+                            'quantized': quantize,
+                            'recall@2': recall,
+                            'ms_per_question': latency})
+            print(
+                'pruned {:.0%} of the heads{}: '
+                'recall@2 {:.4f}, {:.1f} ms/question'.format(
+                    prune_ratio, ' + int8' if quantize else '', recall,
+                    latency))
+            del compressed
+
+    if args.save_ratio is not None:
+        dict_layer2heads = heads_to_prune(importance, args.save_ratio)
+        compressed = compress(model, dict_layer2heads, args.save_quantized)
+        compression = {'prune_ratio': args.save_ratio,
+                       'quantized': args.save_quantized,
+                       'pruned_heads': {str(k): v for k, v
+                                        in dict_layer2heads.items()},
+                       'results': results}
+        save_compressed(compressed, args.output_dir, compression)
+        print('saved', args.output_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,7 +13,7 @@ import os
 import code
 from torch.utils.data import (DataLoader, RandomSampler, SequentialSampler,
                               TensorDataset, Dataset)
-from prepro import get_features
+from prepro import get_features_from_data
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
 import pickle
@@ -33,58 +33,13 @@ from pytorch_pretrained_bert import (WEIGHTS_NAME, BertConfig,
 from pytorch_pretrained_bert import AdamW, WarmupLinearSchedule
 from scipy import stats
 
-#files = glob.glob('results/ensemble_large*/pytorch_model.bin')
-
-parser = argparse.ArgumentParser()
-parser.add_argument('--dev_name', type=str, default='dev_orig_bert-base-uncased.pkl')
-parser.add_argument('--test_name', type=str, default='dev_orig_bert-base-uncased.pkl')
-parser.add_argument('--use_mini', action='store_true', help='Load in a mini set for debug')
-parser.add_argument('--max_seq_len', type=int, default=512, help='Maximum BERT Sequence Length')
-parser.add_argument('--do_lower_case', action='store_true', help='Lower case BERT')
-parser.add_argument('--use_peng', action='store_true', help='Load in Peng IR results')
-parser.add_argument('--orig_train_file', type=str, default='hotpot_train_v1.1.json', help='Train File Name')
-parser.add_argument('--orig_dev_file', type=str, default='hotpot_dev_distractor_v1.json', help='Dev File Name')
-parser.add_argument('--peng_train_file', type=str, default='hotpot_dev_distractor_v1.json', help='Peng Train File Name')
-parser.add_argument('--peng_dev_file', type=str, default='hotpot_dev_distractor_v1.json', help='Peng Dev File Name')
-parser.add_argument('--data_dir', type=str, default='/mnt/cephfs2/asr/users/kevin.huang/hotpot/data',
-                    help='Load in a mini set for debug')
-parser.add_argument('--name', type=str, default='',
-                    help='name for the saved file')
-parser.add_argument("--bert_model", default='bert-large-uncased', type=str,
-                    help='Bert Model to use for tokenization')
-parser.add_argument('--output_name', default='',type=str)
-args = parser.parse_args()
-
-#with open(args.dev_name, 'rb') as f:
-    #eval_features = pickle.load(f)
-#with open(args.test_name, 'rb') as f:
-    #test_features = pickle.load(f)
-
-#models=[]
-#for f in files:
-    #print('files', f)
-    #models.append(torch.load(f))
-##args = models[0]['args']    
-
-model = BertForSequenceClassification.from_pretrained('models/bert-large-uncased-whole-word-masking/',
-          num_labels = 2,
-          layers = 1,
-          weight = 0)
-
-dev_file = args.peng_dev_file if args.use_peng else args.orig_dev_file
-
-tokenizer = BertTokenizer.from_pretrained('models/bert-large-uncased-whole-word-masking/', do_lower_case=args.do_lower_case)
-#ddPeval_features = get_features(os.path.join(args.data_dir, dev_file), tokenizer, args.use_mini)
-eval_features = get_features(args.dev_name, tokenizer, args.use_mini)
-eval_data = ExampleDataset(eval_features, 350)
-eval_sampler = SequentialSampler(eval_data)
-eval_dataloader = DataLoader(eval_data, num_workers = 4, sampler=eval_sampler, batch_size=20, collate_fn = batchify)
-
-#test_data = ExampleDataset(test_features, 350)
-#test_sampler = SequentialSampler(test_data)
-#test_dataloader = DataLoader(test_data, num_workers = 20, sampler=test_sampler, batch_size=16, collate_fn = batchify)
-
-files = glob.glob('models/doc_filter/pytorch_model.bin')
+SAE_DIR = os.path.dirname(os.path.abspath(__file__))
+BERT_PATH = os.path.join(SAE_DIR,
+                         'models/bert-large-uncased-whole-word-masking/')
+WEIGHTS_GLOB = os.path.join(SAE_DIR, 'models/doc_filter/pytorch_model.bin')
+COMPRESSION_FILE = 'compression.json'
+
+
 def sample_accuracy_and_recall(out, docs):
     num_docs = docs.size(1) 
     #labels=labels.reshape(-1,num_docs,num_docs)
@@ -104,34 +59,53 @@ def sample_accuracy_and_recall(out, docs):
     return all_correct, total, all_preds, None
 
 
-models=[]
-for f in files:
-    print('files', f)
-    models.append(torch.load(f))
-#models=[models[0],models[1],models[2],models[5]]
-
-distributed_models=[]
-for i in range(len(models)):
-    d={}
-    for j, key in enumerate(models[i].keys()):
-        d['module.'+key]=models[i][key]
-    distributed_models.append(d)
-device = torch.device('cuda')
-model=model.to(device)
-model=torch.nn.DataParallel(model)
-all_results=[]
-
-for i in range(len(distributed_models)):
-    model.load_state_dict(distributed_models[i])
-    print('loaded new model')
-    eval_accuracy=0
-    eval_recall=0
-    nb_eval_examples=0
-    nb_eval_steps=0
-    model.eval()
+def ensemble_vote(all_results):
+    '''
+    all_results: (num_models, num_examples, num_docs) docs of each example
+    sorted by score
+    returns the 2 docs of each example most voted by the models
+    '''
+    all_results=all_results[:,:, -2:]
+    final_results=[]
+    for i in range(len(all_results[0])):
+        preds=[]
+        for j in range(len(all_results)):
+            preds.append(all_results[j][i])
+        preds = np.concatenate(preds, axis=0)
+        unique, counts = np.unique(preds, return_counts=True)
+        order = np.argsort(counts)
+        tmp_result = list(unique[order][-2:])
+        final_results.append([int(x) for x in tmp_result])
+    return final_results
+
+
+def load_compressed(compressed_path):
+    '''
+    Loads a checkpoint written by compress_docfilter.py: the config has the
+    pruned heads (removed when the model is built) and compression.json says
+    whether the linear layers are int8
+    '''
+    config = BertConfig.from_pretrained(compressed_path)
+    model = BertForSequenceClassification(config, num_labels=2, layers=1,
+                                          weight=0)
+    with open(os.path.join(compressed_path, COMPRESSION_FILE), 'r') as f:
+        compression = json.load(f)
+    if compression['quantized']:
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear},
+                                                    dtype=torch.qint8)
+    model.load_state_dict(
+        torch.load(os.path.join(compressed_path, WEIGHTS_NAME),
+                   map_location='cpu'))
+    return model, compression
+
+
+def predict_docs(model, dataloader, device):
+    '''
+    returns the docs of each example sorted by score (ascending), shape
+    (num_examples, num_docs)
+    '''
     results=[]
-    eval_acc, eval_recall, num_examples, truth = 0,0,0,[]
-    for batch in tqdm(eval_dataloader):
+    for batch in tqdm(dataloader):
         batch = tuple(t.to(device) if type(t) == torch.Tensor else t for t in batch )
         inputs = {
             'input_ids':batch[0],
@@ -143,102 +117,130 @@ for i in range(len(distributed_models)):
         with torch.no_grad():
             logits = model(**inputs)
             logits = logits.detach().cpu().numpy()
-            #labels = batch[3].squeeze(-1).to('cpu').numpy() 
-            labels=None
-            tmp_acc, tmp_recall, preds, tmp_truth = sample_accuracy_and_recall(logits, batch[0])
-            #eval_acc+=tmp_acc
-            #eval_recall+=tmp_recall
-            #truth+=tmp_truth
-            num_examples+=int(batch[0].size(0))
-            #num_docs = int(math.sqrt(labels.shape[-1]))
-            #out=logits
-            #out=out.reshape(-1,num_docs,num_docs)
-            #out[out>0.5]=1
-            #out[out<=0.5]=0
-            #preds = np.sum(out, axis=-1).argsort(axis=-1)[:, -2:]
+            _, _, preds, _ = sample_accuracy_and_recall(logits, batch[0])
             results.append(preds)
-    #print(eval_acc, num_examples, eval_acc/num_examples)
-    #print(eval_recall, num_examples, eval_recall/(2*num_examples))
-    results=np.concatenate(results, axis=0)
-    all_results.append(results)
-
-#print('This is the length of all results')
-#with open('all_results.pkl','wb') as f:
-    #pickle.dump(all_results, f)
-
-all_results = np.stack(all_results, axis=0)
-#with open('all_results3.pkl','wb') as f:
-    #pickle.dump(all_results, f)
-#with open('all_results3.pkl','rb') as f:
-    #all_results = pickle.load(f)
-#all_results = np.stack(all_results, axis=0)
-
-all_results=all_results[:,:, -2:]
-
-final_results=[]
-for i in range(len(all_results[0])):
-    preds=[]
-    for j in range(len(all_results)):
-        preds.append(all_results[j][i])
-    preds = np.concatenate(preds, axis=0)
-    unique, counts = np.unique(preds, return_counts=True)
-    order = np.argsort(counts)
-    tmp_result = list(unique[order][-2:])
-    final_results.append([int(x) for x in tmp_result])
-    
-#for i in range(len(all_results[0])):
-    #preds = []
-    #for j in range(len(all_results)):
-        #preds.append(all_results[j][i])
-    #preds = np.concatenate(preds, axis=0)
-    #preds=preds.reshape(-1,2)
-    #preds = stats.mode(preds)[0].tolist()[0] 
-    #final_results.append(preds)
-
-#acc=0
-#rec=0
-#for i, docs in enumerate(final_results):
-    #if docs[0] in truth[i] and docs[1] in truth[i]:
-        #acc+=1
-        #rec+=2
-    #elif docs[0] in truth[i] or docs[1] in truth[i]:
-        #rec+=1
-#print('acc', acc/len(final_results))
-#print('recall', rec/(2*len(final_results)))
-
-#with open('truth.json','w') as f:
-#    json.dump(truth, f)
-
-with open(args.output_name,'w') as f:
-    json.dump(final_results, f)
-
-#print('This is the length of all results')
-#with open('all_results3.pkl','wb') as f:
-    #pickle.dump(all_results, f)
-
-#code.interact(local=locals())
-#exit()
-    #logits = logits.detach().cpu().numpy()
-    #label_ids = batch[3]
-    #label_ids = label_ids.squeeze(-1).to('cpu').numpy()
-    #tmp_eval_accuracy, tmp_eval_recall = sample_accuracy_and_recall(logits, label_ids)
-
-    ##eval_loss += tmp_eval_loss.mean().item()
-    #eval_accuracy += tmp_eval_accuracy
-    #eval_recall += tmp_eval_recall
-
-    #nb_eval_examples += batch[0].size(0)
-    #nb_eval_steps += 1
-
-#eval_accuracy = eval_accuracy / nb_eval_examples
-#eval_recall = eval_recall / (2*nb_eval_examples)
-#result = {  #'loss': loss,
-            #'eval_accuracy': eval_accuracy,
-            #'eval_recall': eval_recall, 
-            ##'global_step': global_step,
-            #}
-
-#logger.info("*****EVAL results *****")
-#for key in sorted(result.keys()):
-    #logger.info("  %s = %s", key, str(result[key]))
-
+    return np.concatenate(results, axis=0)
+
+
+class DocFilter():
+    '''
+    Loads the tokenizer and the models of the document filter once, so that
+    several datasets can be filtered in the same process (see
+    src.models.document_retrieval.SAEDocumentRetrieval)
+    compressed_path: checkpoint of compress_docfilter.py, used instead of the
+    models of weights_glob
+    '''
+    def __init__(self, bert_path=BERT_PATH, weights_glob=WEIGHTS_GLOB,
+                 do_lower_case=True, device='cuda', batch_size=20,
+                 num_workers=4, max_seq_len=350, compressed_path=None):
+        self.device = torch.device(device)
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.max_seq_len = max_seq_len
+        self.tokenizer = BertTokenizer.from_pretrained(
+            bert_path, do_lower_case=do_lower_case)
+        self.distributed_models=[]
+        if compressed_path is not None:
+            model, compression = load_compressed(compressed_path)
+            if compression['quantized'] and self.device.type != 'cpu':
+                raise ValueError("{} is quantized (int8), it only runs on "
+                                 "the cpu".format(compressed_path))
+            self.num_models = 1
+        else:
+            model = BertForSequenceClassification.from_pretrained(bert_path,
+                      num_labels = 2,
+                      layers = 1,
+                      weight = 0)
+            for f in glob.glob(weights_glob):
+                print('files', f)
+                state_dict = torch.load(f, map_location='cpu')
+                self.distributed_models.append(
+                    {'module.' + key: value
+                     for key, value in state_dict.items()})
+            self.num_models = len(self.distributed_models)
+        model=model.to(self.device)
+        self.model=torch.nn.DataParallel(model)
+        # the weights are only swapped if there is more than one model in the
+        # ensemble
+        if len(self.distributed_models) == 1:
+            self.model.load_state_dict(self.distributed_models[0])
+        self.model.eval()
+
+    def get_dataloader(self, data, use_mini=False, with_labels=False):
+        eval_features = get_features_from_data(data, self.tokenizer, use_mini,
+                                               with_labels=with_labels)
+        eval_data = ExampleDataset(eval_features, self.max_seq_len)
+        eval_sampler = SequentialSampler(eval_data)
+        return DataLoader(eval_data, num_workers=self.num_workers,
+                          sampler=eval_sampler, batch_size=self.batch_size,
+                          collate_fn=batchify)
+
+    def predict_gold_idx(self, data, use_mini=False):
+        '''
+        data: list of hotpot examples (already loaded)
+        returns the idx of the 2 predicted gold docs of each example
+        '''
+        eval_dataloader = self.get_dataloader(data, use_mini)
+        all_results=[]
+        for i in range(self.num_models):
+            if len(self.distributed_models) > 1:
+                self.model.load_state_dict(self.distributed_models[i])
+                print('loaded new model')
+            all_results.append(
+                predict_docs(self.model, eval_dataloader, self.device))
+        return ensemble_vote(np.stack(all_results, axis=0))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dev_name', type=str,
+                        default='dev_orig_bert-base-uncased.pkl')
+    parser.add_argument('--test_name', type=str,
+                        default='dev_orig_bert-base-uncased.pkl')
+    parser.add_argument('--use_mini', action='store_true',
+                        help='Load in a mini set for debug')
+    parser.add_argument('--max_seq_len', type=int, default=512,
+                        help='Maximum BERT Sequence Length')
+    parser.add_argument('--do_lower_case', action='store_true',
+                        help='Lower case BERT')
+    parser.add_argument('--use_peng', action='store_true',
+                        help='Load in Peng IR results')
+    parser.add_argument('--orig_train_file', type=str,
+                        default='hotpot_train_v1.1.json',
+                        help='Train File Name')
+    parser.add_argument('--orig_dev_file', type=str,
+                        default='hotpot_dev_distractor_v1.json',
+                        help='Dev File Name')
+    parser.add_argument('--peng_train_file', type=str,
+                        default='hotpot_dev_distractor_v1.json',
+                        help='Peng Train File Name')
+    parser.add_argument('--peng_dev_file', type=str,
+                        default='hotpot_dev_distractor_v1.json',
+                        help='Peng Dev File Name')
+    parser.add_argument(
+        '--data_dir', type=str,
+        default='/mnt/cephfs2/asr/users/kevin.huang/hotpot/data',
+        help='Load in a mini set for debug')
+    parser.add_argument('--name', type=str, default='',
+                        help='name for the saved file')
+    parser.add_argument("--bert_model", default='bert-large-uncased', type=str,
+                        help='Bert Model to use for tokenization')
+    parser.add_argument('--output_name', default='',type=str)
+    parser.add_argument('--compressed_path', default=None, type=str,
+                        help='checkpoint of compress_docfilter.py (pruned '
+                             'and/or int8 model)')
+    parser.add_argument('--device', default='cuda', type=str)
+    args = parser.parse_args()
+
+    doc_filter = DocFilter(do_lower_case=args.do_lower_case,
+                           device=args.device,
+                           compressed_path=args.compressed_path)
+    with open(args.dev_name, 'r') as f:
+        d = json.load(f)
+    final_results = doc_filter.predict_gold_idx(d, args.use_mini)
+    with open(args.output_name,'w') as f:
+        json.dump(final_results, f)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,18 @@
-import sys, subprocess
+import os
+import sys
+import json
 
 def main(input_file):
 
-    # step 1: get predicted gold documents
-    subprocess.call("CUDA_VISIBLE_DEVICES=0 python -u docfilter.py --do_lower_case \
-                    --dev_name {} --output_name output/pred_gold_idx.json".format(input_file), shell=True)
+    # step 1: get predicted gold documents (in this process, see
+    # docfilter.DocFilter)
+    os.environ.setdefault('CUDA_VISIBLE_DEVICES', '0')
+    from docfilter import DocFilter
+    with open(input_file, 'r') as f:
+        data = json.load(f)
+    doc_filter = DocFilter(do_lower_case=True)
+    with open('output/pred_gold_idx.json', 'w') as f:
+        json.dump(doc_filter.predict_gold_idx(data), f)
     
     # # step 2: data preparation and NER extraction
     # subprocess.call("python -u prepare_pred_gold.py output/pred_gold_idx.json \
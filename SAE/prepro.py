@@ -55,9 +55,15 @@ def find_test_facts(ex):
 # question
 # labels
 def get_features(data_path, tokenizer, use_mini=False, max_seq_len=512):
-    max_sent_len=0
     with open(data_path, 'r') as f:
         d = json.load(f)
+    return get_features_from_data(d, tokenizer, use_mini, max_seq_len)
+
+# same as get_features, for an already loaded dataset (list of hotpot examples)
+# with_labels: label of each doc from the supporting facts (see find_facts)
+def get_features_from_data(d, tokenizer, use_mini=False, max_seq_len=512,
+                           with_labels=False):
+    max_sent_len=0
     all_labels, all_offsets, all_ques, all_docs, all_title = [],[],[],[],[]
     for i, ex in enumerate(d):
         if use_mini and i == 128:
@@ -85,7 +91,7 @@ def get_features(data_path, tokenizer, use_mini=False, max_seq_len=512):
             example_docs.append(docs)
         labels=[]
         #if 'answer' in ex:
-        if False:
+        if with_labels:
             facts = find_facts(ex)
             for key, item in facts.items():
                 labels.append(item[-1])
@@ -1144,7 +1144,8 @@ class BertForSequenceClassification(BertPreTrainedModel):
         self.bilinear_classifier = nn.Bilinear(100,100,100)
         self.init_weights()
 
-    def forward(self, input_ids=None, segment_ids=None, input_mask=None, labels=None, triplet=None, triplet_mask=None):
+    def forward(self, input_ids=None, segment_ids=None, input_mask=None,
+                labels=None, triplet=None, triplet_mask=None, head_mask=None):
         #print('input_ids',input_ids.dtype)
         #print('input_mask', input_mask.dtype)
         #print('segment ids', segment_ids.dtype)
@@ -1154,7 +1155,7 @@ class BertForSequenceClassification(BertPreTrainedModel):
         input_mask = input_mask.view(-1, input_mask.size(-1))
         out = []
         _, pooled_output = self.bert(input_ids, segment_ids, 
-                                     input_mask)
+                                     input_mask, head_mask=head_mask)
         out = self.dropout(pooled_output).view(bs, docs, -1)
         for i in range(self.layers):
             out = self.transformer[i](out)[0] + out
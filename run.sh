@@ -1,6 +1,2 @@
-cd SAE/
-echo 'Computing the relevant documents'
-python main.py ../data/external/input.json
-echo 'Done'
-cd ../
-python run_prediction.py
\ No newline at end of file
+echo 'Computing the relevant documents and the answers'
+CUDA_VISIBLE_DEVICES=0 python run_prediction.py
@@ -1,34 +1,65 @@
-from src.data.preprocess_dataset import create_dataloader
+from src.data.preprocess_dataset import create_dataloader, context_tensors
 from src.models.model import HGNModel, Validation
-from src.models.document_retrieval import DocumentRetrieval
+from src.models.document_retrieval import (DocumentRetrieval,
+                                           SAEDocumentRetrieval,
+                                           gold_idx2dict_ins2dict_doc2pred)
+from src.models.pipeline import StreamingPrediction
+from src.models.cpu_inference import configure_threads, quantize_dynamic_int8
 import torch
 import json
 import os
 import sys, subprocess
+import argparse
 
-def convert_sae_doc_ret_output2our_input(hotpot):
-    with open('SAE/output/pred_gold_idx.json', 'r') as f:
+def convert_sae_doc_ret_output2our_input(hotpot, sae_output_file):
+    with open(sae_output_file, 'r') as f:
         pred_gold_idx = json.load(f)
-    out = dict()
-    for ins_idx, pred in enumerate(pred_gold_idx):
-        dict_doc2pred = dict()
-        if len(hotpot[ins_idx]['context']) == 2:
-            dict_doc2pred = {0: 1, 1: 1}
-        else:
-            for i in range(len(hotpot[ins_idx]['context'])):
-                if i in pred:
-                    dict_doc2pred[i] = 1
-                else:
-                    dict_doc2pred[i] = 0
-        out[ins_idx] = dict_doc2pred
-    return out
+    return gold_idx2dict_ins2dict_doc2pred(hotpot, pred_gold_idx)
 
 
-device = 'cuda'
+parser = argparse.ArgumentParser()
+parser.add_argument('--stream', action='store_true',
+                    help="process the instances in chunks through NER -> SRL "
+                         "-> graphs -> model (bounded memory)")
+parser.add_argument('--chunk_size', type=int, default=256,
+                    help="instances per chunk (with --stream)")
+parser.add_argument('--sae_output', type=str, default=None,
+                    help="predicted gold docs of a previous run of "
+                         "SAE/docfilter.py (e.g., "
+                         "SAE/output/pred_gold_idx.json). By default the "
+                         "document filter runs in this process")
+parser.add_argument('--compressed_doc_filter', type=str, default=None,
+                    help="checkpoint of SAE/compress_docfilter.py used by the "
+                         "document filter")
+parser.add_argument('--annotation_cache', type=str,
+                    default='data/annotation_cache.sqlite',
+                    help="sqlite file with the NER and SRL annotations of "
+                         "previous runs ('' to disable)")
+parser.add_argument('--graph_store_path', type=str, default=None,
+                    help="GraphStore directory with the graphs of previous "
+                         "runs (reused if their inputs did not change)")
+parser.add_argument('--device', type=str,
+                    default='cuda' if torch.cuda.is_available() else 'cpu',
+                    choices=['cuda', 'cpu'])
+parser.add_argument('--num_threads', type=int, default=None,
+                    help="intra-op threads (cpu)")
+parser.add_argument('--num_interop_threads', type=int, default=None,
+                    help="inter-op threads (cpu)")
+parser.add_argument('--quantize', action='store_true',
+                    help="dynamic int8 quantization of the linear layers of "
+                         "BERT and the graph layers (cpu only)")
+args = parser.parse_args()
+
+device = args.device
+if device == 'cpu':
+    print("Threads:",
+          configure_threads(args.num_threads, args.num_interop_threads))
 data_path = 'data/'
 pretrained_weights = 'bert-large-uncased-whole-word-masking'
 #pretrained_weights = 'bert-base-uncased'
 model_path = 'models/graph_model'
+eval_batch_size = 8
+annotation_cache_path = args.annotation_cache or None
 
 print("Preprocessing data")
 print("Loading HotpotQA")
@@ -37,29 +68,60 @@ input_file = os.path.join(data_path, hotpotqa_path, "input.json")
 with open(input_file, "r") as f:
     hotpot = json.load(f)
 
-dict_ins2dict_doc2pred = convert_sae_doc_ret_output2our_input(hotpot)
-print("Creating graphs for the predicted relevant documents")
-output = create_dataloader(hotpot, dict_ins2dict_doc2pred, pretrained_weights)
-list_graphs = output['list_graphs']
-list_context = output['list_context']
-list_span_idx = output['list_span_idx']
-print("Loading model")
-model = HGNModel.from_pretrained(model_path)
-model.cuda()
+if args.sae_output is not None:
+    dict_ins2dict_doc2pred = convert_sae_doc_ret_output2our_input(
+        hotpot, args.sae_output)
+else:
+    print("Computing the relevant documents")
+    doc_retrieval = SAEDocumentRetrieval(
+        sae_path='SAE', device=device,
+        compressed_path=args.compressed_doc_filter)
+    dict_ins2dict_doc2pred = doc_retrieval.predict_relevant_docs(hotpot)
+    # free the gpu memory of the document filter before loading the graph model
+    del doc_retrieval
+    if device == 'cuda':
+        torch.cuda.empty_cache()
+
+
+def load_model():
+    print("Loading model")
+    model = HGNModel.from_pretrained(model_path)
+    model.to(device)
+    if args.quantize:
+        model = quantize_dynamic_int8(model)
+    return model
+
 
-list_input_ids = [context['input_ids'] for context in list_context]
-list_token_type_ids = [context['token_type_ids'] for context in list_context]
-list_attention_masks = [context['attention_mask'] for context in list_context]
+if args.stream:
+    model = load_model()
+    print("Computing answers (streaming, {} instances per chunk)".format(
+        args.chunk_size))
+    streaming = StreamingPrediction(
+        model, pretrained_weights, chunk_size=args.chunk_size,
+        eval_batch_size=eval_batch_size,
+        annotation_cache_path=annotation_cache_path, device=device)
+    preds = streaming.predict(hotpot, dict_ins2dict_doc2pred)
+    streaming.close()
+else:
+    print("Creating graphs for the predicted relevant documents")
+    output = create_dataloader(hotpot, dict_ins2dict_doc2pred,
+                               pretrained_weights,
+                               annotation_cache_path=annotation_cache_path,
+                               graph_store_path=args.graph_store_path,
+                               device=device)
+    list_graphs = output['list_graphs']
+    list_context = output['list_context']
+    list_span_idx = output['list_span_idx']
+    model = load_model()
 
-tensor_input_ids = torch.tensor(list_input_ids)
-tensor_token_type_ids = torch.tensor(list_token_type_ids)
-tensor_attention_masks = torch.tensor(list_attention_masks)
+    (tensor_input_ids, tensor_attention_masks,
+     tensor_token_type_ids) = context_tensors(list_context)
 
-print("Computing answers")
-validation = Validation(model, hotpot, list_graphs,
-                        tensor_input_ids, tensor_attention_masks,
-                        tensor_token_type_ids)
-preds = validation.get_answer_predictions(dict_ins2dict_doc2pred)
+    print("Computing answers")
+    validation = Validation(model, hotpot, list_graphs,
+                            tensor_input_ids, tensor_attention_masks,
+                            tensor_token_type_ids, batch_size=eval_batch_size)
+    preds = validation.get_answer_predictions(dict_ins2dict_doc2pred)
 with open('./pred.json', 'w+') as f:
     json.dump(preds, f)
 print("Finished :)")
\ No newline at end of file
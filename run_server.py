@@ -0,0 +1,68 @@
+from src.models.model import HGNModel
+from src.models.document_retrieval import SAEDocumentRetrieval
+from src.models.serving import PredictionService, make_http_server
+from src.models.cpu_inference import configure_threads, quantize_dynamic_int8
+import torch
+import argparse
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--host', type=str, default='127.0.0.1')
+parser.add_argument('--port', type=int, default=8000)
+parser.add_argument('--max_batch_size', type=int, default=32,
+                    help="max instances per micro-batch")
+parser.add_argument('--max_wait', type=float, default=0.01,
+                    help="max seconds a request waits for others to fill its "
+                         "micro-batch")
+parser.add_argument('--no_doc_retrieval', action='store_true',
+                    help="select all the documents instead of running the SAE "
+                         "document filter")
+parser.add_argument('--compressed_doc_filter', type=str, default=None,
+                    help="checkpoint of SAE/compress_docfilter.py used by the "
+                         "document filter")
+parser.add_argument('--device', type=str,
+                    default='cuda' if torch.cuda.is_available() else 'cpu',
+                    choices=['cuda', 'cpu'])
+parser.add_argument('--num_threads', type=int, default=None,
+                    help="intra-op threads (cpu)")
+parser.add_argument('--num_interop_threads', type=int, default=None,
+                    help="inter-op threads (cpu)")
+parser.add_argument('--quantize', action='store_true',
+                    help="dynamic int8 quantization of the linear layers of "
+                         "BERT and the graph layers (cpu only)")
+args = parser.parse_args()
+
+device = args.device
+if device == 'cpu':
+    print("Threads:",
+          configure_threads(args.num_threads, args.num_interop_threads))
+pretrained_weights = 'bert-large-uncased-whole-word-masking'
+model_path = 'models/graph_model'
+eval_batch_size = 8
+
+doc_retrieval = None
+if not args.no_doc_retrieval:
+    print("Loading the document filter")
+    # no dataloader workers: forking them for every micro-batch would cost more
+    # than the batch
+    doc_retrieval = SAEDocumentRetrieval(
+        sae_path='SAE', device=device, num_workers=0,
+        compressed_path=args.compressed_doc_filter)
+print("Loading model")
+model = HGNModel.from_pretrained(model_path)
+model.to(device)
+if args.quantize:
+    model = quantize_dynamic_int8(model)
+service = PredictionService(model, pretrained_weights,
+                            doc_retrieval=doc_retrieval,
+                            max_batch_size=args.max_batch_size,
+                            max_wait=args.max_wait,
+                            eval_batch_size=eval_batch_size,
+                            device=device).start()
+server = make_http_server(service, args.host, args.port)
+print("Serving on http://{}:{} (POST /predict)".format(args.host, args.port))
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
+server.server_close()
+service.stop()
@@ -0,0 +1,81 @@
+'''
+Inference throughput of HGNModel for several batch sizes.
+
+    python -m src.benchmarks.batched_forward \
+        data/processed/dev/hsgn_2021_fix/ models/graph_model \
+        --num_instances 256 --batch_sizes 1 4 8 16
+'''
+import argparse
+import torch
+from torch.utils.data import DataLoader
+from src.models.model import HGNModel, GraphCollator
+from src.benchmarks.utils import load_processed_graphs, timeit
+
+
+def run_inference(model, list_graphs, tensors, batch_size, device,
+                  batch_sampler=None):
+    '''
+    Returns the answer type logits of the instances, in the order of the
+    batches (batch_sampler, e.g. LengthBucketBatchSampler; by default
+    consecutive instances)
+    '''
+    if batch_sampler is None:
+        dataloader = DataLoader(range(len(list_graphs)), batch_size=batch_size,
+                                collate_fn=GraphCollator(list_graphs))
+    else:
+        dataloader = DataLoader(range(len(list_graphs)),
+                                batch_sampler=batch_sampler,
+                                collate_fn=GraphCollator(list_graphs))
+    list_ans_type_logits = []
+    with torch.no_grad():
+        for b_graph, list_idx in dataloader:
+            output = model(
+                b_graph,
+                input_ids=tensors['tensor_input_ids'][list_idx].to(device),
+                attention_mask=(
+                    tensors['tensor_attention_masks'][list_idx].to(device)),
+                token_type_ids=(
+                    tensors['tensor_token_type_ids'][list_idx].to(device)),
+                train=False)
+            list_ans_type_logits.append(output['ans_type']['logits'].cpu())
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    return torch.cat(list_ans_type_logits)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('processed_path', type=str)
+    parser.add_argument('model_path', type=str)
+    parser.add_argument('--num_instances', type=int, default=256)
+    parser.add_argument('--batch_sizes', type=int, nargs='+',
+                        default=[1, 4, 8, 16])
+    args = parser.parse_args()
+
+    device = 'cuda'
+    list_graphs, tensors, _ = load_processed_graphs(args.processed_path,
+                                                    args.num_instances)
+    model = HGNModel.from_pretrained(args.model_path)
+    model.to(device)
+    model.eval()
+    # warm-up
+    run_inference(model, list_graphs[:max(args.batch_sizes)], tensors,
+                  max(args.batch_sizes), device)
+
+    baseline = None
+    for batch_size in args.batch_sizes:
+        torch.cuda.reset_peak_memory_stats()
+        logits, secs = timeit(run_inference, model, list_graphs, tensors,
+                              batch_size, device)
+        if baseline is None:
+            baseline = logits
+        print(
+            "batch size {:2d}: {:.1f} instances/s, peak gpu memory {:.0f} MB, "
+            "max abs diff {:.2e}".format(
+                batch_size, len(list_graphs) / secs,
+                torch.cuda.max_memory_allocated() / 2**20,
+                (logits - baseline).abs().max().item()))
+
+
+if __name__ == "__main__":
+    main()
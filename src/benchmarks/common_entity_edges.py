@@ -0,0 +1,60 @@
+'''
+Sentence-level common-entity edges: intersecting the entities of every pair of
+sentences (previous create_common_entity_edges_sent_lvl) vs the entity ->
+sentences inverted index (common_entity_pairs). Every sentence of an instance
+is a node.
+
+    python -m src.benchmarks.common_entity_edges \
+        data/interim/training/list_hotpot_ner_no_coref_train.p \
+        --num_instances 1000
+'''
+import pickle
+import argparse
+from src.data.graph_utils import common_entity_pairs
+from src.benchmarks.utils import timeit
+
+
+def all_pairs(list_node_entities):
+    list_edges = []
+    for i, list_ent_i in enumerate(list_node_entities):
+        for j, list_ent_j in enumerate(list_node_entities):
+            if i != j and set(list_ent_i).intersection(list_ent_j):
+                list_edges.append((i, j))
+    return list_edges
+
+
+def inverted_index(list_node_entities):
+    return [(i, j)
+            for (i, j) in common_entity_pairs(list_node_entities).tolist()]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('ner_file', type=str, help="list_hotpot_ner pickle")
+    parser.add_argument('--num_instances', type=int, default=1000)
+    args = parser.parse_args()
+
+    with open(args.ner_file, "rb") as f:
+        list_hotpot_ner = pickle.load(f)[:args.num_instances]
+    list_instances = [[list_ents for list_doc_ner in list_entities
+                       for list_ents in list_doc_ner]
+                      for list_entities in list_hotpot_ner]
+    num_sentences = sum(
+        len(list_node_entities) for list_node_entities in list_instances)
+    print("{} instances, {} sentences".format(len(list_instances),
+                                              num_sentences))
+
+    list_all_pairs, t_all_pairs = timeit(
+        lambda: [all_pairs(l) for l in list_instances])
+    list_index_pairs, t_index = timeit(
+        lambda: [inverted_index(l) for l in list_instances])
+    print(
+        "all pairs: {:.2f}s, inverted index: {:.2f}s (x{:.1f}). "
+        "{} edges. Same edges: {}".format(
+            t_all_pairs, t_index, t_all_pairs / t_index,
+            sum(len(l) for l in list_index_pairs),
+            list_all_pairs == list_index_pairs))
+
+
+if __name__ == "__main__":
+    main()
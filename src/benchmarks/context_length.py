@@ -0,0 +1,110 @@
+'''
+Length distribution of the contexts of the dev set and inference speedup of
+variable-length contexts (one token node per token, each batch trimmed to its
+longest context) over the fixed 512-token padding. The documents of each
+question are its supporting documents (as selected by the document filter).
+
+    python -m src.benchmarks.context_length \
+        data/external/hotpot_dev_distractor_v1.json models/graph_model \
+        --num_instances 500 --batch_size 8 \
+        --fixed_processed_path data/processed/dev/hsgn_2021_fix/
+
+--fixed_processed_path is a processed split built before the graphs had one
+token node per token (512 token nodes per graph), used as the fixed-padding
+baseline.
+'''
+import argparse
+import numpy as np
+import torch
+from src.data.preprocess_dataset import create_dataloader, context_tensors
+from src.models.model import HGNModel, LengthBucketBatchSampler
+from src.benchmarks.batched_forward import run_inference
+from src.benchmarks.utils import load_hotpot, load_processed_graphs, timeit
+
+PRETRAINED_WEIGHTS = 'bert-large-uncased-whole-word-masking'
+MAX_LEN = 512
+
+
+def select_supporting_docs(hotpot):
+    '''
+    dict_ins2dict_doc2pred that selects the supporting documents of each
+    instance
+    '''
+    dict_ins2dict_doc2pred = dict()
+    for ins_idx, hotpot_instance in enumerate(hotpot):
+        set_titles = set(title
+                         for title, _ in hotpot_instance['supporting_facts'])
+        dict_ins2dict_doc2pred[ins_idx] = {
+            doc_idx: int(title in set_titles)
+            for doc_idx, (title, _) in enumerate(hotpot_instance['context'])}
+    return dict_ins2dict_doc2pred
+
+
+def print_length_distribution(lengths):
+    print(
+        "context length: mean {:.1f}, std {:.1f}, "
+        "p50 {:.0f}, p90 {:.0f}, p99 {:.0f}, max {:.0f}".format(
+            lengths.mean(), lengths.std(),
+            *np.percentile(lengths, [50, 90, 99]), lengths.max()))
+    print("{:.1%} of the positions of a context padded to {} tokens are "
+          "padding".format(1 - lengths.mean() / MAX_LEN, MAX_LEN))
+    counts, bins = np.histogram(lengths, bins=np.arange(0, MAX_LEN + 64, 64))
+    for count, st in zip(counts, bins):
+        print("  [{:3d}, {:3d}): {:5.1%} {}".format(
+            st, st + 64, count / len(lengths),
+            '#' * int(50 * count / len(lengths))))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('hotpot_file', type=str)
+    parser.add_argument('model_path', type=str)
+    parser.add_argument('--num_instances', type=int, default=500)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--fixed_processed_path', type=str, default=None,
+                        help="processed split with 512 token nodes per graph "
+                             "(fixed-padding baseline)")
+    parser.add_argument('--device', type=str,
+                        default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    hotpot = load_hotpot(args.hotpot_file, args.num_instances)
+    output = create_dataloader(hotpot, select_supporting_docs(hotpot),
+                               PRETRAINED_WEIGHTS, device=args.device)
+    list_graphs = output['list_graphs']
+    (tensor_input_ids, tensor_attention_masks,
+     tensor_token_type_ids) = context_tensors(output['list_context'])
+    tensors = {'tensor_input_ids': tensor_input_ids,
+               'tensor_attention_masks': tensor_attention_masks,
+               'tensor_token_type_ids': tensor_token_type_ids}
+    lengths = tensor_attention_masks.sum(1).numpy()
+    print_length_distribution(lengths)
+
+    model = HGNModel.from_pretrained(args.model_path)
+    model.to(args.device)
+    model.eval()
+    # warm-up
+    run_inference(model, list_graphs[:args.batch_size], tensors,
+                  args.batch_size, args.device)
+    dict_results = dict()
+    if args.fixed_processed_path is not None:
+        fixed_graphs, fixed_tensors, _ = load_processed_graphs(
+            args.fixed_processed_path, args.num_instances)
+        _, dict_results['fixed {} tokens'.format(MAX_LEN)] = timeit(
+            run_inference, model, fixed_graphs, fixed_tensors, args.batch_size,
+            args.device)
+    _, dict_results['variable length'] = timeit(run_inference, model,
+                                                list_graphs, tensors,
+                                                args.batch_size, args.device)
+    batch_sampler = LengthBucketBatchSampler(lengths.tolist(), args.batch_size)
+    _, dict_results['variable length, bucketed'] = timeit(
+        run_inference, model, list_graphs, tensors, args.batch_size,
+        args.device, batch_sampler)
+    baseline = next(iter(dict_results.values()))
+    for name, secs in dict_results.items():
+        print("{}: {:.2f} instances/s (x{:.2f})".format(
+            name, len(list_graphs) / secs, baseline / secs))
+
+
+if __name__ == "__main__":
+    main()
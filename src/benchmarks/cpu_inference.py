@@ -0,0 +1,58 @@
+'''
+CPU inference throughput of HGNModel on the processed dev set: fp32 vs dynamic
+int8 quantization (quantize_dynamic_int8) for several numbers of intra-op
+threads. Reports the agreement of the answer types with fp32 and the max abs
+diff of their logits.
+
+    python -m src.benchmarks.cpu_inference data/processed/dev/hsgn_2021_fix/ \
+        models/graph_model --num_instances 128 --batch_size 8 \
+        --num_threads 1 4 8 16
+'''
+import copy
+import argparse
+from src.models.model import HGNModel
+from src.models.cpu_inference import configure_threads, quantize_dynamic_int8
+from src.benchmarks.batched_forward import run_inference
+from src.benchmarks.utils import load_processed_graphs, timeit
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('processed_path', type=str)
+    parser.add_argument('model_path', type=str)
+    parser.add_argument('--num_instances', type=int, default=128)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--num_threads', type=int, nargs='+',
+                        default=[1, 4, 8, 16])
+    parser.add_argument('--num_interop_threads', type=int, default=None)
+    args = parser.parse_args()
+
+    configure_threads(num_interop_threads=args.num_interop_threads)
+    list_graphs, tensors, _ = load_processed_graphs(args.processed_path,
+                                                    args.num_instances)
+    model = HGNModel.from_pretrained(args.model_path)
+    model.eval()
+    dict_models = {'fp32': model,
+                   'int8': quantize_dynamic_int8(copy.deepcopy(model))}
+    baseline = None
+    for num_threads in args.num_threads:
+        configure_threads(num_threads)
+        for name, m in dict_models.items():
+            # warm-up
+            run_inference(m, list_graphs[:args.batch_size], tensors,
+                          args.batch_size, 'cpu')
+            logits, secs = timeit(run_inference, m, list_graphs, tensors,
+                                  args.batch_size, 'cpu')
+            if baseline is None:
+                baseline = logits
+            same_ans_type = logits.argmax(1) == baseline.argmax(1)
+            print(
+                "{:2d} threads, {}: {:.2f} instances/s, "
+                "same answer type {:.1%}, max abs diff {:.2e}".format(
+                    num_threads, name, len(list_graphs) / secs,
+                    same_ans_type.float().mean().item(),
+                    (logits - baseline).abs().max().item()))
+
+
+if __name__ == "__main__":
+    main()
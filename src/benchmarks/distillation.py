@@ -0,0 +1,65 @@
+'''
+Teacher vs distilled student (src/models/distillation.py): parameters,
+inference throughput and EM/F1/joint metrics (Validation.do_validation) on the
+processed dev set.
+
+    python -m src.benchmarks.distillation data/processed/dev/hsgn_2021_fix/ \
+        data/external/hotpot_dev_distractor_v1.json models/graph_model \
+        models/graph_model_base --num_instances 500 --batch_size 8
+'''
+import argparse
+import torch
+from src.models.model import HGNModel, Validation
+from src.benchmarks.batched_forward import run_inference
+from src.benchmarks.utils import load_hotpot, load_processed_graphs, timeit
+
+METRICS = ['ans_em', 'ans_f1', 'sp_em', 'sp_f1', 'joint_em', 'joint_f1']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('processed_path', type=str)
+    parser.add_argument('hotpot_file', type=str,
+                        help="hotpot json of the processed split")
+    parser.add_argument('teacher_path', type=str)
+    parser.add_argument('student_path', type=str)
+    parser.add_argument('--num_instances', type=int, default=500)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--device', type=str,
+                        default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    list_graphs, tensors, list_span_idx = load_processed_graphs(
+        args.processed_path, args.num_instances)
+    hotpot = load_hotpot(args.hotpot_file, len(list_graphs))
+    for name, model_path in [('teacher', args.teacher_path),
+                             ('student', args.student_path)]:
+        model = HGNModel.from_pretrained(model_path)
+        model.to(args.device)
+        model.eval()
+        # warm-up
+        run_inference(model, list_graphs[:args.batch_size], tensors,
+                      args.batch_size, args.device)
+        _, secs = timeit(run_inference, model, list_graphs, tensors,
+                         args.batch_size, args.device)
+        validation = Validation(model, hotpot, list_graphs,
+                                tensors['tensor_input_ids'],
+                                tensors['tensor_attention_masks'],
+                                tensors['tensor_token_type_ids'],
+                                batch_size=args.batch_size,
+                                list_span_idx=list_span_idx)
+        metrics = validation.do_validation()
+        print(
+            "{} (hidden size {}, {:.0f}M parameters): "
+            "{:.2f} instances/s, {}".format(
+                name, model.config.hidden_size,
+                sum(p.numel() for p in model.parameters()) / 1e6,
+                len(list_graphs) / secs,
+                ', '.join('{} {:.4f}'.format(k, metrics[k]) for k in METRICS)))
+        del model, validation
+        if args.device == 'cuda':
+            torch.cuda.empty_cache()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+'''
+Document retrieval with the SAE document filter: docfilter.py in a subprocess
+(loads the models, parses the input json and writes pred_gold_idx.json, which
+is parsed again) vs SAEDocumentRetrieval in this process on the already loaded
+dataset. The in-process filter is called twice to show the time once the models
+are loaded.
+
+    python -m src.benchmarks.doc_filter \
+        data/external/hotpot_dev_distractor_v1.json --num_instances 500
+'''
+import os
+import json
+import argparse
+import subprocess
+import tempfile
+from src.models.document_retrieval import (SAEDocumentRetrieval,
+                                           gold_idx2dict_ins2dict_doc2pred)
+from src.benchmarks.utils import load_hotpot, timeit
+
+SAE_PATH = 'SAE'
+
+
+def retrieve_subprocess(hotpot):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_file = os.path.join(tmp_dir, 'input.json')
+        output_file = os.path.join(tmp_dir, 'pred_gold_idx.json')
+        with open(input_file, 'w') as f:
+            json.dump(hotpot, f)
+        subprocess.run(
+            "python -u docfilter.py --do_lower_case "
+            "--dev_name {} --output_name {}".format(input_file, output_file),
+            shell=True, check=True, cwd=SAE_PATH, stdout=subprocess.DEVNULL)
+        with open(output_file, 'r') as f:
+            pred_gold_idx = json.load(f)
+    return gold_idx2dict_ins2dict_doc2pred(hotpot, pred_gold_idx)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('hotpot_file', type=str)
+    parser.add_argument('--num_instances', type=int, default=500)
+    args = parser.parse_args()
+
+    hotpot = load_hotpot(args.hotpot_file, args.num_instances)
+    dict_subprocess, t_subprocess = timeit(retrieve_subprocess, hotpot)
+    doc_retrieval, t_load = timeit(SAEDocumentRetrieval, SAE_PATH)
+    dict_in_process, t_first = timeit(doc_retrieval.predict_relevant_docs,
+                                      hotpot)
+    _, t_second = timeit(doc_retrieval.predict_relevant_docs, hotpot)
+    print(
+        "subprocess: {:.1f}s. in process: {:.1f}s model load + "
+        "{:.1f}s (first call), {:.1f}s (second call)".format(
+            t_subprocess, t_load, t_first, t_second))
+    print("Same documents:", dict_subprocess == dict_in_process)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+'''
+DocumentRetrieval with one batch per question (padded to 128 tokens) vs flat
+batching (pairs of all the questions in batches of similar length, padded to
+the longest pair of the batch).
+
+    python -m src.benchmarks.doc_retrieval_batching \
+        data/external/hotpot_dev_distractor_v1.json models/doc_retrieval \
+        --num_instances 500 --device cpu
+'''
+import argparse
+from src.models.document_retrieval import DocumentRetrieval
+from src.benchmarks.utils import load_hotpot, timeit
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('hotpot_file', type=str)
+    parser.add_argument('model_path', type=str)
+    parser.add_argument('--pretrained_weights', type=str,
+                        default='bert-base-uncased')
+    parser.add_argument('--num_instances', type=int, default=500)
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--device', type=str, default='cuda',
+                        choices=['cuda', 'cpu'])
+    args = parser.parse_args()
+
+    hotpot = load_hotpot(args.hotpot_file, args.num_instances)
+    doc_retrieval = DocumentRetrieval(args.device, args.model_path,
+                                      args.pretrained_weights)
+    dict_per_question, t_per_question = timeit(
+        doc_retrieval.predict_relevant_docs, hotpot, flat_batching=False)
+    dict_flat, t_flat = timeit(doc_retrieval.predict_relevant_docs, hotpot,
+                               batch_size=args.batch_size)
+    num_same = sum(dict_per_question[qid] == dict_flat[qid]
+                   for qid in dict_flat)
+    print(
+        "per question: {:.1f}s, flat: {:.1f}s (x{:.1f}). "
+        "Same docs in {}/{} questions".format(
+            t_per_question, t_flat, t_per_question / t_flat, num_same,
+            len(dict_flat)))
+
+
+if __name__ == "__main__":
+    main()
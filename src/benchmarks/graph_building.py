@@ -0,0 +1,117 @@
+'''
+Graph-building throughput of graph_creation.Dataset.create_dataloader
+with and without the bulk-encoded memo of srl arguments and entities.
+
+    python -m src.benchmarks.graph_building \
+        data/external/hotpot_train_v1.1.json data/interim/training/ \
+        --num_instances 1000
+'''
+import os
+import json
+import pickle
+import argparse
+from src.data.graph_creation import Dataset
+from src.benchmarks.utils import load_hotpot, select_all_docs, timeit
+
+
+class NoMemo():
+    '''
+    Same interface as EncodingMemo, but each call goes to the tokenizer
+    (previous create_graph)
+    '''
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+
+    def add(self, list_str):
+        pass
+
+    def encode(self, s):
+        return self.tokenizer.encode(s, add_special_tokens=False)
+
+    def decode(self, s):
+        return self.tokenizer.decode(self.encode(s))
+
+
+def int_keys(obj):
+    # json files have str keys; Dataset uses the int indexes of the instances,
+    # docs and sentences
+    if isinstance(obj, dict):
+        return {
+            int(k) if isinstance(k, str) and k.isdigit() else k: int_keys(v)
+            for k, v in obj.items()}
+    return obj
+
+
+def load_interim(interim_path, split, num_instances):
+    ner_file = "list_hotpot_ner_no_coref_{}.p".format(split)
+    with open(os.path.join(interim_path, ner_file), "rb") as f:
+        list_hotpot_ner = pickle.load(f)[:num_instances]
+    if split == 'train':
+        srl_file = "dict_ins_doc_sent_srl_triples.json"
+    else:
+        srl_file = "dict_ins_doc_sent_srl_triples_dev.json"
+    with open(os.path.join(interim_path, srl_file), 'r') as f:
+        dict_ins_doc_sent_srl_triples = int_keys(json.load(f))
+    query_srl_file = "dict_ins_query_srl_triples.json"
+    with open(os.path.join(interim_path, query_srl_file), "r") as f:
+        dict_ins_query_srl_triples = int_keys(json.load(f))
+    ent_query_file = "list_ent_query_{}.p".format(
+        'training' if split == 'train' else split)
+    with open(os.path.join(interim_path, ent_query_file), "rb") as f:
+        list_ent_query = pickle.load(f)[:num_instances]
+    if num_instances is not None:
+        dict_ins_doc_sent_srl_triples = {
+            k: v for k, v in dict_ins_doc_sent_srl_triples.items()
+            if k < num_instances}
+        dict_ins_query_srl_triples = {
+            k: v for k, v in dict_ins_query_srl_triples.items()
+            if k < num_instances}
+    return (list_hotpot_ner, dict_ins_doc_sent_srl_triples,
+            dict_ins_query_srl_triples, list_ent_query)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('hotpot_file', type=str)
+    parser.add_argument('interim_path', type=str,
+                        help="directory with the NER and SRL annotations")
+    parser.add_argument('--split', type=str, default='train',
+                        choices=['train', 'dev'])
+    parser.add_argument('--num_instances', type=int, default=1000)
+    parser.add_argument('--pretrained_weights', type=str,
+                        default='bert-base-uncased')
+    args = parser.parse_args()
+
+    hotpot = load_hotpot(args.hotpot_file, args.num_instances)
+    (list_hotpot_ner, dict_ins_doc_sent_srl_triples,
+     dict_ins_query_srl_triples,
+     list_ent_query) = load_interim(args.interim_path, args.split,
+                                    args.num_instances)
+
+    def build(memo):
+        dataset = Dataset(hotpot, list_hotpot_ner,
+                          dict_ins_doc_sent_srl_triples,
+                          dict_ins_query_srl_triples, list_ent_query,
+                          dict_ins2dict_doc2pred=select_all_docs(hotpot),
+                          batch_size=1,
+                          pretrained_weights=args.pretrained_weights)
+        if not memo:
+            dataset.encoding_memo = NoMemo(dataset.tokenizer)
+        return timeit(dataset.create_dataloader)
+
+    (list_graphs, _, list_span_idx), t_no_memo = build(memo=False)
+    (memo_list_graphs, _, memo_list_span_idx), t_memo = build(memo=True)
+    def num_nodes(g):
+        return {ntype: g.number_of_nodes(ntype) for ntype in g.ntypes}
+    same_output = (list_span_idx == memo_list_span_idx
+                   and all(num_nodes(g) == num_nodes(g2)
+                           for g, g2 in zip(list_graphs, memo_list_graphs)))
+    print(
+        "no memo: {:.1f} instances/s, memo: {:.1f} instances/s (x{:.2f}). "
+        "Same output: {}".format(
+            len(hotpot) / t_no_memo, len(hotpot) / t_memo, t_no_memo / t_memo,
+            same_output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+'''
+Per-graph construction time and peak memory (tracemalloc) of
+graph_creation.Dataset.create_graph, and edge emission with one (u, v) tuple
+per edge + dgl.heterograph(lists) (previous create_graph) vs array blocks +
+build_heterograph on the same graphs.
+
+    python -m src.benchmarks.graph_construction \
+        data/external/hotpot_train_v1.1.json data/interim/training/ \
+        --num_instances 200
+'''
+import argparse
+import tracemalloc
+import numpy as np
+import dgl
+from src.data.graph_creation import Dataset
+from src.data.graph_utils import build_heterograph, collect_strings
+from src.benchmarks.utils import load_hotpot, select_all_docs, timeit
+from src.benchmarks.graph_building import load_interim
+
+
+def tuple_lists(graph):
+    return {c_etype: list(zip(*[e.tolist()
+                                for e in graph.edges(etype=c_etype[1])]))
+            for c_etype in graph.canonical_etypes}
+
+
+def arrays(graph):
+    return {c_etype: tuple(e.numpy().astype(np.int32)
+                           for e in graph.edges(etype=c_etype[1]))
+            for c_etype in graph.canonical_etypes}
+
+
+def measure(fn, *args):
+    '''
+    Returns the output, the elapsed time (s) and the peak of python allocations
+    (MB) of fn(*args)
+    '''
+    tracemalloc.start()
+    out, t = timeit(fn, *args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return out, t, peak / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('hotpot_file', type=str)
+    parser.add_argument('interim_path', type=str,
+                        help="directory with the NER and SRL annotations")
+    parser.add_argument('--split', type=str, default='train',
+                        choices=['train', 'dev'])
+    parser.add_argument('--num_instances', type=int, default=200)
+    parser.add_argument('--pretrained_weights', type=str,
+                        default='bert-base-uncased')
+    args = parser.parse_args()
+
+    hotpot = load_hotpot(args.hotpot_file, args.num_instances)
+    (list_hotpot_ner, dict_ins_doc_sent_srl_triples,
+     dict_ins_query_srl_triples,
+     list_ent_query) = load_interim(args.interim_path, args.split,
+                                    args.num_instances)
+    dataset = Dataset(hotpot, list_hotpot_ner, dict_ins_doc_sent_srl_triples,
+                      dict_ins_query_srl_triples, list_ent_query,
+                      dict_ins2dict_doc2pred=select_all_docs(hotpot),
+                      batch_size=1, pretrained_weights=args.pretrained_weights)
+    list_context, list_dict_idx = dataset.encode_all_sentences()
+    dataset.encoding_memo.add(collect_strings(
+        [dataset.dict_ins_doc_sent_srl_triples, dataset.list_hotpot_ner,
+         dataset.dict_ins_query_triples, dataset.list_entities_query]))
+
+    list_graphs, list_t, list_peak = [], [], []
+    for ins_idx in range(len(hotpot)):
+        (g, _), t, peak = measure(dataset.create_instance_graph, ins_idx,
+                                  list_context[ins_idx],
+                                  list_dict_idx[ins_idx])
+        list_graphs.append(g)
+        list_t.append(t)
+        list_peak.append(peak)
+    num_edges = [g.number_of_edges() for g in list_graphs]
+    print(
+        "create_graph: {:.1f} ms/graph, peak {:.2f} MB/graph (max {:.2f} MB), "
+        "{:.0f} edges/graph".format(
+            1000 * np.mean(list_t), np.mean(list_peak), np.max(list_peak),
+            np.mean(num_edges)))
+
+    t_lists, t_arrays, peak_lists, peak_arrays = [], [], [], []
+    for g in list_graphs:
+        _, t, peak = measure(lambda: dgl.heterograph(tuple_lists(g)))
+        t_lists.append(t)
+        peak_lists.append(peak)
+        _, t, peak = measure(lambda: build_heterograph(arrays(g)))
+        t_arrays.append(t)
+        peak_arrays.append(peak)
+    print(
+        "tuple lists: {:.2f} ms/graph, peak {:.2f} MB. "
+        "arrays: {:.2f} ms/graph, peak {:.2f} MB (x{:.1f})".format(
+            1000 * np.mean(t_lists), np.mean(peak_lists),
+            1000 * np.mean(t_arrays), np.mean(peak_arrays),
+            np.sum(t_lists) / np.sum(t_arrays)))
+
+
+if __name__ == "__main__":
+    main()
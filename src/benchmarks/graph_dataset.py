@@ -0,0 +1,69 @@
+'''
+Time to first batch, iteration time and peak RSS of the training input
+pipeline:
+    - eager: all the pickled graphs and input tensors loaded up front
+        (previous training script)
+    - lazy: GraphDataset over the GraphStore with DataLoader workers
+        prefetching and pinning the batches
+Peak RSS is the one of the main process. Run each mode in its own process so
+that it is not shared:
+
+    python -m src.benchmarks.graph_dataset \
+        data/processed/training/hsgn_2021_fix/ --mode eager
+    python -m src.benchmarks.graph_dataset \
+        data/processed/training/hsgn_2021_fix/ --mode lazy --num_workers 4
+'''
+import time
+import argparse
+from torch.utils.data import DataLoader
+from src.data.graph_dataset import GraphDataset, GraphDatasetCollator
+from src.benchmarks.utils import load_processed_graphs, peak_rss_mb
+
+
+def no_batching(list_graphs):
+    # the graph batching itself is the same in both modes
+    return list_graphs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('split_path', type=str)
+    parser.add_argument('--mode', type=str, choices=['eager', 'lazy'],
+                        required=True)
+    parser.add_argument('--num_batches', type=int, default=1000)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--num_workers', type=int, default=4)
+    args = parser.parse_args()
+
+    t0 = time.time()
+    if args.mode == 'eager':
+        list_graphs, tensors, list_span_idx = load_processed_graphs(
+            args.split_path)
+        def iter_batches():
+            for st in range(0, len(list_graphs), args.batch_size):
+                end = st + args.batch_size
+                yield (list_graphs[st:end],
+                       tensors['tensor_input_ids'][st:end],
+                       tensors['tensor_attention_masks'][st:end],
+                       tensors['tensor_token_type_ids'][st:end])
+        batches = iter_batches()
+    else:
+        dataloader = DataLoader(GraphDataset(args.split_path),
+                                batch_size=args.batch_size,
+                                collate_fn=GraphDatasetCollator(no_batching),
+                                num_workers=args.num_workers, pin_memory=True)
+        batches = iter(dataloader)
+    next(batches)
+    print("{}: time to first batch {:.1f}s, peak RSS {:.0f} MB".format(
+        args.mode, time.time() - t0, peak_rss_mb()))
+
+    t0 = time.time()
+    for _ in range(args.num_batches):
+        next(batches)
+    print("{}: {:.2f} ms per batch, peak RSS {:.0f} MB".format(
+        args.mode, 1000 * (time.time() - t0) / args.num_batches,
+        peak_rss_mb()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+'''
+Startup time and resident memory of loading a split from the per-graph pickles
+vs the GraphStore. Run each mode in its own process so that the peak RSS is not
+shared:
+
+    python -m src.benchmarks.graph_store \
+        data/processed/training/hsgn_2021_fix/ --mode pickle
+    python -m src.benchmarks.graph_store \
+        data/processed/training/hsgn_2021_fix/ --mode store
+'''
+import os
+import random
+import argparse
+from src.data.graph_store import GraphStore
+from src.benchmarks.utils import load_processed_graphs, peak_rss_mb, timeit
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('split_path', type=str)
+    parser.add_argument('--mode', type=str, choices=['pickle', 'store'],
+                        required=True)
+    parser.add_argument('--num_instances', type=int, default=None)
+    parser.add_argument('--num_accesses', type=int, default=1000,
+                        help="random graphs materialized after startup")
+    args = parser.parse_args()
+
+    if args.mode == 'pickle':
+        (list_graphs, _, _), t_startup = timeit(load_processed_graphs,
+                                                args.split_path,
+                                                args.num_instances)
+    else:
+        list_graphs, t_startup = timeit(
+            GraphStore, os.path.join(args.split_path, 'graph_store'))
+    print("{}: startup {:.1f}s, {} graphs, peak RSS {:.0f} MB".format(
+        args.mode, t_startup, len(list_graphs), peak_rss_mb()))
+
+    random.seed(2020)
+    list_idx = [random.randrange(len(list_graphs))
+                for _ in range(args.num_accesses)]
+    _, t_access = timeit(lambda: [list_graphs[idx] for idx in list_idx])
+    print("{}: {:.2f} ms per random access, peak RSS {:.0f} MB".format(
+        args.mode, 1000 * t_access / args.num_accesses, peak_rss_mb()))
+
+
+if __name__ == "__main__":
+    main()
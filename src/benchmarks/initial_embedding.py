@@ -0,0 +1,97 @@
+'''
+Per-node loop vs gather (index_select) for the initial node embeddings of
+HGNModel.graph_initial_embedding, on realistic graph sizes.
+
+    python -m src.benchmarks.initial_embedding --device cuda --repeat 100
+'''
+import argparse
+import random
+import torch
+from src.benchmarks.utils import timeit
+
+IN_FEATS = 1024  # bert-large
+MAX_LEN = 512
+# number of nodes and max span length of each node type in a typical graph
+DICT_NTYPE2SIZE = {'query': (1, 30), 'doc': (4, 150), 'sent': (40, 50),
+                   'srl': (300, 15), 'srl_loc': (20, 6), 'srl_tmp': (20, 6),
+                   'ent': (150, 6), 'tok': (MAX_LEN, 1)}
+
+
+def random_st_end_idx(num_nodes, max_span_len):
+    list_st_end = []
+    for _ in range(num_nodes):
+        st = random.randrange(0, MAX_LEN - 1)
+        end = min(MAX_LEN, st + random.randint(1, max_span_len))
+        list_st_end.append((st, end))
+    return torch.tensor(list_st_end)
+
+
+def loop_emb(encoder_output, dict_st_end_idx):
+    graph_emb = dict()
+    for ntype, st_end_idx in dict_st_end_idx.items():
+        list_emb = []
+        for (st, end) in st_end_idx:
+            node_token_emb = encoder_output[st:end]
+            left2right = node_token_emb[-1, :IN_FEATS].view(-1, IN_FEATS)
+            right2left = node_token_emb[0, IN_FEATS:].view(-1, IN_FEATS)
+            list_emb.append(
+                torch.cat((left2right, right2left), dim=1).squeeze(0))
+        graph_emb[ntype] = torch.stack(list_emb, dim=0)
+    return graph_emb
+
+
+def gather_emb(encoder_output, dict_st_end_idx):
+    graph_emb = dict()
+    for ntype, st_end_idx in dict_st_end_idx.items():
+        st_end_idx = st_end_idx.to(encoder_output.device).long()
+        end_idx = st_end_idx[:, 1].clamp(max=encoder_output.shape[0]) - 1
+        left2right = encoder_output[:, :IN_FEATS].index_select(0, end_idx)
+        right2left = encoder_output[:, IN_FEATS:].index_select(
+            0, st_end_idx[:, 0])
+        graph_emb[ntype] = torch.cat((left2right, right2left), dim=1)
+    return graph_emb
+
+
+def bench(fn, encoder_output, dict_st_end_idx, repeat, device):
+    def run():
+        for _ in range(repeat):
+            out = fn(encoder_output, dict_st_end_idx)
+            # backward as in training
+            sum(v.sum() for v in out.values()).backward()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        return out
+    return timeit(run)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str,
+                        default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    random.seed(2020)
+    torch.manual_seed(2020)
+    encoder_output = torch.randn(MAX_LEN, 2 * IN_FEATS, device=args.device,
+                                 requires_grad=True)
+    dict_st_end_idx = {ntype: random_st_end_idx(*size)
+                       for ntype, size in DICT_NTYPE2SIZE.items()}
+    print("nodes per graph:",
+          sum(num_nodes for num_nodes, _ in DICT_NTYPE2SIZE.values()))
+
+    # warm-up
+    gather_emb(encoder_output, dict_st_end_idx)
+    out_loop, t_loop = bench(loop_emb, encoder_output, dict_st_end_idx,
+                             args.repeat, args.device)
+    out_gather, t_gather = bench(gather_emb, encoder_output, dict_st_end_idx,
+                                 args.repeat, args.device)
+    print("loop:   {:.2f} ms/graph".format(1000 * t_loop / args.repeat))
+    print("gather: {:.2f} ms/graph (x{:.1f})".format(
+        1000 * t_gather / args.repeat, t_loop / t_gather))
+    print("identical:", all(torch.equal(out_loop[ntype], out_gather[ntype])
+                            for ntype in out_loop))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+'''
+Load generator for run_server.py: sends the instances of a HotpotQA file (one
+per request) from --concurrency clients and reports the latency percentiles and
+the throughput. Only the standard library is needed, so it can run on a
+different machine than the server.
+
+    python -m src.benchmarks.load_generator \
+        data/external/hotpot_dev_distractor_v1.json \
+        --url http://127.0.0.1:8000 --num_requests 500 --concurrency 16
+'''
+import json
+import time
+import argparse
+import threading
+import urllib.request
+from src.benchmarks.utils import load_hotpot
+
+
+def percentile(list_values, p):
+    list_values = sorted(list_values)
+    idx = min(len(list_values) - 1, int(p / 100 * len(list_values)))
+    return list_values[idx]
+
+
+def send(url, hotpot_instance):
+    request = urllib.request.Request(
+        url + '/predict', data=json.dumps(hotpot_instance).encode('utf-8'),
+        headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('hotpot_file', type=str)
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:8000')
+    parser.add_argument('--num_requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=16)
+    args = parser.parse_args()
+
+    hotpot = load_hotpot(args.hotpot_file, args.num_requests)
+    list_latencies = []
+    list_errors = []
+    next_idx = iter(range(len(hotpot)))
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                idx = next(next_idx, None)
+            if idx is None:
+                return
+            t0 = time.perf_counter()
+            try:
+                send(args.url, hotpot[idx])
+            except Exception as e:
+                list_errors.append(e)
+                continue
+            list_latencies.append(time.perf_counter() - t0)
+
+    # warm up (first cuda kernels, lazy initializations)
+    send(args.url, hotpot[0])
+    t0 = time.perf_counter()
+    list_threads = [threading.Thread(target=client)
+                    for _ in range(args.concurrency)]
+    for thread in list_threads:
+        thread.start()
+    for thread in list_threads:
+        thread.join()
+    elapsed = time.perf_counter() - t0
+    if len(list_latencies) == 0:
+        print("All the requests failed:", list_errors[:3])
+        return
+    print("{} requests ({} errors), concurrency {}".format(
+        len(hotpot), len(list_errors), args.concurrency))
+    print(
+        "latency p50 {:.0f} ms, p99 {:.0f} ms, max {:.0f} ms. "
+        "throughput {:.1f} questions/s".format(
+            1000 * percentile(list_latencies, 50),
+            1000 * percentile(list_latencies, 99), 1000 * max(list_latencies),
+            len(list_latencies) / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+'''
+Entity-pair matching of Dataset.multi_hop_edges: scoring all the pairs with
+fuzz.token_set_ratio vs FuzzyMatcher (candidate pairs only) on the instances
+with the most entities.
+
+    python -m src.benchmarks.multihop_matching \
+        data/interim/training/list_hotpot_ner_no_coref_train.p \
+        --num_instances 100
+'''
+import pickle
+import argparse
+from fuzzywuzzy import fuzz
+from src.data.graph_utils import FuzzyMatcher
+from src.benchmarks.utils import timeit
+
+
+def all_pairs(list_nodes, list_str, threshold):
+    # previous nested loop of multi_hop_edges
+    list_pairs = []
+    for e1 in list_nodes:
+        for e2 in list_nodes:
+            if e1 < e2 and (fuzz.token_set_ratio(list_str[e1], list_str[e2])
+                            >= threshold):
+                list_pairs.append((e1, e2))
+    return list_pairs
+
+
+def instance_entities(list_entities):
+    '''
+    Entity node strings of an instance: one node per unique (lowercased)
+    entity, as in create_graph
+    '''
+    list_ent_str = []
+    for list_doc_ner in list_entities:
+        for list_ents in list_doc_ner:
+            for ent in list_ents:
+                if ent.lower() not in list_ent_str:
+                    list_ent_str.append(ent.lower())
+    return list_ent_str
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('ner_file', type=str, help="list_hotpot_ner pickle")
+    parser.add_argument('--num_instances', type=int, default=100,
+                        help="number of worst-case instances")
+    parser.add_argument('--threshold', type=int, default=90)
+    args = parser.parse_args()
+
+    with open(args.ner_file, "rb") as f:
+        list_hotpot_ner = pickle.load(f)
+    list_instances = sorted((instance_entities(list_entities)
+                             for list_entities in list_hotpot_ner), key=len,
+                            reverse=True)[:args.num_instances]
+    print("{} instances, {} to {} entities".format(len(list_instances),
+                                                   len(list_instances[-1]),
+                                                   len(list_instances[0])))
+
+    def run(match_fn):
+        return [match_fn(list(range(len(list_ent_str))), list_ent_str,
+                         args.threshold) for list_ent_str in list_instances]
+
+    list_all_pairs, t_all_pairs = timeit(run, all_pairs)
+    matcher = FuzzyMatcher()
+    list_matched_pairs, t_matcher = timeit(run, matcher.matching_pairs)
+    print(
+        "all pairs: {:.2f}s, fuzzy matcher: {:.2f}s (x{:.1f}). "
+        "Scored pairs: {}. Same edges: {}".format(
+            t_all_pairs, t_matcher, t_all_pairs / t_matcher,
+            len(matcher.dict_pair2score),
+            list_all_pairs == list_matched_pairs))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+'''
+Sent, srl and ent classifiers of HGNModel.graph_forward: one cat(query, node) +
+classifier per node type (old graph_forward) vs the fused classify_nodes (query
+projected once per graph for the three classifiers, one output matmul for all
+the node types). Reports the latency (forward + backward) and the max abs
+difference of the logits.
+
+    python -m src.benchmarks.node_classifiers --batch_size 8 --num_sent 40 \
+        --num_srl 150 --num_ent 60
+'''
+import argparse
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from src.benchmarks.utils import timeit
+
+BERT_DIM = 1024
+
+
+def classify_nodes(list_classifiers, query_emb, list_node_emb,
+                   list_node_graph_ids):
+    # same as src.models.model.classify_nodes (model.py cannot be imported
+    # without a gpu)
+    d = query_emb.shape[1]
+    num_clf = len(list_classifiers)
+    hidden_size = list_classifiers[0][0].out_features
+    w1_query = torch.cat([clf[0].weight[:, :d] for clf in list_classifiers])
+    b1 = torch.cat([clf[0].bias for clf in list_classifiers])
+    w2 = torch.cat([clf[2].weight for clf in list_classifiers])
+    b2 = torch.cat([clf[2].bias for clf in list_classifiers])
+    list_num_nodes = [node_emb.shape[0] for node_emb in list_node_emb]
+    clf_idx = torch.repeat_interleave(
+        torch.arange(num_clf, device=query_emb.device),
+        torch.tensor(list_num_nodes, device=query_emb.device))
+    node_idx = torch.arange(clf_idx.shape[0], device=query_emb.device)
+    node_graph_ids = torch.cat(list_node_graph_ids).to(query_emb.device)
+    query_proj = F.linear(query_emb, w1_query, b1).view(-1, num_clf,
+                                                        hidden_size)
+    node_proj = torch.cat([F.linear(node_emb, clf[0].weight[:, d:])
+                           for clf, node_emb in zip(list_classifiers,
+                                                    list_node_emb)])
+    hidden = F.relu(node_proj + query_proj[node_graph_ids, clf_idx])
+    logits = F.linear(hidden, w2, b2).view(-1, num_clf, 2)[node_idx, clf_idx]
+    return list(torch.split(logits, list_num_nodes))
+
+
+def per_type_classify_nodes(list_classifiers, query_emb, list_node_emb,
+                            list_node_graph_ids):
+    return [clf(torch.cat((query_emb[node_graph_ids], node_emb), dim=1))
+            for clf, node_emb, node_graph_ids in zip(
+                list_classifiers, list_node_emb, list_node_graph_ids)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str,
+                        default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--num_sent', type=int, default=40,
+                        help="nodes per graph")
+    parser.add_argument('--num_srl', type=int, default=150,
+                        help="nodes per graph")
+    parser.add_argument('--num_ent', type=int, default=60,
+                        help="nodes per graph")
+    parser.add_argument('--repeat', type=int, default=100)
+    args = parser.parse_args()
+
+    torch.manual_seed(2020)
+    list_classifiers = [
+        nn.Sequential(nn.Linear(2 * BERT_DIM, BERT_DIM), nn.ReLU(),
+                      nn.Linear(BERT_DIM, 2)).to(args.device)
+        for _ in range(3)]
+    query_emb = torch.randn(args.batch_size, BERT_DIM, device=args.device,
+                            requires_grad=True)
+    list_node_emb = []
+    list_node_graph_ids = []
+    for num_nodes in [args.num_sent, args.num_srl, args.num_ent]:
+        list_node_emb.append(
+            torch.randn(args.batch_size * num_nodes, BERT_DIM,
+                        device=args.device, requires_grad=True))
+        list_node_graph_ids.append(torch.arange(
+            args.batch_size, device=args.device).repeat_interleave(num_nodes))
+
+    def run(fn):
+        for _ in range(args.repeat):
+            list_logits = fn(list_classifiers, query_emb, list_node_emb,
+                             list_node_graph_ids)
+            sum(logits.sum() for logits in list_logits).backward()
+        if args.device == 'cuda':
+            torch.cuda.synchronize()
+        return fn(list_classifiers, query_emb, list_node_emb,
+                  list_node_graph_ids)
+
+    run(per_type_classify_nodes)  # warm-up
+    logits_per_type, t_per_type = timeit(run, per_type_classify_nodes)
+    logits_fused, t_fused = timeit(run, classify_nodes)
+    max_diff = max((a - b).abs().max().item()
+                   for a, b in zip(logits_per_type, logits_fused))
+    print(
+        "per type: {:.2f} ms, fused: {:.2f} ms ({:.2f}x), "
+        "max abs diff of the logits {:.2e}".format(
+            1000 * t_per_type / args.repeat, 1000 * t_fused / args.repeat,
+            t_per_type / t_fused, max_diff))
+
+
+if __name__ == "__main__":
+    main()
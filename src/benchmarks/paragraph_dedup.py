@@ -0,0 +1,48 @@
+'''
+Wall-clock time of the NER and SRL extraction with and without paragraph
+deduplication.
+
+    python -m src.benchmarks.paragraph_dedup \
+        data/external/hotpot_train_v1.1.json --num_instances 1000 \
+        --ner_batch_size 256 --srl_batch_size 64
+'''
+import argparse
+from src.data.preprocessing import NER_stanza, SRL, ParagraphTable
+from src.benchmarks.utils import load_hotpot, select_all_docs, timeit
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('hotpot_file', type=str)
+    parser.add_argument('--num_instances', type=int, default=1000)
+    parser.add_argument('--ner_batch_size', type=int, default=256)
+    parser.add_argument('--srl_batch_size', type=int, default=64)
+    args = parser.parse_args()
+
+    hotpot = load_hotpot(args.hotpot_file, args.num_instances)
+    dict_ins2dict_doc2pred = select_all_docs(hotpot)
+
+    paragraph_table, t_table = timeit(ParagraphTable, hotpot,
+                                      dict_ins2dict_doc2pred)
+    num_refs = len(paragraph_table.dict_ins_doc2paragraph_idx)
+    num_unique = len(paragraph_table.list_paragraphs)
+    print(
+        "{} selected docs, {} unique paragraphs (ratio {:.2f}), "
+        "table built in {:.2f}s".format(
+            num_refs, num_unique, paragraph_table.dedup_ratio(), t_table))
+
+    ner = NER_stanza(batch_size=args.ner_batch_size)
+    srl = SRL(batch_size=args.srl_batch_size)
+    for name, fn in [('NER', ner.extract_named_entities),
+                     ('SRL', srl.extract_srl)]:
+        baseline, t_baseline = timeit(fn, hotpot, dict_ins2dict_doc2pred)
+        dedup, t_dedup = timeit(fn, hotpot, dict_ins2dict_doc2pred,
+                                paragraph_table)
+        print("{}: {:.1f}s -> {:.1f}s with dedup (x{:.2f}). "
+              "Same output: {}".format(name, t_baseline, t_dedup,
+                                       t_baseline / t_dedup,
+                                       dedup == baseline))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+'''
+Scaling of graph_creation.Dataset.create_dataloader with the number of worker
+processes.
+
+    python -m src.benchmarks.parallel_graph_building \
+        data/external/hotpot_train_v1.1.json data/interim/training/ \
+        --num_instances 90447 --num_workers 0 1 2 4 8 16 32
+'''
+import os
+import argparse
+from src.data.graph_creation import Dataset
+from src.benchmarks.graph_building import load_interim
+from src.benchmarks.utils import load_hotpot, select_all_docs, timeit
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('hotpot_file', type=str)
+    parser.add_argument('interim_path', type=str,
+                        help="directory with the NER and SRL annotations")
+    parser.add_argument('--split', type=str, default='train',
+                        choices=['train', 'dev'])
+    parser.add_argument('--num_instances', type=int, default=None,
+                        help="default: full set")
+    parser.add_argument('--num_workers', type=int, nargs='+',
+                        default=[0, 1, 2, 4, 8, os.cpu_count()])
+    parser.add_argument('--chunk_size', type=int, default=64)
+    parser.add_argument('--pretrained_weights', type=str,
+                        default='bert-base-uncased')
+    args = parser.parse_args()
+
+    hotpot = load_hotpot(args.hotpot_file, args.num_instances)
+    (list_hotpot_ner, dict_ins_doc_sent_srl_triples,
+     dict_ins_query_srl_triples,
+     list_ent_query) = load_interim(args.interim_path, args.split,
+                                    args.num_instances)
+    dataset = Dataset(hotpot, list_hotpot_ner, dict_ins_doc_sent_srl_triples,
+                      dict_ins_query_srl_triples, list_ent_query,
+                      dict_ins2dict_doc2pred=select_all_docs(hotpot),
+                      batch_size=1, pretrained_weights=args.pretrained_weights)
+
+    baseline = None
+    t_sequential = None
+    for num_workers in args.num_workers:
+        (list_graphs, _, list_span_idx), secs = timeit(
+            dataset.create_dataloader, num_workers, args.chunk_size)
+        num_nodes = [{ntype: g.number_of_nodes(ntype) for ntype in g.ntypes}
+                     for g in list_graphs]
+        if baseline is None:
+            baseline = (num_nodes, list_span_idx)
+            t_sequential = secs
+        print(
+            "{:2d} workers: {:.0f}s, {:.1f} instances/s, speed-up x{:.2f}. "
+            "Same output: {}".format(
+                num_workers, secs, len(hotpot) / secs, t_sequential / secs,
+                (num_nodes, list_span_idx) == baseline))
+
+
+if __name__ == "__main__":
+    main()
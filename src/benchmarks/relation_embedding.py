@@ -0,0 +1,88 @@
+'''
+Relation-span embeddings of the srl2srl and ent2ent_rel edges: per-edge
+torch.mean in every layer (old message_func_rel) vs a single prefix-sum segment
+mean per forward.
+
+    python -m src.benchmarks.relation_embedding --num_edges 2000 --num_layers 2
+'''
+import argparse
+import random
+import torch
+from src.benchmarks.utils import timeit
+
+BERT_DIM = 1024
+MAX_LEN = 512
+
+
+def loop_rel_emb(bert_token_emb, span_idx):
+    rel_emb = []
+    for (x, y) in span_idx:
+        rel_emb.append(torch.mean(bert_token_emb[x:y], dim=0))
+    return torch.stack(rel_emb, dim=0)
+
+
+def span_mean(token_emb, span_idx):
+    # same as src.models.model.span_mean (model.py cannot be imported without a
+    # gpu)
+    span_idx = span_idx.to(token_emb.device).long()
+    span_idx = span_idx.clamp(max=token_emb.shape[0])
+    prefix_sum = torch.cat((token_emb.new_zeros(1, token_emb.shape[1]),
+                            torch.cumsum(token_emb, dim=0)), dim=0)
+    x, y = span_idx[:, 0], span_idx[:, 1]
+    lengths = (y - x).unsqueeze(1).to(token_emb.dtype)
+    return (prefix_sum[y] - prefix_sum[x]) / lengths
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str,
+                        default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--num_edges', type=int, default=2000)
+    parser.add_argument('--num_layers', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    random.seed(2020)
+    torch.manual_seed(2020)
+    bert_token_emb = torch.randn(MAX_LEN, BERT_DIM, device=args.device,
+                                 requires_grad=True)
+    list_span = []
+    for _ in range(args.num_edges):
+        x = random.randrange(0, MAX_LEN - 1)
+        list_span.append((x, min(MAX_LEN, x + random.randint(1, 10))))
+    span_idx = torch.tensor(list_span)
+
+    def run_loop():
+        for _ in range(args.repeat):
+            # recomputed by each layer
+            out = [loop_rel_emb(bert_token_emb, span_idx)
+                   for _ in range(args.num_layers)]
+            sum(o.sum() for o in out).backward()
+        if args.device == 'cuda':
+            torch.cuda.synchronize()
+        return out[0]
+
+    def run_segment():
+        for _ in range(args.repeat):
+            # computed once per forward and shared by the layers
+            rel_emb = span_mean(bert_token_emb, span_idx)
+            out = [rel_emb for _ in range(args.num_layers)]
+            sum(o.sum() for o in out).backward()
+        if args.device == 'cuda':
+            torch.cuda.synchronize()
+        return out[0]
+
+    out_loop, t_loop = timeit(run_loop)
+    out_segment, t_segment = timeit(run_segment)
+    print("{} relation edges, {} layers".format(args.num_edges,
+                                                args.num_layers))
+    print("per-edge mean:  {:.2f} ms/forward".format(
+        1000 * t_loop / args.repeat))
+    print("segment mean:   {:.2f} ms/forward (x{:.1f})".format(
+        1000 * t_segment / args.repeat, t_loop / t_segment))
+    print("max abs diff: {:.2e}".format(
+        (out_loop - out_segment).abs().max().item()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+'''
+Span location during graph construction: find_sublist_idx over the sentence for
+every srl argument and entity (previous implementation) vs a SpanAligner per
+sentence. Same search pattern as Dataset.create_graph: each argument of each
+triple, and each entity of the sentence for each argument.
+
+    python -m src.benchmarks.span_alignment \
+        data/external/hotpot_train_v1.1.json \
+        data/interim/training/dict_ins_doc_sent_srl_triples.json \
+        data/interim/training/list_hotpot_ner_no_coref_train.p
+'''
+import json
+import pickle
+import argparse
+from tqdm import tqdm
+from transformers import BertTokenizer
+from src.data.graph_utils import SpanAligner
+from src.benchmarks.utils import load_hotpot, timeit
+
+
+def old_find_sublist_idx(x: list, y: list) -> int:
+    # previous src.data.graph_creation.find_sublist_idx
+    occ = [i for i, a in enumerate(x) if a == y[0]]
+    for b in occ:
+        if x[b:b+len(y)] == y:
+            return b
+        if len(occ)-1 == occ.index(b):
+            return occ[0]
+    raise Exception("Sublist not in list")
+
+
+def locate_all(list_sentences, find_fn, make_aligner):
+    list_idx = []
+    for (sent_encoded, list_args_encoded, list_ents_encoded) in list_sentences:
+        aligner = make_aligner(sent_encoded)
+        for arg_encoded in list_args_encoded:
+            for span in [arg_encoded] + list_ents_encoded:
+                try:
+                    list_idx.append(find_fn(aligner, span))
+                except:
+                    list_idx.append(None)
+    return list_idx
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('hotpot_file', type=str)
+    parser.add_argument('srl_triples_file', type=str)
+    parser.add_argument('ner_file', type=str)
+    parser.add_argument('--num_instances', type=int, default=None,
+                        help="default: full set")
+    parser.add_argument('--pretrained_weights', type=str,
+                        default='bert-base-uncased')
+    args = parser.parse_args()
+
+    hotpot = load_hotpot(args.hotpot_file, args.num_instances)
+    with open(args.srl_triples_file, 'r') as f:
+        dict_ins_doc_sent_srl_triples = json.load(f)
+    with open(args.ner_file, 'rb') as f:
+        list_hotpot_ner = pickle.load(f)
+    tokenizer = BertTokenizer.from_pretrained(args.pretrained_weights)
+
+    # encodings are computed beforehand: only the span location is timed
+    list_sentences = []
+    for ins_idx, hotpot_instance in enumerate(tqdm(hotpot)):
+        dict_doc_sent_triples = dict_ins_doc_sent_srl_triples[str(ins_idx)]
+        for doc_key, dict_sent_triples in dict_doc_sent_triples.items():
+            doc = hotpot_instance['context'][int(doc_key)][1]
+            for sent_key, dict_triples in dict_sent_triples.items():
+                sent_idx = int(sent_key)
+                list_args = [arg_str for triple_dict in dict_triples.values()
+                             for arg_str in triple_dict.values()]
+                list_ents = list_hotpot_ner[ins_idx][int(doc_key)][sent_idx]
+                list_sentences.append(
+                    (tokenizer.encode(doc[sent_idx], add_special_tokens=False),
+                     [tokenizer.encode(a, add_special_tokens=False)
+                      for a in list_args],
+                     [tokenizer.encode(e, add_special_tokens=False)
+                      for e in list_ents]))
+
+    old_idx, t_old = timeit(
+        locate_all, list_sentences,
+        lambda sent, span: old_find_sublist_idx(sent, span),
+        lambda sent_encoded: sent_encoded)
+    new_idx, t_new = timeit(locate_all, list_sentences,
+                            lambda aligner, span: aligner.find(span),
+                            SpanAligner)
+    print(
+        "{} sentences, {} span lookups: find_sublist_idx {:.1f}s, "
+        "SpanAligner {:.1f}s (x{:.1f}). Same output: {}".format(
+            len(list_sentences), len(old_idx), t_old, t_new, t_old / t_new,
+            old_idx == new_idx))
+
+
+if __name__ == "__main__":
+    main()
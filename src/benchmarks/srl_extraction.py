@@ -0,0 +1,54 @@
+'''
+Throughput of the per-sentence SRL extraction vs the batched (and sharded) one.
+
+    python -m src.benchmarks.srl_extraction \
+        data/external/hotpot_dev_distractor_v1.json --num_instances 200 \
+        --batch_size 64 --num_workers 4
+'''
+import argparse
+from src.data.preprocessing import SRL
+from src.benchmarks.utils import load_hotpot, select_all_docs, timeit
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('hotpot_file', type=str)
+    parser.add_argument('--num_instances', type=int, default=200)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--num_workers', type=int, default=0)
+    parser.add_argument('--device', type=str, default='cpu')
+    args = parser.parse_args()
+
+    hotpot = load_hotpot(args.hotpot_file, args.num_instances)
+    dict_ins2dict_doc2pred = select_all_docs(hotpot)
+    num_sents = sum(len(doc) for ins in hotpot for (_, doc) in ins['context'])
+
+    srl = SRL(device=args.device)
+    baseline, t_baseline = timeit(srl.extract_srl, hotpot,
+                                  dict_ins2dict_doc2pred)
+    print("per-sentence: {:.1f}s ({:.1f} sents/s)".format(
+        t_baseline, num_sents / t_baseline))
+
+    srl.batch_size = args.batch_size
+    batched, t_batched = timeit(srl.extract_srl, hotpot,
+                                dict_ins2dict_doc2pred)
+    print("batched (batch_size={}): {:.1f}s ({:.1f} sents/s) "
+          "speedup x{:.2f}".format(args.batch_size, t_batched,
+                                   num_sents / t_batched,
+                                   t_baseline / t_batched))
+    print("same output:", batched == baseline)
+
+    if args.num_workers > 0:
+        srl.num_workers = args.num_workers
+        sharded, t_sharded = timeit(srl.extract_srl, hotpot,
+                                    dict_ins2dict_doc2pred)
+        print(
+            "sharded (num_workers={}): {:.1f}s ({:.1f} sents/s) "
+            "speedup x{:.2f}".format(args.num_workers, t_sharded,
+                                     num_sents / t_sharded,
+                                     t_baseline / t_sharded))
+        print("same output:", sharded == baseline)
+
+
+if __name__ == "__main__":
+    main()
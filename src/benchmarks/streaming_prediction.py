@@ -0,0 +1,94 @@
+'''
+Peak memory and time of the prediction pipeline, stage by stage over the whole
+input (run_prediction.py) vs streaming in chunks (StreamingPrediction). All the
+documents are selected. Each mode runs in its own process so that the peak RSS
+of one does not hide the other; without --mode both are run and their
+predictions compared.
+
+    python -m src.benchmarks.streaming_prediction \
+        data/external/hotpot_dev_distractor_v1.json models/graph_model \
+        --num_instances 2000 --chunk_size 256
+'''
+import sys
+import json
+import argparse
+import subprocess
+from src.benchmarks.utils import (load_hotpot, select_all_docs, timeit,
+                                  peak_rss_mb)
+
+PRETRAINED_WEIGHTS = 'bert-large-uncased-whole-word-masking'
+
+
+def predict_full(model, hotpot, dict_ins2dict_doc2pred, args):
+    from src.data.preprocess_dataset import create_dataloader, context_tensors
+    from src.models.model import Validation
+    output = create_dataloader(hotpot, dict_ins2dict_doc2pred,
+                               PRETRAINED_WEIGHTS)
+    validation = Validation(model, hotpot, output['list_graphs'],
+                            *context_tensors(output['list_context']),
+                            batch_size=args.eval_batch_size)
+    return validation.get_answer_predictions(dict_ins2dict_doc2pred)
+
+
+def predict_stream(model, hotpot, dict_ins2dict_doc2pred, args):
+    from src.models.pipeline import StreamingPrediction
+    streaming = StreamingPrediction(model, PRETRAINED_WEIGHTS,
+                                    chunk_size=args.chunk_size,
+                                    eval_batch_size=args.eval_batch_size)
+    return streaming.predict(hotpot, dict_ins2dict_doc2pred)
+
+
+def run_mode(args):
+    from src.models.model import HGNModel
+    hotpot = load_hotpot(args.hotpot_file, args.num_instances)
+    model = HGNModel.from_pretrained(args.model_path)
+    model.cuda()
+    predict_fn = predict_stream if args.mode == 'stream' else predict_full
+    preds, secs = timeit(predict_fn, model, hotpot, select_all_docs(hotpot),
+                         args)
+    with open(args.output_file, 'w') as f:
+        json.dump(preds, f)
+    print(json.dumps({'mode': args.mode, 'secs': secs,
+                      'peak_rss_mb': peak_rss_mb()}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('hotpot_file', type=str)
+    parser.add_argument('model_path', type=str)
+    parser.add_argument('--num_instances', type=int, default=2000)
+    parser.add_argument('--chunk_size', type=int, default=256)
+    parser.add_argument('--eval_batch_size', type=int, default=8)
+    parser.add_argument('--mode', type=str, default=None,
+                        choices=['full', 'stream'])
+    parser.add_argument('--output_file', type=str, default=None)
+    args = parser.parse_args()
+
+    if args.mode is not None:
+        run_mode(args)
+        return
+    dict_mode2result = dict()
+    for mode in ['full', 'stream']:
+        output_file = '/tmp/pred_{}.json'.format(mode)
+        out = subprocess.run([sys.executable, '-m',
+                              'src.benchmarks.streaming_prediction',
+                              args.hotpot_file, args.model_path,
+                              '--num_instances', str(args.num_instances),
+                              '--chunk_size', str(args.chunk_size),
+                              '--eval_batch_size', str(args.eval_batch_size),
+                              '--mode', mode, '--output_file', output_file],
+                             stdout=subprocess.PIPE, check=True,
+                             universal_newlines=True).stdout
+        dict_mode2result[mode] = json.loads(out.strip().splitlines()[-1])
+        with open(output_file, 'r') as f:
+            dict_mode2result[mode]['preds'] = json.load(f)
+    for mode in ['full', 'stream']:
+        print("{}: {:.1f}s, peak RSS {:.0f} MB".format(
+            mode, dict_mode2result[mode]['secs'],
+            dict_mode2result[mode]['peak_rss_mb']))
+    print("Same predictions:", (dict_mode2result['full']['preds']
+                                == dict_mode2result['stream']['preds']))
+
+
+if __name__ == "__main__":
+    main()
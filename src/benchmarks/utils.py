@@ -0,0 +1,73 @@
+import json
+import time
+import resource
+
+
+def load_hotpot(path, num_instances=None):
+    with open(path, "r") as f:
+        hotpot = json.load(f)
+    if num_instances is not None:
+        hotpot = hotpot[:num_instances]
+    return hotpot
+
+
+def select_all_docs(hotpot):
+    '''
+    dict_ins2dict_doc2pred that selects all the documents of each instance
+    '''
+    return {ins_idx: {doc_idx: 1
+                      for doc_idx in range(len(hotpot_instance['context']))}
+            for ins_idx, hotpot_instance in enumerate(hotpot)}
+
+
+def timeit(fn, *args, **kwargs):
+    '''
+    Returns the output of fn and the elapsed wall-clock time in seconds
+    '''
+    t0 = time.perf_counter()
+    out = fn(*args, **kwargs)
+    return out, time.perf_counter() - t0
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def load_processed_graphs(path, num_instances=None):
+    '''
+    Loads the graphs (with their metadata), the input tensors and the span idx
+    of a processed split (same layout as the training script: graphs/,
+    metadata/, tensor_*.p, list_span_idx.p)
+    '''
+    import os
+    import re
+    import pickle
+    import torch
+    from src.data.preprocess_dataset import add_metadata2graph
+
+    def natural_sort(l):
+        convert = lambda text: int(text) if text.isdigit() else text.lower()
+        return sorted(
+            l, key=lambda key: [convert(c) for c in re.split('([0-9]+)', key)])
+
+    list_graph_files = natural_sort(
+        [f for f in os.listdir(os.path.join(path, 'graphs')) if ".bin" in f])
+    list_metadata_files = natural_sort(
+        os.listdir(os.path.join(path, 'metadata')))
+    list_graphs = []
+    list_files = list(zip(list_graph_files, list_metadata_files))
+    for (g_file, metadata_file) in list_files[:num_instances]:
+        with open(os.path.join(path, 'graphs', g_file), "rb") as f:
+            graph = pickle.load(f)
+        with open(os.path.join(path, 'metadata', metadata_file), "rb") as f:
+            metadata = pickle.load(f)
+        list_graphs.append(add_metadata2graph(graph, metadata))
+    with open(os.path.join(path, 'list_span_idx.p'), 'rb') as f:
+        list_span_idx = pickle.load(f)
+    list_names = ['tensor_input_ids', 'tensor_attention_masks',
+                  'tensor_token_type_ids']
+    tensors = {
+        name: torch.load(os.path.join(path, name + '.p'))[:len(list_graphs)]
+        for name in list_names}
+    return list_graphs, tensors, list_span_idx[:len(list_graphs)]
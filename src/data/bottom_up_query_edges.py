@@ -12,6 +12,13 @@ import torch
 import dgl
 from transformers import *
 # from dgl.data.utils import load_graphs
+from src.data.graph_store import GraphStore, write_graphs, INDEX_FILE
+from src.data.graph_utils import (SpanAligner, EncodingMemo, FuzzyMatcher,
+                                  SpanEdges, self_loop_arrays,
+                                  build_heterograph, collect_strings,
+                                  common_entity_edges_sent_lvl, fingerprint,
+                                  find_sublist_idx as _find_sublist_idx,
+                                  context_tensors)
 import random
 
 os.environ['DGLBACKEND'] = 'pytorch'
@@ -47,27 +54,15 @@ print("Training data loaded")
 # %%
 def find_sublist_idx(x: list, y: list) -> int:
     '''
-    Return the first index of the sublist in the list
+    Return the first index of the sublist in the list (without falling back to
+    the first occurrence of y[0])
     Input:
         - x: list
         - y: sublist
     Returns:
         - index of the occurence of the sublist in the list
     '''
-    occ = [i for i, a in enumerate(x) if a == y[0]]
-    
-    for b in occ:
-        # check if the full sublist is in the list
-        if x[b:b+len(y)] == y:
-            return b
-        # if len(occ)-1 ==  occ.index(b):
-        #     # check all possible sublist candidates but not found the full sublist
-        #     # return the first occurrence. Be careful, it can lead to wrong results
-        #     # but in 99% of the cases should be fine.
-        #     # If we reach this case, it is becase the SRL model skipped some token
-        #     # i.e. B-arg0, I-arg0, O, I-arg0,...
-        #     return occ[0]
-    raise Exception("Sublist not in list")
+    return _find_sublist_idx(x, y, fallback_first_occurrence=False)
 x = [0,1,2,3,4,5,6,7]
 y = [3,4,5]
 assert find_sublist_idx(x, y) == 3
@@ -94,6 +89,10 @@ def ans_type(ans):
 
 # %%
 MAX_LEN = 512
+# part of the fingerprint of each graph (see Dataset.instance_fingerprint).
+# Bump it when create_graph changes the graphs it builds, so that stored graphs
+# are rebuilt
+GRAPH_BUILDER_VERSION = 2
 node_type2idx = {'doc': 0, 'sent': 1, 'srl': 2, 'ent': 3, 'token': 4, 'query': 5}
 class Dataset():
     def __init__(self, dataset = None, list_hotpot_ner = None, dict_ins_doc_sent_srl_triples = None,
@@ -113,9 +112,19 @@ class Dataset():
         self.list_entities_query = list_entities_query
         self.batch_size = batch_size
         self.max_len = max_len
+        # wordpiece encodings of the srl arguments and entities (filled in bulk
+        # by create_dataloader)
+        self.encoding_memo = EncodingMemo(self.tokenizer)
+        # memo of the entity pairs scored by multi_hop_edges
+        self.fuzzy_matcher = FuzzyMatcher()
+        self.tokenizer_id = '{}:{}'.format(pretrained_weights,
+                                           len(self.tokenizer))
         
     def create_dataloader(self):
         list_context, list_dict_idx = self.encode_all_sentences()
+        self.encoding_memo.add(collect_strings(
+            [self.dict_ins_doc_sent_srl_triples, self.list_hotpot_ner,
+             self.dict_ins_query_triples, self.list_entities_query]))
         list_graphs = []
         list_span_idx = []
         list_g_metadata = []
@@ -133,6 +142,88 @@ class Dataset():
             list_list_ent2ent_metadata.append(list_ent2ent_metadata)
         return list_graphs, list_g_metadata, list_context, list_list_srl_edges_metadata, list_list_ent2ent_metadata, list_span_idx
 
+    def create_graphs(self, graph_store=None):
+        '''
+        Graphs of create_dataloader with their node metadata and the data of
+        their relation edges (as they are written to the GraphStore of the
+        split)
+        Inputs:
+            - graph_store: GraphStore of a previous run (optional). The graphs
+                of the instances whose fingerprint (instance_fingerprint) is in
+                the store are loaded from it instead of being rebuilt
+        After the call, self.list_graph_info has the info record of each graph
+        (fingerprint and span idx) to store with it (write_graphs)
+        '''
+        list_context, list_dict_idx = self.encode_all_sentences()
+        list_fingerprints = [self.instance_fingerprint(ins_idx)
+                             for ins_idx in range(len(self.dataset))]
+        list_graphs = [None] * len(self.dataset)
+        list_span_idx = [None] * len(self.dataset)
+        if graph_store is not None:
+            dict_fingerprint2store_idx = dict()
+            for store_idx in range(len(graph_store)):
+                info = graph_store.info(store_idx)
+                if info is not None:
+                    dict_fingerprint2store_idx[info['fingerprint']] = store_idx
+            for ins_idx, ins_fingerprint in enumerate(list_fingerprints):
+                if ins_fingerprint in dict_fingerprint2store_idx:
+                    store_idx = dict_fingerprint2store_idx[ins_fingerprint]
+                    list_graphs[ins_idx] = graph_store[store_idx]
+                    list_span_idx[ins_idx] = tuple(
+                        graph_store.info(store_idx)['span_idx'])
+        list_ins_idx = [ins_idx for ins_idx in range(len(self.dataset))
+                        if list_graphs[ins_idx] is None]
+        print("Building {} graphs ({} reused)".format(
+            len(list_ins_idx), len(self.dataset) - len(list_ins_idx)))
+        # only the annotations of the instances to build
+        self.encoding_memo.add(
+            collect_strings([(self.dict_ins_doc_sent_srl_triples[str(ins_idx)],
+                              self.list_hotpot_ner[ins_idx],
+                              self.dict_ins_query_triples[str(ins_idx)],
+                              self.list_entities_query[ins_idx])
+                             for ins_idx in list_ins_idx]))
+        for ins_idx in tqdm(list_ins_idx):
+            list_graphs[ins_idx], list_span_idx[ins_idx] = (
+                self.create_instance_graph(ins_idx, list_context[ins_idx],
+                                           list_dict_idx[ins_idx]))
+        self.list_graph_info = [
+            {'fingerprint': ins_fingerprint, 'span_idx': list(span_idx)}
+            for ins_fingerprint, span_idx in zip(list_fingerprints,
+                                                 list_span_idx)]
+        return list_graphs, list_context, list_span_idx
+
+    def instance_fingerprint(self, ins_idx) -> str:
+        '''
+        Fingerprint of all the inputs of the graph of the instance ins_idx: the
+        instance, its NER and SRL annotations, the tokenizer and the
+        graph-builder config. If it does not change, the graph does not change
+        '''
+        return fingerprint({
+            'builder': 'bottom_up_query_edges',
+            'builder_version': GRAPH_BUILDER_VERSION,
+            'tokenizer': self.tokenizer_id,
+            'max_len': self.max_len,
+            'instance': self.dataset[ins_idx],
+            'ner': self.list_hotpot_ner[ins_idx],
+            'query_ner': self.list_entities_query[ins_idx],
+            'srl': self.dict_ins_doc_sent_srl_triples[str(ins_idx)],
+            'query_srl': self.dict_ins_query_triples[str(ins_idx)]})
+
+    def create_instance_graph(self, ins_idx, context, dict_idx):
+        '''
+        Returns the graph (with its node metadata and the data of the relation
+        edges) and the answer span of the instance ins_idx
+        '''
+        hotpot_instance = self.dataset[ins_idx]
+        (g, g_metadata, list_srl_edges_metadata, list_ent2ent_metadata,
+         span_idx) = self.create_graph(
+            hotpot_instance, self.list_hotpot_ner[ins_idx], dict_idx,
+            context['input_ids'], ins_idx)
+        self.build_tests(ins_idx, g, span_idx, hotpot_instance['answer'])
+        g = add_edge_metadata2graph(g, list_srl_edges_metadata,
+                                    list_ent2ent_metadata)
+        return add_metadata2graph(g, g_metadata), span_idx
+
     def build_tests(self, ins_idx, g, span_idx, ans):
         #print(ins_idx, span_idx)
 #         if ans == 'yes' or ans == 'no':
@@ -210,7 +301,9 @@ class Dataset():
             - list_list_sent_idx: list of list of idx (in encoding) of setences. The first dimension represents docs.
                 eg: [[70, 71, 72], [73, 74, 75, 76]], so 2 docs (3 sents, 4 sents)
         Return:
-            - context: input_ids of question and list of documents (with special tokens)
+            - context: input_ids of question and list of documents (with
+                special tokens), truncated to max_len but not padded (see
+                context_tensors in graph_utils.py)
             - dict_idx: dict with the idx of the query, doc, and sentences
                 eg: {'q': (1, 21),
                      'list_docs': [{'idx_doc': (22, 136),
@@ -254,11 +347,8 @@ class Dataset():
         context_attention_mask = [1] * len(context_input_ids)
         # token type 1 to evid doc
         context_token_type_ids.extend([1] * (len(context_input_ids)-len(context_token_type_ids)))
-        if len(context_input_ids) < self.max_len:
-            context_input_ids.extend([0]*(self.max_len-len(context_input_ids))) # 0 = [PAD]
-            context_attention_mask.extend([0] * (self.max_len-len(context_attention_mask)))
-            context_token_type_ids.extend([0] * (self.max_len-len(context_token_type_ids)))
-        else:
+        # no padding: each batch is padded to its longest context
+        if len(context_input_ids) > self.max_len:
             context_input_ids = context_input_ids[:self.max_len]
             context_input_ids[-1] = 102 # SEP (last one)
             context_attention_mask = context_attention_mask[:self.max_len]
@@ -284,14 +374,12 @@ class Dataset():
         list_query2ent = []
         list_query2sent = []
         ### to tokens
-        list_doc2tok = []
-        list_tok2doc = []
-        list_sent2tok = []
-        list_tok2sent = []
-        list_srl2tok = []
-        list_tok2srl = []
-        list_ent2tok = []
-        list_tok2ent = []
+        # node -> token ranges. tok -> node edges are their reverse
+        # (SpanEdges.arrays(reverse=True))
+        doc2tok_edges = SpanEdges()  # lbl: [DOC2TOK]
+        sent2tok_edges = SpanEdges()  # lbl: [SENT2TOK]
+        srl2tok_edges = SpanEdges()  # lbl: [SRL2TOK]
+        ent2tok_edges = SpanEdges()  # lbl: [ENT2TOK]
         ## same level
         list_sent2sent = []
         list_srl2srl = []
@@ -299,7 +387,6 @@ class Dataset():
         list_srl_tmp2srl = []
         list_srl_loc2srl = []
         list_ent2ent_self = []
-        list_token2token = []
         ## multi-hop
         list_doc_multihop = []
         list_sent_multihop = []
@@ -344,13 +431,12 @@ class Dataset():
         
         list_ent_node2str = []
         dict_ent_str2ent_node = dict()
-        token_node_idx = 0
-        for i in range(self.max_len):
-            list_token_context_idx.append(ins_idx)
-            list_token_st_end_idx.append((i, i+1))
-            list_token2token.append((i, i))  # lbl: [TOK2TOK_SELF]
-            list_token_lbl.append(0)
-            token_node_idx += 1
+        # one token node per token of the context (not per position of a padded
+        # context)
+        num_tokens = len(context)
+        list_token_context_idx.extend([ins_idx] * num_tokens)
+        list_token_st_end_idx.extend((i, i+1) for i in range(num_tokens))
+        list_token_lbl.extend([0] * num_tokens)
         
         ans_str = hotpot_instance['answer']
         ans_encoded = self.tokenizer.encode(ans_str, add_special_tokens=False)
@@ -380,10 +466,9 @@ class Dataset():
             # end metada doc
             # add edges to its tokens
             (st, end) = doc_metadata['doc_token_st_end_idx']
-            end = min(end, self.max_len)
-            for tok in range(st, end):
-                list_doc2tok.append((current_doc_node, tok))  # lbl: [DOC2TOK]
-                list_tok2doc.append((tok, current_doc_node))  # lbl: [TOK2DOC]
+            end = min(end, num_tokens)
+            # lbl: [DOC2TOK], [TOK2DOC]
+            doc2tok_edges.add(current_doc_node, st, end)
             doc_idx = dict_idx['list_golden_doc_idx'][idx]
             #get supp sentences
             doc_title = hotpot_instance['context'][doc_idx][0]
@@ -397,7 +482,12 @@ class Dataset():
                 # hotpotqa contains some empty sentences
                 if sent_st == sent_end:
                     continue
-                sent_end = min(sent_end, self.max_len)
+                sent_end = min(sent_end, num_tokens)
+                # positions of the tokens of the sentence to locate its srl
+                # arguments and entities
+                sent_aligner = SpanAligner(context[sent_st:sent_end],
+                                           fallback_first_occurrence=False,
+                                           offset=sent_st, max_len=num_tokens)
                 # sent node
                 current_sent_node = sent_node_idx
                 sent_node_idx += 1
@@ -409,14 +499,14 @@ class Dataset():
                 list_sent_lbl.append(sent_lbl)
                 # end metada sent
                 
-                for tok in range(sent_st, sent_end):
-                    list_sent2tok.append((current_sent_node, tok))  # lbl: [SENT2TOK]
-                    list_tok2sent.append((tok, current_sent_node))  # lbl: [TOK2SENT]
+                # lbl: [SENT2TOK], [TOK2SENT]
+                sent2tok_edges.add(current_sent_node, sent_st, sent_end)
                 
                 if sent_lbl or (yn_ans and sent_idx == 0):
                     try:
-                        ans_st_idx = find_sublist_idx(context[sent_st:sent_end], ans_encoded) + sent_st
-                        ans_end_idx = min(ans_st_idx + len(ans_encoded), self.max_len-1)
+                        ans_st_idx = sent_aligner.find(ans_encoded) + sent_st
+                        ans_end_idx = min(ans_st_idx + len(ans_encoded),
+                                          num_tokens - 1)
                     except:
                         pass
                 dict_sent_node2metadata[current_sent_node] = {'doc_idx': doc_idx, 'sent_idx': sent_idx}
@@ -439,13 +529,13 @@ class Dataset():
                     
                     if 'V' in triple_dict:
                         verb = triple_dict['V']
-                        rel_encoded = self.tokenizer.encode(verb, add_special_tokens=False)
+                        rel_encoded = self.encoding_memo.encode(verb)
                         # find location of the entity in the context (inputs ids)
                         # +sent_st 'cuz I need the index in the full context
                         # if I search using the full context instead of its sentence I may get a wrong entity (the entity may appear many times, including in the question)
                         try:
-                            st_tok_idx = find_sublist_idx(context[sent_st:sent_end], rel_encoded) + sent_st
-                            end_tok_idx = min(st_tok_idx + len(rel_encoded), self.max_len)
+                            st_tok_idx, end_tok_idx = (
+                                sent_aligner.locate(rel_encoded))
                             srl_rel['st_tok_idx'] = st_tok_idx
                             srl_rel['end_tok_idx'] = end_tok_idx
                         except:
@@ -458,12 +548,13 @@ class Dataset():
                                 # already processed it before the loop
                                 pass
                             elif arg_type == 'TMP':
-                                arg_encoded = self.tokenizer.encode(arg_str, add_special_tokens=False)
+                                arg_encoded = (
+                                    self.encoding_memo.encode(arg_str))
                                 # find location of the entity in the context (inputs ids)
                                 # +sent_st 'cuz I need the index in the full context
                                 # if I search using the full context instead of its sentence I may get a wrong entity (the entity may appear many times, including in the question)
-                                st_tok_idx = find_sublist_idx(context[sent_st:sent_end], arg_encoded) + sent_st
-                                end_tok_idx = min(st_tok_idx + len(arg_encoded), self.max_len)
+                                st_tok_idx, end_tok_idx = (
+                                    sent_aligner.locate(arg_encoded))
                                 # metadata
                                 list_srl_tmp_context_idx.append(ins_idx)
                                 list_srl_tmp_st_end_idx.append((st_tok_idx, end_tok_idx))
@@ -471,12 +562,13 @@ class Dataset():
                                 current_srl_tmp_node = srl_tmp_node_idx
                                 srl_tmp_node_idx += 1
                             elif arg_type == 'LOC':
-                                arg_encoded = self.tokenizer.encode(arg_str, add_special_tokens=False)
+                                arg_encoded = (
+                                    self.encoding_memo.encode(arg_str))
                                 # find location of the entity in the context (inputs ids)
                                 # +sent_st 'cuz I need the index in the full context
                                 # if I search using the full context instead of its sentence I may get a wrong entity (the entity may appear many times, including in the question)
-                                st_tok_idx = find_sublist_idx(context[sent_st:sent_end], arg_encoded) + sent_st
-                                end_tok_idx = min(st_tok_idx + len(arg_encoded), self.max_len)
+                                st_tok_idx, end_tok_idx = (
+                                    sent_aligner.locate(arg_encoded))
                                 # metadata
                                 list_srl_loc_context_idx.append(ins_idx)
                                 list_srl_loc_st_end_idx.append((st_tok_idx, end_tok_idx))
@@ -486,13 +578,14 @@ class Dataset():
                             else:
                                 if 'ARG' in arg_type and subject_srl == -1:
                                     subject_srl = srl_node_idx
-                                arg_encoded = self.tokenizer.encode(arg_str, add_special_tokens=False)
-                                arg_str = self.tokenizer.decode(arg_encoded)
+                                arg_encoded = (
+                                    self.encoding_memo.encode(arg_str))
+                                arg_str = self.encoding_memo.decode(arg_str)
                                 # find location of the entity in the context (inputs ids)
                                 # +sent_st 'cuz I need the index in the full context
                                 # if I search using the full context instead of its sentence I may get a wrong entity (the entity may appear many times, including in the question)
-                                st_tok_idx = find_sublist_idx(context[sent_st:sent_end], arg_encoded) + sent_st
-                                end_tok_idx = min(st_tok_idx + len(arg_encoded), self.max_len)
+                                st_tok_idx, end_tok_idx = (
+                                    sent_aligner.locate(arg_encoded))
                                 # metadata ent
                                 list_srl_context_idx.append(ins_idx)
                                 list_srl_st_end_idx.append((st_tok_idx, end_tok_idx))
@@ -505,25 +598,26 @@ class Dataset():
                                 list_arg_nodes.append(current_srl_node)
 #                                 print("SRL:", current_srl_node, arg_str)
                                 # srl <-> token
-                                for tok in range(st_tok_idx, end_tok_idx):
-                                    list_srl2tok.append((current_srl_node, tok))  # lbl: [SRL2TOK]
-                                    list_tok2srl.append((tok, current_srl_node))  # lbl: [TOK2SRL]
+                                # lbl: [SRL2TOK], [TOK2SRL]
+                                srl2tok_edges.add(current_srl_node, st_tok_idx,
+                                                  end_tok_idx)
                                 #######################################################
                                 # for each entity
                                 list_srl_ent = []
                                 for ent in list_entities[doc_idx][sent_idx]:
                                     try:
                                         # compute this beforehand ################################ here!!!!!!!!!!!!!!!!!!!
-                                        ent_encoded = self.tokenizer.encode(ent, add_special_tokens=False)
-                                        ent = self.tokenizer.decode(ent_encoded)
+                                        ent_encoded = (
+                                            self.encoding_memo.encode(ent))
+                                        ent = self.encoding_memo.decode(ent)
                                         if ent not in arg_str:
                                             continue
                                         list_srl_ent.append(ent)
                                         # find location of the entity in the context (inputs ids)
                                         # +sent_st 'cuz I need the index in the full context
                                         # if I search using the full context instead of its sentence I may get a wrong entity (the entity may appear many times, including in the question)
-                                        st_tok_idx = find_sublist_idx(context[sent_st:sent_end], ent_encoded) + sent_st
-                                        end_tok_idx = min(st_tok_idx + len(ent_encoded), self.max_len)
+                                        st_tok_idx, end_tok_idx = (
+                                            sent_aligner.locate(ent_encoded))
                                         
                                         lbl = (fuzz.token_set_ratio(ans_detokenized, ent) >= 90)
                                         if (not srl_lbl) and lbl:
@@ -550,9 +644,10 @@ class Dataset():
                                         list_ent2ent_self.append((current_ent_node, current_ent_node))  # lbl: [ENT2ENT_SELF]
                                         
                                         # srl -> token
-                                        for tok in range(st_tok_idx, end_tok_idx):
-                                            list_ent2tok.append((current_ent_node, tok))  # lbl: [ENT2TOK]
-                                            list_tok2ent.append((tok, current_ent_node))   # lbl: [TOK2ENT]
+                                        # lbl: [ENT2TOK], [TOK2ENT]
+                                        ent2tok_edges.add(
+                                            current_ent_node, st_tok_idx,
+                                            end_tok_idx)
                 #                         print("#### ent ", lbl, self.tokenizer.decode(context[st_tok_idx:end_tok_idx]))
                                     except:
                 #                         print(ent)
@@ -605,6 +700,9 @@ class Dataset():
         #     list_query2ent = [(0, e) for e in range(ent_node_idx)]  # lbl: [QUERY2ENT]
         ############ Query node ################
         (q_st, q_end) = dict_idx['q_token_st_end_idx']
+        q_aligner = SpanAligner(context[q_st:q_end],
+                                fallback_first_occurrence=False, offset=q_st,
+                                max_len=num_tokens)
         list_query_st_end_idx = [(q_st, q_end)]
         
         first_query_srl = srl_node_idx
@@ -619,13 +717,12 @@ class Dataset():
 
             if 'V' in triple_dict:
                 verb = triple_dict['V']
-                rel_encoded = self.tokenizer.encode(verb, add_special_tokens=False)
+                rel_encoded = self.encoding_memo.encode(verb)
                 # find location of the entity in the context (inputs ids)
                 # +sent_st 'cuz I need the index in the full context
                 # if I search using the full context instead of its sentence I may get a wrong entity (the entity may appear many times, including in the question)
                 try:
-                    st_tok_idx = find_sublist_idx(context[q_st:q_end], rel_encoded) + q_st
-                    end_tok_idx = min(st_tok_idx + len(rel_encoded), self.max_len)
+                    st_tok_idx, end_tok_idx = q_aligner.locate(rel_encoded)
                     srl_rel['st_tok_idx'] = st_tok_idx
                     srl_rel['end_tok_idx'] = end_tok_idx
                 except:
@@ -638,12 +735,11 @@ class Dataset():
                         # already processed it before the loop
                         continue
                     elif arg_type == 'TMP':
-                        arg_encoded = self.tokenizer.encode(arg_str, add_special_tokens=False)
+                        arg_encoded = self.encoding_memo.encode(arg_str)
                         # find location of the entity in the context (inputs ids)
                         # +sent_st 'cuz I need the index in the full context
                         # if I search using the full context instead of its sentence I may get a wrong entity (the entity may appear many times, including in the question)
-                        st_tok_idx = find_sublist_idx(context[q_st:q_end], arg_encoded) + q_st
-                        end_tok_idx = min(st_tok_idx + len(arg_encoded), self.max_len)
+                        st_tok_idx, end_tok_idx = q_aligner.locate(arg_encoded)
                         # metadata
                         list_srl_tmp_context_idx.append(ins_idx)
                         list_srl_tmp_st_end_idx.append((st_tok_idx, end_tok_idx))
@@ -651,12 +747,13 @@ class Dataset():
                         current_srl_tmp_node = srl_tmp_node_idx
                         srl_tmp_node_idx += 1
                     elif arg_type == 'LOC':
-                        arg_encoded = self.tokenizer.encode(arg_str, add_special_tokens=False)
+                        arg_encoded = self.encoding_memo.encode(arg_str)
                         # find location of the entity in the context (inputs ids)
                         # +sent_st 'cuz I need the index in the full context
                         # if I search using the full context instead of its sentence I may get a wrong entity (the entity may appear many times, including in the question)
                         st_tok_idx = find_sublist_idx(context[sent_st:sent_end], arg_encoded) + sent_st
-                        end_tok_idx = min(st_tok_idx + len(arg_encoded), self.max_len)
+                        end_tok_idx = min(st_tok_idx + len(arg_encoded),
+                                          num_tokens)
                         # metadata
                         list_srl_loc_context_idx.append(ins_idx)
                         list_srl_loc_st_end_idx.append((st_tok_idx, end_tok_idx))
@@ -666,13 +763,12 @@ class Dataset():
                     else:
                         if 'ARG' in arg_type and subject_srl == -1:
                             subject_srl = srl_node_idx
-                        arg_encoded = self.tokenizer.encode(arg_str, add_special_tokens=False)
-                        arg_str = self.tokenizer.decode(arg_encoded)
+                        arg_encoded = self.encoding_memo.encode(arg_str)
+                        arg_str = self.encoding_memo.decode(arg_str)
                         # find location of the entity in the context (inputs ids)
                         # +sent_st 'cuz I need the index in the full context
                         # if I search using the full context instead of its sentence I may get a wrong entity (the entity may appear many times, including in the question)
-                        st_tok_idx = find_sublist_idx(context[q_st:q_end], arg_encoded) + q_st
-                        end_tok_idx = min(st_tok_idx + len(arg_encoded), self.max_len)
+                        st_tok_idx, end_tok_idx = q_aligner.locate(arg_encoded)
                         # metadata ent
                         list_srl_context_idx.append(ins_idx)
                         list_srl_st_end_idx.append((st_tok_idx, end_tok_idx))
@@ -685,25 +781,25 @@ class Dataset():
                         list_arg_nodes.append(current_srl_node)
 
                         # srl <-> token
-                        for tok in range(st_tok_idx, end_tok_idx):
-                            list_srl2tok.append((current_srl_node, tok))  # lbl: [SRL2TOK]
-                            list_tok2srl.append((tok, current_srl_node))  # lbl: [TOK2SRL]
+                        # lbl: [SRL2TOK], [TOK2SRL]
+                        srl2tok_edges.add(current_srl_node, st_tok_idx,
+                                          end_tok_idx)
                         #######################################################
                         # for each entity
                         list_srl_ent = []
                         for ent in self.list_entities_query[ins_idx]:
                             try:
                                 # compute this beforehand ################################ here!!!!!!!!!!!!!!!!!!!
-                                ent_encoded = self.tokenizer.encode(ent, add_special_tokens=False)
-                                ent = self.tokenizer.decode(ent_encoded)
+                                ent_encoded = self.encoding_memo.encode(ent)
+                                ent = self.encoding_memo.decode(ent)
                                 if ent not in arg_str:
                                     continue
                                 list_srl_ent.append(ent)
                                 # find location of the entity in the context (inputs ids)
                                 # +sent_st 'cuz I need the index in the full context
                                 # if I search using the full context instead of its sentence I may get a wrong entity (the entity may appear many times, including in the question)
-                                st_tok_idx = find_sublist_idx(context[q_st:q_end], ent_encoded) + q_st
-                                end_tok_idx = min(st_tok_idx + len(ent_encoded), self.max_len)
+                                st_tok_idx, end_tok_idx = (
+                                    q_aligner.locate(ent_encoded))
 
                                 lbl = (fuzz.token_set_ratio(ans_detokenized, ent) >= 90)
                                 if (not srl_lbl) and lbl:
@@ -728,9 +824,9 @@ class Dataset():
                                 list_ent2ent_self.append((current_ent_node, current_ent_node))  # lbl: [ENT2ENT_SELF]
                                 
                                 # srl -> token
-                                for tok in range(st_tok_idx, end_tok_idx):
-                                    list_ent2tok.append((current_ent_node, tok))  # lbl: [ENT2TOK]
-                                    list_tok2ent.append((tok, current_ent_node))   # lbl: [TOK2ENT]
+                                # lbl: [ENT2TOK], [TOK2ENT]
+                                ent2tok_edges.add(current_ent_node, st_tok_idx,
+                                                  end_tok_idx)
         #                         print("#### ent ", lbl, self.tokenizer.decode(context[st_tok_idx:end_tok_idx]))
                             except:
         #                         print(ent)
@@ -780,7 +876,7 @@ class Dataset():
                                                           90)
        
         # make the heterogenous graph
-        list_srl2self = [(v, v) for v in range(srl_node_idx)]
+        list_srl2self = self_loop_arrays(srl_node_idx)
         # create ent rel using SRL predicates
         list_ent2ent_rel, list_ent2ent_metadata = self.compute_ent_relations(list_srl2srl, 
                                                                              list_srl2ent, 
@@ -789,13 +885,16 @@ class Dataset():
         dict_edges = {
                      ('srl', 'srl2sent', 'sent'): list_srl2sent,  # lbl: [SRL2SENT]
                      # to token
-                     ('srl', 'srl2tok', 'tok'): list_srl2tok,     # lbl: [SRL2TOK]
+                     # lbl: [SRL2TOK]
+                     ('srl', 'srl2tok', 'tok'): srl2tok_edges,
                      # end hierarchical
                      # same-level edges
                      ('sent', 'sent2sent', 'sent'): list_sent2sent,   # lbl: [SENT2SENT]
                      ('srl', 'srl2srl', 'srl'): list_srl2srl,         # lbl: [SRL2SRL]
                      ('srl', 'srl2self', 'srl'): list_srl2self,         # lbl: [SRL2SELF]
-                     ('tok', 'token2token_self', 'tok'): list_token2token, # lbl: [TOK2TOK_SELF]
+                     # lbl: [TOK2TOK_SELF]
+                     ('tok', 'token2token_self', 'tok'):
+                         self_loop_arrays(num_tokens),
                      # multi-hop edges
                      ('srl', 'srl_multihop', 'srl'): list_srl_multihop,
                      ('sent', 'sent_multihop', 'sent'): list_sent_multihop,
@@ -803,8 +902,9 @@ class Dataset():
                     }
         if list_ent2srl != []:
             dict_edges[('ent', 'ent2srl', 'srl')] = list_ent2srl     # lbl: [ENT2SRL]
-        if list_ent2tok != []:
-            dict_edges[('ent', 'ent2tok', 'tok')] = list_ent2tok     # lbl: [ENT2TOK]
+        if len(ent2tok_edges) > 0:
+            # lbl: [ENT2TOK]
+            dict_edges[('ent', 'ent2tok', 'tok')] = ent2tok_edges
         if list_ent2ent_self != []:
             dict_edges[('ent', 'ent2ent_self', 'ent')] = list_ent2ent_self # lbl: [ENT2ENT_SELF]
         if list_ent2ent_rel != []:
@@ -813,10 +913,14 @@ class Dataset():
             dict_edges[('ent', 'ent_multihop', 'ent')] = list_ent_multihop # lbl: [ENT2ENT_MH]
         if list_srl_loc2srl != []:
             dict_edges[('srl_loc', 'srl_loc2srl', 'srl')] = list_srl_loc2srl  # lbl: [SRL_LOC2SRL]
-            dict_edges[('srl_loc', 'srl_loc2self', 'srl_loc')] =  [(u,u) for u in range(srl_loc_node_idx)] # lbl: [SRL_LOC2SELF]
+            # lbl: [SRL_LOC2SELF]
+            dict_edges[('srl_loc', 'srl_loc2self', 'srl_loc')] = (
+                self_loop_arrays(srl_loc_node_idx))
         if list_srl_tmp2srl != []:
             dict_edges[('srl_tmp', 'srl_tmp2srl', 'srl')] = list_srl_tmp2srl  # lbl: [SRL_TMP2SRL]
-            dict_edges[('srl_tmp', 'srl_tmp2self', 'srl_tmp')] =  [(u,u) for u in range(srl_tmp_node_idx)] # lbl: [SRL_TMP2SELF]
+            # lbl: [SRL_TMP2SELF]
+            dict_edges[('srl_tmp', 'srl_tmp2self', 'srl_tmp')] = (
+                self_loop_arrays(srl_tmp_node_idx))
         if list_query2sent_multihop != []:
             dict_edges[('query', 'query2sent_multihop', 'sent')] = list_query2sent_multihop
         if list_srl2query != []:
@@ -825,7 +929,7 @@ class Dataset():
             dict_edges['query', 'query2sent_pred', 'sent'] = list_query2sent_pred
         
         
-        graph = dgl.heterograph(dict_edges)
+        graph = build_heterograph(dict_edges)
         graph_metadata = dict()
         # doc metadata
 #         graph_metadata['doc'] = dict()
@@ -958,27 +1062,8 @@ class Dataset():
         return set_supporting_doc_titles
     
     def create_common_entity_edges_sent_lvl(self, dict_sent_node2metadata: dict, list_hotpot_instance_ner: list) -> list:
-        '''
-        Input: dict {node_idx: {'doc_idx': doc_idx, 'sent_idx': sent_idx}}
-        Output: [(node_i, node_j)]
-        Check all sentences in a hotpot instance with common named entities
-        Cost: O(n^2)
-        '''
-        list_ent_edges = []
-        for (node_i, dict_sent_i) in dict_sent_node2metadata.items():
-            for (node_j, dict_sent_j) in dict_sent_node2metadata.items():
-                if node_i != node_j:
-                    doc_i = dict_sent_i['doc_idx']
-                    sent_i = dict_sent_i['sent_idx']
-                    doc_j = dict_sent_j['doc_idx']
-                    sent_j = dict_sent_j['sent_idx']
-                    try:
-                        if self.intersection(list_hotpot_instance_ner[doc_i][sent_i], 
-                                             list_hotpot_instance_ner[doc_j][sent_j]):
-                            list_ent_edges.append((node_i, node_j))
-                    except:
-                        pass
-        return list_ent_edges
+        return common_entity_edges_sent_lvl(dict_sent_node2metadata,
+                                            list_hotpot_instance_ner)
     
     def create_common_entity_edges_srl_lvl(self, dict_srl_node2list_ent: dict):
         list_edges = []
@@ -999,9 +1084,6 @@ class Dataset():
             list_edges.extend([(u, v) for u in list_srl for v in list_srl if u != v])
         return list_edges
 
-    def intersection(self, l1: list, l2: list) -> set:
-        return set(l1).intersection(l2)
-    
     def multi_hop_edges(self, list_ent_nodes, list_ent_str, list_ent2srl, list_srl2sent, list_srl2query, threshold):
 #         print("######################## num ent", max(list_ent_nodes))
 #         print("ent2srl", list_ent2srl)
@@ -1022,43 +1104,43 @@ class Dataset():
         list_sent_multihop = []
         list_sent2query_multihop = []
         list_query2sent_multihop = []
-        for e1 in list_ent_nodes:
-            for e2 in list_ent_nodes:
-                if e1 < e2:
-                    e1_str = list_ent_str[e1]
-                    e2_str = list_ent_str[e2]
-                    if fuzz.token_set_ratio(e1_str, e2_str) >= threshold:
+        # only the pairs that can reach the threshold are scored (same pairs
+        # and order as comparing all of them)
+        list_pairs = self.fuzzy_matcher.matching_pairs(list_ent_nodes,
+                                                       list_ent_str, threshold)
+        for (e1, e2) in list_pairs:
 #                         print(e1_str, e2_str, fuzz.token_set_ratio(e1_str, e2_str))
-                        # ent
-                        list_ent_multihop.append((e1, e2))  # LBL: [ENT2ENT_MULTIHOP]
-                        list_ent_multihop.append((e2, e1))  # LBL: [ENT2ENT_MULTIHOP]
-                        # srl
-                        srl1 = dict_ent2srl[e1]
-                        srl2 = dict_ent2srl[e2]
-                        list_srl_multihop.append((srl1, srl2))  # LBL: [SRL2SRL_MULTIHOP]
-                        list_srl_multihop.append((srl2, srl1))  # LBL: [SRL2SRL_MULTIHOP]
-                        # sent
-                        sent1 = None
-                        sent2 = None
-                        q_node = None
-                        if srl1 in dict_srl2sent:
-                            sent1 = dict_srl2sent[srl1]
-                        elif srl1 in dict_srl2query:
-                            q_node = dict_srl2query[srl]
-                        if srl2 in dict_srl2sent:
-                            sent2 = dict_srl2sent[srl2]
-                        elif srl2 in dict_srl2query:
-                            q_node = dict_srl2query[srl]
-                        if sent1 is not None and sent2 is not None:
-                            list_sent_multihop.append((sent1, sent2))  # LBL: [SENT2SENT_MULTIHOP]
-                            list_sent_multihop.append((sent2, sent1))  # LBL: [SENT2SENT_MULTIHOP]
+            # ent
+            list_ent_multihop.append((e1, e2))  # LBL: [ENT2ENT_MULTIHOP]
+            list_ent_multihop.append((e2, e1))  # LBL: [ENT2ENT_MULTIHOP]
+            # srl
+            srl1 = dict_ent2srl[e1]
+            srl2 = dict_ent2srl[e2]
+            list_srl_multihop.append((srl1, srl2))  # LBL: [SRL2SRL_MULTIHOP]
+            list_srl_multihop.append((srl2, srl1))  # LBL: [SRL2SRL_MULTIHOP]
+            # sent
+            sent1 = None
+            sent2 = None
+            q_node = None
+            if srl1 in dict_srl2sent:
+                sent1 = dict_srl2sent[srl1]
+            elif srl1 in dict_srl2query:
+                q_node = dict_srl2query[srl]
+            if srl2 in dict_srl2sent:
+                sent2 = dict_srl2sent[srl2]
+            elif srl2 in dict_srl2query:
+                q_node = dict_srl2query[srl]
+            if sent1 is not None and sent2 is not None:
+                # LBL: [SENT2SENT_MULTIHOP]
+                list_sent_multihop.append((sent1, sent2))
+                list_sent_multihop.append((sent2, sent1))
 #                             print(sent1, sent2, srl1, srl2, e1, e2, e1_str, e2_str, fuzz.token_set_ratio(e1_str, e2_str))
-                        elif sent1 is None and (sent2 is not None and q_node is not None):
-                            list_sent2query_multihop.append((sent2, query))
-                            list_query2sent_multihop.append((query, sent2))
-                        elif sent2 is None and (sent1 is not None and q_node is not None):
-                            list_sent2query_multihop.append((sent1, query))
-                            list_query2sent_multihop.append((query, sent1))
+            elif sent1 is None and (sent2 is not None and q_node is not None):
+                list_sent2query_multihop.append((sent2, query))
+                list_query2sent_multihop.append((query, sent2))
+            elif sent2 is None and (sent1 is not None and q_node is not None):
+                list_sent2query_multihop.append((sent1, query))
+                list_query2sent_multihop.append((query, sent1))
         
         list_ent_multihop = list(set(list_ent_multihop))
 #         for (e1, e2) in list_ent_multihop:
@@ -1102,60 +1184,63 @@ def add_metadata2graph(graph, metadata):
             graph.nodes[node].data[k] = torch.tensor(v)
     return graph
 
+def add_edge_metadata2graph(graph, list_srl_edges_metadata,
+                            list_ent2ent_metadata):
+    if 'srl2srl' in graph.etypes:
+        graph.edges['srl2srl'].data['rel_type'] = torch.tensor(
+            [edge['rel_type'] for edge in list_srl_edges_metadata])
+        graph.edges['srl2srl'].data['span_idx'] = torch.tensor(
+            [edge['span_idx'] for edge in list_srl_edges_metadata])
+    if 'ent2ent_rel' in graph.etypes:
+        graph.edges['ent2ent_rel'].data['rel_type'] = torch.tensor(
+            [edge['rel_type'] for edge in list_ent2ent_metadata])
+        graph.edges['ent2ent_rel'].data['span_idx'] = torch.tensor(
+            [edge['span_idx'] for edge in list_ent2ent_metadata])
+    return graph
+
 # %%
+def load_graph_store(graph_store_path):
+    # graphs of the previous run (reused for the instances whose inputs did not
+    # change)
+    if os.path.exists(os.path.join(graph_store_path, INDEX_FILE)):
+        return GraphStore(graph_store_path)
+    return None
+
+# %%
+training_path = os.path.join(data_path, 'processed/training/hsgn_2021_fix')
 train_dataset = Dataset(hotpot_train, list_hotpot_train_ner, dict_ins_doc_sent_srl_triples,
                         dict_ins_query_srl_triples_training, list_ent_query_training, batch_size=1)
-(list_graphs, 
- list_g_metadata,
- list_context,
- list_list_srl_edges_metadata,
- list_list_ent2ent_metadata,
- list_span_idx) = train_dataset.create_dataloader()
+(list_graphs, list_context, list_span_idx) = train_dataset.create_graphs(
+    load_graph_store(os.path.join(training_path, 'graph_store')))
 
 # %%
 def print_ent_rel():
-    (list_u, list_v, _) = list_graphs[0].all_edges(form='all', etype='ent2ent_rel')
-    for i, u in enumerate(list_u):
-        st = list_g_metadata[0]['ent']['st_end_idx'][u][0]
-        end = list_g_metadata[0]['ent']['st_end_idx'][u][1]
-        st_v = list_g_metadata[0]['ent']['st_end_idx'][list_v[i]][0]
-        end_v = list_g_metadata[0]['ent']['st_end_idx'][list_v[i]][1]
+    (list_u, list_v, list_e) = list_graphs[0].all_edges(form='all',
+                                                        etype='ent2ent_rel')
+    ent_st_end_idx = list_graphs[0].nodes['ent'].data['st_end_idx'].tolist()
+    ent2ent_rel_data = list_graphs[0].edges['ent2ent_rel'].data
+    for i, u in enumerate(list_u.tolist()):
+        st, end = ent_st_end_idx[u]
+        st_v, end_v = ent_st_end_idx[list_v[i]]
         # rel
-        st_r, end_r = list_list_ent2ent_metadata[0][i]['span_idx']
-        r_type = list_list_ent2ent_metadata[0][i]['rel_type']
+        st_r, end_r = ent2ent_rel_data['span_idx'][list_e[i]].tolist()
+        r_type = ent2ent_rel_data['rel_type'][list_e[i]].item()
         print(train_dataset.tokenizer.decode(list_context[0]['input_ids'][st:end]), ", ", 
              r_type, train_dataset.tokenizer.decode(list_context[0]['input_ids'][st_r:end_r]), ", ",
              train_dataset.tokenizer.decode(list_context[0]['input_ids'][st_v:end_v]))
 
 
-%%
+# %%
 edges = 0
 for g in list_graphs:
     edges += g.number_of_edges('ent2ent_multihop')
 print(edges/len(list_graphs)/2) # divided by two because edges are bidirectional
 
 # %%
-for g_idx, list_dict_edge in enumerate(list_list_srl_edges_metadata):
-    list_graphs[g_idx].edges['srl2srl'].data['rel_type'] = torch.tensor([edge['rel_type'] for edge in list_dict_edge])
-    list_graphs[g_idx].edges['srl2srl'].data['span_idx'] = torch.tensor([edge['span_idx'] for edge in list_dict_edge])
-
-for g_idx, list_dict_edge in enumerate(list_list_ent2ent_metadata):
-    if 'ent2ent_rel' in list_graphs[g_idx].etypes:
-        list_graphs[g_idx].edges['ent2ent_rel'].data['rel_type'] = torch.tensor([edge['rel_type'] for edge in list_dict_edge])
-        list_graphs[g_idx].edges['ent2ent_rel'].data['span_idx'] = torch.tensor([edge['span_idx'] for edge in list_dict_edge])
-# %%
-training_path = os.path.join(data_path, 'processed/training/hsgn_2021_fix')
-training_graph_path = os.path.join(training_path, 'graphs')
-training_metadata_path = os.path.join(training_path, 'metadata')
-
-# %%
-for i, g in enumerate(tqdm(list_graphs)):
-    with open(os.path.join(training_graph_path, "graph" + str(i) + ".bin"), "wb" ) as f:
-        pickle.dump(g, f)
-    with open( os.path.join(training_metadata_path, "metadata" + str(i) + ".bin"), "wb" ) as f:
-        pickle.dump(list_g_metadata[i], f)
-    # separate the metadata from the graph to store it (do not add metadata in the first place)
-    # weird problem if the metadata is inside the graph
+# columnar store with the graphs, their metadata and fingerprints (see
+# src/data/graph_store.py)
+write_graphs(os.path.join(training_path, 'graph_store'), list_graphs,
+             train_dataset.list_graph_info)
 
 # %%
 def natural_sort(l): 
@@ -1164,13 +1249,10 @@ def natural_sort(l):
     return sorted(l, key = alphanum_key)
 
 # %%
-list_input_ids = [context['input_ids'] for context in list_context]
-list_token_type_ids = [context['token_type_ids'] for context in list_context]
-list_attention_masks = [context['attention_mask'] for context in list_context]
-
-tensor_input_ids = torch.tensor(list_input_ids)
-tensor_token_type_ids = torch.tensor(list_token_type_ids)
-tensor_attention_masks = torch.tensor(list_attention_masks)
+# contexts padded to the longest one (HGNModel trims each batch to its longest
+# context)
+(tensor_input_ids, tensor_attention_masks,
+ tensor_token_type_ids) = context_tensors(list_context)
 
 torch.save(tensor_input_ids, os.path.join(training_path, 'tensor_input_ids.p'))
 torch.save(tensor_token_type_ids, os.path.join(training_path, 'tensor_token_type_ids.p'))
@@ -1194,46 +1276,21 @@ with open(os.path.join(data_path, intermediate_dev_data_path, "list_ent_query_de
 print("Dev data loaded")
 
 # %%
+dev_path = os.path.join(data_path, 'processed/dev/hsgn_2021_fix')
 dev_dataset = Dataset(hotpot_dev, list_hotpot_dev_ner, dict_ins_doc_sent_srl_triples_dev,
                       dict_ins_query_srl_triples_dev, list_ent_query_dev, batch_size=1)
-(list_graphs, 
- list_g_metadata,
- list_context,
- list_list_srl_edges_metadata,
- list_list_ent2ent_metadata,
- list_span_idx) = dev_dataset.create_dataloader()
+(list_graphs, list_context, list_span_idx) = dev_dataset.create_graphs(
+    load_graph_store(os.path.join(dev_path, 'graph_store')))
 
 # %%
-for g_idx, list_dict_edge in enumerate(list_list_srl_edges_metadata):
-    list_graphs[g_idx].edges['srl2srl'].data['rel_type'] = torch.tensor([edge['rel_type'] for edge in list_dict_edge])
-    list_graphs[g_idx].edges['srl2srl'].data['span_idx'] = torch.tensor([edge['span_idx'] for edge in list_dict_edge])
-
-for g_idx, list_dict_edge in enumerate(list_list_ent2ent_metadata):
-    list_etypes = [etype for (src, etype, dst) in list_graphs[g_idx].canonical_etypes]
-    if 'ent2ent_rel' in list_etypes:
-        list_graphs[g_idx].edges['ent2ent_rel'].data['rel_type'] = torch.tensor([edge['rel_type'] for edge in list_dict_edge])
-        list_graphs[g_idx].edges['ent2ent_rel'].data['span_idx'] = torch.tensor([edge['span_idx'] for edge in list_dict_edge])
-
-# %%
-list_input_ids = [context['input_ids'] for context in list_context]
-list_token_type_ids = [context['token_type_ids'] for context in list_context]
-list_attention_masks = [context['attention_mask'] for context in list_context]
-tensor_input_ids = torch.tensor(list_input_ids)
-tensor_token_type_ids = torch.tensor(list_token_type_ids)
-tensor_attention_masks = torch.tensor(list_attention_masks)
-
-# %%
-dev_path = os.path.join(data_path, 'processed/dev/hsgn_2021_fix')
-dev_graph_path = os.path.join(dev_path, 'graphs')
-dev_metadata_path = os.path.join(dev_path, 'metadata')
+# contexts padded to the longest one (HGNModel trims each batch to its longest
+# context)
+(tensor_input_ids, tensor_attention_masks,
+ tensor_token_type_ids) = context_tensors(list_context)
 
 # %%
-for i, g in enumerate(list_graphs):
-    with open(os.path.join(dev_graph_path, "graph" + str(i) + ".bin"), "wb" ) as f:
-        pickle.dump(g, f)
-    with open( os.path.join(dev_metadata_path, "metadata" + str(i) + ".bin"), "wb" ) as f:
-        pickle.dump(list_g_metadata[i], f)
-    # separate the metadata from the graph to store it (do not add metadata in the first place)
+write_graphs(os.path.join(dev_path, 'graph_store'), list_graphs,
+             dev_dataset.list_graph_info)
 
 # %%
 torch.save(tensor_input_ids, os.path.join(dev_path, 'tensor_input_ids.p'))
@@ -1,6 +1,7 @@
 # %%
 import os
 import warnings
+import multiprocessing
 from transformers import BertTokenizer
 from fuzzywuzzy import fuzz
 from tqdm import tqdm
@@ -10,6 +11,11 @@ import dgl
 from transformers import *
 # from dgl.data.utils import load_graphs
 import random
+from .graph_utils import (SpanAligner, EncodingMemo, FuzzyMatcher, SpanEdges,
+                          self_loop_arrays, build_heterograph, collect_strings,
+                          common_entity_edges_sent_lvl, find_sublist_idx,
+                          fingerprint)
+from .graph_store import graph_to_arrays, graph_from_arrays
 
 os.environ['DGLBACKEND'] = 'pytorch'
 warnings.filterwarnings(action='once')
@@ -23,29 +29,6 @@ torch.cuda.manual_seed_all(random_seed)
 device = 'cuda'
 
 # %%
-def find_sublist_idx(x: list, y: list) -> int:
-    '''
-    Return the first index of the sublist in the list
-    Input:
-        - x: list
-        - y: sublist
-    Returns:
-        - index of the occurence of the sublist in the list
-    '''
-    occ = [i for i, a in enumerate(x) if a == y[0]]
-    
-    for b in occ:
-        # check if the full sublist is in the list
-        if x[b:b+len(y)] == y:
-            return b
-        if len(occ)-1 ==  occ.index(b):
-            # check all possible sublist candidates but not found the full sublist
-            # return the first occurrence. Be careful, it can lead to wrong results
-            # but in 99% of the cases should be fine.
-            # If we reach this case, it is becase the SRL model skipped some token
-            # i.e. B-arg0, I-arg0, O, I-arg0,...
-            return occ[0]
-    raise Exception("Sublist not in list")
 # x = [0,1,2,3,4,5,6,7]
 # y = [3,4,5]
 # assert find_sublist_idx(x, y) == 3
@@ -70,42 +53,210 @@ def ans_type(ans):
         return 0
 
 
+# %%
+# Dataset of the worker processes of the process pool (see
+# Dataset.create_dataloader)
+_worker_dataset = None
+
+
+def _init_worker():
+    # one process per core
+    torch.set_num_threads(1)
+
+
+def _worker_create_graphs(list_instances):
+    '''
+    Creates the graphs of a chunk of (ins_idx, context, dict_idx). Graphs are
+    returned as numpy arrays (graph_to_arrays), which are cheaper to send back
+    to the parent
+    '''
+    output = []
+    for (ins_idx, context, dict_idx) in list_instances:
+        g, span_idx = _worker_dataset.create_instance_graph(
+            ins_idx, context, dict_idx)
+        output.append((graph_to_arrays(g), g.canonical_etypes, span_idx))
+    return output
+
+
 # %%
 MAX_LEN = 512
+# part of the fingerprint of each graph (see Dataset.instance_fingerprint).
+# Bump it when create_graph changes the graphs it builds, so that stored graphs
+# are rebuilt
+GRAPH_BUILDER_VERSION = 2
 class Dataset():
-    def __init__(self, dataset=None, list_hotpot_ner=None, dict_ins_doc_sent_srl_triples=None,
-                 dict_ins_query_triples=None, list_entities_query=None, dict_ins2dict_doc2pred=None,
-                 batch_size=None, max_len=512, pretrained_weights=None):
+    def __init__(self, dataset=None, list_hotpot_ner=None,
+                 dict_ins_doc_sent_srl_triples=None,
+                 dict_ins_query_triples=None, list_entities_query=None,
+                 dict_ins2dict_doc2pred=None, batch_size=None, max_len=512,
+                 pretrained_weights=None, multihop_threshold=90):
         self.tokenizer = BertTokenizer.from_pretrained(pretrained_weights,
                                                        do_basic_tokenize=False,
                                                        clean_text=False)
+        self.tokenizer_id = '{}:{}'.format(pretrained_weights,
+                                           len(self.tokenizer))
+        self.batch_size = batch_size
+        self.max_len = max_len
+        # min fuzz.token_set_ratio of the entities connected by multi-hop edges
+        self.multihop_threshold = multihop_threshold
+        self.set_data(dataset, list_hotpot_ner, dict_ins_doc_sent_srl_triples,
+                      dict_ins_query_triples, list_entities_query,
+                      dict_ins2dict_doc2pred)
+
+    def set_data(self, dataset, list_hotpot_ner, dict_ins_doc_sent_srl_triples,
+                 dict_ins_query_triples, list_entities_query,
+                 dict_ins2dict_doc2pred=None):
+        '''
+        Sets the instances (and their annotations) of the graphs to create
+        (e.g., the next chunk of a streaming prediction, see
+        src/models/pipeline.py) without reloading the tokenizer
+        '''
         self.dataset = dataset
         self.list_hotpot_ner = list_hotpot_ner
         self.dict_ins_doc_sent_srl_triples = dict_ins_doc_sent_srl_triples
         self.dict_ins_query_triples = dict_ins_query_triples
         self.list_entities_query = list_entities_query
-        self.batch_size = batch_size
-        self.max_len = max_len
         self.dict_ins2dict_doc2pred = dict_ins2dict_doc2pred
+        # wordpiece encodings of the srl arguments and entities (filled in bulk
+        # by create_dataloader)
+        self.encoding_memo = EncodingMemo(self.tokenizer)
+        # memo of the entity pairs scored by multi_hop_edges
+        self.fuzzy_matcher = FuzzyMatcher()
 
-    def create_dataloader(self):
+    def create_dataloader(self, num_workers=0, chunk_size=64,
+                          graph_store=None):
+        '''
+        Inputs:
+            - num_workers: if > 0, the graphs are created by a pool of
+                num_workers processes
+            - chunk_size: number of instances sent to a worker at a time
+            - graph_store: GraphStore of a previous run (optional). The graphs
+                of the instances whose fingerprint (instance_fingerprint) is in
+                the store are loaded from it instead of being rebuilt
+        After the call, self.list_graph_info has the info record of each graph
+        (fingerprint and span idx) to store with it (GraphStoreWriter.add)
+        '''
         list_context, list_dict_idx = self.encode_all_sentences()
+        list_fingerprints = [self.instance_fingerprint(ins_idx)
+                             for ins_idx in range(len(self.dataset))]
+        list_graphs = [None] * len(self.dataset)
+        list_span_idx = [None] * len(self.dataset)
+        if graph_store is not None:
+            dict_fingerprint2store_idx = dict()
+            for store_idx in range(len(graph_store)):
+                info = graph_store.info(store_idx)
+                if info is not None:
+                    dict_fingerprint2store_idx[info['fingerprint']] = store_idx
+            for ins_idx, ins_fingerprint in enumerate(list_fingerprints):
+                if ins_fingerprint in dict_fingerprint2store_idx:
+                    store_idx = dict_fingerprint2store_idx[ins_fingerprint]
+                    list_graphs[ins_idx] = graph_store[store_idx]
+                    list_span_idx[ins_idx] = tuple(
+                        graph_store.info(store_idx)['span_idx'])
+        list_ins_idx = [ins_idx for ins_idx in range(len(self.dataset))
+                        if list_graphs[ins_idx] is None]
+        print("Building {} graphs ({} reused)".format(
+            len(list_ins_idx), len(self.dataset) - len(list_ins_idx)))
+        # only the annotations of the instances to build
+        self.encoding_memo.add(
+            collect_strings([(self.dict_ins_doc_sent_srl_triples[ins_idx],
+                              self.list_hotpot_ner[ins_idx],
+                              self.dict_ins_query_triples[ins_idx],
+                              self.list_entities_query[ins_idx])
+                             for ins_idx in list_ins_idx]))
+        if num_workers > 0:
+            list_new_graphs, list_new_span_idx = self.__parallel_create_graphs(
+                list_ins_idx, list_context, list_dict_idx, num_workers,
+                chunk_size)
+        else:
+            list_new_graphs = []
+            list_new_span_idx = []
+            for ins_idx in tqdm(list_ins_idx):
+                g, span_idx = self.create_instance_graph(
+                    ins_idx, list_context[ins_idx], list_dict_idx[ins_idx])
+                list_new_graphs.append(g)
+                list_new_span_idx.append(span_idx)
+        for ins_idx, g, span_idx in zip(list_ins_idx, list_new_graphs,
+                                        list_new_span_idx):
+            list_graphs[ins_idx] = g
+            list_span_idx[ins_idx] = span_idx
+        self.list_graph_info = [
+            {'fingerprint': ins_fingerprint, 'span_idx': list(span_idx)}
+            for ins_fingerprint, span_idx in zip(list_fingerprints,
+                                                 list_span_idx)]
+        return list_graphs, list_context, list_span_idx
+
+    def instance_fingerprint(self, ins_idx) -> str:
+        '''
+        Fingerprint of all the inputs of the graph of the instance ins_idx: the
+        instance, its selected documents, its NER and SRL annotations, the
+        tokenizer and the graph-builder config. If it does not change, the
+        graph does not change
+        '''
+        dict_doc2pred = None
+        if self.dict_ins2dict_doc2pred is not None:
+            dict_doc2pred = self.dict_ins2dict_doc2pred[ins_idx]
+        return fingerprint({'builder_version': GRAPH_BUILDER_VERSION,
+                            'tokenizer': self.tokenizer_id,
+                            'max_len': self.max_len,
+                            'multihop_threshold': self.multihop_threshold,
+                            'instance': self.dataset[ins_idx],
+                            'dict_doc2pred': dict_doc2pred,
+                            'ner': self.list_hotpot_ner[ins_idx],
+                            'query_ner': self.list_entities_query[ins_idx],
+                            'srl': self.dict_ins_doc_sent_srl_triples[ins_idx],
+                            'query_srl': self.dict_ins_query_triples[ins_idx]})
+
+    def create_instance_graph(self, ins_idx, context, dict_idx):
+        '''
+        Returns the graph (with the metadata of the relation edges) and the
+        answer span of the instance ins_idx
+        '''
+        hotpot_instance = self.dataset[ins_idx]
+        list_entities = self.list_hotpot_ner[ins_idx]
+        (g, list_srl_edges_metadata, list_ent2ent_metadata,
+         span_idx) = self.create_graph(
+            hotpot_instance, list_entities, dict_idx, context['input_ids'],
+            ins_idx)
+        if 'ent2ent_rel' in g.etypes:
+            g.edges['ent2ent_rel'].data['rel_type'] = torch.tensor(
+                [edge['rel_type'] for edge in list_ent2ent_metadata])
+            g.edges['ent2ent_rel'].data['span_idx'] = torch.tensor(
+                [edge['span_idx'] for edge in list_ent2ent_metadata])
+        if 'srl2srl' in g.etypes:
+            g.edges['srl2srl'].data['rel_type'] = torch.tensor(
+                [edge['rel_type'] for edge in list_srl_edges_metadata])
+            g.edges['srl2srl'].data['span_idx'] = torch.tensor(
+                [edge['span_idx'] for edge in list_srl_edges_metadata])
+        return g, span_idx
+
+    def __parallel_create_graphs(self, list_ins_idx, list_context,
+                                 list_dict_idx, num_workers, chunk_size):
+        global _worker_dataset
+        # workers are forked (they do not use the gpu), so they share this
+        # dataset, its tokenizer and the filled encoding memo without pickling
+        # them
+        _worker_dataset = self
+        list_chunks = [[(ins_idx, list_context[ins_idx],
+                         list_dict_idx[ins_idx])
+                        for ins_idx in list_ins_idx[st:st + chunk_size]]
+                       for st in range(0, len(list_ins_idx), chunk_size)]
         list_graphs = []
         list_span_idx = []
-        for ins_idx, hotpot_instance in enumerate(tqdm(self.dataset)):
-            list_entities = self.list_hotpot_ner[ins_idx]
-            dict_idx = list_dict_idx[ins_idx]
-            g, list_srl_edges_metadata, list_ent2ent_metadata, span_idx = self.create_graph(hotpot_instance, list_entities, dict_idx, list_context[ins_idx]['input_ids'], ins_idx)
-            if 'ent2ent_rel' in g.etypes:
-                g.edges['ent2ent_rel'].data['rel_type'] = torch.tensor([edge['rel_type'] for edge in list_ent2ent_metadata])
-                g.edges['ent2ent_rel'].data['span_idx'] = torch.tensor([edge['span_idx'] for edge in list_ent2ent_metadata])
-            if 'srl2srl' in g.etypes:
-                g.edges['srl2srl'].data['rel_type'] = torch.tensor([edge['rel_type'] for edge in list_srl_edges_metadata])
-                g.edges['srl2srl'].data['span_idx'] = torch.tensor([edge['span_idx'] for edge in list_srl_edges_metadata])
-
-            list_graphs.append(g)
-            list_span_idx.append(span_idx)
-        return list_graphs, list_context, list_span_idx
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(num_workers, initializer=_init_worker) as pool:
+            # imap keeps the order of the instances
+            with tqdm(total=len(list_ins_idx)) as pbar:
+                for chunk_output in pool.imap(_worker_create_graphs,
+                                              list_chunks):
+                    for (dict_arrays, canonical_etypes,
+                         span_idx) in chunk_output:
+                        list_graphs.append(
+                            graph_from_arrays(dict_arrays, canonical_etypes))
+                        list_span_idx.append(span_idx)
+                    pbar.update(len(chunk_output))
+        _worker_dataset = None
+        return list_graphs, list_span_idx
 
     def build_tests(self, ins_idx, g, span_idx, ans):
         #print(ins_idx, span_idx)
@@ -132,15 +283,26 @@ class Dataset():
         return list_context, list_dict_idx
     
     def batch_encoding(self, dataset):
+        '''
+        Encodes the queries and the sentences of the selected documents. Each
+        unique string is encoded only once (the same paragraphs appear in many
+        instances), so several instances can point to the same idx of the
+        encoding.
+        '''
         list_instance2idx = []
         list_query_idx = []
-        idx = 0
         list_sent = []
+        dict_sent2idx = dict()
+
+        def sent2idx(sent):
+            if sent not in dict_sent2idx:
+                dict_sent2idx[sent] = len(list_sent)
+                list_sent.append(sent)
+            return dict_sent2idx[sent]
+
         for hotpot_idx, hotpot_instance in enumerate(self.dataset):
             # query
-            list_query_idx.append(idx)
-            list_sent.append(hotpot_instance['question'])
-            idx += 1
+            list_query_idx.append(sent2idx(hotpot_instance['question']))
             # doc
             list_doc_list_sent_idx = []
             list_golden_doc_idx = []
@@ -156,9 +318,7 @@ class Dataset():
                     if not yes_no_added:
                         sent = " yes no " + sent
                         yes_no_added = True
-                    list_sent.append(sent)
-                    list_sent_idx.append(idx)
-                    idx += 1
+                    list_sent_idx.append(sent2idx(sent))
                 list_doc_list_sent_idx.append(list_sent_idx)
                 
             list_instance2idx.append({"list_list_sent_encoding_idx": list_doc_list_sent_idx, 
@@ -181,7 +341,9 @@ class Dataset():
             - list_list_sent_idx: list of list of idx (in encoding) of setences. The first dimension represents docs.
                 eg: [[70, 71, 72], [73, 74, 75, 76]], so 2 docs (3 sents, 4 sents)
         Return:
-            - context: input_ids of question and list of documents (with special tokens)
+            - context: input_ids of question and list of documents (with
+                special tokens), truncated to max_len but not padded (see
+                context_tensors in graph_utils.py)
             - dict_idx: dict with the idx of the query, doc, and sentences
                 eg: {'q': (1, 21),
                      'list_docs': [{'idx_doc': (22, 136),
@@ -225,11 +387,8 @@ class Dataset():
         context_attention_mask = [1] * len(context_input_ids)
         # token type 1 to evid doc
         context_token_type_ids.extend([1] * (len(context_input_ids)-len(context_token_type_ids)))
-        if len(context_input_ids) < self.max_len:
-            context_input_ids.extend([0]*(self.max_len-len(context_input_ids))) # 0 = [PAD]
-            context_attention_mask.extend([0] * (self.max_len-len(context_attention_mask)))
-            context_token_type_ids.extend([0] * (self.max_len-len(context_token_type_ids)))
-        else:
+        # no padding: each batch is padded to its longest context
+        if len(context_input_ids) > self.max_len:
             context_input_ids = context_input_ids[:self.max_len]
             context_attention_mask = context_attention_mask[:self.max_len]
             context_token_type_ids = context_token_type_ids[:self.max_len]
@@ -254,14 +413,12 @@ class Dataset():
         list_query2ent = []
         list_query2sent = []
         ### to tokens
-        list_doc2tok = []
-        list_tok2doc = []
-        list_sent2tok = []
-        list_tok2sent = []
-        list_srl2tok = []
-        list_tok2srl = []
-        list_ent2tok = []
-        list_tok2ent = []
+        # node -> token ranges. tok -> node edges are their reverse
+        # (SpanEdges.arrays(reverse=True))
+        doc2tok_edges = SpanEdges()  # lbl: [DOC2TOK]
+        sent2tok_edges = SpanEdges()  # lbl: [SENT2TOK]
+        srl2tok_edges = SpanEdges()  # lbl: [SRL2TOK]
+        ent2tok_edges = SpanEdges()  # lbl: [ENT2TOK]
         ## same level
         list_sent2sent = []
         list_srl2srl = []
@@ -269,7 +426,6 @@ class Dataset():
         list_srl_tmp2srl = []
         list_srl_loc2srl = []
         list_ent2ent_self = []
-        list_token2token = []
         ## multi-hop
         list_doc_multihop = []
         list_sent_multihop = []
@@ -314,13 +470,12 @@ class Dataset():
         
         list_ent_node2str = []
         dict_ent_str2ent_node = dict()
-        token_node_idx = 0
-        for i in range(self.max_len):
-            list_token_context_idx.append(ins_idx)
-            list_token_st_end_idx.append((i, i+1))
-            list_token2token.append((i, i))  # lbl: [TOK2TOK_SELF]
-            # list_token_lbl.append(0)
-            token_node_idx += 1
+        # one token node per token of the context (not per position of a padded
+        # context)
+        num_tokens = len(context)
+        list_token_context_idx.extend([ins_idx] * num_tokens)
+        list_token_st_end_idx.extend((i, i+1) for i in range(num_tokens))
+        # list_token_lbl.extend([0] * num_tokens)
         
         # ans_str = hotpot_instance['answer']
         # ans_encoded = self.tokenizer.encode(ans_str, add_special_tokens=False)
@@ -350,10 +505,9 @@ class Dataset():
             # end metada doc
             # add edges to its tokens
             (st, end) = doc_metadata['doc_token_st_end_idx']
-            end = min(end, self.max_len)
-            for tok in range(st, end):
-                list_doc2tok.append((current_doc_node, tok))  # lbl: [DOC2TOK]
-                list_tok2doc.append((tok, current_doc_node))  # lbl: [TOK2DOC]
+            end = min(end, num_tokens)
+            # lbl: [DOC2TOK], [TOK2DOC]
+            doc2tok_edges.add(current_doc_node, st, end)
             doc_idx = dict_idx['list_golden_doc_idx'][idx]
             #get supp sentences
             # doc_title = hotpot_instance['context'][doc_idx][0]
@@ -367,7 +521,11 @@ class Dataset():
                 # hotpotqa contains some empty sentences
                 if sent_st == sent_end:
                     continue
-                sent_end = min(sent_end, self.max_len)
+                sent_end = min(sent_end, num_tokens)
+                # positions of the tokens of the sentence to locate its srl
+                # arguments and entities
+                sent_aligner = SpanAligner(context[sent_st:sent_end],
+                                           offset=sent_st, max_len=num_tokens)
                 # sent node
                 current_sent_node = sent_node_idx
                 sent_node_idx += 1
@@ -379,9 +537,8 @@ class Dataset():
                 # list_sent_lbl.append(sent_lbl)
                 # end metada sent
                 
-                for tok in range(sent_st, sent_end):
-                    list_sent2tok.append((current_sent_node, tok))  # lbl: [SENT2TOK]
-                    list_tok2sent.append((tok, current_sent_node))  # lbl: [TOK2SENT]
+                # lbl: [SENT2TOK], [TOK2SENT]
+                sent2tok_edges.add(current_sent_node, sent_st, sent_end)
                 
                 # if sent_lbl or (yn_ans and sent_idx == 0):
                 #     try:
@@ -409,13 +566,13 @@ class Dataset():
                     
                     if 'V' in triple_dict:
                         verb = triple_dict['V']
-                        rel_encoded = self.tokenizer.encode(verb, add_special_tokens=False)
+                        rel_encoded = self.encoding_memo.encode(verb)
                         # find location of the entity in the context (inputs ids)
                         # +sent_st 'cuz I need the index in the full context
                         # if I search using the full context instead of its sentence I may get a wrong entity (the entity may appear many times, including in the question)
                         try:
-                            st_tok_idx = find_sublist_idx(context[sent_st:sent_end], rel_encoded) + sent_st
-                            end_tok_idx = min(st_tok_idx + len(rel_encoded), self.max_len)
+                            st_tok_idx, end_tok_idx = (
+                                sent_aligner.locate(rel_encoded))
                             srl_rel['st_tok_idx'] = st_tok_idx
                             srl_rel['end_tok_idx'] = end_tok_idx
                         except:
@@ -428,12 +585,13 @@ class Dataset():
                                 # already processed it before the loop
                                 pass
                             elif arg_type == 'TMP':
-                                arg_encoded = self.tokenizer.encode(arg_str, add_special_tokens=False)
+                                arg_encoded = (
+                                    self.encoding_memo.encode(arg_str))
                                 # find location of the entity in the context (inputs ids)
                                 # +sent_st 'cuz I need the index in the full context
                                 # if I search using the full context instead of its sentence I may get a wrong entity (the entity may appear many times, including in the question)
-                                st_tok_idx = find_sublist_idx(context[sent_st:sent_end], arg_encoded) + sent_st
-                                end_tok_idx = min(st_tok_idx + len(arg_encoded), self.max_len)
+                                st_tok_idx, end_tok_idx = (
+                                    sent_aligner.locate(arg_encoded))
                                 # metadata
                                 list_srl_tmp_context_idx.append(ins_idx)
                                 list_srl_tmp_st_end_idx.append((st_tok_idx, end_tok_idx))
@@ -441,12 +599,13 @@ class Dataset():
                                 current_srl_tmp_node = srl_tmp_node_idx
                                 srl_tmp_node_idx += 1
                             elif arg_type == 'LOC':
-                                arg_encoded = self.tokenizer.encode(arg_str, add_special_tokens=False)
+                                arg_encoded = (
+                                    self.encoding_memo.encode(arg_str))
                                 # find location of the entity in the context (inputs ids)
                                 # +sent_st 'cuz I need the index in the full context
                                 # if I search using the full context instead of its sentence I may get a wrong entity (the entity may appear many times, including in the question)
-                                st_tok_idx = find_sublist_idx(context[sent_st:sent_end], arg_encoded) + sent_st
-                                end_tok_idx = min(st_tok_idx + len(arg_encoded), self.max_len)
+                                st_tok_idx, end_tok_idx = (
+                                    sent_aligner.locate(arg_encoded))
                                 # metadata
                                 list_srl_loc_context_idx.append(ins_idx)
                                 list_srl_loc_st_end_idx.append((st_tok_idx, end_tok_idx))
@@ -456,13 +615,14 @@ class Dataset():
                             else:
                                 if 'ARG' in arg_type and subject_srl == -1:
                                     subject_srl = srl_node_idx
-                                arg_encoded = self.tokenizer.encode(arg_str, add_special_tokens=False)
-                                arg_str = self.tokenizer.decode(arg_encoded)
+                                arg_encoded = (
+                                    self.encoding_memo.encode(arg_str))
+                                arg_str = self.encoding_memo.decode(arg_str)
                                 # find location of the entity in the context (inputs ids)
                                 # +sent_st 'cuz I need the index in the full context
                                 # if I search using the full context instead of its sentence I may get a wrong entity (the entity may appear many times, including in the question)
-                                st_tok_idx = find_sublist_idx(context[sent_st:sent_end], arg_encoded) + sent_st
-                                end_tok_idx = min(st_tok_idx + len(arg_encoded), self.max_len)
+                                st_tok_idx, end_tok_idx = (
+                                    sent_aligner.locate(arg_encoded))
                                 # metadata ent
                                 list_srl_context_idx.append(ins_idx)
                                 list_srl_st_end_idx.append((st_tok_idx, end_tok_idx))
@@ -475,25 +635,26 @@ class Dataset():
                                 list_arg_nodes.append(current_srl_node)
 #                                 print("SRL:", current_srl_node, arg_str)
                                 # srl <-> token
-                                for tok in range(st_tok_idx, end_tok_idx):
-                                    list_srl2tok.append((current_srl_node, tok))  # lbl: [SRL2TOK]
-                                    list_tok2srl.append((tok, current_srl_node))  # lbl: [TOK2SRL]
+                                # lbl: [SRL2TOK], [TOK2SRL]
+                                srl2tok_edges.add(current_srl_node, st_tok_idx,
+                                                  end_tok_idx)
                                 #######################################################
                                 # for each entity
                                 list_srl_ent = []
                                 for ent in list_entities[doc_idx][sent_idx]:
                                     try:
                                         # compute this beforehand ################################ here!!!!!!!!!!!!!!!!!!!
-                                        ent_encoded = self.tokenizer.encode(ent, add_special_tokens=False)
-                                        ent = self.tokenizer.decode(ent_encoded)
+                                        ent_encoded = (
+                                            self.encoding_memo.encode(ent))
+                                        ent = self.encoding_memo.decode(ent)
                                         if ent not in arg_str:
                                             continue
                                         list_srl_ent.append(ent)
                                         # find location of the entity in the context (inputs ids)
                                         # +sent_st 'cuz I need the index in the full context
                                         # if I search using the full context instead of its sentence I may get a wrong entity (the entity may appear many times, including in the question)
-                                        st_tok_idx = find_sublist_idx(context[sent_st:sent_end], ent_encoded) + sent_st
-                                        end_tok_idx = min(st_tok_idx + len(ent_encoded), self.max_len)
+                                        st_tok_idx, end_tok_idx = (
+                                            sent_aligner.locate(ent_encoded))
                                         
                                         # lbl = (fuzz.token_set_ratio(ans_detokenized, ent) >= 90)
                                         # if (not srl_lbl) and lbl:
@@ -521,9 +682,10 @@ class Dataset():
                                         list_ent2ent_self.append((current_ent_node, current_ent_node))  # lbl: [ENT2ENT_SELF]
                                         
                                         # srl -> token
-                                        for tok in range(st_tok_idx, end_tok_idx):
-                                            list_ent2tok.append((current_ent_node, tok))  # lbl: [ENT2TOK]
-                                            list_tok2ent.append((tok, current_ent_node))   # lbl: [TOK2ENT]
+                                        # lbl: [ENT2TOK], [TOK2ENT]
+                                        ent2tok_edges.add(
+                                            current_ent_node, st_tok_idx,
+                                            end_tok_idx)
                 #                         print("#### ent ", lbl, self.tokenizer.decode(context[st_tok_idx:end_tok_idx]))
                                     except:
                 #                         print(ent)
@@ -576,6 +738,8 @@ class Dataset():
         #     list_query2ent = [(0, e) for e in range(ent_node_idx)]  # lbl: [QUERY2ENT]
         ############ Query node ################
         (q_st, q_end) = dict_idx['q_token_st_end_idx']
+        q_aligner = SpanAligner(context[q_st:q_end], offset=q_st,
+                                max_len=num_tokens)
         list_query_st_end_idx = [(q_st, q_end)]
         
         first_query_srl = srl_node_idx
@@ -590,13 +754,12 @@ class Dataset():
 
             if 'V' in triple_dict:
                 verb = triple_dict['V']
-                rel_encoded = self.tokenizer.encode(verb, add_special_tokens=False)
+                rel_encoded = self.encoding_memo.encode(verb)
                 # find location of the entity in the context (inputs ids)
                 # +sent_st 'cuz I need the index in the full context
                 # if I search using the full context instead of its sentence I may get a wrong entity (the entity may appear many times, including in the question)
                 try:
-                    st_tok_idx = find_sublist_idx(context[q_st:q_end], rel_encoded) + q_st
-                    end_tok_idx = min(st_tok_idx + len(rel_encoded), self.max_len)
+                    st_tok_idx, end_tok_idx = q_aligner.locate(rel_encoded)
                     srl_rel['st_tok_idx'] = st_tok_idx
                     srl_rel['end_tok_idx'] = end_tok_idx
                 except:
@@ -609,12 +772,11 @@ class Dataset():
                         # already processed it before the loop
                         continue
                     elif arg_type == 'TMP':
-                        arg_encoded = self.tokenizer.encode(arg_str, add_special_tokens=False)
+                        arg_encoded = self.encoding_memo.encode(arg_str)
                         # find location of the entity in the context (inputs ids)
                         # +sent_st 'cuz I need the index in the full context
                         # if I search using the full context instead of its sentence I may get a wrong entity (the entity may appear many times, including in the question)
-                        st_tok_idx = find_sublist_idx(context[q_st:q_end], arg_encoded) + q_st
-                        end_tok_idx = min(st_tok_idx + len(arg_encoded), self.max_len)
+                        st_tok_idx, end_tok_idx = q_aligner.locate(arg_encoded)
                         # metadata
                         list_srl_tmp_context_idx.append(ins_idx)
                         list_srl_tmp_st_end_idx.append((st_tok_idx, end_tok_idx))
@@ -622,12 +784,13 @@ class Dataset():
                         current_srl_tmp_node = srl_tmp_node_idx
                         srl_tmp_node_idx += 1
                     elif arg_type == 'LOC':
-                        arg_encoded = self.tokenizer.encode(arg_str, add_special_tokens=False)
+                        arg_encoded = self.encoding_memo.encode(arg_str)
                         # find location of the entity in the context (inputs ids)
                         # +sent_st 'cuz I need the index in the full context
                         # if I search using the full context instead of its sentence I may get a wrong entity (the entity may appear many times, including in the question)
                         st_tok_idx = find_sublist_idx(context[sent_st:sent_end], arg_encoded) + sent_st
-                        end_tok_idx = min(st_tok_idx + len(arg_encoded), self.max_len)
+                        end_tok_idx = min(st_tok_idx + len(arg_encoded),
+                                          num_tokens)
                         # metadata
                         list_srl_loc_context_idx.append(ins_idx)
                         list_srl_loc_st_end_idx.append((st_tok_idx, end_tok_idx))
@@ -637,13 +800,12 @@ class Dataset():
                     else:
                         if 'ARG' in arg_type and subject_srl == -1:
                             subject_srl = srl_node_idx
-                        arg_encoded = self.tokenizer.encode(arg_str, add_special_tokens=False)
-                        arg_str = self.tokenizer.decode(arg_encoded)
+                        arg_encoded = self.encoding_memo.encode(arg_str)
+                        arg_str = self.encoding_memo.decode(arg_str)
                         # find location of the entity in the context (inputs ids)
                         # +sent_st 'cuz I need the index in the full context
                         # if I search using the full context instead of its sentence I may get a wrong entity (the entity may appear many times, including in the question)
-                        st_tok_idx = find_sublist_idx(context[q_st:q_end], arg_encoded) + q_st
-                        end_tok_idx = min(st_tok_idx + len(arg_encoded), self.max_len)
+                        st_tok_idx, end_tok_idx = q_aligner.locate(arg_encoded)
                         # metadata ent
                         list_srl_context_idx.append(ins_idx)
                         list_srl_st_end_idx.append((st_tok_idx, end_tok_idx))
@@ -656,25 +818,25 @@ class Dataset():
                         list_arg_nodes.append(current_srl_node)
 
                         # srl <-> token
-                        for tok in range(st_tok_idx, end_tok_idx):
-                            list_srl2tok.append((current_srl_node, tok))  # lbl: [SRL2TOK]
-                            list_tok2srl.append((tok, current_srl_node))  # lbl: [TOK2SRL]
+                        # lbl: [SRL2TOK], [TOK2SRL]
+                        srl2tok_edges.add(current_srl_node, st_tok_idx,
+                                          end_tok_idx)
                         #######################################################
                         # for each entity
                         list_srl_ent = []
                         for ent in self.list_entities_query[ins_idx]:
                             try:
                                 # compute this beforehand ################################ here!!!!!!!!!!!!!!!!!!!
-                                ent_encoded = self.tokenizer.encode(ent, add_special_tokens=False)
-                                ent = self.tokenizer.decode(ent_encoded)
+                                ent_encoded = self.encoding_memo.encode(ent)
+                                ent = self.encoding_memo.decode(ent)
                                 if ent not in arg_str:
                                     continue
                                 list_srl_ent.append(ent)
                                 # find location of the entity in the context (inputs ids)
                                 # +sent_st 'cuz I need the index in the full context
                                 # if I search using the full context instead of its sentence I may get a wrong entity (the entity may appear many times, including in the question)
-                                st_tok_idx = find_sublist_idx(context[q_st:q_end], ent_encoded) + q_st
-                                end_tok_idx = min(st_tok_idx + len(ent_encoded), self.max_len)
+                                st_tok_idx, end_tok_idx = (
+                                    q_aligner.locate(ent_encoded))
 
                                 # lbl = (fuzz.token_set_ratio(ans_detokenized, ent) >= 90)
                                 # if (not srl_lbl) and lbl:
@@ -700,9 +862,9 @@ class Dataset():
                                 list_ent2ent_self.append((current_ent_node, current_ent_node))  # lbl: [ENT2ENT_SELF]
                                 
                                 # srl -> token
-                                for tok in range(st_tok_idx, end_tok_idx):
-                                    list_ent2tok.append((current_ent_node, tok))  # lbl: [ENT2TOK]
-                                    list_tok2ent.append((tok, current_ent_node))   # lbl: [TOK2ENT]
+                                # lbl: [ENT2TOK], [TOK2ENT]
+                                ent2tok_edges.add(current_ent_node, st_tok_idx,
+                                                  end_tok_idx)
         #                         print("#### ent ", lbl, self.tokenizer.decode(context[st_tok_idx:end_tok_idx]))
                             except:
         #                         print(ent)
@@ -740,19 +902,14 @@ class Dataset():
         # metadata sent
         ############ END Query node ################
         list_ent_nodes = list(range(ent_node_idx))
-        (list_ent_multihop, 
-         list_srl_multihop,
-         list_sent_multihop,
+        (list_ent_multihop, list_srl_multihop, list_sent_multihop,
          list_sent2query_multihop,
-         list_query2sent_multihop) = self.multi_hop_edges(list_ent_nodes, 
-                                                          list_ent_node2str, 
-                                                          list_ent2srl,                
-                                                          list_srl2sent,
-                                                          list_srl2query,
-                                                          90)
+         list_query2sent_multihop) = self.multi_hop_edges(
+             list_ent_nodes, list_ent_node2str, list_ent2srl, list_srl2sent,
+             list_srl2query, self.multihop_threshold)
        
         # make the heterogenous graph
-        list_srl2self = [(v, v) for v in range(srl_node_idx)]
+        list_srl2self = self_loop_arrays(srl_node_idx)
         # create ent rel using SRL predicates
         list_ent2ent_rel, list_ent2ent_metadata = self.compute_ent_relations(list_srl2srl, 
                                                                              list_srl2ent, 
@@ -762,14 +919,17 @@ class Dataset():
                      #('sent', 'sent2doc', 'doc'): list_sent2doc,  # lbl: [SENT2DOC]
                      ('srl', 'srl2sent', 'sent'): list_srl2sent,  # lbl: [SRL2SENT]
                      # to token
-                     ('srl', 'srl2tok', 'tok'): list_srl2tok,     # lbl: [SRL2TOK]
+                     # lbl: [SRL2TOK]
+                     ('srl', 'srl2tok', 'tok'): srl2tok_edges,
                      # end hierarchical
                      # same-level edges
                      #('doc', 'doc2doc_self', 'doc'): list_doc2doc,         # lbl: [DOC2DOC_SELF]
                      ('sent', 'sent2sent', 'sent'): list_sent2sent,   # lbl: [SENT2SENT]
                      ('srl', 'srl2srl', 'srl'): list_srl2srl,         # lbl: [SRL2SRL]
                      ('srl', 'srl2self', 'srl'): list_srl2self,         # lbl: [SRL2SELF]
-                     ('tok', 'token2token_self', 'tok'): list_token2token, # lbl: [TOK2TOK_SELF]
+                     # lbl: [TOK2TOK_SELF]
+                     ('tok', 'token2token_self', 'tok'):
+                         self_loop_arrays(num_tokens),
                      # multi-hop edges
                      ('srl', 'srl_multihop', 'srl'): list_srl_multihop,
                      ('sent', 'sent_multihop', 'sent'): list_sent_multihop,
@@ -778,8 +938,9 @@ class Dataset():
         
         if list_ent2srl != []:
             dict_edges[('ent', 'ent2srl', 'srl')] = list_ent2srl     # lbl: [ENT2SRL]
-        if list_ent2tok != []:
-            dict_edges[('ent', 'ent2tok', 'tok')] = list_ent2tok     # lbl: [ENT2TOK]
+        if len(ent2tok_edges) > 0:
+            # lbl: [ENT2TOK]
+            dict_edges[('ent', 'ent2tok', 'tok')] = ent2tok_edges
         if list_ent2ent_self != []:
             dict_edges[('ent', 'ent2ent_self', 'ent')] = list_ent2ent_self # lbl: [ENT2ENT_SELF]
         if list_ent2ent_rel != []:
@@ -788,10 +949,14 @@ class Dataset():
             dict_edges[('ent', 'ent_multihop', 'ent')] = list_ent_multihop # lbl: [ENT2ENT_MH]
         if list_srl_loc2srl != []:
             dict_edges[('srl_loc', 'srl_loc2srl', 'srl')] = list_srl_loc2srl  # lbl: [SRL_LOC2SRL]
-            dict_edges[('srl_loc', 'srl_loc2self', 'srl_loc')] =  [(u,u) for u in range(srl_loc_node_idx)] # lbl: [SRL_LOC2SELF]
+            # lbl: [SRL_LOC2SELF]
+            dict_edges[('srl_loc', 'srl_loc2self', 'srl_loc')] = (
+                self_loop_arrays(srl_loc_node_idx))
         if list_srl_tmp2srl != []:
             dict_edges[('srl_tmp', 'srl_tmp2srl', 'srl')] = list_srl_tmp2srl  # lbl: [SRL_TMP2SRL]
-            dict_edges[('srl_tmp', 'srl_tmp2self', 'srl_tmp')] =  [(u,u) for u in range(srl_tmp_node_idx)] # lbl: [SRL_TMP2SELF]
+            # lbl: [SRL_TMP2SELF]
+            dict_edges[('srl_tmp', 'srl_tmp2self', 'srl_tmp')] = (
+                self_loop_arrays(srl_tmp_node_idx))
         
         if list_query2sent_multihop != []:
             dict_edges[('query', 'query2sent_multihop', 'sent')] = list_query2sent_multihop
@@ -799,7 +964,7 @@ class Dataset():
             dict_edges[('srl', 'srl2query', 'query')] = list_srl2query
         if list_query2sent_pred != []:
             dict_edges['query', 'query2sent_pred', 'sent'] = list_query2sent_pred
-        graph = dgl.heterograph(dict_edges)
+        graph = build_heterograph(dict_edges)
         # sent metadata
         graph.nodes['sent'].data['st_end_idx'] =  torch.tensor(list_sent_st_end_idx)
 #         graph.nodes['sent']['list_context_idx'] = torch.tensor(list_sent_context_idx).reshape(-1,1)
@@ -925,27 +1090,8 @@ class Dataset():
         return set_supporting_doc_titles
     
     def create_common_entity_edges_sent_lvl(self, dict_sent_node2metadata: dict, list_hotpot_instance_ner: list) -> list:
-        '''
-        Input: dict {node_idx: {'doc_idx': doc_idx, 'sent_idx': sent_idx}}
-        Output: [(node_i, node_j)]
-        Check all sentences in a hotpot instance with common named entities
-        Cost: O(n^2)
-        '''
-        list_ent_edges = []
-        for (node_i, dict_sent_i) in dict_sent_node2metadata.items():
-            for (node_j, dict_sent_j) in dict_sent_node2metadata.items():
-                if node_i != node_j:
-                    doc_i = dict_sent_i['doc_idx']
-                    sent_i = dict_sent_i['sent_idx']
-                    doc_j = dict_sent_j['doc_idx']
-                    sent_j = dict_sent_j['sent_idx']
-                    try:
-                        if self.intersection(list_hotpot_instance_ner[doc_i][sent_i], 
-                                             list_hotpot_instance_ner[doc_j][sent_j]):
-                            list_ent_edges.append((node_i, node_j))
-                    except:
-                        pass
-        return list_ent_edges
+        return common_entity_edges_sent_lvl(dict_sent_node2metadata,
+                                            list_hotpot_instance_ner)
     
     def create_common_entity_edges_srl_lvl(self, dict_srl_node2list_ent: dict):
         list_edges = []
@@ -966,9 +1112,6 @@ class Dataset():
             list_edges.extend([(u, v) for u in list_srl for v in list_srl if u != v])
         return list_edges
 
-    def intersection(self, l1: list, l2: list) -> set:
-        return set(l1).intersection(l2)
-    
     def multi_hop_edges(self, list_ent_nodes, list_ent_str, list_ent2srl, list_srl2sent, list_srl2query, threshold):
 #         print("######################## num ent", max(list_ent_nodes))
 #         print("ent2srl", list_ent2srl)
@@ -989,43 +1132,43 @@ class Dataset():
         list_sent_multihop = []
         list_sent2query_multihop = []
         list_query2sent_multihop = []
-        for e1 in list_ent_nodes:
-            for e2 in list_ent_nodes:
-                if e1 < e2:
-                    e1_str = list_ent_str[e1]
-                    e2_str = list_ent_str[e2]
-                    if fuzz.token_set_ratio(e1_str, e2_str) >= threshold:
+        # only the pairs that can reach the threshold are scored (same pairs
+        # and order as comparing all of them)
+        list_pairs = self.fuzzy_matcher.matching_pairs(list_ent_nodes,
+                                                       list_ent_str, threshold)
+        for (e1, e2) in list_pairs:
 #                         print(e1_str, e2_str, fuzz.token_set_ratio(e1_str, e2_str))
-                        # ent
-                        list_ent_multihop.append((e1, e2))  # LBL: [ENT2ENT_MULTIHOP]
-                        list_ent_multihop.append((e2, e1))  # LBL: [ENT2ENT_MULTIHOP]
-                        # srl
-                        srl1 = dict_ent2srl[e1]
-                        srl2 = dict_ent2srl[e2]
-                        list_srl_multihop.append((srl1, srl2))  # LBL: [SRL2SRL_MULTIHOP]
-                        list_srl_multihop.append((srl2, srl1))  # LBL: [SRL2SRL_MULTIHOP]
-                        # sent
-                        sent1 = None
-                        sent2 = None
-                        q_node = None
-                        if srl1 in dict_srl2sent:
-                            sent1 = dict_srl2sent[srl1]
-                        elif srl1 in dict_srl2query:
-                            q_node = dict_srl2query[srl]
-                        if srl2 in dict_srl2sent:
-                            sent2 = dict_srl2sent[srl2]
-                        elif srl2 in dict_srl2query:
-                            q_node = dict_srl2query[srl]
-                        if sent1 is not None and sent2 is not None:
-                            list_sent_multihop.append((sent1, sent2))  # LBL: [SENT2SENT_MULTIHOP]
-                            list_sent_multihop.append((sent2, sent1))  # LBL: [SENT2SENT_MULTIHOP]
+            # ent
+            list_ent_multihop.append((e1, e2))  # LBL: [ENT2ENT_MULTIHOP]
+            list_ent_multihop.append((e2, e1))  # LBL: [ENT2ENT_MULTIHOP]
+            # srl
+            srl1 = dict_ent2srl[e1]
+            srl2 = dict_ent2srl[e2]
+            list_srl_multihop.append((srl1, srl2))  # LBL: [SRL2SRL_MULTIHOP]
+            list_srl_multihop.append((srl2, srl1))  # LBL: [SRL2SRL_MULTIHOP]
+            # sent
+            sent1 = None
+            sent2 = None
+            q_node = None
+            if srl1 in dict_srl2sent:
+                sent1 = dict_srl2sent[srl1]
+            elif srl1 in dict_srl2query:
+                q_node = dict_srl2query[srl]
+            if srl2 in dict_srl2sent:
+                sent2 = dict_srl2sent[srl2]
+            elif srl2 in dict_srl2query:
+                q_node = dict_srl2query[srl]
+            if sent1 is not None and sent2 is not None:
+                # LBL: [SENT2SENT_MULTIHOP]
+                list_sent_multihop.append((sent1, sent2))
+                list_sent_multihop.append((sent2, sent1))
 #                             print(sent1, sent2, srl1, srl2, e1, e2, e1_str, e2_str, fuzz.token_set_ratio(e1_str, e2_str))
-                        elif sent1 is None and (sent2 is not None and q_node is not None):
-                            list_sent2query_multihop.append((sent2, query))
-                            list_query2sent_multihop.append((query, sent2))
-                        elif sent2 is None and (sent1 is not None and q_node is not None):
-                            list_sent2query_multihop.append((sent1, query))
-                            list_query2sent_multihop.append((query, sent1))
+            elif sent1 is None and (sent2 is not None and q_node is not None):
+                list_sent2query_multihop.append((sent2, query))
+                list_query2sent_multihop.append((query, sent2))
+            elif sent2 is None and (sent1 is not None and q_node is not None):
+                list_sent2query_multihop.append((sent1, query))
+                list_query2sent_multihop.append((query, sent1))
         
         list_ent_multihop = list(set(list_ent_multihop))
 #         for (e1, e2) in list_ent_multihop:
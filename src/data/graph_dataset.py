@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# coding: utf-8
+'''
+torch Dataset over a processed split (GraphStore + input tensors + answer
+spans). Graphs are materialized on demand, so a DataLoader with workers can
+prefetch (and pin) the next batches while the model runs on the current one.
+'''
+import os
+import pickle
+import torch
+from torch.utils.data import Dataset
+from .graph_store import GraphStore
+
+TENSOR_KEYS = ['input_ids', 'attention_mask', 'token_type_ids',
+               'start_positions', 'end_positions']
+
+
+class GraphDataset(Dataset):
+    def __init__(self, split_path, store_name='graph_store'):
+        '''
+        Inputs:
+            - split_path: directory of the processed split (graph_store/,
+                tensor_*.p, list_span_idx.p)
+            - store_name: name of the GraphStore directory inside split_path
+        '''
+        self.graphs = GraphStore(os.path.join(split_path, store_name))
+        with open(os.path.join(split_path, 'list_span_idx.p'), 'rb') as f:
+            self.list_span_idx = pickle.load(f)
+        # the input tensors stay on cpu. Only the tensors of the current batch
+        # are moved to the gpu
+        self.tensor_input_ids = torch.load(
+            os.path.join(split_path, 'tensor_input_ids.p'))
+        self.tensor_attention_masks = torch.load(
+            os.path.join(split_path, 'tensor_attention_masks.p'))
+        self.tensor_token_type_ids = torch.load(
+            os.path.join(split_path, 'tensor_token_type_ids.p'))
+
+    def __len__(self):
+        return len(self.graphs)
+
+    def __getitem__(self, idx):
+        return {'idx': idx,
+                'graph': self.graphs[idx],
+                'input_ids': self.tensor_input_ids[idx],
+                'attention_mask': self.tensor_attention_masks[idx],
+                'token_type_ids': self.tensor_token_type_ids[idx],
+                'start_positions': torch.tensor(self.list_span_idx[idx][0]),
+                'end_positions': torch.tensor(self.list_span_idx[idx][1])}
+
+
+class GraphDatasetCollator():
+    '''
+    collate_fn of a DataLoader over a GraphDataset.
+    Returns a dict with the batched graph, the stacked tensors (TENSOR_KEYS)
+    and the list of instance indexes. Tensors are in a dict so that the
+    DataLoader can pin them (pin_memory=True); the graph is left as is.
+    '''
+    def __init__(self, batch_graphs_fn):
+        '''
+        Inputs:
+            - batch_graphs_fn: function list of graphs -> batched graph
+        '''
+        self.batch_graphs_fn = batch_graphs_fn
+
+    def __call__(self, list_instances):
+        batch = {k: torch.stack([instance[k] for instance in list_instances])
+                 for k in TENSOR_KEYS}
+        batch['graph'] = self.batch_graphs_fn(
+            [instance['graph'] for instance in list_instances])
+        batch['list_idx'] = [instance['idx'] for instance in list_instances]
+        return batch
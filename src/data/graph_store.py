@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+# coding: utf-8
+'''
+Columnar on-disk store of DGL heterographs.
+
+Each shard keeps, for every column (edge index arrays, node data and edge data
+of each type), the arrays of all its graphs concatenated into a single .npy
+file plus an offsets file, so a graph is materialized by slicing memory-mapped
+arrays. Each graph can also have an info record (e.g., the fingerprint of the
+inputs it was built from, see graph_creation.Dataset.instance_fingerprint),
+kept in the index.
+
+Convert the per-graph pickles of a split (graphs/graph{i}.bin +
+metadata/metadata{i}.bin):
+
+    python -m src.data.graph_store data/processed/training/hsgn_2021_fix/ \
+        data/processed/training/hsgn_2021_fix/graph_store
+'''
+import os
+import re
+import json
+import shutil
+import pickle
+import argparse
+import numpy as np
+import torch
+import dgl
+from tqdm import tqdm
+
+INDEX_FILE = 'index.json'
+
+
+def graph_to_arrays(graph) -> dict:
+    '''
+    Returns a dict: column name -> numpy array with the edges, node data and
+    edge data of the graph.
+    Column names:
+        - edges/{etype}/src, edges/{etype}/dst
+        - num_nodes/{ntype}
+        - ndata/{ntype}/{key}
+        - edata/{etype}/{key}
+    '''
+    dict_arrays = dict()
+    for ntype in graph.ntypes:
+        dict_arrays['num_nodes/' + ntype] = np.array(
+            [graph.number_of_nodes(ntype)])
+        for k, v in graph.nodes[ntype].data.items():
+            dict_arrays['ndata/{}/{}'.format(ntype, k)] = v.numpy()
+    for (src_type, etype, dst_type) in graph.canonical_etypes:
+        src, dst = graph.edges(etype=etype)
+        dict_arrays['edges/{}/src'.format(etype)] = src.numpy()
+        dict_arrays['edges/{}/dst'.format(etype)] = dst.numpy()
+        for k, v in graph.edges[etype].data.items():
+            dict_arrays['edata/{}/{}'.format(etype, k)] = v.numpy()
+    return dict_arrays
+
+
+def graph_from_arrays(dict_arrays: dict, canonical_etypes: list):
+    '''
+    Inverse of graph_to_arrays
+    Inputs:
+        - dict_arrays: output of graph_to_arrays (only with the columns of the
+            graph)
+        - canonical_etypes: list of (src type, etype, dst type) of the graph
+    '''
+    dict_edges = {
+        (src_type, etype, dst_type): (
+            torch.from_numpy(dict_arrays['edges/{}/src'.format(etype)]),
+            torch.from_numpy(dict_arrays['edges/{}/dst'.format(etype)]))
+        for (src_type, etype, dst_type) in canonical_etypes}
+    num_nodes_dict = {
+        name.split('/')[1]: int(v[0]) for name, v in dict_arrays.items()
+        if name.startswith('num_nodes/')}
+    graph = dgl.heterograph(dict_edges, num_nodes_dict)
+    for name, v in dict_arrays.items():
+        parts = name.split('/')
+        if parts[0] == 'ndata':
+            graph.nodes[parts[1]].data[parts[2]] = torch.from_numpy(v)
+        elif parts[0] == 'edata':
+            graph.edges[parts[1]].data[parts[2]] = torch.from_numpy(v)
+    return graph
+
+
+def column_file_name(column: str) -> str:
+    return column.replace('/', '__')
+
+
+class GraphStoreWriter():
+    '''
+    Writes graphs to a GraphStore directory. int64 columns are stored as int32.
+    '''
+    def __init__(self, path, shard_size=10000):
+        self.path = path
+        self.shard_size = shard_size
+        os.makedirs(path, exist_ok=True)
+        self.canonical_etypes = []  # schema: all the canonical etypes seen
+        self.dict_column2dtype = dict()  # dtype in memory
+        self.list_shards = []
+        self.list_info = []
+        self.num_graphs = 0
+        self.__reset_shard()
+
+    def __reset_shard(self):
+        self.shard_arrays = []
+        self.shard_etypes = []
+
+    def add(self, graph, info=None):
+        '''
+        Inputs:
+            - graph: dgl heterograph
+            - info: json-serializable record of the graph (optional)
+        '''
+        dict_arrays = graph_to_arrays(graph)
+        for c_etype in graph.canonical_etypes:
+            if c_etype not in self.canonical_etypes:
+                self.canonical_etypes.append(c_etype)
+        for column, v in dict_arrays.items():
+            self.dict_column2dtype.setdefault(column, str(v.dtype))
+        self.shard_arrays.append(dict_arrays)
+        self.shard_etypes.append(graph.canonical_etypes)
+        self.list_info.append(info)
+        self.num_graphs += 1
+        if len(self.shard_arrays) == self.shard_size:
+            self.__flush()
+
+    def __flush(self):
+        if len(self.shard_arrays) == 0:
+            return
+        shard_name = 'shard_{}'.format(len(self.list_shards))
+        shard_path = os.path.join(self.path, shard_name)
+        os.makedirs(shard_path, exist_ok=True)
+        list_columns = sorted(
+            set(column for dict_arrays in self.shard_arrays
+                for column in dict_arrays.keys()))
+        for column in list_columns:
+            list_v = [dict_arrays.get(column)
+                      for dict_arrays in self.shard_arrays]
+            # graphs without the column (e.g., without entities) have an empty
+            # slice
+            lengths = [0 if v is None else v.shape[0] for v in list_v]
+            offsets = np.zeros(len(list_v) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum(lengths)
+            values = np.concatenate([v for v in list_v if v is not None],
+                                    axis=0)
+            if values.dtype == np.int64:
+                values = values.astype(np.int32)
+            file_name = os.path.join(shard_path, column_file_name(column))
+            np.save(file_name + '.npy', values)
+            np.save(file_name + '.offsets.npy', offsets)
+        # canonical etypes of each graph
+        etype_presence = np.array(
+            [[c_etype in graph_etypes for c_etype in self.canonical_etypes]
+             for graph_etypes in self.shard_etypes], dtype=np.bool_)
+        np.save(os.path.join(shard_path, 'etype_presence.npy'), etype_presence)
+        self.list_shards.append({'name': shard_name,
+                                 'num_graphs': len(self.shard_arrays),
+                                 'columns': list_columns})
+        self.__reset_shard()
+
+    def close(self):
+        self.__flush()
+        index = {'num_graphs': self.num_graphs,
+                 'shard_size': self.shard_size,
+                 'canonical_etypes': self.canonical_etypes,
+                 'dtypes': self.dict_column2dtype,
+                 'shards': self.list_shards,
+                 'info': self.list_info}
+        with open(os.path.join(self.path, INDEX_FILE), 'w') as f:
+            json.dump(index, f)
+
+
+class GraphStore():
+    '''
+    Read-only, indexable list of graphs of a GraphStore directory. Arrays are
+    memory-mapped and a graph is only materialized when it is accessed.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE), 'r') as f:
+            self.index = json.load(f)
+        self.canonical_etypes = [tuple(c_etype)
+                                 for c_etype in self.index['canonical_etypes']]
+        self.shard_size = self.index['shard_size']
+        self.dict_shard_idx2arrays = dict()
+
+    def __len__(self):
+        return self.index['num_graphs']
+
+    def __shard_arrays(self, shard_idx):
+        if shard_idx not in self.dict_shard_idx2arrays:
+            shard = self.index['shards'][shard_idx]
+            shard_path = os.path.join(self.path, shard['name'])
+            presence_file = os.path.join(shard_path, 'etype_presence.npy')
+            # (num graphs, num canonical etypes), kept apart from the columns
+            etype_presence = np.load(presence_file)
+            dict_arrays = dict()
+            for column in shard['columns']:
+                file_name = os.path.join(shard_path, column_file_name(column))
+                dict_arrays[column] = (np.load(file_name + '.npy',
+                                               mmap_mode='r'),
+                                       np.load(file_name + '.offsets.npy'))
+            self.dict_shard_idx2arrays[shard_idx] = (etype_presence,
+                                                     dict_arrays)
+        return self.dict_shard_idx2arrays[shard_idx]
+
+    def get_arrays(self, idx) -> (dict, list):
+        '''
+        Returns the arrays (output of graph_to_arrays) and the canonical etypes
+        of the graph idx
+        '''
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("graph index out of range")
+        shard_idx, local_idx = divmod(idx, self.shard_size)
+        etype_presence, shard_arrays = self.__shard_arrays(shard_idx)
+        canonical_etypes = [c_etype for c_etype, present
+                            in zip(self.canonical_etypes,
+                                   etype_presence[local_idx])
+                            if present]
+        set_ntypes = set(ntype for (src_type, _, dst_type) in canonical_etypes
+                         for ntype in (src_type, dst_type))
+        set_etypes = set(etype for (_, etype, _) in canonical_etypes)
+        dict_arrays = dict()
+        for column, (values, offsets) in shard_arrays.items():
+            parts = column.split('/')
+            if (parts[0] in ('num_nodes', 'ndata')
+                    and parts[1] not in set_ntypes):
+                continue
+            if parts[0] in ('edges', 'edata') and parts[1] not in set_etypes:
+                continue
+            st, end = offsets[local_idx], offsets[local_idx + 1]
+            if parts[0] in ('ndata', 'edata') and st == end:
+                # the graph does not have this feature
+                continue
+            dict_arrays[column] = np.array(values[st:end],
+                                           dtype=self.index['dtypes'][column])
+        return dict_arrays, canonical_etypes
+
+    def __getitem__(self, idx):
+        dict_arrays, canonical_etypes = self.get_arrays(idx)
+        return graph_from_arrays(dict_arrays, canonical_etypes)
+
+    def info(self, idx):
+        '''
+        Returns the info record of the graph idx (None for stores written
+        without them)
+        '''
+        list_info = self.index.get('info')
+        if list_info is None:
+            return None
+        return list_info[idx]
+
+
+def write_graphs(path, list_graphs, list_info=None, shard_size=10000):
+    '''
+    Writes the graphs to a new GraphStore in path, replacing the existing one
+    (if any) only once the new one is complete. An existing store can be read
+    while its replacement is written.
+    '''
+    path = path.rstrip('/')
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    writer = GraphStoreWriter(tmp_path, shard_size=shard_size)
+    for i, graph in enumerate(tqdm(list_graphs)):
+        writer.add(graph, None if list_info is None else list_info[i])
+    writer.close()
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    return writer.num_graphs
+
+
+def natural_sort(l):
+    convert = lambda text: int(text) if text.isdigit() else text.lower()
+    alphanum_key = lambda key: [convert(c) for c in re.split('([0-9]+)', key)]
+    return sorted(l, key=alphanum_key)
+
+
+def convert_pickles(split_path, store_path, shard_size=10000):
+    '''
+    Converts the graphs/graph{i}.bin and metadata/metadata{i}.bin pickles of a
+    split into a GraphStore
+    '''
+    from .preprocess_dataset import add_metadata2graph
+    graphs_path = os.path.join(split_path, 'graphs')
+    metadata_path = os.path.join(split_path, 'metadata')
+    list_graph_files = natural_sort(
+        [f for f in os.listdir(graphs_path) if ".bin" in f])
+    list_metadata_files = natural_sort(
+        [f for f in os.listdir(metadata_path) if ".bin" in f])
+    writer = GraphStoreWriter(store_path, shard_size=shard_size)
+    for (g_file, metadata_file) in tqdm(
+            list(zip(list_graph_files, list_metadata_files))):
+        with open(os.path.join(graphs_path, g_file), "rb") as f:
+            graph = pickle.load(f)
+        with open(os.path.join(metadata_path, metadata_file), "rb") as f:
+            metadata = pickle.load(f)
+        writer.add(add_metadata2graph(graph, metadata))
+    writer.close()
+    return writer.num_graphs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('split_path', type=str,
+                        help="directory with the graphs/ and metadata/ "
+                             "pickles")
+    parser.add_argument('store_path', type=str)
+    parser.add_argument('--shard_size', type=int, default=10000)
+    args = parser.parse_args()
+    num_graphs = convert_pickles(args.split_path, args.store_path,
+                                 args.shard_size)
+    print("Converted {} graphs".format(num_graphs))
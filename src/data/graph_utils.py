@@ -0,0 +1,444 @@
+#!/usr/bin/env python
+# coding: utf-8
+'''
+Helpers shared by the graph construction modules (graph_creation,
+bottom_up_query_edges, query_srl_ent_heterog)
+'''
+import json
+import hashlib
+from collections import defaultdict
+import numpy as np
+import torch
+import dgl
+from fuzzywuzzy import fuzz
+from fuzzywuzzy import utils as fuzz_utils
+
+
+class SpanAligner():
+    '''
+    Span-alignment index of a sequence of token ids (e.g., the input ids of a
+    sentence). The positions of each token id are indexed in a single pass, so
+    locating a span (srl argument, predicate, entity) only checks the
+    occurrences of its first token instead of scanning the whole sequence. The
+    position of each span is memoized (e.g., an entity is searched for each
+    argument that contains it).
+    '''
+    def __init__(self, tokens: list, fallback_first_occurrence=True, offset=0,
+                 max_len=None):
+        '''
+        Inputs:
+            - tokens: list of token ids
+            - fallback_first_occurrence: if the full span is not in tokens,
+                return the first occurrence of its first token instead of
+                raising an exception. It can lead to wrong results but in 99%
+                of the cases should be fine: it happens when the SRL model
+                skipped some token, i.e., B-arg0, I-arg0, O, I-arg0,...
+            - offset: position of tokens in the full context (e.g., the first
+                token of the sentence), see locate
+            - max_len: end positions returned by locate are clamped to max_len
+        '''
+        self.tokens = tokens
+        self.fallback_first_occurrence = fallback_first_occurrence
+        self.offset = offset
+        self.max_len = max_len
+        self.dict_tok2positions = defaultdict(list)
+        for i, tok in enumerate(tokens):
+            self.dict_tok2positions[tok].append(i)
+        self.dict_span2idx = dict()
+
+    def find(self, span: list) -> int:
+        '''
+        Returns the first index of span in tokens (same as
+        find_sublist_idx(tokens, span))
+        '''
+        key = tuple(span)
+        if key not in self.dict_span2idx:
+            self.dict_span2idx[key] = self.__find(span)
+        idx = self.dict_span2idx[key]
+        if idx is None:
+            raise Exception("Sublist not in list")
+        return idx
+
+    def locate(self, span: list) -> (int, int):
+        '''
+        Returns the (st, end) positions of span in the full context (offset +
+        find(span), end clamped to max_len)
+        '''
+        st = self.find(span) + self.offset
+        end = st + len(span)
+        if self.max_len is not None:
+            end = min(end, self.max_len)
+        return st, end
+
+    def __find(self, span: list):
+        occ = self.dict_tok2positions.get(span[0])
+        if not occ:
+            return None
+        len_span = len(span)
+        for b in occ:
+            # check if the full span is in the list
+            if self.tokens[b:b+len_span] == span:
+                return b
+        if self.fallback_first_occurrence:
+            return occ[0]
+        return None
+
+
+def find_sublist_idx(x: list, y: list, fallback_first_occurrence=True) -> int:
+    '''
+    Return the first index of the sublist in the list
+    Input:
+        - x: list
+        - y: sublist
+        - fallback_first_occurrence: see SpanAligner
+    Returns:
+        - index of the occurence of the sublist in the list
+    Use a SpanAligner to locate several sublists in the same list.
+    '''
+    return SpanAligner(x, fallback_first_occurrence).find(y)
+
+
+def collect_strings(obj) -> list:
+    '''
+    Returns the strings (values, not dict keys) of a nested structure of dicts
+    and lists (e.g., dict_ins_doc_sent_srl_triples or list_hotpot_ner)
+    '''
+    list_str = []
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, str):
+            list_str.append(obj)
+        elif isinstance(obj, dict):
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+    return list_str
+
+
+def fingerprint(obj) -> str:
+    '''
+    sha1 of a json-serializable object (dict keys are sorted, so it does not
+    depend on their order)
+    '''
+    dumped = json.dumps(obj, sort_keys=True, default=str)
+    return hashlib.sha1(dumped.encode('utf-8')).hexdigest()
+
+
+class EncodingMemo():
+    '''
+    Memo table of the wordpiece encoding (without special tokens) of srl
+    arguments and entities, and of the decoding of these encodings. Strings are
+    encoded in bulk with add(). Strings that were not added beforehand are
+    encoded on demand.
+    '''
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.dict_str2input_ids = dict()
+        self.dict_str2decoded = dict()
+
+    def add(self, list_str: list):
+        '''
+        Encodes the strings of list_str that are not in the memo with a single
+        batch_encode_plus call
+        '''
+        list_new_str = [s for s in dict.fromkeys(list_str)
+                        if s not in self.dict_str2input_ids]
+        if len(list_new_str) == 0:
+            return
+        encoding = self.tokenizer.batch_encode_plus(
+            list_new_str, add_special_tokens=False,
+            return_token_type_ids=False, return_attention_mask=False)
+        self.dict_str2input_ids.update(zip(list_new_str,
+                                           encoding['input_ids']))
+
+    def encode(self, s: str) -> list:
+        '''
+        Same as tokenizer.encode(s, add_special_tokens=False). The returned
+        list must not be modified
+        '''
+        if s not in self.dict_str2input_ids:
+            self.dict_str2input_ids[s] = self.tokenizer.encode(
+                s, add_special_tokens=False)
+        return self.dict_str2input_ids[s]
+
+    def decode(self, s: str) -> str:
+        '''
+        Same as tokenizer.decode(tokenizer.encode(s, add_special_tokens=False))
+        '''
+        if s not in self.dict_str2decoded:
+            self.dict_str2decoded[s] = self.tokenizer.decode(self.encode(s))
+        return self.dict_str2decoded[s]
+
+
+class FuzzyMatcher():
+    '''
+    Finds the pairs of strings with fuzz.token_set_ratio >= threshold without
+    scoring all the pairs. token_set_ratio(s1, s2) is the max of
+    ratio(intersection, s1 tokens), ratio(intersection, s2 tokens) and
+    ratio(s1 tokens, s2 tokens), where the tokens are the sorted set of tokens
+    of the processed string.
+    Candidate pairs:
+        - pairs sharing a token (inverted index over the tokens)
+        - pairs without common tokens whose score, ratio(s1 tokens, s2 tokens),
+            can reach the threshold: ratio <= 2 * (common characters) / (total
+            length), computed with character histograms
+    Only the candidates are scored, so the output is the same as scoring all
+    the pairs. Scores are memoized across calls.
+    '''
+    def __init__(self):
+        self.dict_pair2score = dict()
+
+    def token_set_ratio(self, s1: str, s2: str) -> int:
+        if (s1, s2) not in self.dict_pair2score:
+            self.dict_pair2score[(s1, s2)] = fuzz.token_set_ratio(s1, s2)
+        return self.dict_pair2score[(s1, s2)]
+
+    def matching_pairs(self, list_nodes: list, list_str: list,
+                       threshold) -> list:
+        '''
+        Inputs:
+            - list_nodes: list of node idx
+            - list_str: string of each node (indexed by node idx)
+            - threshold: min token_set_ratio
+        Returns:
+            - list of pairs (u, v) of list_nodes, u < v, with
+                token_set_ratio(list_str[u], list_str[v]) >= threshold, in the
+                same order as a nested loop over list_nodes
+        '''
+        list_candidates = self.__candidates([list_str[u] for u in list_nodes],
+                                            threshold)
+        list_pairs = []
+        for (i, j) in list_candidates:
+            u, v = list_nodes[i], list_nodes[j]
+            if u == v:
+                # repeated node: the nested loop only visits u < v
+                continue
+            if u > v:
+                # visited by the nested loop as (v, u) with v at position j
+                i, j, u, v = j, i, v, u
+            list_pairs.append((i, j, u, v))
+        list_pairs.sort()
+        return [(u, v) for (i, j, u, v) in list_pairs
+                if self.token_set_ratio(list_str[u], list_str[v]) >= threshold]
+
+    def __candidates(self, list_str: list, threshold) -> list:
+        '''
+        Returns the pairs of positions (i, j), i < j, that can reach the
+        threshold
+        '''
+        n = len(list_str)
+        if threshold <= 0:
+            return [(i, j) for i in range(n) for j in range(i+1, n)]
+        list_tokens = []
+        for s in list_str:
+            processed = fuzz_utils.full_process(s, force_ascii=True)
+            # invalid (empty) strings have a score of 0
+            list_tokens.append(sorted(set(processed.split()))
+                               if fuzz_utils.validate_string(processed)
+                               else None)
+        set_candidates = set()
+        # pairs sharing a token
+        dict_token2positions = defaultdict(list)
+        for i, tokens in enumerate(list_tokens):
+            if tokens is None:
+                continue
+            for tok in tokens:
+                dict_token2positions[tok].append(i)
+        for positions in dict_token2positions.values():
+            for a in range(len(positions)):
+                for b in range(a+1, len(positions)):
+                    set_candidates.add((positions[a], positions[b]))
+        # pairs without common tokens: upper bound of
+        # ratio(s1 tokens, s2 tokens)
+        list_valid = [i for i, tokens in enumerate(list_tokens)
+                      if tokens is not None]
+        if len(list_valid) > 1:
+            list_joined = [" ".join(list_tokens[i]) for i in list_valid]
+            dict_char2idx = dict()
+            for joined in list_joined:
+                for c in joined:
+                    dict_char2idx.setdefault(c, len(dict_char2idx))
+            histograms = np.zeros((len(list_valid), len(dict_char2idx)),
+                                  dtype=np.int32)
+            for k, joined in enumerate(list_joined):
+                for c in joined:
+                    histograms[k, dict_char2idx[c]] += 1
+            lengths = histograms.sum(axis=1)
+            for k in range(len(list_valid) - 1):
+                common = np.minimum(histograms[k],
+                                    histograms[k + 1:]).sum(axis=1)
+                max_ratio = 200.0 * common / (lengths[k] + lengths[k+1:])
+                # scores are rounded to the closest integer
+                min_ratio = threshold - 0.5 - 1e-6
+                for offset in np.nonzero(max_ratio >= min_ratio)[0]:
+                    set_candidates.add(
+                        (list_valid[k], list_valid[k + 1 + offset]))
+        return sorted(set_candidates)
+
+
+def common_entity_edges_sent_lvl(dict_sent_node2metadata: dict,
+                                 list_hotpot_instance_ner: list) -> list:
+    '''
+    Input: dict {node_idx: {'doc_idx': doc_idx, 'sent_idx': sent_idx}}
+    Output: [(node_i, node_j)]
+    Check all sentences in a hotpot instance with common named entities
+    Cost: O(#sentences * #entities per sentence + #edges) (entity -> sentences
+    inverted index)
+    '''
+    list_nodes = list(dict_sent_node2metadata.keys())
+    list_node_entities = []
+    for dict_sent in dict_sent_node2metadata.values():
+        try:
+            list_doc_ner = list_hotpot_instance_ner[dict_sent['doc_idx']]
+            list_node_entities.append(list_doc_ner[dict_sent['sent_idx']])
+        except (IndexError, KeyError):
+            # sentence without ner annotations
+            list_node_entities.append([])
+    return [(list_nodes[i], list_nodes[j])
+            for (i, j) in common_entity_pairs(list_node_entities).tolist()]
+
+
+def common_entity_pairs(list_node_entities: list) -> np.ndarray:
+    '''
+    Pairs of nodes with at least one entity in common, built from an entity ->
+    nodes inverted index instead of intersecting the entities of every pair of
+    nodes.
+    Inputs:
+        - list_node_entities: list with the entities (hashable) of each node
+    Returns:
+        - int64 array (num pairs, 2) of node positions (i, j), i != j, in both
+            directions, sorted (same order as a nested loop over the nodes)
+    '''
+    dict_ent2idx = dict()
+    list_node_pos = []
+    list_ent_idx = []
+    for i, list_ent in enumerate(list_node_entities):
+        for ent in set(list_ent):
+            list_node_pos.append(i)
+            list_ent_idx.append(dict_ent2idx.setdefault(
+                ent, len(dict_ent2idx)))
+    if len(list_node_pos) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    # inverted index: node positions grouped by entity
+    ent_idx = np.array(list_ent_idx, dtype=np.int64)
+    order = np.argsort(ent_idx, kind='stable')
+    nodes = np.array(list_node_pos, dtype=np.int64)[order]
+    _, group_st, group_size = np.unique(ent_idx[order], return_index=True,
+                                        return_counts=True)
+    # all the pairs of each group: every member of the group is paired with the
+    # full group
+    row_st = np.repeat(group_st, group_size)
+    row_size = np.repeat(group_size, group_size)
+    src = np.repeat(nodes, row_size)
+    offsets = np.arange(row_size.sum()) - np.repeat(
+        np.cumsum(row_size) - row_size, row_size)
+    dst = nodes[np.repeat(row_st, row_size) + offsets]
+    pairs = np.stack([src, dst], axis=1)[src != dst]
+    # nodes sharing several entities
+    return np.unique(pairs, axis=0)
+
+
+class SpanEdges():
+    '''
+    Edges from nodes to contiguous ranges of node ids (e.g., srl argument ->
+    its tokens). Only (node, st, end) is kept per node. The edges are emitted
+    at the end as int32 arrays with np.repeat/np.arange, in the same order as
+    appending one (node, tok) pair per token.
+    '''
+    def __init__(self):
+        self.list_node = []
+        self.list_st = []
+        self.list_end = []
+
+    def add(self, node: int, st: int, end: int):
+        '''
+        Adds the edges node -> st, ..., node -> end-1 (none if end <= st)
+        '''
+        self.list_node.append(node)
+        self.list_st.append(st)
+        self.list_end.append(end)
+
+    def arrays(self, reverse=False) -> (np.ndarray, np.ndarray):
+        '''
+        Returns the int32 arrays (src, dst) of the edges. If reverse, the edges
+        range -> node (e.g., tok2srl)
+        '''
+        nodes = np.array(self.list_node, dtype=np.int32)
+        st = np.array(self.list_st, dtype=np.int32)
+        lengths = np.maximum(np.array(self.list_end, dtype=np.int32) - st, 0)
+        src = np.repeat(nodes, lengths)
+        # dst = st of the range + position of the edge in the range
+        block_st = (np.cumsum(lengths) - lengths).astype(np.int32)
+        dst = np.arange(len(src), dtype=np.int32) + np.repeat(
+            st - block_st, lengths)
+        return (dst, src) if reverse else (src, dst)
+
+    def __len__(self):
+        return sum(
+            max(end - st, 0) for (st, end) in zip(self.list_st, self.list_end))
+
+
+def self_loop_arrays(num_nodes: int) -> (np.ndarray, np.ndarray):
+    nodes = np.arange(num_nodes, dtype=np.int32)
+    return (nodes, nodes)
+
+
+def edge_arrays(edges) -> (np.ndarray, np.ndarray):
+    '''
+    Inputs:
+        - edges: list of (u, v) pairs, (src, dst) arrays or SpanEdges
+    Returns:
+        - int32 arrays (src, dst)
+    '''
+    if isinstance(edges, SpanEdges):
+        return edges.arrays()
+    if isinstance(edges, tuple):
+        return (np.asarray(edges[0], dtype=np.int32),
+                np.asarray(edges[1], dtype=np.int32))
+    pairs = np.array(edges, dtype=np.int32).reshape(-1, 2)
+    return (pairs[:, 0], pairs[:, 1])
+
+
+def build_heterograph(dict_edges: dict):
+    '''
+    dgl.heterograph from edge arrays, built in one call. The number of nodes of
+    each type is inferred as dgl does (max node id + 1) but with numpy, so dgl
+    does not iterate over the edges in python.
+    Inputs:
+        - dict_edges: (src type, etype, dst type) -> list of (u, v) pairs,
+            (src, dst) arrays or SpanEdges
+    '''
+    dict_arrays = {c_etype: edge_arrays(edges)
+                   for c_etype, edges in dict_edges.items()}
+    num_nodes_dict = defaultdict(int)
+    for (src_type, _, dst_type), (src, dst) in dict_arrays.items():
+        num_nodes_dict[src_type] = max(
+            num_nodes_dict[src_type],
+            int(src.max()) + 1 if len(src) > 0 else 0)
+        num_nodes_dict[dst_type] = max(
+            num_nodes_dict[dst_type],
+            int(dst.max()) + 1 if len(dst) > 0 else 0)
+    # dgl indexes are int64
+    dict_tensors = {c_etype: (torch.from_numpy(src.astype(np.int64)),
+                              torch.from_numpy(dst.astype(np.int64)))
+                    for c_etype, (src, dst) in dict_arrays.items()}
+    return dgl.heterograph(dict_tensors, dict(num_nodes_dict))
+
+
+def context_tensors(list_context):
+    '''
+    Stacks the (unpadded) encoded contexts of Dataset.create_context, padded to
+    the longest one. HGNModel trims each batch to its longest context
+    Returns:
+        - tensor_input_ids, tensor_attention_masks, tensor_token_type_ids:
+            shape [#contexts, longest context]
+    '''
+    max_len = max([len(context['input_ids']) for context in list_context],
+                  default=0)
+
+    def pad(key):
+        return torch.tensor(
+            [context[key] + [0] * (max_len - len(context[key]))
+             for context in list_context], dtype=torch.long)
+    return pad('input_ids'), pad('attention_mask'), pad('token_type_ids')
@@ -1,6 +1,11 @@
+import os
 from .graph_creation import Dataset
+from .graph_store import GraphStore, write_graphs, INDEX_FILE
+from .graph_utils import context_tensors
 from .preprocessing import NER_stanza
 from .preprocessing import SRL
+from .preprocessing import AnnotationCache
+from .preprocessing import ParagraphTable
 import torch
 
 
@@ -12,27 +17,122 @@ def add_metadata2graph(graph, metadata):
     return graph
 
 
-def create_dataloader(hotpot, dict_ins2dict_doc2pred, pretrained_weights):
+def create_dataloader(hotpot, dict_ins2dict_doc2pred, pretrained_weights,
+                      ner_batch_size=None, ner_num_workers=0,
+                      srl_batch_size=None, srl_num_workers=0,
+                      annotation_cache_path=None,
+                      annotation_cache_max_entries=None, dedup_paragraphs=True,
+                      graph_num_workers=0, graph_store_path=None,
+                      device='cuda'):
+    '''
+    Inputs:
+        - graph_store_path: GraphStore directory (optional). The graphs of the
+            instances whose inputs did not change since the store was written
+            are reused, and the store is then replaced by the new graphs (with
+            their fingerprints)
+        - device: 'cuda' or 'cpu', for NER and SRL
+    '''
     # extract entities and SRL
-    ner = NER_stanza()
-    srl = SRL()
+    cache = None
+    if annotation_cache_path is not None:
+        cache = AnnotationCache(annotation_cache_path,
+                                max_entries=annotation_cache_max_entries)
+    ner = NER_stanza(batch_size=ner_batch_size, num_workers=ner_num_workers,
+                     use_gpu=(device == 'cuda'), cache=cache)
+    srl = SRL(device=device, batch_size=srl_batch_size,
+              num_workers=srl_num_workers, cache=cache)
+    paragraph_table = None
+    if dedup_paragraphs:
+        paragraph_table = ParagraphTable(hotpot, dict_ins2dict_doc2pred)
+        print("{} unique paragraphs ({:.2f} selected docs per "
+              "paragraph)".format(len(paragraph_table.list_paragraphs),
+                                  paragraph_table.dedup_ratio()))
+    annotations = extract_named_entities(hotpot, dict_ins2dict_doc2pred, ner,
+                                         paragraph_table)
+    annotations.update(
+        extract_srl(hotpot, dict_ins2dict_doc2pred, srl, paragraph_table))
+
+    if cache is not None:
+        print("Annotation cache:", cache.stats())
+        cache.close()
+
+    print("Data loaded. Creating graphs")
+    return create_graphs(hotpot, dict_ins2dict_doc2pred, pretrained_weights,
+                         annotations, graph_num_workers=graph_num_workers,
+                         graph_store_path=graph_store_path)
+
+
+def extract_named_entities(hotpot, dict_ins2dict_doc2pred, ner,
+                           paragraph_table=None) -> dict:
+    '''
+    Returns a dict with the entities of the queries (list_ent_query) and of the
+    selected documents (list_hotpot_ner)
+    '''
     print("Extracting named entities from the query")
     list_ent_query = ner.extract_named_entities_from_query(hotpot)
     print("Extracting named entities")
-    list_hotpot_ner = ner.extract_named_entities(hotpot, dict_ins2dict_doc2pred)
+    list_hotpot_ner = ner.extract_named_entities(hotpot,
+                                                 dict_ins2dict_doc2pred,
+                                                 paragraph_table)
+    return {'list_ent_query': list_ent_query,
+            'list_hotpot_ner': list_hotpot_ner}
+
+
+def extract_srl(hotpot, dict_ins2dict_doc2pred, srl,
+                paragraph_table=None) -> dict:
+    '''
+    Returns a dict with the srl triples of the queries
+    (dict_ins_query_srl_triples) and of the selected documents
+    (dict_ins_doc_sent_srl_triples)
+    '''
     print("Extracting SRL arguments from the query")
     dict_ins_query_srl_triples = srl.extract_srl_from_query(hotpot)
     print("Extracting SRL arguments")
-    dict_ins_doc_sent_srl_triples = srl.extract_srl(hotpot, dict_ins2dict_doc2pred)
+    dict_ins_doc_sent_srl_triples = srl.extract_srl(hotpot,
+                                                    dict_ins2dict_doc2pred,
+                                                    paragraph_table)
+    return {'dict_ins_query_srl_triples': dict_ins_query_srl_triples,
+            'dict_ins_doc_sent_srl_triples': dict_ins_doc_sent_srl_triples}
 
-    print("Data loaded. Creating graphs")
-    train_dataset = Dataset(hotpot, list_hotpot_ner, dict_ins_doc_sent_srl_triples,
-                            dict_ins_query_srl_triples, list_ent_query, 
-                            dict_ins2dict_doc2pred=dict_ins2dict_doc2pred, batch_size=1,
-                            pretrained_weights=pretrained_weights)
+
+def create_graphs(hotpot, dict_ins2dict_doc2pred, pretrained_weights,
+                  annotations, graph_num_workers=0, graph_store_path=None,
+                  train_dataset=None) -> dict:
+    '''
+    Inputs:
+        - annotations: dict with the outputs of extract_named_entities and
+            extract_srl
+        - train_dataset: Dataset to reuse (optional), e.g., across the chunks
+            of a streaming prediction, so its tokenizer is loaded only once.
+            Its data are replaced by hotpot and annotations
+    Returns a dict with the graphs, the encoded contexts and the answer spans
+    '''
+    if train_dataset is None:
+        train_dataset = Dataset(hotpot, annotations['list_hotpot_ner'],
+                                annotations['dict_ins_doc_sent_srl_triples'],
+                                annotations['dict_ins_query_srl_triples'],
+                                annotations['list_ent_query'],
+                                dict_ins2dict_doc2pred=dict_ins2dict_doc2pred,
+                                batch_size=1,
+                                pretrained_weights=pretrained_weights)
+    else:
+        train_dataset.set_data(hotpot, annotations['list_hotpot_ner'],
+                               annotations['dict_ins_doc_sent_srl_triples'],
+                               annotations['dict_ins_query_srl_triples'],
+                               annotations['list_ent_query'],
+                               dict_ins2dict_doc2pred=dict_ins2dict_doc2pred)
+    graph_store = None
+    if graph_store_path is not None and os.path.exists(
+            os.path.join(graph_store_path, INDEX_FILE)):
+        graph_store = GraphStore(graph_store_path)
     (list_graphs,
         list_context,
-        list_span_idx) = train_dataset.create_dataloader()
+        list_span_idx) = train_dataset.create_dataloader(
+            num_workers=graph_num_workers, graph_store=graph_store)
+    if graph_store_path is not None:
+        print("Writing the graph store")
+        write_graphs(graph_store_path, list_graphs,
+                     train_dataset.list_graph_info)
 
     return {'list_graphs': list_graphs,
             'list_context': list_context,
@@ -1,23 +1,127 @@
 #!/usr/bin/env python
 # coding: utf-8
 # %%
+import os
+import copy
+import multiprocessing
+from bisect import bisect_right
 from tqdm import tqdm
+import torch
 import stanza
 
+# stanza processes each paragraph (separated by a blank line) independently, so
+# sentences joined with this separator are annotated as if they were sent one
+# by one
+SENT_SEPARATOR = "\n\n"
+
+# pipeline of each worker process of the process pool (see
+# NER_stanza.get_ner_batch)
+_worker_ner = None
+
+
+def _init_worker(batch_size, num_threads):
+    global _worker_ner
+    torch.set_num_threads(num_threads)
+    _worker_ner = NER_stanza(batch_size=batch_size, use_gpu=False)
+
+
+def _worker_get_ner_batch(list_sentences):
+    return _worker_ner.get_ner_batch(list_sentences)
+
 
 class NER_stanza():
-    def __init__(self):
+    def __init__(self, batch_size=None, num_workers=0, use_gpu=True,
+                 cache=None):
+        '''
+        Inputs:
+            - batch_size: number of sentences annotated with a single call to
+                the stanza pipeline. If None, sentences are annotated one by
+                one
+            - num_workers: if > 0, sentences are sharded across a pool of cpu
+                processes (batch_size is required). Each worker loads the
+                pipeline, this process does not
+            - cache: AnnotationCache shared across runs (optional)
+        '''
         super(NER_stanza).__init__()
-        self.nlp = stanza.Pipeline(lang='en', processors='tokenize,ner')
+        if num_workers > 0 and batch_size is None:
+            raise ValueError("batch_size is required when num_workers > 0")
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.cache = cache
+        self.model_id = "stanza-{}-en-tokenize,ner".format(stanza.__version__)
+        self.nlp = None
+        if num_workers == 0:
+            self.nlp = stanza.Pipeline(lang='en', processors='tokenize,ner',
+                                       use_gpu=use_gpu)
 
     def get_ner(self, doc_str):
-        ''' 
+        '''
         Do not use to get SQuAD answers since it lacks answer position
         '''
+        if self.cache is not None:
+            return self.cache.annotate(self.model_id, [doc_str],
+                                       lambda l: [self.__get_ner(doc_str)])[0]
+        return self.__get_ner(doc_str)
+
+    def __get_ner(self, doc_str):
         doc = self.nlp(doc_str)
         return [ent.text for ent in doc.ents]
 
+    def get_ner_batch(self, list_sentences: list) -> list:
+        '''
+        Same output as [self.get_ner(sent) for sent in list_sentences] but the
+        sentences are annotated by stanza in multi-sentence documents of
+        self.batch_size sentences
+        '''
+        if self.cache is not None:
+            return self.cache.annotate(self.model_id, list_sentences,
+                                       self.__get_ner_batch)
+        return self.__get_ner_batch(list_sentences)
+
+    def __get_ner_batch(self, list_sentences: list) -> list:
+        if len(list_sentences) == 0:
+            return []
+        if self.num_workers > 0:
+            return self.__sharded_get_ner_batch(list_sentences)
+        list_sent_ner = []
+        for i in tqdm(range(0, len(list_sentences), self.batch_size)):
+            list_sent_ner.extend(
+                self.__get_ner_chunk(list_sentences[i:i + self.batch_size]))
+        return list_sent_ner
+
+    def __get_ner_chunk(self, list_sentences: list) -> list:
+        # character offset of each sentence in the joined document
+        list_sent_st = []
+        offset = 0
+        for sent in list_sentences:
+            list_sent_st.append(offset)
+            offset += len(sent) + len(SENT_SEPARATOR)
+        doc = self.nlp(SENT_SEPARATOR.join(list_sentences))
+        list_sent_ner = [[] for _ in list_sentences]
+        for ent in doc.ents:
+            # map the entity back to its sentence
+            sent_idx = bisect_right(list_sent_st, ent.start_char) - 1
+            list_sent_ner[sent_idx].append(ent.text)
+        return list_sent_ner
+
+    def __sharded_get_ner_batch(self, list_sentences: list) -> list:
+        # contiguous shards, i.e., each worker gets a contiguous range of
+        # instances
+        shard_size = -(-len(list_sentences) // self.num_workers)
+        list_shards = [list_sentences[i:i + shard_size]
+                       for i in range(0, len(list_sentences), shard_size)]
+        num_threads = max(1, (os.cpu_count() or 1) // self.num_workers)
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(self.num_workers, initializer=_init_worker,
+                      initargs=(self.batch_size, num_threads)) as pool:
+            list_shard_ner = pool.map(_worker_get_ner_batch, list_shards)
+        return [sent_ner for shard_ner in list_shard_ner
+                for sent_ner in shard_ner]
+
     def extract_named_entities_from_query(self, hotpot):
+        if self.batch_size is not None:
+            return self.get_ner_batch(
+                [hotpot_instance['question'] for hotpot_instance in hotpot])
         list_hotpot_ner = []
         for instance_idx, hotpot_instance in enumerate(tqdm(hotpot)):
             query = hotpot_instance['question']
@@ -25,7 +129,21 @@ class NER_stanza():
             list_hotpot_ner.append(list_ent)
         return list_hotpot_ner
 
-    def extract_named_entities(self, hotpot, dict_ins2dict_doc2pred):
+    def extract_named_entities(self, hotpot, dict_ins2dict_doc2pred,
+                               paragraph_table=None):
+        '''
+        Inputs:
+            - paragraph_table: ParagraphTable of (hotpot,
+                dict_ins2dict_doc2pred) (optional). If given, each unique
+                paragraph is annotated only once
+        '''
+        if paragraph_table is not None:
+            return self.__dedup_extract_named_entities(hotpot,
+                                                       dict_ins2dict_doc2pred,
+                                                       paragraph_table)
+        if self.batch_size is not None:
+            return self.__batched_extract_named_entities(
+                hotpot, dict_ins2dict_doc2pred)
         list_hotpot_ner = []
         for instance_idx, hotpot_instance in enumerate(tqdm(hotpot)):
             list_doc_ner = []
@@ -37,3 +155,48 @@ class NER_stanza():
                 list_doc_ner.append(list_sent_ner)
             list_hotpot_ner.append(list_doc_ner)
         return list_hotpot_ner
+
+    def __batched_extract_named_entities(self, hotpot, dict_ins2dict_doc2pred):
+        # create the output structure (same as extract_named_entities)
+        # and collect all the sentences of the selected documents
+        list_hotpot_ner = []
+        list_sentences = []
+        for instance_idx, hotpot_instance in enumerate(hotpot):
+            list_doc_ner = []
+            for doc_idx, (doc_title, doc) in enumerate(
+                    hotpot_instance['context']):
+                list_sent_ner = []
+                if dict_ins2dict_doc2pred[instance_idx][doc_idx] == 1:
+                    list_sentences.extend(doc)
+                    list_sent_ner = [None] * len(doc)
+                list_doc_ner.append(list_sent_ner)
+            list_hotpot_ner.append(list_doc_ner)
+        # fill it in the same order
+        iter_sent_ner = iter(self.get_ner_batch(list_sentences))
+        for list_doc_ner in list_hotpot_ner:
+            for list_sent_ner in list_doc_ner:
+                for sent_idx in range(len(list_sent_ner)):
+                    list_sent_ner[sent_idx] = next(iter_sent_ner)
+        return list_hotpot_ner
+
+    def __dedup_extract_named_entities(self, hotpot, dict_ins2dict_doc2pred,
+                                       paragraph_table):
+        if self.batch_size is not None:
+            list_paragraph_ner = paragraph_table.annotate(self.get_ner_batch)
+        else:
+            list_paragraph_ner = paragraph_table.annotate(
+                lambda l: [self.get_ner(sent) for sent in tqdm(l)])
+        # fan out the annotations of the unique paragraphs to the instances
+        list_hotpot_ner = []
+        for instance_idx, hotpot_instance in enumerate(hotpot):
+            list_doc_ner = []
+            for doc_idx in range(len(hotpot_instance['context'])):
+                list_sent_ner = []
+                if dict_ins2dict_doc2pred[instance_idx][doc_idx] == 1:
+                    paragraph_idx = paragraph_table.paragraph_idx(
+                        instance_idx, doc_idx)
+                    list_sent_ner = copy.deepcopy(
+                        list_paragraph_ner[paragraph_idx])
+                list_doc_ner.append(list_sent_ner)
+            list_hotpot_ner.append(list_doc_ner)
+        return list_hotpot_ner
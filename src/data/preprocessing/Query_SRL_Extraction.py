@@ -1,16 +1,60 @@
 #!/usr/bin/env python
 # coding: utf-8
+import os
+import copy
+import multiprocessing
 from tqdm import tqdm
+import torch
+from spacy.tokens import Doc
+from allennlp.common.util import sanitize
 from allennlp.predictors.predictor import Predictor
 
+SRL_MODEL_PATH = "models/srl_model/bert-base-srl-2019.06.17.tar.gz"
+
+# SRL model of each worker process of the process pool (see
+# SRL.sentences2srl_args)
+_worker_srl = None
+
+
+def _init_worker(batch_size, num_threads):
+    global _worker_srl
+    torch.set_num_threads(num_threads)
+    # the workers always run on cpu. Each of them holds its own copy of the
+    # model
+    _worker_srl = SRL(device='cpu', batch_size=batch_size)
+
+
+def _worker_sentences2srl_args(list_sentences):
+    return _worker_srl.sentences2srl_args(list_sentences)
+
 
 class SRL():
-    def __init__(self, device='cuda'):
+    def __init__(self, device='cuda', batch_size=None, num_workers=0,
+                 cache=None):
+        '''
+        Inputs:
+            - device: 'cuda' or 'cpu'
+            - batch_size: number of SRL instances (one per verb) per forward.
+                If None, sentences are processed one by one
+            - num_workers: if > 0, sentences are sharded across a pool of cpu
+                processes (batch_size is required). Each worker loads the
+                model, this process does not
+            - cache: AnnotationCache shared across runs (optional)
+        '''
+        if num_workers > 0 and batch_size is None:
+            raise ValueError("batch_size is required when num_workers > 0")
         self.predictor = None
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.cache = cache
+        self.model_id = os.path.basename(SRL_MODEL_PATH)
+        if num_workers > 0:
+            # all the sentences go to the workers
+            return
         if device == 'cuda':
-            self.predictor = Predictor.from_path("models/srl_model/bert-base-srl-2019.06.17.tar.gz", cuda_device=0)
+            self.predictor = Predictor.from_path(SRL_MODEL_PATH, cuda_device=0)
         else:
-            self.predictor = Predictor.from_path("models/srl_model/bert-base-srl-2019.06.17.tar.gz")
+            self.predictor = Predictor.from_path(SRL_MODEL_PATH)
 
     def sentence2srl_args(self, sentence: str) -> (list, list):
         '''
@@ -18,7 +62,18 @@ class SRL():
             - dictionary of the form: argX -> [int] (argument to spacy token index)
             - list of spacy tokens
         '''
+        if self.cache is not None:
+            srl_args = self.cache.annotate(
+                self.model_id, [sentence],
+                lambda l: [self.__sentence2srl_args(sentence)])[0]
+            return tuple(srl_args)
+        return self.__sentence2srl_args(sentence)
+
+    def __sentence2srl_args(self, sentence: str) -> (list, list):
         srl_instance = self.predictor.predict_tokenized(sentence.split())
+        return self.srl_instance2args(srl_instance)
+
+    def srl_instance2args(self, srl_instance: dict) -> (list, list):
         list_dict_arg2idx = []
         for verb in srl_instance['verbs']:
             dict_tag2idx = dict()
@@ -32,55 +87,210 @@ class SRL():
             list_dict_arg2idx.append(dict_tag2idx)
         return list_dict_arg2idx, srl_instance['words']
 
+    def sentences2srl_args(self, list_sentences: list) -> list:
+        '''
+        Batched version of sentence2srl_args. Sentences are sorted by length so
+        that each batch needs as little padding as possible.
+        Returns a list with the output of sentence2srl_args for each sentence
+        (same order as the input)
+        '''
+        if self.cache is not None:
+            list_srl_args = self.cache.annotate(self.model_id, list_sentences,
+                                                self.__sentences2srl_args)
+            return [tuple(srl_args) for srl_args in list_srl_args]
+        return self.__sentences2srl_args(list_sentences)
+
+    def __sentences2srl_args(self, list_sentences: list) -> list:
+        if self.num_workers > 0:
+            return self.__sharded_sentences2srl_args(list_sentences)
+        list_tokenized = [sentence.split() for sentence in list_sentences]
+        sorted_idx = sorted(range(len(list_tokenized)),
+                            key=lambda i: len(list_tokenized[i]))
+        list_srl_instances = self.predict_batch_tokenized(
+            [list_tokenized[i] for i in sorted_idx])
+        output = [None] * len(list_sentences)
+        for i, srl_instance in zip(sorted_idx, list_srl_instances):
+            output[i] = self.srl_instance2args(srl_instance)
+        return output
+
+    def predict_batch_tokenized(self, list_tokenized_sentences: list) -> list:
+        '''
+        Same output as calling predictor.predict_tokenized for each sentence,
+        but the SRL instances (one per verb) of all the sentences are run
+        through the model in batches of self.batch_size instances.
+        '''
+        predictor = self.predictor
+        list_sent_instances = []
+        for tokenized_sentence in list_tokenized_sentences:
+            spacy_doc = Doc(predictor._tokenizer.spacy.vocab,
+                            words=tokenized_sentence)
+            for pipe in filter(None, predictor._tokenizer.spacy.pipeline):
+                pipe[1](spacy_doc)
+            tokens = [token for token in spacy_doc]
+            list_sent_instances.append(
+                (tokens, predictor.tokens_to_instances(tokens)))
+        flattened_instances = [
+            instance for (_, instances) in list_sent_instances
+            for instance in instances]
+        outputs = []
+        for i in tqdm(range(0, len(flattened_instances), self.batch_size)):
+            outputs.extend(
+                predictor._model.forward_on_instances(
+                    flattened_instances[i:i + self.batch_size]))
+        # group the outputs back by sentence
+        list_srl_instances = []
+        output_idx = 0
+        for (tokens, instances) in list_sent_instances:
+            if not instances:
+                list_srl_instances.append(sanitize({"verbs": [],
+                                                    "words": tokens}))
+                continue
+            sent_outputs = outputs[output_idx:output_idx+len(instances)]
+            output_idx += len(instances)
+            list_verbs = [{"verb": output["verb"],
+                           "description": predictor.make_srl_string(
+                               output["words"], output["tags"]),
+                           "tags": output["tags"]}
+                          for output in sent_outputs]
+            list_srl_instances.append(sanitize(
+                {"verbs": list_verbs, "words": sent_outputs[0]["words"]}))
+        return list_srl_instances
+
+    def __sharded_sentences2srl_args(self, list_sentences: list) -> list:
+        # interleaved shards so that all workers get a similar mix of short and
+        # long sentences
+        list_shard_idx = [list(range(len(list_sentences)))[i::self.num_workers]
+                          for i in range(self.num_workers)]
+        num_threads = max(1, (os.cpu_count() or 1) // self.num_workers)
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(self.num_workers, initializer=_init_worker,
+                      initargs=(self.batch_size, num_threads)) as pool:
+            list_shard_output = pool.map(
+                _worker_sentences2srl_args,
+                [[list_sentences[i] for i in shard_idx]
+                 for shard_idx in list_shard_idx])
+        output = [None] * len(list_sentences)
+        for shard_idx, shard_output in zip(list_shard_idx, list_shard_output):
+            for i, srl_args in zip(shard_idx, shard_output):
+                output[i] = srl_args
+        return output
+
+    def srl_args2triples(self, list_dict_arg2idx: list,
+                         list_tokens: list) -> dict:
+        # TRIPLES
+        dict_srl_triples = dict()
+        for triple_idx, dict_arg2idx in enumerate(list_dict_arg2idx):
+            # ARGUMENTS
+            dict_triple = dict()
+            if len(dict_arg2idx.keys()) <= 1:
+                # avoid triples where we only have the verb. They are not real
+                # srl triples
+                continue
+            for key_idx, (arg, list_token_idx) in enumerate(
+                    dict_arg2idx.items()):
+                srl_tokenized_span = [list_tokens[idx]
+                                      for idx in list_token_idx]
+                srl_span = " ".join(srl_tokenized_span)
+                dict_triple[arg] = srl_span
+            dict_srl_triples[triple_idx] = dict_triple
+        return dict_srl_triples
+
     def extract_srl_from_query(self, hotpot):
+        if self.batch_size is not None:
+            list_srl_args = self.sentences2srl_args(
+                [hotpot_instance['question'] for hotpot_instance in hotpot])
         dict_ins_query_srl_triples = dict()
         for ins_idx, hotpot_instance in enumerate(tqdm(hotpot)):
-            query = hotpot_instance['question']
-            list_dict_arg2idx, list_tokens = self.sentence2srl_args(query)
-            # TRIPLES
-            dict_srl_triples = dict()
-            for triple_idx, dict_arg2idx in enumerate(list_dict_arg2idx):
-                # ARGUMENTS
-                dict_triple = dict()
-                if len(dict_arg2idx.keys()) <= 1:
-                    # avoid triples where we only have the verb. They are not real srl triples
-                    continue
-                for key_idx, (arg, list_token_idx) in enumerate(dict_arg2idx.items()):
-                    srl_tokenized_span = [list_tokens[idx] for idx in list_token_idx]
-                    srl_span = " ".join(srl_tokenized_span)
-                    dict_triple[arg] = srl_span
-                dict_srl_triples[triple_idx] = dict_triple
-            dict_ins_query_srl_triples[ins_idx] = dict_srl_triples
+            if self.batch_size is not None:
+                list_dict_arg2idx, list_tokens = list_srl_args[ins_idx]
+            else:
+                query = hotpot_instance['question']
+                list_dict_arg2idx, list_tokens = self.sentence2srl_args(query)
+            dict_ins_query_srl_triples[ins_idx] = self.srl_args2triples(
+                list_dict_arg2idx, list_tokens)
         return dict_ins_query_srl_triples
 
-    def extract_srl(self, hotpot, dict_ins2dict_doc2pred):
+    def extract_srl(self, hotpot, dict_ins2dict_doc2pred,
+                    paragraph_table=None):
+        '''
+        Inputs:
+            - paragraph_table: ParagraphTable of (hotpot,
+                dict_ins2dict_doc2pred) (optional). If given, each unique
+                paragraph is annotated only once
+        '''
+        if paragraph_table is not None:
+            return self.__dedup_extract_srl(hotpot, dict_ins2dict_doc2pred,
+                                            paragraph_table)
+        if self.batch_size is not None:
+            return self.__batched_extract_srl(hotpot, dict_ins2dict_doc2pred)
         dict_ins_doc_sent_srl_triples = dict()
         for ins_idx, hotpot_instance in enumerate(tqdm(hotpot)):
             dict_doc_sent_srl_triples = dict()
             for doc_idx, (doc_title, doc) in enumerate(hotpot_instance['context']):
-                if dict_ins2dict_doc2pred[ins_idx][doc_idx] == 0:
+                if dict_ins2dict_doc2pred[ins_idx][doc_idx] != 1:
                     continue
-                ####### Process sentences #######            
+                ####### Process sentences #######
                 dict_sent_srl_triples = dict()
                 for sent_idx, sent in enumerate(doc):
                     ##### SRL Level ######
                     #get SRL instance
                     list_dict_arg2idx, list_tokens = self.sentence2srl_args(sent)
-
-                    ######################################## TRIPLES
-                    dict_srl_triples = dict()
-                    for triple_idx, dict_arg2idx in enumerate(list_dict_arg2idx):
-                        ###################################### ARGUMENTS
-                        dict_triple = dict()
-                        if len(dict_arg2idx.keys()) <= 1:
-                            # avoid triples where we only have the verb. They are not real srl triples
-                            continue
-                        for key_idx, (arg, list_token_idx) in enumerate(dict_arg2idx.items()):
-                            srl_tokenized_span = [list_tokens[idx] for idx in list_token_idx]
-                            srl_span = " ".join(srl_tokenized_span) 
-                            dict_triple[arg] = srl_span
-                        dict_srl_triples[triple_idx] = dict_triple
-                    dict_sent_srl_triples[sent_idx] = dict_srl_triples
+                    dict_sent_srl_triples[sent_idx] = self.srl_args2triples(
+                        list_dict_arg2idx, list_tokens)
                 dict_doc_sent_srl_triples[doc_idx] = dict_sent_srl_triples
             dict_ins_doc_sent_srl_triples[ins_idx] = dict_doc_sent_srl_triples
         return dict_ins_doc_sent_srl_triples
+
+    def __batched_extract_srl(self, hotpot, dict_ins2dict_doc2pred):
+        # collect all the sentences of the selected documents and create the
+        # output structure (same as extract_srl) in the same order
+        dict_ins_doc_sent_srl_triples = dict()
+        list_sent_keys = []
+        list_sentences = []
+        for ins_idx, hotpot_instance in enumerate(hotpot):
+            dict_doc_sent_srl_triples = dict()
+            for doc_idx, (doc_title, doc) in enumerate(
+                    hotpot_instance['context']):
+                if dict_ins2dict_doc2pred[ins_idx][doc_idx] != 1:
+                    continue
+                dict_doc_sent_srl_triples[doc_idx] = dict()
+                for sent_idx, sent in enumerate(doc):
+                    list_sent_keys.append((ins_idx, doc_idx, sent_idx))
+                    list_sentences.append(sent)
+            dict_ins_doc_sent_srl_triples[ins_idx] = dict_doc_sent_srl_triples
+        list_srl_args = self.sentences2srl_args(list_sentences)
+        for ((ins_idx, doc_idx, sent_idx),
+             (list_dict_arg2idx, list_tokens)) in zip(list_sent_keys,
+                                                      list_srl_args):
+            triples = self.srl_args2triples(list_dict_arg2idx, list_tokens)
+            dict_ins_doc_sent_srl_triples[ins_idx][doc_idx][sent_idx] = triples
+        return dict_ins_doc_sent_srl_triples
+
+    def __dedup_extract_srl(self, hotpot, dict_ins2dict_doc2pred,
+                            paragraph_table):
+        if self.batch_size is not None:
+            list_paragraph_srl_args = paragraph_table.annotate(
+                self.sentences2srl_args)
+        else:
+            list_paragraph_srl_args = paragraph_table.annotate(
+                lambda l: [self.sentence2srl_args(sent) for sent in tqdm(l)])
+        list_paragraph_triples = [
+            {sent_idx: self.srl_args2triples(list_dict_arg2idx, list_tokens)
+             for sent_idx, (list_dict_arg2idx, list_tokens) in enumerate(
+                 list_srl_args)}
+            for list_srl_args in list_paragraph_srl_args]
+        # fan out the triples of the unique paragraphs to the instances. Each
+        # instance gets its own copy (the graph builders must not see the
+        # changes of another instance)
+        dict_ins_doc_sent_srl_triples = dict()
+        for ins_idx, hotpot_instance in enumerate(hotpot):
+            dict_doc_sent_srl_triples = dict()
+            for doc_idx in range(len(hotpot_instance['context'])):
+                if dict_ins2dict_doc2pred[ins_idx][doc_idx] != 1:
+                    continue
+                paragraph_idx = paragraph_table.paragraph_idx(ins_idx,
+                                                              doc_idx)
+                dict_doc_sent_srl_triples[doc_idx] = copy.deepcopy(
+                    list_paragraph_triples[paragraph_idx])
+            dict_ins_doc_sent_srl_triples[ins_idx] = dict_doc_sent_srl_triples
+        return dict_ins_doc_sent_srl_triples
@@ -1,2 +1,4 @@
 from .NER_Extraction import NER_stanza
 from .Query_SRL_Extraction import SRL
+from .annotation_cache import AnnotationCache
+from .paragraph_table import ParagraphTable
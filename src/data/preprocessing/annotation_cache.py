@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# coding: utf-8
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+class AnnotationCache():
+    '''
+    Persistent cache of sentence annotations (NER, SRL) in a single sqlite
+    file. Entries are keyed by a hash of (model id, sentence) and evicted in
+    least recently used order when there are more than max_entries.
+    '''
+    def __init__(self, path, max_entries=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS annotations "
+                          "(key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                          "last_access REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access "
+                          "ON annotations (last_access)")
+        self.conn.commit()
+
+    def key(self, model_id: str, text: str) -> str:
+        return hashlib.sha256(
+            (model_id + "\x00" + text).encode('utf-8')).hexdigest()
+
+    def get_many(self, model_id: str, list_text: list) -> list:
+        '''
+        Returns the cached annotation of each text or None if it is not in the
+        cache
+        '''
+        list_keys = [self.key(model_id, text) for text in list_text]
+        dict_key2value = dict()
+        with self.lock:
+            # sqlite limits the number of variables of a query
+            for i in range(0, len(list_keys), 500):
+                chunk = list_keys[i:i+500]
+                query = ("SELECT key, value FROM annotations WHERE key IN "
+                         "({})".format(",".join("?" * len(chunk))))
+                dict_key2value.update(
+                    self.conn.execute(query, chunk).fetchall())
+            now = time.time()
+            self.conn.executemany(
+                "UPDATE annotations SET last_access = ? WHERE key = ?",
+                [(now, key) for key in dict_key2value.keys()])
+            self.conn.commit()
+            self.hits += len(dict_key2value)
+            self.misses += len(list_keys) - len(dict_key2value)
+        return [
+            json.loads(dict_key2value[key]) if key in dict_key2value else None
+            for key in list_keys]
+
+    def put_many(self, model_id: str, list_text: list, list_value: list):
+        now = time.time()
+        rows = [(self.key(model_id, text), json.dumps(value), now)
+                for text, value in zip(list_text, list_value)]
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO annotations "
+                                  "(key, value, last_access) VALUES (?, ?, ?)",
+                                  rows)
+            self.__evict()
+            self.conn.commit()
+
+    def annotate(self, model_id: str, list_text: list, annotate_fn) -> list:
+        '''
+        Same output as annotate_fn(list_text), but annotate_fn only runs on the
+        (unique) texts that are not in the cache. Their annotations are added
+        to the cache.
+        '''
+        list_annotations = self.get_many(model_id, list_text)
+        list_miss_text = list(dict.fromkeys(
+            text for text, annotation in zip(list_text, list_annotations)
+            if annotation is None))
+        if len(list_miss_text) == 0:
+            return list_annotations
+        list_miss_annotations = annotate_fn(list_miss_text)
+        self.put_many(model_id, list_miss_text, list_miss_annotations)
+        dict_miss = dict(zip(list_miss_text, list_miss_annotations))
+        return [dict_miss[text] if annotation is None else annotation
+                for text, annotation in zip(list_text, list_annotations)]
+
+    def get(self, model_id: str, text: str):
+        return self.get_many(model_id, [text])[0]
+
+    def put(self, model_id: str, text: str, value):
+        self.put_many(model_id, [text], [value])
+
+    def __evict(self):
+        if self.max_entries is None:
+            return
+        num_entries = self.conn.execute(
+            "SELECT COUNT(*) FROM annotations").fetchone()[0]
+        if num_entries > self.max_entries:
+            self.conn.execute(
+                "DELETE FROM annotations WHERE key IN "
+                "(SELECT key FROM annotations ORDER BY last_access LIMIT ?)",
+                (num_entries - self.max_entries,))
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM annotations").fetchone()[0]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total > 0 else 0.,
+                'entries': len(self)}
+
+    def close(self):
+        self.conn.close()
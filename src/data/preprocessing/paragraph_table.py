@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+
+class ParagraphTable():
+    '''
+    Table of the unique paragraphs of the selected documents of a HotpotQA
+    dataset. The same Wikipedia paragraph appears in many instances, so
+    annotating the unique paragraphs and fanning the results out to the
+    instances avoids most of the work.
+    '''
+    def __init__(self, hotpot, dict_ins2dict_doc2pred):
+        self.list_paragraphs = []  # unique (title, list of sentences)
+        # (ins_idx, doc_idx) -> idx in list_paragraphs
+        self.dict_ins_doc2paragraph_idx = dict()
+        dict_key2paragraph_idx = dict()
+        for ins_idx, hotpot_instance in enumerate(hotpot):
+            for doc_idx, (doc_title, doc) in enumerate(
+                    hotpot_instance['context']):
+                if dict_ins2dict_doc2pred[ins_idx][doc_idx] != 1:
+                    continue
+                # the title is not enough since there are paragraphs with the
+                # same title but different content
+                key = (doc_title, tuple(doc))
+                if key not in dict_key2paragraph_idx:
+                    dict_key2paragraph_idx[key] = len(self.list_paragraphs)
+                    self.list_paragraphs.append((doc_title, doc))
+                self.dict_ins_doc2paragraph_idx[(ins_idx, doc_idx)] = (
+                    dict_key2paragraph_idx[key])
+
+    def dedup_ratio(self) -> float:
+        '''
+        Number of selected (instance, doc) pairs per unique paragraph
+        '''
+        return len(self.dict_ins_doc2paragraph_idx) / max(
+            1, len(self.list_paragraphs))
+
+    def annotate(self, annotate_sentences_fn) -> list:
+        '''
+        Runs annotate_sentences_fn (list of sentences -> list of annotations)
+        once over the sentences of all the unique paragraphs.
+        Returns a list with the list of sentence annotations of each unique
+        paragraph
+        '''
+        list_sentences = [sent for (_, doc) in self.list_paragraphs
+                          for sent in doc]
+        list_annotations = annotate_sentences_fn(list_sentences)
+        list_paragraph_annotations = []
+        offset = 0
+        for (_, doc) in self.list_paragraphs:
+            list_paragraph_annotations.append(
+                list_annotations[offset:offset + len(doc)])
+            offset += len(doc)
+        return list_paragraph_annotations
+
+    def paragraph_idx(self, ins_idx, doc_idx) -> int:
+        return self.dict_ins_doc2paragraph_idx[(ins_idx, doc_idx)]
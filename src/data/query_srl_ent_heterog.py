@@ -18,6 +18,11 @@ from itertools import product
 from dgl.data.utils import load_graphs
 from torch.utils.data import TensorDataset
 from torch.utils.data import DataLoader
+from src.data.graph_utils import (SpanAligner, EncodingMemo, FuzzyMatcher,
+                                  SpanEdges, self_loop_arrays,
+                                  build_heterograph, collect_strings,
+                                  common_entity_edges_sent_lvl,
+                                  find_sublist_idx, context_tensors)
 
 import warnings
 warnings.filterwarnings(action='once')
@@ -57,29 +62,6 @@ print("Training data loaded")
 
 # -
 
-def find_sublist_idx(x: list, y: list) -> int:
-    '''
-    Return the first index of the sublist in the list
-    Input:
-        - x: list
-        - y: sublist
-    Returns:
-        - index of the occurence of the sublist in the list
-    '''
-    occ = [i for i, a in enumerate(x) if a == y[0]]
-    
-    for b in occ:
-        # check if the full sublist is in the list
-        if x[b:b+len(y)] == y:
-            return b
-        if len(occ)-1 ==  occ.index(b):
-            # check all possible sublist candidates but not found the full sublist
-            # return the first occurrence. Be careful, it can lead to wrong results
-            # but in 99% of the cases should be fine.
-            # If we reach this case, it is becase the SRL model skipped some token
-            # i.e. B-arg0, I-arg0, O, I-arg0,...
-            return occ[0]
-    raise Exception("Sublist not in list")
 x = [0,1,2,3,4,5,6,7]
 y = [3,4,5]
 assert find_sublist_idx(x, y) == 3
@@ -121,9 +103,17 @@ class Dataset():
         self.list_entities_query = list_entities_query
         self.batch_size = batch_size
         self.max_len = max_len
+        # wordpiece encodings of the srl arguments and entities (filled in bulk
+        # by create_dataloader)
+        self.encoding_memo = EncodingMemo(self.tokenizer)
+        # memo of the entity pairs scored by multi_hop_edges
+        self.fuzzy_matcher = FuzzyMatcher()
         
     def create_dataloader(self):
         list_context, list_dict_idx = self.encode_all_sentences()
+        self.encoding_memo.add(collect_strings(
+            [self.dict_ins_doc_sent_srl_triples, self.list_hotpot_ner,
+             self.dict_ins_query_triples, self.list_entities_query]))
         list_graphs = []
         list_span_idx = []
         list_g_metadata = []
@@ -212,7 +202,9 @@ class Dataset():
             - list_list_sent_idx: list of list of idx (in encoding) of setences. The first dimension represents docs.
                 eg: [[70, 71, 72], [73, 74, 75, 76]], so 2 docs (3 sents, 4 sents)
         Return:
-            - context: input_ids of question and list of documents (with special tokens)
+            - context: input_ids of question and list of documents (with
+                special tokens), truncated to max_len but not padded (see
+                context_tensors in graph_utils.py)
             - dict_idx: dict with the idx of the query, doc, and sentences
                 eg: {'q': (1, 21),
                      'list_docs': [{'idx_doc': (22, 136),
@@ -256,11 +248,8 @@ class Dataset():
         context_attention_mask = [1] * len(context_input_ids)
         # token type 1 to evid doc
         context_token_type_ids.extend([1] * (len(context_input_ids)-len(context_token_type_ids)))
-        if len(context_input_ids) < self.max_len:
-            context_input_ids.extend([0]*(self.max_len-len(context_input_ids))) # 0 = [PAD]
-            context_attention_mask.extend([0] * (self.max_len-len(context_attention_mask)))
-            context_token_type_ids.extend([0] * (self.max_len-len(context_token_type_ids)))
-        else:
+        # no padding: each batch is padded to its longest context
+        if len(context_input_ids) > self.max_len:
             context_input_ids = context_input_ids[:self.max_len]
             context_attention_mask = context_attention_mask[:self.max_len]
             context_token_type_ids = context_token_type_ids[:self.max_len]
@@ -283,14 +272,12 @@ class Dataset():
         list_srl2query = []
         list_query2srl = []
         ### to tokens
-        list_doc2tok = []
-        list_tok2doc = []
-        list_sent2tok = []
-        list_tok2sent = []
-        list_srl2tok = []
-        list_tok2srl = []
-        list_ent2tok = []
-        list_tok2ent = []
+        # node -> token ranges. tok -> node edges are their reverse
+        # (SpanEdges.arrays(reverse=True))
+        doc2tok_edges = SpanEdges()  # lbl: [DOC2TOK]
+        sent2tok_edges = SpanEdges()  # lbl: [SENT2TOK]
+        srl2tok_edges = SpanEdges()  # lbl: [SRL2TOK]
+        ent2tok_edges = SpanEdges()  # lbl: [ENT2TOK]
         ## same level
         list_sent2sent = []
         list_srl2srl = []
@@ -298,7 +285,6 @@ class Dataset():
         list_srl_tmp2srl = []
         list_srl_loc2srl = []
         list_ent2ent_self = []
-        list_token2token = []
         ## multi-hop
         list_doc_multihop = []
         list_sent_multihop = []
@@ -341,13 +327,12 @@ class Dataset():
         
         list_ent_node2str = []
         dict_ent_str2ent_node = dict()
-        token_node_idx = 0
-        for i in range(self.max_len):
-            list_token_context_idx.append(ins_idx)
-            list_token_st_end_idx.append((i, i+1))
-            list_token2token.append((i, i))  # lbl: [TOK2TOK_SELF]
-            list_token_lbl.append(0)
-            token_node_idx += 1
+        # one token node per token of the context (not per position of a padded
+        # context)
+        num_tokens = len(context)
+        list_token_context_idx.extend([ins_idx] * num_tokens)
+        list_token_st_end_idx.extend((i, i+1) for i in range(num_tokens))
+        list_token_lbl.extend([0] * num_tokens)
         
         ans_str = hotpot_instance['answer']
         ans_encoded = self.tokenizer.encode(ans_str, add_special_tokens=False)
@@ -377,10 +362,9 @@ class Dataset():
             # end metada doc
             # add edges to its tokens
             (st, end) = doc_metadata['doc_token_st_end_idx']
-            end = min(end, self.max_len)
-            for tok in range(st, end):
-                list_doc2tok.append((current_doc_node, tok))  # lbl: [DOC2TOK]
-                list_tok2doc.append((tok, current_doc_node))  # lbl: [TOK2DOC]
+            end = min(end, num_tokens)
+            # lbl: [DOC2TOK], [TOK2DOC]
+            doc2tok_edges.add(current_doc_node, st, end)
             doc_idx = dict_idx['list_golden_doc_idx'][idx]
             #get supp sentences
             doc_title = hotpot_instance['context'][doc_idx][0]
@@ -394,7 +378,11 @@ class Dataset():
                 # hotpotqa contains some empty sentences
                 if sent_st == sent_end:
                     continue
-                sent_end = min(sent_end, self.max_len)
+                sent_end = min(sent_end, num_tokens)
+                # positions of the tokens of the sentence to locate its srl
+                # arguments and entities
+                sent_aligner = SpanAligner(context[sent_st:sent_end],
+                                           offset=sent_st, max_len=num_tokens)
                 # sent node
                 current_sent_node = sent_node_idx
                 sent_node_idx += 1
@@ -406,14 +394,14 @@ class Dataset():
                 list_sent_lbl.append(sent_lbl)
                 # end metada sent
                 
-                for tok in range(sent_st, sent_end):
-                    list_sent2tok.append((current_sent_node, tok))  # lbl: [SENT2TOK]
-                    list_tok2sent.append((tok, current_sent_node))  # lbl: [TOK2SENT]
+                # lbl: [SENT2TOK], [TOK2SENT]
+                sent2tok_edges.add(current_sent_node, sent_st, sent_end)
                 
                 if sent_lbl and not yn_ans:
                     try:
-                        ans_st_idx = find_sublist_idx(context[sent_st:sent_end], ans_encoded) + sent_st
-                        ans_end_idx = min(ans_st_idx + len(ans_encoded), self.max_len-1)
+                        ans_st_idx = sent_aligner.find(ans_encoded) + sent_st
+                        ans_end_idx = min(ans_st_idx + len(ans_encoded),
+                                          num_tokens - 1)
                     except:
                         pass
                 dict_sent_node2metadata[current_sent_node] = {'doc_idx': doc_idx, 'sent_idx': sent_idx}
@@ -436,13 +424,13 @@ class Dataset():
                     
                     if 'V' in triple_dict:
                         verb = triple_dict['V']
-                        rel_encoded = self.tokenizer.encode(verb, add_special_tokens=False)
+                        rel_encoded = self.encoding_memo.encode(verb)
                         # find location of the entity in the context (inputs ids)
                         # +sent_st 'cuz I need the index in the full context
                         # if I search using the full context instead of its sentence I may get a wrong entity (the entity may appear many times, including in the question)
                         try:
-                            st_tok_idx = find_sublist_idx(context[sent_st:sent_end], rel_encoded) + sent_st
-                            end_tok_idx = min(st_tok_idx + len(rel_encoded), self.max_len)
+                            st_tok_idx, end_tok_idx = (
+                                sent_aligner.locate(rel_encoded))
                             srl_rel['st_tok_idx'] = st_tok_idx
                             srl_rel['end_tok_idx'] = end_tok_idx
                         except:
@@ -455,12 +443,13 @@ class Dataset():
                                 # already processed it before the loop
                                 pass
                             elif arg_type == 'TMP':
-                                arg_encoded = self.tokenizer.encode(arg_str, add_special_tokens=False)
+                                arg_encoded = (
+                                    self.encoding_memo.encode(arg_str))
                                 # find location of the entity in the context (inputs ids)
                                 # +sent_st 'cuz I need the index in the full context
                                 # if I search using the full context instead of its sentence I may get a wrong entity (the entity may appear many times, including in the question)
-                                st_tok_idx = find_sublist_idx(context[sent_st:sent_end], arg_encoded) + sent_st
-                                end_tok_idx = min(st_tok_idx + len(arg_encoded), self.max_len)
+                                st_tok_idx, end_tok_idx = (
+                                    sent_aligner.locate(arg_encoded))
                                 # metadata
                                 list_srl_tmp_context_idx.append(ins_idx)
                                 list_srl_tmp_st_end_idx.append((st_tok_idx, end_tok_idx))
@@ -468,12 +457,13 @@ class Dataset():
                                 current_srl_tmp_node = srl_tmp_node_idx
                                 srl_tmp_node_idx += 1
                             elif arg_type == 'LOC':
-                                arg_encoded = self.tokenizer.encode(arg_str, add_special_tokens=False)
+                                arg_encoded = (
+                                    self.encoding_memo.encode(arg_str))
                                 # find location of the entity in the context (inputs ids)
                                 # +sent_st 'cuz I need the index in the full context
                                 # if I search using the full context instead of its sentence I may get a wrong entity (the entity may appear many times, including in the question)
-                                st_tok_idx = find_sublist_idx(context[sent_st:sent_end], arg_encoded) + sent_st
-                                end_tok_idx = min(st_tok_idx + len(arg_encoded), self.max_len)
+                                st_tok_idx, end_tok_idx = (
+                                    sent_aligner.locate(arg_encoded))
                                 # metadata
                                 list_srl_loc_context_idx.append(ins_idx)
                                 list_srl_loc_st_end_idx.append((st_tok_idx, end_tok_idx))
@@ -483,13 +473,14 @@ class Dataset():
                             else:
                                 if 'ARG' in arg_type and subject_srl == -1:
                                     subject_srl = srl_node_idx
-                                arg_encoded = self.tokenizer.encode(arg_str, add_special_tokens=False)
-                                arg_str = self.tokenizer.decode(arg_encoded)
+                                arg_encoded = (
+                                    self.encoding_memo.encode(arg_str))
+                                arg_str = self.encoding_memo.decode(arg_str)
                                 # find location of the entity in the context (inputs ids)
                                 # +sent_st 'cuz I need the index in the full context
                                 # if I search using the full context instead of its sentence I may get a wrong entity (the entity may appear many times, including in the question)
-                                st_tok_idx = find_sublist_idx(context[sent_st:sent_end], arg_encoded) + sent_st
-                                end_tok_idx = min(st_tok_idx + len(arg_encoded), self.max_len)
+                                st_tok_idx, end_tok_idx = (
+                                    sent_aligner.locate(arg_encoded))
                                 # metadata ent
                                 list_srl_context_idx.append(ins_idx)
                                 list_srl_st_end_idx.append((st_tok_idx, end_tok_idx))
@@ -502,25 +493,26 @@ class Dataset():
                                 list_arg_nodes.append(current_srl_node)
 #                                 print("SRL:", current_srl_node, arg_str)
                                 # srl <-> token
-                                for tok in range(st_tok_idx, end_tok_idx):
-                                    list_srl2tok.append((current_srl_node, tok))  # lbl: [SRL2TOK]
-                                    list_tok2srl.append((tok, current_srl_node))  # lbl: [TOK2SRL]
+                                # lbl: [SRL2TOK], [TOK2SRL]
+                                srl2tok_edges.add(current_srl_node, st_tok_idx,
+                                                  end_tok_idx)
                                 #######################################################
                                 # for each entity
                                 list_srl_ent = []
                                 for ent in list_entities[doc_idx][sent_idx]:
                                     try:
                                         # compute this beforehand ################################ here!!!!!!!!!!!!!!!!!!!
-                                        ent_encoded = self.tokenizer.encode(ent, add_special_tokens=False)
-                                        ent = self.tokenizer.decode(ent_encoded)
+                                        ent_encoded = (
+                                            self.encoding_memo.encode(ent))
+                                        ent = self.encoding_memo.decode(ent)
                                         if ent not in arg_str:
                                             continue
                                         list_srl_ent.append(ent)
                                         # find location of the entity in the context (inputs ids)
                                         # +sent_st 'cuz I need the index in the full context
                                         # if I search using the full context instead of its sentence I may get a wrong entity (the entity may appear many times, including in the question)
-                                        st_tok_idx = find_sublist_idx(context[sent_st:sent_end], ent_encoded) + sent_st
-                                        end_tok_idx = min(st_tok_idx + len(ent_encoded), self.max_len)
+                                        st_tok_idx, end_tok_idx = (
+                                            sent_aligner.locate(ent_encoded))
                                         
                                         lbl = (fuzz.token_set_ratio(ans_detokenized, ent) >= 90)
                                         if (not srl_lbl) and lbl:
@@ -548,9 +540,10 @@ class Dataset():
                                         list_ent2ent_self.append((current_ent_node, current_ent_node))  # lbl: [ENT2ENT_SELF]
                                         
                                         # srl -> token
-                                        for tok in range(st_tok_idx, end_tok_idx):
-                                            list_ent2tok.append((current_ent_node, tok))  # lbl: [ENT2TOK]
-                                            list_tok2ent.append((tok, current_ent_node))   # lbl: [TOK2ENT]
+                                        # lbl: [ENT2TOK], [TOK2ENT]
+                                        ent2tok_edges.add(
+                                            current_ent_node, st_tok_idx,
+                                            end_tok_idx)
                 #                         print("#### ent ", lbl, self.tokenizer.decode(context[st_tok_idx:end_tok_idx]))
                                     except:
                 #                         print(ent)
@@ -609,13 +602,14 @@ class Dataset():
 
             if 'V' in triple_dict:
                 verb = triple_dict['V']
-                rel_encoded = self.tokenizer.encode(verb, add_special_tokens=False)
+                rel_encoded = self.encoding_memo.encode(verb)
                 # find location of the entity in the context (inputs ids)
                 # +sent_st 'cuz I need the index in the full context
                 # if I search using the full context instead of its sentence I may get a wrong entity (the entity may appear many times, including in the question)
                 try:
                     st_tok_idx = find_sublist_idx(context[q_st:q_end], rel_encoded) + q_st
-                    end_tok_idx = min(st_tok_idx + len(rel_encoded), self.max_len)
+                    end_tok_idx = min(st_tok_idx + len(rel_encoded),
+                                      num_tokens)
                     srl_rel['st_tok_idx'] = st_tok_idx
                     srl_rel['end_tok_idx'] = end_tok_idx
                 except:
@@ -629,12 +623,13 @@ class Dataset():
                         # already processed it before the loop
                         continue
                     elif arg_type == 'TMP':
-                        arg_encoded = self.tokenizer.encode(arg_str, add_special_tokens=False)
+                        arg_encoded = self.encoding_memo.encode(arg_str)
                         # find location of the entity in the context (inputs ids)
                         # +sent_st 'cuz I need the index in the full context
                         # if I search using the full context instead of its sentence I may get a wrong entity (the entity may appear many times, including in the question)
                         st_tok_idx = find_sublist_idx(context[q_st:q_end], arg_encoded) + q_st
-                        end_tok_idx = min(st_tok_idx + len(arg_encoded), self.max_len)
+                        end_tok_idx = min(st_tok_idx + len(arg_encoded),
+                                          num_tokens)
                         # metadata
                         list_srl_tmp_context_idx.append(ins_idx)
                         list_srl_tmp_st_end_idx.append((st_tok_idx, end_tok_idx))
@@ -642,12 +637,13 @@ class Dataset():
                         current_srl_tmp_node = srl_tmp_node_idx
                         srl_tmp_node_idx += 1
                     elif arg_type == 'LOC':
-                        arg_encoded = self.tokenizer.encode(arg_str, add_special_tokens=False)
+                        arg_encoded = self.encoding_memo.encode(arg_str)
                         # find location of the entity in the context (inputs ids)
                         # +sent_st 'cuz I need the index in the full context
                         # if I search using the full context instead of its sentence I may get a wrong entity (the entity may appear many times, including in the question)
                         st_tok_idx = find_sublist_idx(context[sent_st:sent_end], arg_encoded) + sent_st
-                        end_tok_idx = min(st_tok_idx + len(arg_encoded), self.max_len)
+                        end_tok_idx = min(st_tok_idx + len(arg_encoded),
+                                          num_tokens)
                         # metadata
                         list_srl_loc_context_idx.append(ins_idx)
                         list_srl_loc_st_end_idx.append((st_tok_idx, end_tok_idx))
@@ -657,13 +653,14 @@ class Dataset():
                     else:
                         if 'ARG' in arg_type and subject_srl == -1:
                             subject_srl = srl_node_idx
-                        arg_encoded = self.tokenizer.encode(arg_str, add_special_tokens=False)
-                        arg_str = self.tokenizer.decode(arg_encoded)
+                        arg_encoded = self.encoding_memo.encode(arg_str)
+                        arg_str = self.encoding_memo.decode(arg_str)
                         # find location of the entity in the context (inputs ids)
                         # +sent_st 'cuz I need the index in the full context
                         # if I search using the full context instead of its sentence I may get a wrong entity (the entity may appear many times, including in the question)
                         st_tok_idx = find_sublist_idx(context[q_st:q_end], arg_encoded) + q_st
-                        end_tok_idx = min(st_tok_idx + len(arg_encoded), self.max_len)
+                        end_tok_idx = min(st_tok_idx + len(arg_encoded),
+                                          num_tokens)
                         # metadata ent
                         list_srl_context_idx.append(ins_idx)
                         list_srl_st_end_idx.append((st_tok_idx, end_tok_idx))
@@ -676,17 +673,17 @@ class Dataset():
                         list_arg_nodes.append(current_srl_node)
 
                         # srl <-> token
-                        for tok in range(st_tok_idx, end_tok_idx):
-                            list_srl2tok.append((current_srl_node, tok))  # lbl: [SRL2TOK]
-                            list_tok2srl.append((tok, current_srl_node))  # lbl: [TOK2SRL]
+                        # lbl: [SRL2TOK], [TOK2SRL]
+                        srl2tok_edges.add(current_srl_node, st_tok_idx,
+                                          end_tok_idx)
                         #######################################################
                         # for each entity
                         list_srl_ent = []
                         for ent in self.list_entities_query[ins_idx]:
                             try:
                                 # compute this beforehand ################################ here!!!!!!!!!!!!!!!!!!!
-                                ent_encoded = self.tokenizer.encode(ent, add_special_tokens=False)
-                                ent = self.tokenizer.decode(ent_encoded)
+                                ent_encoded = self.encoding_memo.encode(ent)
+                                ent = self.encoding_memo.decode(ent)
                                 if ent not in arg_str:
                                     continue
                                 list_srl_ent.append(ent)
@@ -694,7 +691,8 @@ class Dataset():
                                 # +sent_st 'cuz I need the index in the full context
                                 # if I search using the full context instead of its sentence I may get a wrong entity (the entity may appear many times, including in the question)
                                 st_tok_idx = find_sublist_idx(context[q_st:q_end], ent_encoded) + q_st
-                                end_tok_idx = min(st_tok_idx + len(ent_encoded), self.max_len)
+                                end_tok_idx = min(
+                                    st_tok_idx + len(ent_encoded), num_tokens)
 
                                 lbl = (fuzz.token_set_ratio(ans_detokenized, ent) >= 90)
                                 if (not srl_lbl) and lbl:
@@ -720,9 +718,9 @@ class Dataset():
                                 list_ent2ent_self.append((current_ent_node, current_ent_node))  # lbl: [ENT2ENT_SELF]
                                 
                                 # srl -> token
-                                for tok in range(st_tok_idx, end_tok_idx):
-                                    list_ent2tok.append((current_ent_node, tok))  # lbl: [ENT2TOK]
-                                    list_tok2ent.append((tok, current_ent_node))   # lbl: [TOK2ENT]
+                                # lbl: [ENT2TOK], [TOK2ENT]
+                                ent2tok_edges.add(current_ent_node, st_tok_idx,
+                                                  end_tok_idx)
         #                         print("#### ent ", lbl, self.tokenizer.decode(context[st_tok_idx:end_tok_idx]))
                             except:
         #                         print(ent)
@@ -770,14 +768,16 @@ class Dataset():
                                                           list_srl2query,
                                                           90)
         # make the heterogenous graph
-        list_srl2self = [(v, v) for v in range(srl_node_idx)]
+        list_srl2self = self_loop_arrays(srl_node_idx)
         dict_edges = {
                      ('srl', 'srl2ent', 'ent'): list_srl2ent,     # lbl: [SRL2ENT]
                       ('ent', 'ent2srl', 'srl'): list_ent2srl,     # lbl: [ENT2SRL]
                       
                      # to token
-                     ('srl', 'srl2tok', 'tok'): list_srl2tok,     # lbl: [SRL2TOK]
-                     ('ent', 'ent2tok', 'tok'): list_ent2tok,     # lbl: [ENT2TOK]
+                     # lbl: [SRL2TOK]
+                     ('srl', 'srl2tok', 'tok'): srl2tok_edges,
+                     # lbl: [ENT2TOK]
+                     ('ent', 'ent2tok', 'tok'): ent2tok_edges,
                      # end hierarchical
                      # same-level edges
                      ('doc', 'doc2doc_self', 'doc'): list_doc2doc,         # lbl: [DOC2DOC_SELF]
@@ -785,7 +785,9 @@ class Dataset():
                      ('srl', 'srl2srl', 'srl'): list_srl2srl,         # lbl: [SRL2SRL]
                      ('srl', 'srl2self', 'srl'): list_srl2self,         # lbl: [SRL2SELF]
                      ('ent', 'ent2ent_self', 'ent'): list_ent2ent_self,         # lbl: [ENT2ENT_SELF]
-                     ('tok', 'token2token_self', 'tok'): list_token2token, # lbl: [TOK2TOK_SELF]
+                     # lbl: [TOK2TOK_SELF]
+                     ('tok', 'token2token_self', 'tok'):
+                         self_loop_arrays(num_tokens),
                      # multi-hop edges
                      ('ent', 'ent_multihop', 'ent'): list_ent_multihop,
                      ('srl', 'srl_multihop', 'srl'): list_srl_multihop,
@@ -799,7 +801,7 @@ class Dataset():
             dict_edges[('srl', 'srl2query', 'query')] = list_srl2query
         if list_query2srl != []:
             dict_edges[('query', 'query2srl', 'srl')] = list_query2srl
-        graph = dgl.heterograph(dict_edges)
+        graph = build_heterograph(dict_edges)
         graph_metadata = dict()
         # srl metadata
         graph_metadata['srl'] = dict()
@@ -899,27 +901,8 @@ class Dataset():
         return set_supporting_doc_titles
     
     def create_common_entity_edges_sent_lvl(self, dict_sent_node2metadata: dict, list_hotpot_instance_ner: list) -> list:
-        '''
-        Input: dict {node_idx: {'doc_idx': doc_idx, 'sent_idx': sent_idx}}
-        Output: [(node_i, node_j)]
-        Check all sentences in a hotpot instance with common named entities
-        Cost: O(n^2)
-        '''
-        list_ent_edges = []
-        for (node_i, dict_sent_i) in dict_sent_node2metadata.items():
-            for (node_j, dict_sent_j) in dict_sent_node2metadata.items():
-                if node_i != node_j:
-                    doc_i = dict_sent_i['doc_idx']
-                    sent_i = dict_sent_i['sent_idx']
-                    doc_j = dict_sent_j['doc_idx']
-                    sent_j = dict_sent_j['sent_idx']
-                    try:
-                        if self.intersection(list_hotpot_instance_ner[doc_i][sent_i], 
-                                             list_hotpot_instance_ner[doc_j][sent_j]):
-                            list_ent_edges.append((node_i, node_j))
-                    except:
-                        pass
-        return list_ent_edges
+        return common_entity_edges_sent_lvl(dict_sent_node2metadata,
+                                            list_hotpot_instance_ner)
     
     def create_common_entity_edges_srl_lvl(self, dict_srl_node2list_ent: dict):
         list_edges = []
@@ -940,9 +923,6 @@ class Dataset():
             list_edges.extend([(u, v) for u in list_srl for v in list_srl if u != v])
         return list_edges
 
-    def intersection(self, l1: list, l2: list) -> set:
-        return set(l1).intersection(l2)
-    
     def multi_hop_edges(self, list_ent_nodes, list_ent_str, list_ent2srl, list_srl2sent, list_srl2query, threshold):
 #         print("######################## num ent", max(list_ent_nodes))
 #         print("ent2srl", list_ent2srl)
@@ -963,43 +943,43 @@ class Dataset():
         list_sent_multihop = []
         list_sent2query_multihop = []
         list_query2sent_multihop = []
-        for e1 in list_ent_nodes:
-            for e2 in list_ent_nodes:
-                if e1 < e2:
-                    e1_str = list_ent_str[e1]
-                    e2_str = list_ent_str[e2]
-                    if fuzz.token_set_ratio(e1_str, e2_str) >= threshold:
+        # only the pairs that can reach the threshold are scored (same pairs
+        # and order as comparing all of them)
+        list_pairs = self.fuzzy_matcher.matching_pairs(list_ent_nodes,
+                                                       list_ent_str, threshold)
+        for (e1, e2) in list_pairs:
 #                         print(e1_str, e2_str, fuzz.token_set_ratio(e1_str, e2_str))
-                        # ent
-                        list_ent_multihop.append((e1, e2))  # LBL: [ENT2ENT_MULTIHOP]
-                        list_ent_multihop.append((e2, e1))  # LBL: [ENT2ENT_MULTIHOP]
-                        # srl
-                        srl1 = dict_ent2srl[e1]
-                        srl2 = dict_ent2srl[e2]
-                        list_srl_multihop.append((srl1, srl2))  # LBL: [SRL2SRL_MULTIHOP]
-                        list_srl_multihop.append((srl2, srl1))  # LBL: [SRL2SRL_MULTIHOP]
-                        # sent
-                        sent1 = None
-                        sent2 = None
-                        q_node = None
-                        if srl1 in dict_srl2sent:
-                            sent1 = dict_srl2sent[srl1]
-                        elif srl1 in dict_srl2query:
-                            q_node = dict_srl2query[srl]
-                        if srl2 in dict_srl2sent:
-                            sent2 = dict_srl2sent[srl2]
-                        elif srl2 in dict_srl2query:
-                            q_node = dict_srl2query[srl]
-                        if sent1 is not None and sent2 is not None:
-                            list_sent_multihop.append((sent1, sent2))  # LBL: [SENT2SENT_MULTIHOP]
-                            list_sent_multihop.append((sent2, sent1))  # LBL: [SENT2SENT_MULTIHOP]
+            # ent
+            list_ent_multihop.append((e1, e2))  # LBL: [ENT2ENT_MULTIHOP]
+            list_ent_multihop.append((e2, e1))  # LBL: [ENT2ENT_MULTIHOP]
+            # srl
+            srl1 = dict_ent2srl[e1]
+            srl2 = dict_ent2srl[e2]
+            list_srl_multihop.append((srl1, srl2))  # LBL: [SRL2SRL_MULTIHOP]
+            list_srl_multihop.append((srl2, srl1))  # LBL: [SRL2SRL_MULTIHOP]
+            # sent
+            sent1 = None
+            sent2 = None
+            q_node = None
+            if srl1 in dict_srl2sent:
+                sent1 = dict_srl2sent[srl1]
+            elif srl1 in dict_srl2query:
+                q_node = dict_srl2query[srl]
+            if srl2 in dict_srl2sent:
+                sent2 = dict_srl2sent[srl2]
+            elif srl2 in dict_srl2query:
+                q_node = dict_srl2query[srl]
+            if sent1 is not None and sent2 is not None:
+                # LBL: [SENT2SENT_MULTIHOP]
+                list_sent_multihop.append((sent1, sent2))
+                list_sent_multihop.append((sent2, sent1))
 #                             print(sent1, sent2, srl1, srl2, e1, e2, e1_str, e2_str, fuzz.token_set_ratio(e1_str, e2_str))
-                        elif sent1 is None and (sent2 is not None and q_node is not None):
-                            list_sent2query_multihop.append((sent2, query))
-                            list_query2sent_multihop.append((query, sent2))
-                        elif sent2 is None and (sent1 is not None and q_node is not None):
-                            list_sent2query_multihop.append((sent1, query))
-                            list_query2sent_multihop.append((query, sent1))
+            elif sent1 is None and (sent2 is not None and q_node is not None):
+                list_sent2query_multihop.append((sent2, query))
+                list_query2sent_multihop.append((query, sent2))
+            elif sent2 is None and (sent1 is not None and q_node is not None):
+                list_sent2query_multihop.append((sent1, query))
+                list_query2sent_multihop.append((query, sent1))
         
         list_ent_multihop = list(set(list_ent_multihop))
 #         for (e1, e2) in list_ent_multihop:
@@ -1064,13 +1044,10 @@ def natural_sort(l):
 #     dgl.save_graphs(f, [graph])
 
 # +
-list_input_ids = [context['input_ids'] for context in list_context]
-list_token_type_ids = [context['token_type_ids'] for context in list_context]
-list_attention_masks = [context['attention_mask'] for context in list_context]
-
-tensor_input_ids = torch.tensor(list_input_ids)
-tensor_token_type_ids = torch.tensor(list_token_type_ids)
-tensor_attention_masks = torch.tensor(list_attention_masks)
+# contexts padded to the longest one (HGNModel trims each batch to its longest
+# context)
+(tensor_input_ids, tensor_attention_masks,
+ tensor_token_type_ids) = context_tensors(list_context)
 
 torch.save(tensor_input_ids, os.path.join(training_path, 'tensor_input_ids.p'))
 torch.save(tensor_token_type_ids, os.path.join(training_path, 'tensor_token_type_ids.p'))
@@ -1104,12 +1081,10 @@ for g_idx, list_dict_edge in enumerate(list_list_srl_edges_metadata):
     list_graphs[g_idx].edges['srl2srl'].data['rel_type'] = torch.tensor([edge['rel_type'] for edge in list_dict_edge])
     list_graphs[g_idx].edges['srl2srl'].data['span_idx'] = torch.tensor([edge['span_idx'] for edge in list_dict_edge])
 
-list_input_ids = [context['input_ids'] for context in list_context]
-list_token_type_ids = [context['token_type_ids'] for context in list_context]
-list_attention_masks = [context['attention_mask'] for context in list_context]
-tensor_input_ids = torch.tensor(list_input_ids)
-tensor_token_type_ids = torch.tensor(list_token_type_ids)
-tensor_attention_masks = torch.tensor(list_attention_masks)
+# contexts padded to the longest one (HGNModel trims each batch to its longest
+# context)
+(tensor_input_ids, tensor_attention_masks,
+ tensor_token_type_ids) = context_tensors(list_context)
 # -
 
 dev_path = os.path.join(data_path, 'processed/dev/heterog_20200828_query_srl_ent')
@@ -8,11 +8,12 @@ import warnings
 import re
 import math
 
-from os import listdir
-from os.path import isfile, join
 from dgl.data.utils import load_graphs
 
 from tqdm import tqdm, trange
+from torch.utils.data import DataLoader
+from src.data.graph_store import GraphStore
+from src.data.graph_dataset import GraphDataset, GraphDatasetCollator
 
 import numpy as np
 import torch
@@ -32,6 +33,10 @@ warnings.filterwarnings(action='once')
 os.environ['DGLBACKEND'] = 'pytorch'
 
 import random
+import time
+import resource
+# time-to-first-step is measured from here
+script_t0 = time.time()
 random_seed = 2020
 # Set the seed value all over the place to make this reproducible.
 random.seed(random_seed)
@@ -88,16 +93,11 @@ pretrained_weights = 'bert-base-uncased'
 training_path = os.path.join(data_path, "processed/training/hsgn_2021_fix/")
 dev_path = os.path.join(data_path, "processed/dev/hsgn_2021_fix/")
 
-with open(os.path.join(training_path, 'list_span_idx.p'), 'rb') as f:
-    list_span_idx = pickle.load(f)
-
-tensor_input_ids = torch.load(os.path.join(training_path, 'tensor_input_ids.p'))
-tensor_token_type_ids = torch.load(os.path.join(training_path, 'tensor_token_type_ids.p'))
-tensor_attention_masks = torch.load(os.path.join(training_path, 'tensor_attention_masks.p'))
-
-tensor_input_ids = tensor_input_ids.to(device)
-tensor_attention_masks = tensor_attention_masks.to(device)
-tensor_token_type_ids = tensor_token_type_ids.to(device)
+# graphs (with their metadata) are materialized on demand from the
+# memory-mapped store (created with python -m src.data.graph_store from the
+# graphs/ and metadata/ pickles). Input tensors stay on cpu and each batch is
+# moved to the gpu in the training loop
+train_dataset = GraphDataset(training_path)
 
 
 # %%
@@ -107,10 +107,6 @@ dev_tensor_input_ids = torch.load(os.path.join(dev_path, 'tensor_input_ids.p'))
 dev_tensor_token_type_ids = torch.load(os.path.join(dev_path, 'tensor_token_type_ids.p'))
 dev_tensor_attention_masks = torch.load(os.path.join(dev_path, 'tensor_attention_masks.p'))
 
-dev_tensor_input_ids = dev_tensor_input_ids.to(device)
-dev_tensor_attention_masks = dev_tensor_attention_masks.to(device)
-dev_tensor_token_type_ids = dev_tensor_token_type_ids.to(device)
-
 
 # %%
 def natural_sort(l): 
@@ -129,42 +125,7 @@ def add_metadata2graph(graph, metadata):
 
 
 # %%
-training_graphs_path = os.path.join(training_path, 'graphs')
-training_metadata_path = os.path.join(training_path, 'metadata')
-
-list_graph_files = natural_sort([f for f in listdir(training_graphs_path) if isfile(join(training_graphs_path, f))])
-list_metadata_files = natural_sort([f for f in listdir(training_metadata_path) if isfile(join(training_metadata_path, f))])
-list_graph_metadata_files = list(zip(list_graph_files, list_metadata_files))
-
-list_graphs = []
-for (g_file, metadata_file) in tqdm(list_graph_metadata_files):
-    if ".bin" in g_file:
-        with open(os.path.join(training_graphs_path, g_file), "rb") as f:
-            graph = pickle.load(f)
-        with open(os.path.join(training_metadata_path, metadata_file), "rb") as f:
-            metadata = pickle.load(f)
-        # add metadata to the graph
-        graph = add_metadata2graph(graph, metadata)
-        list_graphs.append(graph)
-
-# %%
-dev_graphs_path = os.path.join(dev_path, 'graphs/')
-dev_metadata_path = os.path.join(dev_path, 'metadata/')
-
-list_graph_files = natural_sort([f for f in listdir(dev_graphs_path) if isfile(join(dev_graphs_path, f))])
-list_metadata_files = natural_sort([f for f in listdir(dev_metadata_path) if isfile(join(dev_metadata_path, f))])
-list_graph_metadata_files = list(zip(list_graph_files, list_metadata_files))
-
-dev_list_graphs = []
-for (g_file, metadata_file) in tqdm(list_graph_metadata_files):
-    if ".bin" in g_file:
-        with open(os.path.join(dev_graphs_path, g_file), "rb") as f:
-            graph = pickle.load(f)
-        with open(os.path.join(dev_metadata_path, metadata_file), "rb") as f:
-            metadata = pickle.load(f)
-        # add metadata to the graph
-        graph = add_metadata2graph(graph, metadata)
-        dev_list_graphs.append(graph)
+dev_list_graphs = GraphStore(os.path.join(dev_path, 'graph_store'))
 
 # %%
 # def graph_for_eval(graph):
@@ -231,6 +192,160 @@ class NodeNorm(nn.Module):
         x = (x - mean) / std
         return x
 
+# %%
+def batch_num_nodes(graph, ntype):
+    '''
+    Number of nodes of type ntype of each graph of a (batched) graph
+    '''
+    if hasattr(graph, 'batch_num_nodes'):
+        return torch.as_tensor(graph.batch_num_nodes(ntype))
+    return torch.tensor([graph.number_of_nodes(ntype)])
+
+def batch_num_edges(graph, etype):
+    '''
+    Number of edges of type etype of each graph of a (batched) graph
+    '''
+    if hasattr(graph, 'batch_num_edges'):
+        return torch.as_tensor(graph.batch_num_edges(etype))
+    return torch.tensor([graph.number_of_edges(etype)])
+
+def nodes_in_graphs_with_edges(graph, ntype, etype):
+    '''
+    Boolean mask of the nodes of type ntype of a (batched) graph that belong to
+    a graph with edges of type etype
+    '''
+    has_edges = batch_num_edges(graph, etype) > 0
+    return has_edges[graph_ids(batch_num_nodes(graph, ntype))]
+
+def graph_ids(batch_num):
+    '''
+    Graph idx of each node (or edge) of a batched graph given the number of
+    nodes (edges) of each graph
+    '''
+    batch_num = torch.as_tensor(batch_num)
+    return torch.repeat_interleave(torch.arange(len(batch_num)), batch_num)
+
+def pad_by_graph(x, node_graph_ids, batch_size, pad_value=0.):
+    '''
+    Inputs:
+        - x: features of the nodes of a batched graph [#nodes, ...] (sorted by
+            graph)
+        - node_graph_ids: graph idx of each node
+    Returns:
+        - tensor of shape [batch_size, max #nodes in a graph, ...] padded with
+            pad_value
+    '''
+    counts = torch.bincount(node_graph_ids, minlength=batch_size)
+    first_node = torch.cumsum(counts, dim=0) - counts
+    pos = (torch.arange(len(node_graph_ids), device=node_graph_ids.device)
+           - first_node[node_graph_ids])
+    out = x.new_full((batch_size, int(counts.max())) + tuple(x.shape[1:]),
+                     pad_value)
+    out[node_graph_ids, pos] = x
+    return out
+
+def to_common_schema(graph, canonical_etypes, ntypes, dict_ntype2feats,
+                     dict_etype2feats):
+    '''
+    Returns a copy of graph with all the node and edge types (and features) of
+    a batch. Missing types have 0 nodes (edges) and missing features are empty.
+    '''
+    dict_edges = dict()
+    for (src_type, etype, dst_type) in canonical_etypes:
+        if etype in graph.etypes:
+            dict_edges[(src_type, etype, dst_type)] = graph.edges(etype=etype)
+        else:
+            dict_edges[(src_type, etype, dst_type)] = (
+                torch.tensor([], dtype=torch.long),
+                torch.tensor([], dtype=torch.long))
+    num_nodes_dict = {ntype: (graph.number_of_nodes(ntype)
+                              if ntype in graph.ntypes else 0)
+                      for ntype in ntypes}
+    new_graph = dgl.heterograph(dict_edges, num_nodes_dict)
+    for ntype, dict_feats in dict_ntype2feats.items():
+        for k, v in dict_feats.items():
+            if ntype in graph.ntypes and k in graph.nodes[ntype].data:
+                new_graph.nodes[ntype].data[k] = graph.nodes[ntype].data[k]
+            else:
+                new_graph.nodes[ntype].data[k] = v.new_zeros(
+                    (new_graph.number_of_nodes(ntype),) + tuple(v.shape[1:]))
+    for etype, dict_feats in dict_etype2feats.items():
+        for k, v in dict_feats.items():
+            if etype in graph.etypes and k in graph.edges[etype].data:
+                new_graph.edges[etype].data[k] = graph.edges[etype].data[k]
+            else:
+                new_graph.edges[etype].data[k] = v.new_zeros(
+                    (new_graph.number_of_edges(etype),) + tuple(v.shape[1:]))
+    return new_graph
+
+def batch_graphs(list_graphs):
+    '''
+    dgl.batch for heterographs that do not have the same node and edge types
+    (e.g., graphs without entities). The graphs are converted to the union of
+    their types.
+    '''
+    if len(list_graphs) == 1:
+        return list_graphs[0]
+    canonical_etypes = sorted(
+        set(c_etype for g in list_graphs for c_etype in g.canonical_etypes))
+    ntypes = sorted(set(ntype for g in list_graphs for ntype in g.ntypes))
+    # one example of each feature to create the features of the missing types
+    dict_ntype2feats = dict()
+    dict_etype2feats = dict()
+    for g in list_graphs:
+        for ntype in g.ntypes:
+            for k, v in g.nodes[ntype].data.items():
+                dict_ntype2feats.setdefault(ntype, dict()).setdefault(k, v)
+        for etype in g.etypes:
+            for k, v in g.edges[etype].data.items():
+                dict_etype2feats.setdefault(etype, dict()).setdefault(k, v)
+    list_graphs = [to_common_schema(g, canonical_etypes, ntypes,
+                                    dict_ntype2feats, dict_etype2feats)
+                   for g in list_graphs]
+    if hasattr(dgl, 'batch_hetero'):
+        # dgl < 0.5
+        return dgl.batch_hetero(list_graphs)
+    return dgl.batch(list_graphs)
+
+class GraphCollator():
+    '''
+    collate_fn of a DataLoader over instance indexes.
+    Returns the batched graph and the indexes of the instances of the batch
+    '''
+    def __init__(self, list_graphs):
+        self.list_graphs = list_graphs
+
+    def __call__(self, list_idx):
+        list_graphs = [self.list_graphs[idx] for idx in list_idx]
+        return batch_graphs(list_graphs), list_idx
+
+def split_batch_output(output, batch_size):
+    '''
+    Splits the output of HGNModel.forward for a batch into a list with the
+    output of each instance (same format as the output for a batch of size 1)
+    '''
+    list_output = []
+    for i in range(batch_size):
+        output_i = {'loss': output['loss']}
+        for ntype in ['sent', 'srl', 'ent']:
+            node_output = output[ntype]
+            if node_output['graph_ids'] is None:
+                output_i[ntype] = dict(node_output)
+                continue
+            mask = node_output['graph_ids'] == i
+            output_i[ntype] = {
+                k: (v[mask.to(v.device)]
+                    if torch.is_tensor(v) and v.dim() > 0
+                    and v.shape[0] == mask.shape[0] else v)
+                for k, v in node_output.items()}
+        output_i['ans_type'] = {'loss': output['ans_type']['loss'],
+                                'logits': output['ans_type']['logits'][i:i+1]}
+        output_i['span'] = {
+            k: v[i:i+1] if torch.is_tensor(v) and v.dim() > 1 else v
+            for k, v in output['span'].items()}
+        list_output.append(output_i)
+    return list_output
+
 # %%
 class GAT(nn.Module):
     def __init__(self,
@@ -278,6 +393,74 @@ class GAT(nn.Module):
 
 
 # %%
+def span_mean(token_emb, span_idx):
+    '''
+    Mean of token_emb[x:y] for each (x, y) in span_idx using a prefix sum over
+    the tokens
+    Inputs:
+        - token_emb shape [#tokens, dim]
+        - span_idx shape [#spans, 2]
+    Returns:
+        - tensor of shape [#spans, dim]
+    '''
+    span_idx = span_idx.to(token_emb.device).long()
+    span_idx = span_idx.clamp(max=token_emb.shape[0])
+    prefix_sum = torch.cat((token_emb.new_zeros(1, token_emb.shape[1]),
+                            torch.cumsum(token_emb, dim=0)), dim=0)
+    x, y = span_idx[:, 0], span_idx[:, 1]
+    lengths = (y - x).unsqueeze(1).to(token_emb.dtype)
+    return (prefix_sum[y] - prefix_sum[x]) / lengths
+
+REL_ETYPES = ['srl2srl', 'ent2ent_rel']
+
+# node types with a classifier (HGNModel.{ntype}_classifier)
+NODE_CLF_TYPES = ['sent', 'srl', 'ent']
+
+def classify_nodes(list_classifiers, query_emb, list_node_emb,
+                   list_node_graph_ids):
+    '''
+    Fused evaluation of node classifiers nn.Sequential(Linear(2*d, h), ReLU(),
+    Linear(h, 2)) on cat(query, node). The first layer is split into its query
+    and node parts: the query of each graph is projected once for all the
+    classifiers (instead of being concatenated to each of its nodes), and the
+    second layer is a single matmul over the nodes of all the node types.
+    Inputs:
+        - list_classifiers: classifier of each node type
+        - query_emb shape [batch size, d]
+        - list_node_emb: embeddings of the nodes of each node type, shape
+            [#nodes, d]
+        - list_node_graph_ids: graph of each of these nodes, shape [#nodes]
+    Returns:
+        - list with the logits of each node type, shape [#nodes, 2]
+    '''
+    d = query_emb.shape[1]
+    num_clf = len(list_classifiers)
+    hidden_size = list_classifiers[0][0].out_features
+    w1_query = torch.cat([clf[0].weight[:, :d] for clf in list_classifiers])
+    # shape [num_clf * hidden_size, d]
+    b1 = torch.cat([clf[0].bias for clf in list_classifiers])
+    w2 = torch.cat([clf[2].weight for clf in list_classifiers])
+    # shape [num_clf * 2, hidden_size]
+    b2 = torch.cat([clf[2].bias for clf in list_classifiers])
+    list_num_nodes = [node_emb.shape[0] for node_emb in list_node_emb]
+    # classifier of each node
+    clf_idx = torch.repeat_interleave(
+        torch.arange(num_clf, device=query_emb.device),
+        torch.tensor(list_num_nodes, device=query_emb.device))
+    node_idx = torch.arange(clf_idx.shape[0], device=query_emb.device)
+    node_graph_ids = torch.cat(list_node_graph_ids).to(query_emb.device)
+    query_proj = F.linear(query_emb, w1_query, b1).view(-1, num_clf,
+                                                        hidden_size)
+    # shape [batch size, num_clf, hidden_size]
+    node_proj = torch.cat([F.linear(node_emb, clf[0].weight[:, d:])
+                           for clf, node_emb in zip(list_classifiers,
+                                                    list_node_emb)])
+    # shape [#nodes, hidden_size]
+    hidden = F.relu(node_proj + query_proj[node_graph_ids, clf_idx])
+    logits = F.linear(hidden, w2, b2).view(-1, num_clf, 2)[node_idx, clf_idx]
+    return list(torch.split(logits, list_num_nodes))
+
+
 class HeteroRGCNLayer(nn.Module):
     def __init__(self, in_size, out_size, feat_drop=0., attn_drop=0.):
         super(HeteroRGCNLayer, self).__init__()
@@ -299,13 +482,12 @@ class HeteroRGCNLayer(nn.Module):
         '''
         m_ij = R_ji * W * h_j
         '''
-        # relation emb
-        rel_span_idx = edges.data['span_idx']  # idx at context level
-        rel_emb = []
-        for i, (x, y) in enumerate(rel_span_idx):
-            # rel type = {1, -1}
-            rel_emb.append(torch.mean(bert_token_emb[x:y], dim=0))
-        rel_emb = torch.stack(rel_emb, dim=0)
+        # relation emb (computed once per forward by HeteroRGCN)
+        if 'rel_emb' in edges.data:
+            rel_emb = edges.data['rel_emb']
+        else:
+            # idx at context level
+            rel_emb = span_mean(bert_token_emb, edges.data['span_idx'])
         assert not torch.isnan(rel_emb).any()
 #         return {'rel': rel_emb, 'srl': edges.src['h']}
         src = edges.src['h']
@@ -384,11 +566,23 @@ class HeteroRGCNLayer(nn.Module):
         h_srl = G.nodes['tok'].data.pop('h_srl').view(1,-1,self.out_size)
         gru_input = torch.cat((h_srl, h_tok), dim=0)  
         if 'h_ent' in G.nodes['tok'].data:
-            # there can be an instance without entities (not common anyway)
+            # there can be an instance without entities (not common anyway).
+            # Only the tokens of the graphs with entities have the entity step,
+            # so each instance of a batch gets the same output as by itself
             h_ent = G.nodes['tok'].data.pop('h_ent').view(1,-1,self.out_size)
-            gru_input = torch.cat((h_ent, h_tok), dim=0)
-            gru_input = torch.cat((h_srl, gru_input), dim=0)  
-        G.nodes['tok'].data['h'] = self.gru_node2tok(gru_input)[0][-1]
+            ent_mask = nodes_in_graphs_with_edges(G, 'tok', 'ent2tok')
+            ent_mask = ent_mask.to(h_tok.device)
+            gru_ent_input = torch.cat((h_srl, h_ent, h_tok), dim=0)
+            gru = self.gru_node2tok
+            if ent_mask.all():
+                G.nodes['tok'].data['h'] = gru(gru_ent_input)[0][-1]
+            else:
+                h = h_tok.new_empty(h_tok.shape[1:])
+                h[ent_mask] = gru(gru_ent_input[:, ent_mask])[0][-1]
+                h[~ent_mask] = gru(gru_input[:, ~ent_mask])[0][-1]
+                G.nodes['tok'].data['h'] = h
+        else:
+            G.nodes['tok'].data['h'] = self.gru_node2tok(gru_input)[0][-1]
 
         out = {ntype : G.nodes[ntype].data.pop('h') for ntype in G.ntypes}
         # return the updated node feature dictionary
@@ -455,6 +649,22 @@ class HeteroRGCN(nn.Module):
     def forward(self, G, emb, bert_token_emb):
         #h_tok0 = emb['tok'].view(1,-1,self.in_size) # it's already normalized
         h_dict0 = {k: self.node_norm(h) for k, h in emb.items()}
+        # bert_token_emb shape [batch size, #max len, 768] ->
+        # [batch size * #max len, 768]
+        max_len = bert_token_emb.shape[1]
+        bert_token_emb = bert_token_emb.reshape(-1, bert_token_emb.shape[-1])
+        # the relation embeddings only depend on the bert token embeddings,
+        # so they are shared by all the layers and heads
+        for etype in REL_ETYPES:
+            if etype in G.etypes and G.number_of_edges(etype) > 0:
+                span_idx = G.edges[etype].data['span_idx'].to(
+                    bert_token_emb.device).long().clamp(max=max_len)
+                # the span idx are at context level, so add the offset of the
+                # context of each graph
+                offset = graph_ids(batch_num_edges(G, etype)).to(
+                    bert_token_emb.device).unsqueeze(1) * max_len
+                G.edges[etype].data['rel_emb'] = span_mean(
+                    bert_token_emb, span_idx + offset)
         
         h_dict1 = self.layer1(G, h_dict0, bert_token_emb)
         #h_tok1 = self.node_norm(h_dict['tok'].view(1,-1,self.in_size))
@@ -462,6 +672,9 @@ class HeteroRGCN(nn.Module):
         
         h_dict2 = self.layer2(G, h_dict1, bert_token_emb)
         h_dict2 = {k: F.leaky_relu(self.node_norm(h)) for k, h in h_dict2.items()}
+        for etype in REL_ETYPES:
+            if etype in G.etypes and 'rel_emb' in G.edges[etype].data:
+                del G.edges[etype].data['rel_emb']
         #h_tok2 = self.node_norm(h_dict['tok'].view(1,-1,self.in_size))
         h_final = h_dict2
         if self.residual:
@@ -593,6 +806,20 @@ class HGNModel(BertPreTrainedModel):
         train=True,
         ans_type_label=None
     ):
+        lengths = None
+        if attention_mask is not None:
+            # the contexts are padded to the longest one of their dataset: trim
+            # the batch to its longest context (and at least to the token nodes
+            # of its graphs: graphs of padded contexts have one per position)
+            lengths = attention_mask.sum(1)
+            seq_len = max(int(lengths.max()),
+                          int(batch_num_nodes(graph, 'tok').max()))
+            attention_mask = attention_mask[:, :seq_len]
+            list_inputs = [input_ids, token_type_ids, position_ids,
+                           inputs_embeds]
+            (input_ids, token_type_ids, position_ids,
+             inputs_embeds) = [None if x is None else x[:, :seq_len]
+                               for x in list_inputs]
         outputs = self.bert(
             input_ids,
             attention_mask=attention_mask,
@@ -602,21 +829,47 @@ class HGNModel(BertPreTrainedModel):
             inputs_embeds=inputs_embeds
         )
         sequence_output = outputs[0]
+        # shape [batch size, #max len, 768]
         assert not torch.isnan(sequence_output).any()
+        batch_size, max_len = sequence_output.shape[:2]
         # Graph forward & node classification
-        graph_out, graph_emb = self.graph_forward(graph, sequence_output, train)
-        sequence_output = graph_emb['tok'].unsqueeze(0)
-         # answer type logits
-        ans_type_logits = self.answer_type_classifier(self.attention(graph_out['sent']['emb'].view(1,-1,dict_params['out_feats']),
-                                                                     graph_out['sent']['logits'][:,1].view(1,-1,1))
-                                                      ).squeeze(1)
+        graph_out, graph_emb = self.graph_forward(graph, sequence_output,
+                                                  train, lengths)
+        # each graph has one token node per token of its context (fewer than
+        # max len for the shorter contexts)
+        tok_graph_ids = graph_ids(batch_num_nodes(graph, 'tok')).to(
+            sequence_output.device)
+        sequence_output = pad_by_graph(graph_emb['tok'], tok_graph_ids,
+                                       batch_size)
+        if sequence_output.shape[1] < max_len:
+            sequence_output = F.pad(
+                sequence_output, (0, 0, 0, max_len - sequence_output.shape[1]))
+         # answer type logits (attention over the sentences of each graph)
+        sent_graph_ids = graph_out['sent']['graph_ids'].to(
+            sequence_output.device)
+        sent_emb = pad_by_graph(graph_out['sent']['emb'], sent_graph_ids,
+                                batch_size)
+        sent_att_logits = pad_by_graph(
+            graph_out['sent']['logits'][:, 1].view(-1, 1), sent_graph_ids,
+            batch_size, torch.finfo(sequence_output.dtype).min)
+        ans_type_logits = self.answer_type_classifier(
+            self.attention(sent_emb, sent_att_logits)).squeeze(1)
+        # shape [batch size, 3]
         loss_ans_type = loss_fn_ans_type(ans_type_logits, ans_type_label)
         span_loss = None
         start_logits = None
         end_logits = None
-        if (train and ans_type_label == 0) or (not train):
+        if train and start_positions is not None:
+            # only instances with span answers contribute to the span loss
+            start_positions = start_positions.masked_fill(
+                ans_type_label.view(-1) != 0, -1)
+            end_positions = end_positions.masked_fill(
+                ans_type_label.view(-1) != 0, -1)
+        if (train and (ans_type_label == 0).any()) or (not train):
             # span prediction    
-            span_loss, start_logits, end_logits = self.span_prediction(sequence_output, start_positions, end_positions)
+            span_loss, start_logits, end_logits = self.span_prediction(
+                sequence_output, start_positions, end_positions,
+                attention_mask)
             assert not torch.isnan(start_logits).any()
             assert not torch.isnan(end_logits).any()
         
@@ -645,9 +898,10 @@ class HGNModel(BertPreTrainedModel):
         output = torch.bmm(att.transpose(1,2), x)
         return output
 
-    def graph_forward(self, graph, bert_context_emb, train):
+    def graph_forward(self, graph, bert_context_emb, train, lengths=None):
         # create graph initial embedding #
-        graph_emb = self.graph_initial_embedding(graph, bert_context_emb)
+        graph_emb = self.graph_initial_embedding(graph, bert_context_emb,
+                                                 lengths)
         for (k,v) in graph_emb.items():
             assert not torch.isnan(v).any()
         # graph_emb shape [num_nodes, in_feats]    
@@ -657,83 +911,66 @@ class HGNModel(BertPreTrainedModel):
         initial_graph_emb = graph_emb # for skip-connection
         
         # update graph embedding #
-        graph_emb = self.rgcn(graph, graph_emb, bert_context_emb[0])
+        graph_emb = self.rgcn(graph, graph_emb, bert_context_emb)
         
         # graph_emb shape [num_nodes, num_heads, in_feats] num_heads = 1
 #         graph_emb = graph_emb.view(-1, dict_params['out_feats'])
 #         # graph_emb shape [num_nodes, in_feats]
 
         # classify nodes #
-        sent_labels = None
-        ent_labels = None
-        sent_emb = None
+        # graph (i.e., query) of each node of the batch
+        query_device = graph_emb['query'].device
+        dict_graph_ids = {
+            ntype: graph_ids(batch_num_nodes(graph, ntype)).to(query_device)
+            for ntype in ['sent', 'srl', 'ent'] if ntype in graph.ntypes}
+        # nodes to classify of each node type
         if train:
-            sent_emb = graph_emb['sent'][sample_sent_nodes]
-            # add skip-connection
-            query_emb = torch.cat([graph_emb['query'] for i in range(len(sample_sent_nodes))], dim=0)
-            logits_sent = self.sent_classifier(torch.cat((query_emb,
-                                                          graph_emb['sent'][sample_sent_nodes]), dim=1))
-            assert not torch.isnan(logits_sent).any() 
-            
-            # contains the indexes of the srl nodes
-            if len(sample_srl_nodes) == 0:
-                logits_srl = None
-                srl_labels = None
-            else:
-                query_emb = torch.cat([graph_emb['query'] for i in range(len(sample_srl_nodes))], dim=0)
-                logits_srl = self.srl_classifier(torch.cat((query_emb,
-                                                            graph_emb['srl'][sample_srl_nodes]), dim=1))
-                # shape [num_ent_nodes, 2] 
-                assert not torch.isnan(logits_srl).any()
-                srl_labels = graph.nodes['srl'].data['labels'][sample_srl_nodes].to(device)
-                # shape [num_sampled_srl_nodes, 1]
-            
-            # contains the indexes of the ent nodes
-            if len(sample_ent_nodes) == 0:
-                logits_ent = None
-                ent_labels = None
-            else:
-                query_emb = torch.cat([graph_emb['query'] for i in range(len(sample_ent_nodes))], dim=0)
-                logits_ent = self.ent_classifier(torch.cat((query_emb,
-                                                            graph_emb['ent'][sample_ent_nodes]), dim=1))
-                # shape [num_ent_nodes, 2] 
-                assert not torch.isnan(logits_ent).any()
-                ent_labels = graph.nodes['ent'].data['labels'][sample_ent_nodes].to(device)
-                # shape [num_sampled_ent_nodes, 1]    
-            sent_labels = graph.nodes['sent'].data['labels'][sample_sent_nodes].to(device)
-            # shape [num_sampled_sent_nodes, 1]
-            
-            
+            dict_node_idx = {'sent': sample_sent_nodes,
+                             'srl': sample_srl_nodes,
+                             'ent': sample_ent_nodes}
+            list_ntypes = [ntype for ntype in NODE_CLF_TYPES
+                           if ntype == 'sent' or len(dict_node_idx[ntype]) > 0]
+            dict_node_emb = {ntype: graph_emb[ntype][dict_node_idx[ntype]]
+                             for ntype in list_ntypes}
+            dict_node_graph_ids = {
+                ntype: dict_graph_ids[ntype][dict_node_idx[ntype]]
+                for ntype in list_ntypes}
         else:
-            sent_emb = graph_emb['sent']
-            # add skip-connection
-            query_emb = torch.cat([graph_emb['query'] for i in range(graph_emb['sent'].shape[0])], dim=0)
-            logits_sent = self.sent_classifier(torch.cat((query_emb, 
-                                                          graph_emb['sent']), dim=1))
-            assert not torch.isnan(logits_sent).any()
-            query_emb = torch.cat([graph_emb['query'] for i in range(graph_emb['srl'].shape[0])], dim=0)
-            logits_srl = self.srl_classifier(torch.cat((query_emb,
-                                                        graph_emb['srl']), dim=1))
-            # shape [num_ent_nodes, 2] 
-            assert not torch.isnan(logits_srl).any()
-            logits_ent = None
-            ent_labels = None
-            if 'ent' in graph.ntypes:
-                query_emb = torch.cat([graph_emb['query'] for i in range(graph_emb['ent'].shape[0])], dim=0)
-                logits_ent = self.ent_classifier(torch.cat((query_emb,
-                                                            graph_emb['ent']), dim=1))
-                # shape [num_ent_nodes, 2]
-                assert not torch.isnan(logits_ent).any()
-                ent_labels = graph.nodes['ent'].data['labels'].to(device)
-                # shape [num_srl_nodes, 1]
-                
-            # labels
-            sent_labels = graph.nodes['sent'].data['labels'].to(device)
-            # shape [num_sent_nodes, 1]
-            srl_labels = graph.nodes['srl'].data['labels'].to(device)
-            # shape [num_sampled_srl_nodes, 1]
-            
-           
+            list_ntypes = [ntype for ntype in NODE_CLF_TYPES
+                           if ntype == 'sent' or ntype in graph.ntypes]
+            dict_node_emb = {ntype: graph_emb[ntype] for ntype in list_ntypes}
+            dict_node_graph_ids = {ntype: dict_graph_ids[ntype]
+                                   for ntype in list_ntypes}
+        # all the classifiers at once (with skip-connection to the query)
+        list_logits = classify_nodes(
+            [getattr(self, ntype + '_classifier') for ntype in list_ntypes],
+            graph_emb['query'],
+            [dict_node_emb[ntype] for ntype in list_ntypes],
+            [dict_node_graph_ids[ntype] for ntype in list_ntypes])
+        dict_logits = dict(zip(list_ntypes, list_logits))
+        # shape [num_nodes, 2]
+        for logits in list_logits:
+            assert not torch.isnan(logits).any()
+        logits_sent = dict_logits['sent']
+        logits_srl = dict_logits.get('srl')
+        logits_ent = dict_logits.get('ent')
+        sent_emb = dict_node_emb['sent']
+        sent_graph_ids = dict_node_graph_ids['sent']
+        srl_graph_ids = dict_node_graph_ids.get('srl')
+        ent_graph_ids = dict_node_graph_ids.get('ent')
+        # labels
+        dict_labels = {ntype: graph.nodes[ntype].data['labels']
+                       for ntype in list_ntypes}
+        if train:
+            dict_labels = {ntype: labels[dict_node_idx[ntype]]
+                           for ntype, labels in dict_labels.items()}
+        dict_labels = {ntype: labels.to(device)
+                       for ntype, labels in dict_labels.items()}
+        sent_labels = dict_labels['sent']
+        srl_labels = dict_labels.get('srl')
+        ent_labels = dict_labels.get('ent')
+        # shape [num_nodes, 1]
+
         # sent loss
         loss_sent = loss_fn(logits_sent, sent_labels.view(-1).long())
         probs_sent = F.softmax(logits_sent, dim=1).cpu()
@@ -745,6 +982,7 @@ class HGNModel(BertPreTrainedModel):
         if logits_srl is None:
             loss_srl = None
             probs_srl = None
+            srl_graph_ids = None
         else:
             loss_srl = loss_fn(logits_srl, srl_labels.view(-1).long())
             probs_srl = F.softmax(logits_srl, dim=1).cpu()
@@ -756,6 +994,7 @@ class HGNModel(BertPreTrainedModel):
         if logits_ent is None:
             loss_ent = None
             probs_ent = None
+            ent_graph_ids = None
         else:        
             loss_ent = loss_fn(logits_ent, ent_labels.view(-1).long())
             probs_ent = F.softmax(logits_ent, dim=1).cpu()
@@ -768,37 +1007,66 @@ class HGNModel(BertPreTrainedModel):
         if ent_labels is not None:
             ent_labels = ent_labels.cpu().view(-1)
 
-        return ({'sent': {'loss': loss_sent, 'probs': probs_sent, 'logits': logits_sent, 
-                          'emb': sent_emb, 'lbl': sent_labels},
-                'srl': {'loss': loss_srl, 'probs': probs_srl, 'lbl': srl_labels},
-                'ent': {'loss': loss_ent, 'probs': probs_ent, 'lbl': ent_labels},
+        # graph of each classified node
+        sent_graph_ids = sent_graph_ids.cpu()
+        if srl_graph_ids is not None:
+            srl_graph_ids = srl_graph_ids.cpu()
+        if ent_graph_ids is not None:
+            ent_graph_ids = ent_graph_ids.cpu()
+
+        return ({'sent': {'loss': loss_sent, 'probs': probs_sent,
+                          'logits': logits_sent, 'emb': sent_emb,
+                          'lbl': sent_labels, 'graph_ids': sent_graph_ids},
+                'srl': {'loss': loss_srl, 'probs': probs_srl,
+                        'lbl': srl_labels, 'graph_ids': srl_graph_ids},
+                'ent': {'loss': loss_ent, 'probs': probs_ent,
+                        'lbl': ent_labels, 'graph_ids': ent_graph_ids},
                 },
                 graph_emb)
     
-    def graph_initial_embedding(self, graph, bert_context_emb):
+    def graph_initial_embedding(self, graph, bert_context_emb, lengths=None):
         '''
         Inputs:
             - graph
-            - bert_context_emb shape [1, #max len, 768]
+            - bert_context_emb shape [batch size, #max len, 768]
+            - lengths: number of tokens of each context. If given, the BiGRU
+                only runs over the tokens (the right-to-left direction starts
+                at the last token, not at the padding)
         '''
-        input_gru = bert_context_emb[0].view(-1, 1, dict_params['in_feats'])
-        encoder_output, encoder_hidden = self.bigru(input_gru)
-        encoder_output = encoder_output.view(-1, dict_params['in_feats']*2)
-        graph_emb = {ntype : nn.Parameter(torch.Tensor(graph.number_of_nodes(ntype), dict_params['in_feats']))
-                      for ntype in graph.ntypes if graph.number_of_nodes(ntype) > 0}
+        max_len = bert_context_emb.shape[1]
+        input_gru = bert_context_emb.transpose(0, 1)
+        # shape [#max len, batch size, 768]
+        if lengths is None:
+            encoder_output, encoder_hidden = self.bigru(input_gru)
+        else:
+            packed_input = nn.utils.rnn.pack_padded_sequence(
+                input_gru, lengths.cpu().long(), enforce_sorted=False)
+            encoder_output, encoder_hidden = self.bigru(packed_input)
+            encoder_output, _ = nn.utils.rnn.pad_packed_sequence(
+                encoder_output, total_length=max_len)
+        in_feats = dict_params['in_feats']
+        encoder_output = encoder_output.transpose(0, 1).reshape(-1,
+                                                                in_feats * 2)
+        # shape [batch size * #max len, 2*768]
+        graph_emb = dict()
         for ntype in graph.ntypes:
             if graph.number_of_nodes(ntype) == 0:
                 continue
-            list_emb = []
-            for (st, end) in graph.nodes[ntype].data['st_end_idx']:
-                node_token_emb = encoder_output[st:end]
-                left2right = node_token_emb[-1, :dict_params['in_feats']].view(-1, dict_params['in_feats'])
-                right2left = node_token_emb[0, dict_params['in_feats']:].view(-1, dict_params['in_feats'])
-                # concat
-                concat_both_dir = torch.cat((left2right, right2left), dim=1)
-                list_emb.append(concat_both_dir.squeeze(0))
-            list_emb = torch.stack(list_emb, dim=0)
-            graph_emb[ntype] = self.node_norm(self.gru_aggregation(list_emb))
+            st_end_idx = graph.nodes[ntype].data['st_end_idx'].to(
+                encoder_output.device).long()
+            # offset of the context of the graph of each node in encoder_output
+            offset = graph_ids(batch_num_nodes(graph, ntype)).to(
+                encoder_output.device) * max_len
+            # left2right: last token of each node; right2left: first token of
+            # each node
+            end_idx = st_end_idx[:, 1].clamp(max=max_len) - 1 + offset
+            left2right = encoder_output[:, :in_feats].index_select(0, end_idx)
+            right2left = encoder_output[:, in_feats:].index_select(
+                0, st_end_idx[:, 0] + offset)
+            # concat
+            concat_both_dir = torch.cat((left2right, right2left), dim=1)
+            graph_emb[ntype] = self.node_norm(
+                self.gru_aggregation(concat_both_dir))
         return graph_emb
     
     def aggregate_emb(self, encoder_output):      
@@ -812,60 +1080,91 @@ class HGNModel(BertPreTrainedModel):
 #         return torch.mean(token_emb, dim = 0)
     
     def sample_sent_nodes(self, graph):
-        list_sent_nodes = graph.nodes('sent')
-        sent_nodes_labels = graph.nodes['sent'].data['labels']
-        # shape [num sent nodes x 1]
-        supporting_sent_mask = sent_nodes_labels == torch.ones((sent_nodes_labels.shape))
-        # shape [num sent nodes x 1] with values True or False
-        supporting_sent_idx = [idx for idx, class_ in enumerate(supporting_sent_mask) if class_]
-        # list with the idx of supporting sent
-        non_supp_sent_idx = [i for i, non_supp_sent_node in enumerate(~supporting_sent_mask) if non_supp_sent_node]
-        # list with the idx of non supporting sent
-        num_supp_sent = len(supporting_sent_idx)
-        non_supp_sent_idx_sample = random.sample(non_supp_sent_idx, min(num_supp_sent, 
-                                                                        len(non_supp_sent_idx)))
-        sent_sample_idx = supporting_sent_idx + non_supp_sent_idx_sample
-        sent_sample_idx.sort()
-
+        # balanced sample of the sent nodes of each graph of the batch
+        sent_sample_idx = []
+        offset = 0
+        for num_nodes in batch_num_nodes(graph, 'sent').tolist():
+            sent_nodes_labels = graph.nodes['sent'].data['labels'][
+                offset:offset + num_nodes]
+            # shape [num sent nodes x 1]
+            supporting_sent_mask = sent_nodes_labels == torch.ones(
+                (sent_nodes_labels.shape))
+            # shape [num sent nodes x 1] with values True or False
+            supporting_sent_idx = [idx for idx, class_
+                                   in enumerate(supporting_sent_mask)
+                                   if class_]
+            # list with the idx of supporting sent
+            non_supp_sent_idx = [
+                i for i, non_supp_sent_node in enumerate(~supporting_sent_mask)
+                if non_supp_sent_node]
+            # list with the idx of non supporting sent
+            num_supp_sent = len(supporting_sent_idx)
+            non_supp_sent_idx_sample = random.sample(
+                non_supp_sent_idx, min(num_supp_sent, len(non_supp_sent_idx)))
+            graph_sample_idx = supporting_sent_idx + non_supp_sent_idx_sample
+            graph_sample_idx.sort()
+            sent_sample_idx.extend([offset + idx for idx in graph_sample_idx])
+            offset += num_nodes
         return sent_sample_idx
 
-    def sample_srl_nodes(self, graph):
-        list_srl_nodes = graph.nodes('srl')
-        srl_nodes_labels = graph.nodes['srl'].data['labels']
-        # shape [num labels x 1]
-        supporting_srl_mask = srl_nodes_labels == torch.ones((srl_nodes_labels.shape))
-        # shape [num labels x 1] with values True or False
-        supporting_srl_idx = [idx for idx, class_ in enumerate(supporting_srl_mask) if class_]
-        # list with the idx of supporting srl
-        non_supp_srl_idx = [i for i, non_supp_srl_node in enumerate(~supporting_srl_mask) if non_supp_srl_node]
-        # list with the idx of non supporting srl
-        num_supp_srl = len(supporting_srl_idx)
-        non_supp_srl_idx_sample = random.sample(non_supp_srl_idx, min(num_supp_srl, 
-                                                                        len(non_supp_srl_idx)))
-        srl_sample_idx = supporting_srl_idx + non_supp_srl_idx_sample
-        srl_sample_idx.sort()
 
+    def sample_srl_nodes(self, graph):
+        # balanced sample of the srl nodes of each graph of the batch
+        srl_sample_idx = []
+        offset = 0
+        for num_nodes in batch_num_nodes(graph, 'srl').tolist():
+            srl_nodes_labels = graph.nodes['srl'].data['labels'][
+                offset:offset + num_nodes]
+            # shape [num srl nodes x 1]
+            supporting_srl_mask = srl_nodes_labels == torch.ones(
+                (srl_nodes_labels.shape))
+            # shape [num srl nodes x 1] with values True or False
+            supporting_srl_idx = [idx for idx, class_
+                                  in enumerate(supporting_srl_mask) if class_]
+            # list with the idx of supporting srl
+            non_supp_srl_idx = [
+                i for i, non_supp_srl_node in enumerate(~supporting_srl_mask)
+                if non_supp_srl_node]
+            # list with the idx of non supporting srl
+            num_supp_srl = len(supporting_srl_idx)
+            non_supp_srl_idx_sample = random.sample(
+                non_supp_srl_idx, min(num_supp_srl, len(non_supp_srl_idx)))
+            graph_sample_idx = supporting_srl_idx + non_supp_srl_idx_sample
+            graph_sample_idx.sort()
+            srl_sample_idx.extend([offset + idx for idx in graph_sample_idx])
+            offset += num_nodes
         return srl_sample_idx
+
     
     def sample_ent_nodes(self, graph):
         if 'ent' not in graph.ntypes:
             return []
-        list_ent_nodes = graph.nodes('ent')
-        ent_nodes_labels = graph.nodes['ent'].data['labels']
-        # shape [num labels x 1]
-        supporting_ent_mask = ent_nodes_labels == torch.ones((ent_nodes_labels.shape))
-        # shape [num labels x 1] with values True or False
-        supporting_ent_idx = [idx for idx, class_ in enumerate(supporting_ent_mask) if class_]
-        # list with the idx of supporting srl
-        non_supp_ent_idx = [i for i, non_supp_ent_node in enumerate(~supporting_ent_mask) if non_supp_ent_node]
-        # list with the idx of non supporting srl
-        num_supp_ent = len(supporting_ent_idx)
-        non_supp_ent_idx_sample = random.sample(non_supp_ent_idx, min(num_supp_ent, 
-                                                                      len(non_supp_ent_idx)))
-        ent_sample_idx = supporting_ent_idx + non_supp_ent_idx_sample
-        ent_sample_idx.sort()
-
+        # balanced sample of the ent nodes of each graph of the batch
+        ent_sample_idx = []
+        offset = 0
+        for num_nodes in batch_num_nodes(graph, 'ent').tolist():
+            ent_nodes_labels = graph.nodes['ent'].data['labels'][
+                offset:offset + num_nodes]
+            # shape [num ent nodes x 1]
+            supporting_ent_mask = ent_nodes_labels == torch.ones(
+                (ent_nodes_labels.shape))
+            # shape [num ent nodes x 1] with values True or False
+            supporting_ent_idx = [idx for idx, class_
+                                  in enumerate(supporting_ent_mask) if class_]
+            # list with the idx of supporting ent
+            non_supp_ent_idx = [
+                i for i, non_supp_ent_node in enumerate(~supporting_ent_mask)
+                if non_supp_ent_node]
+            # list with the idx of non supporting ent
+            num_supp_ent = len(supporting_ent_idx)
+            non_supp_ent_idx_sample = random.sample(
+                non_supp_ent_idx, min(num_supp_ent, len(non_supp_ent_idx)))
+            graph_sample_idx = supporting_ent_idx + non_supp_ent_idx_sample
+            graph_sample_idx.sort()
+            ent_sample_idx.extend([offset + idx for idx in graph_sample_idx])
+            offset += num_nodes
         return ent_sample_idx
+
     
     
     def update_sequence_outputs(self, sequence_output, graph, graph_emb):
@@ -885,19 +1184,28 @@ class HGNModel(BertPreTrainedModel):
         g2d_graph_emb = self.graph2token_attention(g2d_graph, g2d_graph_emb)
         return g2d_graph_emb[0:offset_node].unsqueeze(0)
     
-    def span_prediction(self, sequence_output, start_positions, end_positions):
+    def span_prediction(self, sequence_output, start_positions, end_positions,
+                        attention_mask=None):
         logits = self.qa_outputs(sequence_output)
         start_logits, end_logits = logits.split(1, dim=-1)
         start_logits = start_logits.squeeze(-1)
         end_logits = end_logits.squeeze(-1)
+        if attention_mask is not None:
+            # padding tokens cannot be the start/end of the answer
+            start_logits = start_logits.masked_fill(attention_mask == 0,
+                                                    -10000.0)
+            end_logits = end_logits.masked_fill(attention_mask == 0, -10000.0)
 
         total_loss = None
-        if ((start_positions is not None and end_positions is not None) and
-            (start_positions != -1 and end_positions != -1)):
-            loss_fct = nn.CrossEntropyLoss()
-            start_loss = loss_fct(start_logits, start_positions)
-            end_loss = loss_fct(end_logits, end_positions)
-            total_loss = (start_loss + end_loss) / 2
+        if start_positions is not None and end_positions is not None:
+            # instances without answer span have -1 positions
+            valid = (start_positions != -1) & (end_positions != -1)
+            if valid.any():
+                loss_fct = nn.CrossEntropyLoss()
+                start_loss = loss_fct(start_logits[valid],
+                                      start_positions[valid])
+                end_loss = loss_fct(end_logits[valid], end_positions[valid])
+                total_loss = (start_loss + end_loss) / 2
         return (total_loss,  start_logits, end_logits)
 
 
@@ -962,7 +1270,24 @@ def get_ans_type_lbl(ins):
 # #     model.zero_grad()
 
 # %%
-train_dataloader = list_graphs
+# instances without entities can share a batch with the rest (HeteroRGCNLayer
+# gives them the same output as by themselves), so the training can use the
+# batched forward too. lr (below) is tuned for one instance per batch: a
+# larger train_batch_size gives fewer optimizer steps, so scale lr with it
+train_batch_size = 1
+# validation and checkpoints every 10000 instances (as with one instance per
+# batch)
+steps_per_checkpoint = 10000 // train_batch_size
+# validation results do not depend on the batch size
+eval_batch_size = 8
+# the sampler follows the curriculum learning order (shuffled in place after
+# the first epoch). Workers materialize and batch the graphs of the next
+# batches while the model runs on the current one
+num_workers = 4
+train_dataloader = DataLoader(train_dataset, batch_size=train_batch_size,
+                              sampler=list_idx_curriculum_learning,
+                              collate_fn=GraphDatasetCollator(batch_graphs),
+                              num_workers=num_workers, pin_memory=True)
 
 # %%
 lr = 1e-5
@@ -997,12 +1322,6 @@ scheduler = get_linear_schedule_with_warmup(optimizer,
 #                                                                num_training_steps = total_steps,
 #                                                                num_cycles=dict_params['num_cycles'])
 
-# %%
-
-
-train_batch_size = 1
-
-
 # %%
 # import neptune
 # neptune.init(
@@ -1193,7 +1512,13 @@ wh_ans_len = {'which': 25, 'what':25, 'who':20, 'when':10, 'how':15, 'where':15,
 class Validation():
 
     def __init__(self, model, dataset, validation_dataloader, tokenizer,
-                 tensor_input_ids, tensor_attention_masks, tensor_token_type_ids, list_span_idx):
+                 tensor_input_ids, tensor_attention_masks,
+                 tensor_token_type_ids, list_span_idx, batch_size=1):
+        '''
+        Inputs:
+            - validation_dataloader: list of graphs
+            - batch_size: number of instances per forward
+        '''
         self.model = model
         self.model.eval()
         self.dataset = dataset
@@ -1204,6 +1529,12 @@ class Validation():
         self.tensor_attention_masks = tensor_attention_masks
         self.tensor_token_type_ids = tensor_token_type_ids
         self.list_span_idx = list_span_idx
+        self.batch_size = batch_size
+
+    def get_dataloader(self):
+        return DataLoader(range(len(self.validation_dataloader)),
+                          batch_size=self.batch_size,
+                          collate_fn=GraphCollator(self.validation_dataloader))
         
     def do_validation(self):       
         metrics = {'validation_loss': 0, 
@@ -1219,68 +1550,93 @@ class Validation():
         num_valid_examples = 0
         output_pred_sp = {}
         output_predictions_ans = {}
-        for step, b_graph in enumerate(tqdm(self.validation_dataloader)):
-            num_valid_examples += 1
-            ans_type_lbl = get_ans_type_lbl(self.dataset[step])
+        for b_graph, list_idx in tqdm(self.get_dataloader()):
             with torch.no_grad():
-                output = self.model(b_graph,
-                               input_ids=self.tensor_input_ids[step].unsqueeze(0).to(device),
-                               attention_mask=self.tensor_attention_masks[step].unsqueeze(0).to(device),
-                               token_type_ids=self.tensor_token_type_ids[step].unsqueeze(0).to(device), 
-                               start_positions=torch.tensor([self.list_span_idx[step][0]], device='cuda'),
-                               end_positions=torch.tensor([self.list_span_idx[step][1]], device='cuda'), 
-                               ans_type_label=ans_type_lbl,
-                                    train=False)
-            _id = self.dataset[step]['_id']   
-            # Accumulate the validation loss.
-            metrics['validation_loss'] += output['loss'].item()
-            # Sentence evaluation
-            sent_labels = output['sent']['lbl']
-            prediction_sent = torch.argmax(output['sent']['probs'], dim=1)
-            sp_em, sp_prec, sp_recall = self.update_sp_metrics(metrics, prediction_sent, sent_labels)
-            sent_num = 0
-            ## get sent titles and sents idx
-            dict_ins2dict_doc2pred = self.get_oracle_dict_ins2dict_doc2pred()
-            dict_sent_num2str = dict()
-            for doc_idx, (doc_title, doc) in enumerate(self.dataset[step]['context']):
-                if dict_ins2dict_doc2pred[step][doc_idx] == 1:
-                    for i, sent in enumerate(doc):
-                        dict_sent_num2str[sent_num] = {'sent': i, 'doc_title': doc_title}
-                        sent_num += 1
-            output_pred_sp[_id] = []
-            for i, pred in enumerate(prediction_sent):
-                if pred == 1:
-                    output_pred_sp[_id].append([dict_sent_num2str[i]['doc_title'],
-                                                dict_sent_num2str[i]['sent']])
+                ans_type_lbl = torch.cat([get_ans_type_lbl(self.dataset[step])
+                                          for step in list_idx])
+                start_positions = torch.tensor(
+                    [self.list_span_idx[step][0] for step in list_idx],
+                    device=device)
+                end_positions = torch.tensor(
+                    [self.list_span_idx[step][1] for step in list_idx],
+                    device=device)
+                output = self.model(
+                    b_graph,
+                    input_ids=self.tensor_input_ids[list_idx].to(device),
+                    attention_mask=(
+                        self.tensor_attention_masks[list_idx].to(device)),
+                    token_type_ids=(
+                        self.tensor_token_type_ids[list_idx].to(device)),
+                    start_positions=start_positions,
+                    end_positions=end_positions,
+                    ans_type_label=ans_type_lbl, train=False)
+            for step, output in zip(list_idx,
+                                    split_batch_output(output, len(list_idx))):
+                num_valid_examples += 1
+                _id = self.dataset[step]['_id']   
+                # Accumulate the validation loss.
+                metrics['validation_loss'] += output['loss'].item()
+                # Sentence evaluation
+                sent_labels = output['sent']['lbl']
+                prediction_sent = torch.argmax(output['sent']['probs'], dim=1)
+                sp_em, sp_prec, sp_recall = self.update_sp_metrics(
+                    metrics, prediction_sent, sent_labels)
+                sent_num = 0
+                ## get sent titles and sents idx
+                dict_ins2dict_doc2pred = (
+                    self.get_oracle_dict_ins2dict_doc2pred())
+                dict_sent_num2str = dict()
+                for doc_idx, (doc_title, doc) in enumerate(
+                        self.dataset[step]['context']):
+                    if dict_ins2dict_doc2pred[step][doc_idx] == 1:
+                        for i, sent in enumerate(doc):
+                            dict_sent_num2str[sent_num] = {
+                                'sent': i, 'doc_title': doc_title}
+                            sent_num += 1
+                output_pred_sp[_id] = []
+                for i, pred in enumerate(prediction_sent):
+                    if pred == 1:
+                        output_pred_sp[_id].append(
+                            [dict_sent_num2str[i]['doc_title'],
+                             dict_sent_num2str[i]['sent']])
             
-            # srl
-            prediction_srl = torch.argmax(output['srl']['probs'], dim=1)
-            srl_labels = output['srl']['lbl']
-            self.update_srl_metrics(metrics, prediction_srl, srl_labels, output['srl']['probs'][:,1])
-            # ent
-            if output['ent']['probs'] is not None:
-                prediction_ent = torch.argmax(output['ent']['probs'], dim=1)
-                ent_labels = output['ent']['lbl']
-                self.update_ent_metrics(metrics, prediction_ent, ent_labels, output['ent']['probs'][:,1])
-            # answer type prediction
-            ans_type = torch.argmax(output['ans_type']['logits']).item()
-            # answer span prediction
-            golden_ans = self.dataset[step]['answer']
-            predicted_ans = ""
-            if ans_type == 0:
-                ## wh type
-                query = self.dataset[step]['question']
-                wh = self.__findWHword(query)
-                max_ans_len = wh_ans_len[wh]
-                predicted_ans = self.__get_pred_ans_str(self.tensor_input_ids[step], output, max_ans_len)
-            elif ans_type == 1:
-                predicted_ans = 'yes'
-            elif ans_type == 2:
-                predicted_ans = 'no'
-            ans_em, ans_prec, ans_recall = self.update_answer_metrics(metrics, predicted_ans, golden_ans)
-            # joint
-            self.update_joint_metrics(metrics, ans_em, ans_prec, ans_recall, sp_em, sp_prec, sp_recall)                
-            output_predictions_ans[_id] = predicted_ans
+                # srl
+                prediction_srl = torch.argmax(output['srl']['probs'], dim=1)
+                srl_labels = output['srl']['lbl']
+                self.update_srl_metrics(metrics, prediction_srl, srl_labels,
+                                        output['srl']['probs'][:, 1])
+                # ent
+                if output['ent']['probs'] is not None:
+                    prediction_ent = torch.argmax(output['ent']['probs'],
+                                                  dim=1)
+                    ent_labels = output['ent']['lbl']
+                    self.update_ent_metrics(metrics, prediction_ent,
+                                            ent_labels,
+                                            output['ent']['probs'][:, 1])
+                # answer type prediction
+                ans_type = torch.argmax(output['ans_type']['logits']).item()
+                # answer span prediction
+                golden_ans = self.dataset[step]['answer']
+                predicted_ans = ""
+                if ans_type == 0:
+                    ## wh type
+                    query = self.dataset[step]['question']
+                    wh = self.__findWHword(query)
+                    max_ans_len = wh_ans_len[wh]
+                    predicted_ans = self.__get_pred_ans_str(
+                        self.tensor_input_ids[step], output, max_ans_len,
+                        int(self.tensor_attention_masks[step].sum()))
+                elif ans_type == 1:
+                    predicted_ans = 'yes'
+                elif ans_type == 2:
+                    predicted_ans = 'no'
+                ans_em, ans_prec, ans_recall = self.update_answer_metrics(
+                    metrics, predicted_ans, golden_ans)
+                # joint
+                self.update_joint_metrics(metrics, ans_em, ans_prec,
+                                          ans_recall, sp_em, sp_prec,
+                                          sp_recall)
+                output_predictions_ans[_id] = predicted_ans
         #N = len(self.validation_dataloader)
         N = num_valid_examples
         for k in metrics.keys():
@@ -1293,40 +1649,53 @@ class Validation():
         output_predictions_ans = {}
         output_ent = {}
         output_srl = {}
-        for step, b_graph in enumerate(tqdm(self.validation_dataloader)): 
+        for b_graph, list_idx in tqdm(self.get_dataloader()): 
             with torch.no_grad():
-                ans_type_lbl = get_ans_type_lbl(self.dataset[step])
-                output = self.model(b_graph,
-                               input_ids=self.tensor_input_ids[step].unsqueeze(0).to(device),
-                               attention_mask=self.tensor_attention_masks[step].unsqueeze(0).to(device),
-                               token_type_ids=self.tensor_token_type_ids[step].unsqueeze(0).to(device), 
-                               start_positions=torch.tensor([self.list_span_idx[step][0]], device='cuda'),
-                               end_positions=torch.tensor([self.list_span_idx[step][1]], device='cuda'), 
-                               ans_type_label=ans_type_lbl,
-                                train=False)
-            _id = self.dataset[step]['_id']
-            ans_type = torch.argmax(output['ans_type']['logits']).item()
-            # answer span prediction
-            golden_ans = self.dataset[step]['answer']
-            predicted_ans = ""
-            if ans_type == 0:
-                ## wh type
-                query = self.dataset[step]['question']
-                wh = self.__findWHword(query)
-                max_ans_len = wh_ans_len[wh]
-                predicted_ans = self.__get_pred_ans_str(self.tensor_input_ids[step], output, max_ans_len)
-            elif ans_type == 1:
-                predicted_ans = 'yes'
-            elif ans_type == 2:
-                predicted_ans = 'no'
-            output_predictions_ans[_id] = predicted_ans
-            # ent
+                ans_type_lbl = torch.cat([get_ans_type_lbl(self.dataset[step])
+                                          for step in list_idx])
+                start_positions = torch.tensor(
+                    [self.list_span_idx[step][0] for step in list_idx],
+                    device=device)
+                end_positions = torch.tensor(
+                    [self.list_span_idx[step][1] for step in list_idx],
+                    device=device)
+                output = self.model(
+                    b_graph,
+                    input_ids=self.tensor_input_ids[list_idx].to(device),
+                    attention_mask=(
+                        self.tensor_attention_masks[list_idx].to(device)),
+                    token_type_ids=(
+                        self.tensor_token_type_ids[list_idx].to(device)),
+                    start_positions=start_positions,
+                    end_positions=end_positions,
+                    ans_type_label=ans_type_lbl, train=False)
+            for step, output in zip(list_idx,
+                                    split_batch_output(output, len(list_idx))):
+                _id = self.dataset[step]['_id']
+                ans_type = torch.argmax(output['ans_type']['logits']).item()
+                # answer span prediction
+                golden_ans = self.dataset[step]['answer']
+                predicted_ans = ""
+                if ans_type == 0:
+                    ## wh type
+                    query = self.dataset[step]['question']
+                    wh = self.__findWHword(query)
+                    max_ans_len = wh_ans_len[wh]
+                    predicted_ans = self.__get_pred_ans_str(
+                        self.tensor_input_ids[step], output, max_ans_len,
+                        int(self.tensor_attention_masks[step].sum()))
+                elif ans_type == 1:
+                    predicted_ans = 'yes'
+                elif ans_type == 2:
+                    predicted_ans = 'no'
+                output_predictions_ans[_id] = predicted_ans
+                # ent
 #             ent = self.__get_ent_str(b_graph, self.tensor_input_ids[step], output)
 #             output_ent[_id] = ent
 #             # srl
 #             srl = self.__get_srl_str(b_graph, self.tensor_input_ids[step], output)
 #             output_srl[_id] = srl
-            #sp
+                #sp
 #             prediction_sent = torch.argmax(output['sent']['probs'], dim=1)
 #             sent_num = 0
 #             dict_sent_num2str = dict()
@@ -1356,9 +1725,10 @@ class Validation():
             dict_ins2dict_doc2pred[ins_idx] = dict_doc2pred
         return dict_ins2dict_doc2pred
     
-    def __get_pred_ans_str(self, input_ids, output, max_ans_len):
-        st, end = self.__get_st_end_span_idx(output['span']['start_logits'].squeeze(),
-                                             output['span']['end_logits'].squeeze(), max_ans_len)
+    def __get_pred_ans_str(self, input_ids, output, max_ans_len, context_len):
+        st, end = self.__get_st_end_span_idx(
+            output['span']['start_logits'].squeeze(),
+            output['span']['end_logits'].squeeze(), max_ans_len, context_len)
         return self.__get_str_span(input_ids, st, end)
     
     def __get_ent_str(self, graph, input_ids, output):
@@ -1391,7 +1761,13 @@ class Validation():
             best_indexes.append(index_and_score[i][0])
         return best_indexes
     
-    def __get_st_end_span_idx(self, start_logits, end_logits, max_answer_length = 30):
+    def __get_st_end_span_idx(self, start_logits, end_logits,
+                              max_answer_length=30, context_len=None):
+        if context_len is None:
+            context_len = len(start_logits)
+        # only the tokens of the context (not the padding)
+        start_logits = start_logits[:context_len]
+        end_logits = end_logits[:context_len]
         start_indexes = self.__get_best_indexes(start_logits, 10)
         end_indexes = self.__get_best_indexes(end_logits, 10)
         list_candidates = []
@@ -1401,9 +1777,9 @@ class Validation():
                 # We could hypothetically create invalid predictions, e.g., predict
                 # that the start of the span is in the question. We throw out all
                 # invalid predictions.
-                if start_index >= 512:
+                if start_index >= context_len:
                     continue
-                if end_index >= 512:
+                if end_index >= context_len:
                     continue
                 if end_index < start_index:
                     continue
@@ -1606,16 +1982,22 @@ for epoch_i in range(0, epochs):
     if epoch_i > 0:
         random.shuffle(list_idx_curriculum_learning)
     # For each batch of training data...
-    for step, idx in enumerate(tqdm(list_idx_curriculum_learning)):
-        b_graph = list_graphs[idx]
+    for step, batch in enumerate(tqdm(train_dataloader)):
         # neptune.log_metric('step', step)
+        if epoch_i == 0 and step == 0:
+            print("  Time to first step: {:} (peak RSS {:.0f} MB)".format(
+                format_time(time.time() - script_t0),
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
         # forward
-        input_ids=tensor_input_ids[idx].unsqueeze(0).to(device)
-        attention_mask=tensor_attention_masks[idx].unsqueeze(0).to(device)
-        token_type_ids=tensor_token_type_ids[idx].unsqueeze(0).to(device) 
-        start_positions=torch.tensor([list_span_idx[idx][0]], device='cuda')
-        end_positions=torch.tensor([list_span_idx[idx][1]], device='cuda')
-        ans_type_lbl = get_ans_type_lbl(hotpot_train[idx])
+        b_graph = batch['graph']
+        list_idx = batch['list_idx']
+        input_ids=batch['input_ids'].to(device, non_blocking=True)
+        attention_mask=batch['attention_mask'].to(device, non_blocking=True)
+        token_type_ids=batch['token_type_ids'].to(device, non_blocking=True)
+        start_positions=batch['start_positions'].to(device, non_blocking=True)
+        end_positions=batch['end_positions'].to(device, non_blocking=True)
+        ans_type_lbl = torch.cat(
+            [get_ans_type_lbl(hotpot_train[idx]) for idx in list_idx])
         output = model(b_graph,
                         input_ids=input_ids,
                         attention_mask=attention_mask,
@@ -1652,14 +2034,16 @@ for epoch_i in range(0, epochs):
             scheduler.step()
             model.zero_grad()
             
-            if epoch_i == 0 and (step +1) == 10000:
+            if epoch_i == 0 and (step +1) == steps_per_checkpoint:
                 #############################
                 ######### Validation ########
                 #############################
-                validation = Validation(model, hotpot_dev, dev_list_graphs, tokenizer,
-                                        dev_tensor_input_ids, dev_tensor_attention_masks, 
+                validation = Validation(model, hotpot_dev, dev_list_graphs,
+                                        tokenizer, dev_tensor_input_ids,
+                                        dev_tensor_attention_masks,
                                         dev_tensor_token_type_ids,
-                                        dev_list_span_idx)
+                                        dev_list_span_idx,
+                                        batch_size=eval_batch_size)
                 metrics, pred_json = validation.do_validation()
                 model.train()
                 # record_eval_metric(neptune, metrics)
@@ -1670,7 +2054,7 @@ for epoch_i in range(0, epochs):
                     model.save_pretrained(model_path) 
                     with open(os.path.join(model_path, 'output.json'), 'w+') as f:
                         json.dump(pred_json, f)
-            if epoch_i == 2 and (step +1) % 10000 == 0:
+            if epoch_i == 2 and (step +1) % steps_per_checkpoint == 0:
                 model_path_step = model_path + "/epoch3/step_" + str(step)
                 os.mkdir(model_path_step)
                 model.save_pretrained(model_path_step)
@@ -1699,7 +2083,7 @@ for epoch_i in range(0, epochs):
     validation = Validation(model, hotpot_dev, dev_list_graphs, tokenizer,
                             dev_tensor_input_ids, dev_tensor_attention_masks, 
                             dev_tensor_token_type_ids,
-                            dev_list_span_idx)
+                            dev_list_span_idx, batch_size=eval_batch_size)
     metrics, pred_json = validation.do_validation()
     model.train()
     # record_eval_metric(neptune, metrics)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# coding: utf-8
+'''
+CPU inference of HGNModel: thread tuning and dynamic int8 quantization
+(weights in int8, activations quantized on the fly; only on the cpu)
+'''
+import torch
+import torch.nn as nn
+from src.models.model import HeteroRGCNLayer
+
+
+def configure_threads(num_threads=None, num_interop_threads=None):
+    '''
+    Inputs:
+        - num_threads: threads of an op (matmul, ...). By default, torch uses
+            the number of cores
+        - num_interop_threads: threads running independent ops in parallel. Can
+            only be set once, before the first parallel op
+    '''
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads is not None:
+        torch.set_num_interop_threads(num_interop_threads)
+    return {'num_threads': torch.get_num_threads(),
+            'num_interop_threads': torch.get_num_interop_threads()}
+
+
+def quantize_dynamic_int8(model):
+    '''
+    Quantizes (in place) the linear layers of the BERT encoder and of the
+    HeteroRGCNLayers of an HGNModel. The rest of the model (embeddings, GRUs,
+    classifiers) stays in fp32
+    '''
+    if next(model.parameters()).device.type != 'cpu':
+        raise ValueError("dynamic quantization is only supported on the cpu")
+    model.eval()
+    list_modules = [model.bert] + [module for module in model.modules()
+                                   if isinstance(module, HeteroRGCNLayer)]
+    for module in list_modules:
+        torch.quantization.quantize_dynamic(module, {nn.Linear},
+                                            dtype=torch.qint8, inplace=True)
+    return model
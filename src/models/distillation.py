@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+# coding: utf-8
+'''
+Knowledge distillation of HGNModel: a trained teacher (bert-large encoder)
+trains a smaller student (bert-base encoder by default) on the same processed
+heterographs. The student matches the temperature-softened outputs of the
+teacher (span start/end logits, answer type logits, sent/srl/ent node logits)
+and, optionally, the gold span, answer type and node labels. As in training,
+the student classifies a balanced sample of the nodes of each graph
+(train=True). The student is saved with save_pretrained, so it is a drop-in
+checkpoint for HGNModel.from_pretrained (run_prediction.py, run_server.py).
+
+    python -m src.models.distillation models/graph_model \
+        data/processed/training/hsgn_2021_fix/ \
+        data/processed/dev/hsgn_2021_fix/ \
+        data/external/hotpot_train_v1.1.json \
+        data/external/hotpot_dev_distractor_v1.json \
+        --student bert-base-uncased --output_dir models/graph_model_base
+
+The student encoder must share the vocabulary of the teacher (the input ids of
+the processed split are reused), e.g. bert-base-uncased for
+bert-large-uncased-whole-word-masking. The processed splits must have the graph
+layout of inference (one token node per token of the context, see
+src/data/bottom_up_query_edges.py), not the one of the graphs built with
+contexts padded to 512 tokens.
+'''
+import os
+import json
+import time
+import argparse
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from tqdm import tqdm
+from torch.utils.data import DataLoader
+from transformers import AdamW, get_linear_schedule_with_warmup
+from src.data.graph_dataset import GraphDataset, GraphDatasetCollator
+from src.models.model import (HGNModel, Validation, LengthBucketBatchSampler,
+                              batch_graphs)
+
+NODE_TYPES = ['sent', 'srl', 'ent']
+
+
+def ans_type_label(hotpot_instance) -> int:
+    # answer types of HGNModel.answer_type_classifier: 0 span, 1 yes, 2 no
+    if hotpot_instance['answer'] == 'yes':
+        return 1
+    elif hotpot_instance['answer'] == 'no':
+        return 2
+    return 0
+
+
+def check_graph_layout(dataset, num_instances=10):
+    '''
+    Raises ValueError if the graphs of the GraphDataset have one token node per
+    position of a padded context instead of one per token of the context (the
+    layout of the graphs built for inference)
+    '''
+    for idx in range(min(num_instances, len(dataset))):
+        num_tok_nodes = dataset.graphs[idx].number_of_nodes('tok')
+        context_len = int(dataset.tensor_attention_masks[idx].sum())
+        if num_tok_nodes != context_len:
+            raise ValueError(
+                "graph {} has {} token nodes for a context of {} tokens: "
+                "rebuild the split with one token node per token".format(
+                    idx, num_tok_nodes, context_len))
+
+
+def soft_cross_entropy(student_logits, teacher_logits, temperature):
+    '''
+    KL divergence between the softened distributions of the teacher and the
+    student (last dim), averaged over the rows and scaled by temperature^2 (the
+    gradients keep the size of the hard loss)
+    '''
+    if student_logits.shape[0] == 0:
+        return student_logits.sum()
+    return F.kl_div(F.log_softmax(student_logits / temperature, dim=-1),
+                    F.softmax(teacher_logits / temperature, dim=-1),
+                    reduction='batchmean') * temperature ** 2
+
+
+def masked_logits(logits, attention_mask):
+    # padding tokens cannot be the start/end of the answer (finite value: it is
+    # divided by the temperature). HGNModel trims the batch to its longest
+    # context, so the logits can be shorter than the mask
+    return logits.masked_fill(attention_mask[:, :logits.shape[1]] == 0,
+                              -10000.0)
+
+
+def distillation_loss(student_output, teacher_output, attention_mask,
+                      temperature, weights):
+    '''
+    Inputs:
+        - student_output: output of HGNModel.forward(train=True). Its node_idx
+            are the classified nodes
+        - teacher_output: output of HGNModel.forward(train=False) for the same
+            batch (all the nodes are classified)
+        - attention_mask: shape [batch size, #max len]
+        - weights: dict with the weight of each output ('span', 'ans_type',
+            'sent', 'srl', 'ent')
+    Returns:
+        - total soft loss and dict with the loss of each output
+    '''
+    dict_loss = dict()
+    student_span, teacher_span = student_output['span'], teacher_output['span']
+    # the student only predicts spans for the batches with span answers
+    if student_span['start_logits'] is not None:
+        dict_loss['span'] = (soft_cross_entropy(
+            masked_logits(student_span['start_logits'], attention_mask),
+            masked_logits(teacher_span['start_logits'], attention_mask),
+            temperature) + soft_cross_entropy(
+                masked_logits(student_span['end_logits'], attention_mask),
+                masked_logits(teacher_span['end_logits'], attention_mask),
+                temperature)) / 2
+    dict_loss['ans_type'] = soft_cross_entropy(
+        student_output['ans_type']['logits'],
+        teacher_output['ans_type']['logits'], temperature)
+    for ntype in NODE_TYPES:
+        if student_output[ntype].get('logits') is not None:
+            teacher_logits = teacher_output[ntype]['logits']
+            node_idx = student_output[ntype].get('node_idx')
+            if node_idx is not None:
+                # the teacher logits of the nodes sampled by the student
+                node_idx = torch.as_tensor(node_idx, dtype=torch.long,
+                                           device=teacher_logits.device)
+                teacher_logits = teacher_logits[node_idx]
+            dict_loss[ntype] = soft_cross_entropy(
+                student_output[ntype]['logits'], teacher_logits, temperature)
+    total_loss = sum(weights[k] * loss for k, loss in dict_loss.items())
+    return total_loss, dict_loss
+
+
+def hard_loss(student_output, start_positions, end_positions, ans_type_labels,
+              weights):
+    '''
+    Cross entropy with the gold answer types, the gold answer spans (only the
+    instances with span answers; instances without span have -1 positions) and
+    the gold labels of the classified nodes (if the graphs have them)
+    '''
+    loss_fct = nn.CrossEntropyLoss()
+    list_losses = [weights['ans_type'] * loss_fct(
+        student_output['ans_type']['logits'], ans_type_labels)]
+    valid = ((start_positions != -1) & (end_positions != -1)
+             & (ans_type_labels == 0))
+    span = student_output['span']
+    if valid.any() and span['start_logits'] is not None:
+        start_loss = loss_fct(span['start_logits'][valid],
+                              start_positions[valid])
+        end_loss = loss_fct(span['end_logits'][valid], end_positions[valid])
+        list_losses.append(weights['span'] * (start_loss + end_loss) / 2)
+    for ntype in NODE_TYPES:
+        logits = student_output[ntype].get('logits')
+        lbl = student_output[ntype]['lbl']
+        if logits is not None and lbl is not None and lbl.shape[0] > 0:
+            list_losses.append(weights[ntype] * loss_fct(
+                logits, lbl.to(logits.device).long()))
+    return sum(list_losses)
+
+
+class DistillationTrainer():
+    def __init__(self, teacher, student, train_dataset, list_ans_type,
+                 temperature=2.0, alpha=0.5, lr=3e-5, epochs=3, batch_size=1,
+                 num_workers=4, device='cuda'):
+        '''
+        Inputs:
+            - teacher: trained HGNModel (frozen)
+            - student: HGNModel to train (e.g.,
+                HGNModel.from_pretrained('bert-base-uncased'))
+            - train_dataset: GraphDataset of the processed training split
+            - list_ans_type: gold answer type (ans_type_label) of each instance
+                of train_dataset
+            - temperature: softmax temperature of the soft targets
+            - alpha: weight of the soft loss (1 - alpha for the hard loss with
+                the gold labels)
+        '''
+        self.device = device
+        self.teacher = teacher.to(device)
+        self.teacher.eval()
+        for param in self.teacher.parameters():
+            param.requires_grad = False
+        self.student = student.to(device)
+        self.list_ans_type = list_ans_type
+        self.temperature = temperature
+        self.alpha = alpha
+        self.epochs = epochs
+        # same weights as the training losses of HGNModel
+        self.weights = {'span': student.weight_span_loss,
+                        'ans_type': student.weight_ans_type_loss,
+                        'sent': student.weight_sent_loss,
+                        'srl': student.weight_srl_loss,
+                        'ent': student.weight_ent_loss}
+        # shuffled batches of contexts of similar length
+        batch_sampler = LengthBucketBatchSampler(
+            train_dataset.tensor_attention_masks.sum(1).tolist(), batch_size,
+            shuffle=True)
+        self.train_dataloader = DataLoader(
+            train_dataset, batch_sampler=batch_sampler,
+            collate_fn=GraphDatasetCollator(batch_graphs),
+            num_workers=num_workers, pin_memory=(device == 'cuda'))
+        self.optimizer = AdamW(self.student.parameters(), lr=lr, eps=1e-8)
+        self.scheduler = get_linear_schedule_with_warmup(
+            self.optimizer, num_warmup_steps=0,
+            num_training_steps=len(self.train_dataloader) * epochs)
+
+    def train_step(self, batch):
+        b_graph = batch['graph']
+        inputs = {k: batch[k].to(self.device, non_blocking=True)
+                  for k in ['input_ids', 'attention_mask', 'token_type_ids']}
+        start_positions = batch['start_positions'].to(self.device,
+                                                      non_blocking=True)
+        end_positions = batch['end_positions'].to(self.device,
+                                                  non_blocking=True)
+        ans_type_labels = torch.tensor(
+            [self.list_ans_type[idx] for idx in batch['list_idx']],
+            device=self.device)
+        with torch.no_grad():
+            teacher_output = self.teacher(b_graph, train=False, **inputs)
+        # train=True: balanced sample of the nodes and span prediction only for
+        # batches with span answers
+        student_output = self.student(b_graph, train=True,
+                                      ans_type_label=ans_type_labels, **inputs)
+        soft_loss, dict_loss = distillation_loss(student_output,
+                                                 teacher_output,
+                                                 inputs['attention_mask'],
+                                                 self.temperature,
+                                                 self.weights)
+        loss = self.alpha * soft_loss
+        if self.alpha < 1:
+            loss = loss + (1 - self.alpha) * hard_loss(
+                student_output, start_positions, end_positions,
+                ans_type_labels, self.weights)
+        assert not torch.isnan(loss)
+        loss.backward()
+        torch.nn.utils.clip_grad_norm_(self.student.parameters(), 1.0)
+        self.optimizer.step()
+        self.scheduler.step()
+        self.student.zero_grad()
+        dict_loss = {k: v.detach().item() for k, v in dict_loss.items()}
+        return loss.detach().item(), dict_loss
+
+    def train(self, validation=None, output_dir=None):
+        '''
+        Inputs:
+            - validation: Validation of the student on the dev split, run after
+                each epoch
+            - output_dir: the student with the best answer EM is saved there
+        Returns:
+            - list with the metrics of each epoch
+        '''
+        best_em = -1
+        list_metrics = []
+        for epoch_i in range(self.epochs):
+            print('======== Epoch {:} / {:} ========'.format(
+                epoch_i + 1, self.epochs))
+            self.student.train()
+            total_loss = 0
+            t0 = time.time()
+            for step, batch in enumerate(tqdm(self.train_dataloader)):
+                loss, _ = self.train_step(batch)
+                total_loss += loss
+            print("  Average distillation loss: {:.4f} ({:.0f} s)".format(
+                total_loss / len(self.train_dataloader), time.time() - t0))
+            if validation is None:
+                if output_dir is not None:
+                    self.student.save_pretrained(output_dir)
+                continue
+            metrics = validation.do_validation()
+            self.student.train()
+            list_metrics.append(metrics)
+            print(
+                "  ans_em {:.4f} ans_f1 {:.4f} sp_em {:.4f} sp_f1 {:.4f} "
+                "joint_em {:.4f} joint_f1 {:.4f}".format(
+                    metrics['ans_em'], metrics['ans_f1'], metrics['sp_em'],
+                    metrics['sp_f1'], metrics['joint_em'],
+                    metrics['joint_f1']))
+            if output_dir is not None and metrics['ans_em'] > best_em:
+                best_em = metrics['ans_em']
+                self.student.save_pretrained(output_dir)
+        return list_metrics
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('teacher_path', type=str,
+                        help="trained HGNModel (from_pretrained directory)")
+    parser.add_argument('training_path', type=str,
+                        help="processed training split (graph_store/, "
+                             "tensor_*.p)")
+    parser.add_argument('dev_path', type=str, help="processed dev split")
+    parser.add_argument('hotpot_train', type=str,
+                        help="hotpot json of the training split "
+                             "(gold answer types)")
+    parser.add_argument('hotpot_dev', type=str,
+                        help="hotpot json of the dev split "
+                             "(questions and answers)")
+    parser.add_argument('--student', type=str, default='bert-base-uncased',
+                        help="pretrained encoder (or HGNModel checkpoint) of "
+                             "the student")
+    parser.add_argument('--output_dir', type=str,
+                        default='models/graph_model_base')
+    parser.add_argument('--epochs', type=int, default=3)
+    parser.add_argument('--lr', type=float, default=3e-5)
+    parser.add_argument('--temperature', type=float, default=2.0)
+    parser.add_argument('--alpha', type=float, default=0.5,
+                        help="weight of the soft loss")
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--eval_batch_size', type=int, default=8)
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--device', type=str,
+                        default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    teacher = HGNModel.from_pretrained(args.teacher_path)
+    student = HGNModel.from_pretrained(args.student)
+    print("teacher: {:.0f}M parameters, student: {:.0f}M parameters".format(
+        sum(p.numel() for p in teacher.parameters()) / 1e6,
+        sum(p.numel() for p in student.parameters()) / 1e6))
+    train_dataset = GraphDataset(args.training_path)
+    dev_dataset = GraphDataset(args.dev_path)
+    check_graph_layout(train_dataset)
+    check_graph_layout(dev_dataset)
+    with open(args.hotpot_train, 'r') as f:
+        list_ans_type = [ans_type_label(hotpot_instance)
+                         for hotpot_instance in json.load(f)]
+    trainer = DistillationTrainer(
+        teacher, student, train_dataset, list_ans_type,
+        temperature=args.temperature, alpha=args.alpha, lr=args.lr,
+        epochs=args.epochs, batch_size=args.batch_size,
+        num_workers=args.num_workers, device=args.device)
+    with open(args.hotpot_dev, 'r') as f:
+        hotpot_dev = json.load(f)
+    validation = Validation(student, hotpot_dev, dev_dataset.graphs,
+                            dev_dataset.tensor_input_ids,
+                            dev_dataset.tensor_attention_masks,
+                            dev_dataset.tensor_token_type_ids,
+                            batch_size=args.eval_batch_size,
+                            list_span_idx=dev_dataset.list_span_idx)
+    list_metrics = trainer.train(validation, args.output_dir)
+    with open(os.path.join(args.output_dir, 'distillation_metrics.json'),
+              'w') as f:
+        json.dump({'args': vars(args), 'metrics': list_metrics}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import os
+import sys
 from tqdm import tqdm
 import torch
 from transformers import BertTokenizer
@@ -18,12 +20,108 @@ class DocumentRetrieval():
         if device == 'cuda':
             self.model.cuda()
 
-    def predict_relevant_docs(self, data, batch_size=16, k=2):
+    def predict_relevant_docs(self, data, batch_size=128, k=2,
+                              flat_batching=True):
+        '''
+        Inputs:
+            - batch_size: number of (question, doc) pairs per forward (with
+                flat_batching)
+            - k: number of docs selected per question (with flat_batching,
+                otherwise 2)
+            - flat_batching: pack the (question, doc) pairs of all the
+                questions into batches of similar length, padded to the longest
+                pair of the batch. Otherwise one batch per question, padded to
+                128 tokens
+        '''
+        if flat_batching:
+            (list_pairs, list_ques_idx,
+             list_doc_idx) = self.__create_flat_input(data)
+            scores = self.__flat_inference(list_pairs, batch_size)
+            return self._create_topk_output_dictionary(
+                scores, list_ques_idx, list_doc_idx, len(data), k)
         _input = self.__create_input(data)
         (recall2_idx, _, _) = self.__inference(_input)
         dict_ins2dict_doc2pred = self._create_output_dictionary(recall2_idx)
         return dict_ins2dict_doc2pred
 
+    def __create_flat_input(self, dev_data, max_length=128):
+        '''
+        Returns the encoded (question, doc) pairs of all the questions (without
+        padding) and the question and doc idx of each pair
+        '''
+        list_pairs = []
+        list_ques_idx = []
+        list_doc_idx = []
+        for ques_idx, sam in enumerate(tqdm(dev_data)):
+            # the question is tokenized once for all its docs
+            question_ids = self.tokenizer.convert_tokens_to_ids(
+                self.tokenizer.tokenize(sam['question']))
+            for doc_idx, doc in enumerate(sam['context']):
+                context_ids = self.tokenizer.convert_tokens_to_ids(
+                    self.tokenizer.tokenize(" ".join(doc[1])))
+                encoded = self.tokenizer.prepare_for_model(
+                    question_ids, context_ids, add_special_tokens=True,
+                    max_length=max_length, truncation=True)
+                list_pairs.append(
+                    (encoded['input_ids'], encoded['token_type_ids']))
+                list_ques_idx.append(ques_idx)
+                list_doc_idx.append(doc_idx)
+        return list_pairs, list_ques_idx, list_doc_idx
+
+    def __flat_inference(self, list_pairs, batch_size):
+        '''
+        Returns the score (logit of the relevant class) of each pair
+        '''
+        scores = torch.zeros(len(list_pairs))
+        # longest pairs first, so that a batch that does not fit in memory
+        # fails at the beginning
+        list_order = sorted(range(len(list_pairs)),
+                            key=lambda i: len(list_pairs[i][0]), reverse=True)
+        with torch.no_grad():
+            for st in tqdm(range(0, len(list_order), batch_size)):
+                list_batch_idx = list_order[st:st+batch_size]
+                max_len = len(list_pairs[list_batch_idx[0]][0])
+                b_input_ids = torch.zeros((len(list_batch_idx), max_len),
+                                          dtype=torch.long)
+                b_input_tokens = torch.zeros((len(list_batch_idx), max_len),
+                                             dtype=torch.long)
+                b_input_mask = torch.zeros((len(list_batch_idx), max_len),
+                                           dtype=torch.long)
+                for i, pair_idx in enumerate(list_batch_idx):
+                    (input_ids, token_type_ids) = list_pairs[pair_idx]
+                    b_input_ids[i, :len(input_ids)] = torch.tensor(input_ids)
+                    b_input_tokens[i, :len(token_type_ids)] = torch.tensor(
+                        token_type_ids)
+                    b_input_mask[i, :len(input_ids)] = 1
+                logits = self.model(
+                    b_input_ids.to(self.device),
+                    token_type_ids=b_input_tokens.to(self.device),
+                    attention_mask=b_input_mask.to(self.device))[0]
+                scores[list_batch_idx] = logits[:, 0].detach().cpu()
+        return scores
+
+    def _create_topk_output_dictionary(self, scores, list_ques_idx,
+                                       list_doc_idx, num_questions, k):
+        '''
+        Selects the k docs with the highest score of each question
+        '''
+        ques_idx = torch.tensor(list_ques_idx, dtype=torch.long)
+        doc_idx = torch.tensor(list_doc_idx, dtype=torch.long)
+        max_docs = int(doc_idx.max()) + 1 if len(list_doc_idx) > 0 else 0
+        # (num_questions, max_docs) with -inf in the missing docs
+        score_matrix = torch.full((num_questions, max_docs), -float('inf'))
+        score_matrix[ques_idx, doc_idx] = scores
+        (top_values, top_idx) = torch.topk(score_matrix, min(k, max_docs),
+                                           dim=1)
+        selected = torch.zeros((num_questions, max_docs), dtype=torch.long)
+        selected.scatter_(1, top_idx, (top_values > -float('inf')).long())
+        list_num_docs = torch.bincount(ques_idx,
+                                       minlength=num_questions).tolist()
+        list_selected = selected.tolist()
+        return {qid: {doc: list_selected[qid][doc]
+                      for doc in range(list_num_docs[qid])}
+                for qid in range(num_questions)}
+
     def __create_input(self, dev_data):
         batch_for_each_query = []
         for sam in tqdm(dev_data):
@@ -115,4 +213,53 @@ class DocumentRetrieval():
             for predidx in recall2_idx[qid][0]:
                 dict_recall2[qid][predidx] = 1
         return dict_recall2
-       
+
+
+def gold_idx2dict_ins2dict_doc2pred(hotpot, pred_gold_idx):
+    '''
+    Inputs:
+        - pred_gold_idx: list with the idx of the predicted gold documents of
+            each instance (output of the SAE document filter)
+    Returns dict_ins2dict_doc2pred. Both documents are selected for the
+    instances with only two
+    '''
+    out = dict()
+    for ins_idx, pred in enumerate(pred_gold_idx):
+        dict_doc2pred = dict()
+        if len(hotpot[ins_idx]['context']) == 2:
+            dict_doc2pred = {0: 1, 1: 1}
+        else:
+            for i in range(len(hotpot[ins_idx]['context'])):
+                if i in pred:
+                    dict_doc2pred[i] = 1
+                else:
+                    dict_doc2pred[i] = 0
+        out[ins_idx] = dict_doc2pred
+    return out
+
+
+class SAEDocumentRetrieval():
+    '''
+    SAE document filter (SAE/docfilter.py) in the same process: the models are
+    loaded once and the instances are taken from the already loaded dataset (no
+    input/output json files)
+    '''
+    def __init__(self, sae_path='SAE', device='cuda', batch_size=20,
+                 num_workers=4, compressed_path=None):
+        '''
+        Inputs:
+            - compressed_path: checkpoint of SAE/compress_docfilter.py (pruned
+                heads and/or int8), instead of the full ensemble
+        '''
+        # the SAE modules import each other as top-level modules
+        sae_path = os.path.abspath(sae_path)
+        if sae_path not in sys.path:
+            sys.path.insert(0, sae_path)
+        from docfilter import DocFilter
+        self.doc_filter = DocFilter(device=device, batch_size=batch_size,
+                                    num_workers=num_workers,
+                                    compressed_path=compressed_path)
+
+    def predict_relevant_docs(self, hotpot) -> dict:
+        pred_gold_idx = self.doc_filter.predict_gold_idx(hotpot)
+        return gold_idx2dict_ins2dict_doc2pred(hotpot, pred_gold_idx)
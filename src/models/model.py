@@ -11,6 +11,7 @@ from os.path import isfile, join
 from dgl.data.utils import load_graphs
 
 from tqdm import tqdm, trange
+from torch.utils.data import DataLoader
 
 import numpy as np
 import torch
@@ -37,9 +38,8 @@ torch.manual_seed(random_seed)
 torch.cuda.manual_seed_all(random_seed)
 
 pretrained_weights = 'bert-large-uncased-whole-word-masking'
-device = 'cuda'
-
-weights = torch.tensor([1., 30.9, 31.], device=device)
+# default device (Validation uses the device of its model)
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
 # %%
 def get_sent_node_from_srl_node(graph, srl_node, list_srl_nodes):
@@ -65,6 +65,201 @@ class NodeNorm(nn.Module):
         x = (x - mean) / std
         return x
 
+# %%
+def batch_num_nodes(graph, ntype):
+    '''
+    Number of nodes of type ntype of each graph of a (batched) graph
+    '''
+    if hasattr(graph, 'batch_num_nodes'):
+        return torch.as_tensor(graph.batch_num_nodes(ntype))
+    return torch.tensor([graph.number_of_nodes(ntype)])
+
+def batch_num_edges(graph, etype):
+    '''
+    Number of edges of type etype of each graph of a (batched) graph
+    '''
+    if hasattr(graph, 'batch_num_edges'):
+        return torch.as_tensor(graph.batch_num_edges(etype))
+    return torch.tensor([graph.number_of_edges(etype)])
+
+def nodes_in_graphs_with_edges(graph, ntype, etype):
+    '''
+    Boolean mask of the nodes of type ntype of a (batched) graph that belong to
+    a graph with edges of type etype
+    '''
+    has_edges = batch_num_edges(graph, etype) > 0
+    return has_edges[graph_ids(batch_num_nodes(graph, ntype))]
+
+def graph_ids(batch_num):
+    '''
+    Graph idx of each node (or edge) of a batched graph given the number of
+    nodes (edges) of each graph
+    '''
+    batch_num = torch.as_tensor(batch_num)
+    return torch.repeat_interleave(torch.arange(len(batch_num)), batch_num)
+
+def pad_by_graph(x, node_graph_ids, batch_size, pad_value=0.):
+    '''
+    Inputs:
+        - x: features of the nodes of a batched graph [#nodes, ...] (sorted by
+            graph)
+        - node_graph_ids: graph idx of each node
+    Returns:
+        - tensor of shape [batch_size, max #nodes in a graph, ...] padded with
+            pad_value
+    '''
+    counts = torch.bincount(node_graph_ids, minlength=batch_size)
+    first_node = torch.cumsum(counts, dim=0) - counts
+    pos = (torch.arange(len(node_graph_ids), device=node_graph_ids.device)
+           - first_node[node_graph_ids])
+    out = x.new_full((batch_size, int(counts.max())) + tuple(x.shape[1:]),
+                     pad_value)
+    out[node_graph_ids, pos] = x
+    return out
+
+def to_common_schema(graph, canonical_etypes, ntypes, dict_ntype2feats,
+                     dict_etype2feats):
+    '''
+    Returns a copy of graph with all the node and edge types (and features) of
+    a batch. Missing types have 0 nodes (edges) and missing features are empty.
+    '''
+    dict_edges = dict()
+    for (src_type, etype, dst_type) in canonical_etypes:
+        if etype in graph.etypes:
+            dict_edges[(src_type, etype, dst_type)] = graph.edges(etype=etype)
+        else:
+            dict_edges[(src_type, etype, dst_type)] = (
+                torch.tensor([], dtype=torch.long),
+                torch.tensor([], dtype=torch.long))
+    num_nodes_dict = {ntype: (graph.number_of_nodes(ntype)
+                              if ntype in graph.ntypes else 0)
+                      for ntype in ntypes}
+    new_graph = dgl.heterograph(dict_edges, num_nodes_dict)
+    for ntype, dict_feats in dict_ntype2feats.items():
+        for k, v in dict_feats.items():
+            if ntype in graph.ntypes and k in graph.nodes[ntype].data:
+                new_graph.nodes[ntype].data[k] = graph.nodes[ntype].data[k]
+            else:
+                new_graph.nodes[ntype].data[k] = v.new_zeros(
+                    (new_graph.number_of_nodes(ntype),) + tuple(v.shape[1:]))
+    for etype, dict_feats in dict_etype2feats.items():
+        for k, v in dict_feats.items():
+            if etype in graph.etypes and k in graph.edges[etype].data:
+                new_graph.edges[etype].data[k] = graph.edges[etype].data[k]
+            else:
+                new_graph.edges[etype].data[k] = v.new_zeros(
+                    (new_graph.number_of_edges(etype),) + tuple(v.shape[1:]))
+    return new_graph
+
+def batch_graphs(list_graphs):
+    '''
+    dgl.batch for heterographs that do not have the same node and edge types
+    (e.g., graphs without entities). The graphs are converted to the union of
+    their types.
+    '''
+    if len(list_graphs) == 1:
+        return list_graphs[0]
+    canonical_etypes = sorted(
+        set(c_etype for g in list_graphs for c_etype in g.canonical_etypes))
+    ntypes = sorted(set(ntype for g in list_graphs for ntype in g.ntypes))
+    # one example of each feature to create the features of the missing types
+    dict_ntype2feats = dict()
+    dict_etype2feats = dict()
+    for g in list_graphs:
+        for ntype in g.ntypes:
+            for k, v in g.nodes[ntype].data.items():
+                dict_ntype2feats.setdefault(ntype, dict()).setdefault(k, v)
+        for etype in g.etypes:
+            for k, v in g.edges[etype].data.items():
+                dict_etype2feats.setdefault(etype, dict()).setdefault(k, v)
+    list_graphs = [to_common_schema(g, canonical_etypes, ntypes,
+                                    dict_ntype2feats, dict_etype2feats)
+                   for g in list_graphs]
+    if hasattr(dgl, 'batch_hetero'):
+        # dgl < 0.5
+        return dgl.batch_hetero(list_graphs)
+    return dgl.batch(list_graphs)
+
+class GraphCollator():
+    '''
+    collate_fn of a DataLoader over instance indexes.
+    Returns the batched graph and the indexes of the instances of the batch
+    '''
+    def __init__(self, list_graphs):
+        self.list_graphs = list_graphs
+
+    def __call__(self, list_idx):
+        list_graphs = [self.list_graphs[idx] for idx in list_idx]
+        return batch_graphs(list_graphs), list_idx
+
+class LengthBucketBatchSampler():
+    '''
+    batch_sampler of a DataLoader that groups instances of similar context
+    length, so each batch is trimmed to a length close to the length of all its
+    instances (HGNModel.forward). Without shuffle, the instances are sorted by
+    length (longest first, so the peak memory is reached in the first batch).
+    With shuffle, the instances are shuffled, sorted by length inside pools of
+    pool_size batches, and the batches are shuffled
+    '''
+    def __init__(self, list_lengths, batch_size, shuffle=False, pool_size=50):
+        '''
+        Inputs:
+            - list_lengths: number of tokens of the context of each instance
+                (e.g., attention_mask.sum(1))
+        '''
+        self.list_lengths = [int(length) for length in list_lengths]
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pool_size = pool_size
+
+    def __iter__(self):
+        list_idx = list(range(len(self.list_lengths)))
+        if not self.shuffle:
+            list_idx.sort(key=lambda idx: -self.list_lengths[idx])
+            return iter([list_idx[st:st + self.batch_size]
+                         for st in range(0, len(list_idx), self.batch_size)])
+        random.shuffle(list_idx)
+        list_batches = []
+        pool_len = self.batch_size * self.pool_size
+        for pool_st in range(0, len(list_idx), pool_len):
+            pool = sorted(list_idx[pool_st:pool_st + pool_len],
+                          key=lambda idx: -self.list_lengths[idx])
+            list_batches.extend(pool[st:st + self.batch_size]
+                                for st in range(0, len(pool), self.batch_size))
+        random.shuffle(list_batches)
+        return iter(list_batches)
+
+    def __len__(self):
+        return ((len(self.list_lengths) + self.batch_size - 1)
+                // self.batch_size)
+
+def split_batch_output(output, batch_size):
+    '''
+    Splits the output of HGNModel.forward for a batch into a list with the
+    output of each instance (same format as the output for a batch of size 1)
+    '''
+    list_output = []
+    for i in range(batch_size):
+        output_i = {'loss': output['loss']}
+        for ntype in ['sent', 'srl', 'ent']:
+            node_output = output[ntype]
+            if node_output['graph_ids'] is None:
+                output_i[ntype] = dict(node_output)
+                continue
+            mask = node_output['graph_ids'] == i
+            output_i[ntype] = {
+                k: (v[mask.to(v.device)]
+                    if torch.is_tensor(v) and v.dim() > 0
+                    and v.shape[0] == mask.shape[0] else v)
+                for k, v in node_output.items()}
+        output_i['ans_type'] = {'loss': output['ans_type']['loss'],
+                                'logits': output['ans_type']['logits'][i:i+1]}
+        output_i['span'] = {
+            k: v[i:i+1] if torch.is_tensor(v) and v.dim() > 1 else v
+            for k, v in output['span'].items()}
+        list_output.append(output_i)
+    return list_output
+
 # %%
 class GAT(nn.Module):
     def __init__(self,
@@ -112,11 +307,87 @@ class GAT(nn.Module):
 
 
 # %%
+def span_mean(token_emb, span_idx):
+    '''
+    Mean of token_emb[x:y] for each (x, y) in span_idx using a prefix sum over
+    the tokens
+    Inputs:
+        - token_emb shape [#tokens, dim]
+        - span_idx shape [#spans, 2]
+    Returns:
+        - tensor of shape [#spans, dim]
+    '''
+    span_idx = span_idx.to(token_emb.device).long()
+    span_idx = span_idx.clamp(max=token_emb.shape[0])
+    prefix_sum = torch.cat((token_emb.new_zeros(1, token_emb.shape[1]),
+                            torch.cumsum(token_emb, dim=0)), dim=0)
+    x, y = span_idx[:, 0], span_idx[:, 1]
+    lengths = (y - x).unsqueeze(1).to(token_emb.dtype)
+    return (prefix_sum[y] - prefix_sum[x]) / lengths
+
+REL_ETYPES = ['srl2srl', 'ent2ent_rel']
+
+# node types with a classifier (HGNModel.{ntype}_classifier)
+NODE_CLF_TYPES = ['sent', 'srl', 'ent']
+
+def classify_nodes(list_classifiers, query_emb, list_node_emb,
+                   list_node_graph_ids):
+    '''
+    Fused evaluation of node classifiers nn.Sequential(Linear(2*d, h), ReLU(),
+    Linear(h, 2)) on cat(query, node). The first layer is split into its query
+    and node parts: the query of each graph is projected once for all the
+    classifiers (instead of being concatenated to each of its nodes), and the
+    second layer is a single matmul over the nodes of all the node types.
+    Inputs:
+        - list_classifiers: classifier of each node type
+        - query_emb shape [batch size, d]
+        - list_node_emb: embeddings of the nodes of each node type, shape
+            [#nodes, d]
+        - list_node_graph_ids: graph of each of these nodes, shape [#nodes]
+    Returns:
+        - list with the logits of each node type, shape [#nodes, 2]
+    '''
+    d = query_emb.shape[1]
+    num_clf = len(list_classifiers)
+    hidden_size = list_classifiers[0][0].out_features
+    w1_query = torch.cat([clf[0].weight[:, :d] for clf in list_classifiers])
+    # shape [num_clf * hidden_size, d]
+    b1 = torch.cat([clf[0].bias for clf in list_classifiers])
+    w2 = torch.cat([clf[2].weight for clf in list_classifiers])
+    # shape [num_clf * 2, hidden_size]
+    b2 = torch.cat([clf[2].bias for clf in list_classifiers])
+    list_num_nodes = [node_emb.shape[0] for node_emb in list_node_emb]
+    # classifier of each node
+    clf_idx = torch.repeat_interleave(
+        torch.arange(num_clf, device=query_emb.device),
+        torch.tensor(list_num_nodes, device=query_emb.device))
+    node_idx = torch.arange(clf_idx.shape[0], device=query_emb.device)
+    node_graph_ids = torch.cat(list_node_graph_ids).to(query_emb.device)
+    query_proj = F.linear(query_emb, w1_query, b1).view(-1, num_clf,
+                                                        hidden_size)
+    # shape [batch size, num_clf, hidden_size]
+    node_proj = torch.cat([F.linear(node_emb, clf[0].weight[:, d:])
+                           for clf, node_emb in zip(list_classifiers,
+                                                    list_node_emb)])
+    # shape [#nodes, hidden_size]
+    hidden = F.relu(node_proj + query_proj[node_graph_ids, clf_idx])
+    logits = F.linear(hidden, w2, b2).view(-1, num_clf, 2)[node_idx, clf_idx]
+    return list(torch.split(logits, list_num_nodes))
+
+
 class HeteroRGCNLayer(nn.Module):
-    def __init__(self, in_size, out_size, feat_drop=0., attn_drop=0.):
+    def __init__(self, in_size, out_size, feat_drop=0., attn_drop=0.,
+                 bert_dim=None):
+        '''
+        Inputs:
+            - bert_dim: size of the bert token embeddings (relation
+                embeddings). By default in_size
+        '''
         super(HeteroRGCNLayer, self).__init__()
         self.in_size = in_size
         self.out_size = out_size
+        if bert_dim is None:
+            bert_dim = in_size
         self.rel_trans = nn.Linear(in_size + bert_dim, in_size)
         self.node_trans = nn.Sequential(nn.Linear(in_size, in_size),
                                     nn.LeakyReLU(),
@@ -133,13 +404,12 @@ class HeteroRGCNLayer(nn.Module):
         '''
         m_ij = R_ji * W * h_j
         '''
-        # relation emb
-        rel_span_idx = edges.data['span_idx']  # idx at context level
-        rel_emb = []
-        for i, (x, y) in enumerate(rel_span_idx):
-            # rel type = {1, -1}
-            rel_emb.append(torch.mean(bert_token_emb[x:y], dim=0))
-        rel_emb = torch.stack(rel_emb, dim=0)
+        # relation emb (computed once per forward by HeteroRGCN)
+        if 'rel_emb' in edges.data:
+            rel_emb = edges.data['rel_emb']
+        else:
+            # idx at context level
+            rel_emb = span_mean(bert_token_emb, edges.data['span_idx'])
         assert not torch.isnan(rel_emb).any()
 #         return {'rel': rel_emb, 'srl': edges.src['h']}
         src = edges.src['h']
@@ -212,17 +482,30 @@ class HeteroRGCNLayer(nn.Module):
         G['srl2tok'].update_all(self.message_func_2tok, fn.sum('m', 'h_srl'))
         if 'ent' in G.ntypes:
             G['ent2tok'].update_all(self.message_func_2tok, fn.sum('m', 'h_ent'))
-        #batched all tokens since we want to put into the GRU (srl, ent, hidden=tok) so batch size = 512
+        #batched all tokens since we want to put into the GRU
+        # (srl, ent, hidden=tok) so batch size = #tokens of the batch
         h_tok = self.node_trans(G.nodes['tok'].data['h'])
         h_tok = h_tok.view(1,-1,self.out_size)
         h_srl = G.nodes['tok'].data.pop('h_srl').view(1,-1,self.out_size)
         gru_input = torch.cat((h_srl, h_tok), dim=0)  
         if 'h_ent' in G.nodes['tok'].data:
-            # there can be an instance without entities (not common anyway)
+            # there can be an instance without entities (not common anyway).
+            # Only the tokens of the graphs with entities have the entity step,
+            # so each instance of a batch gets the same output as by itself
             h_ent = G.nodes['tok'].data.pop('h_ent').view(1,-1,self.out_size)
-            gru_input = torch.cat((h_ent, h_tok), dim=0)
-            gru_input = torch.cat((h_srl, gru_input), dim=0)  
-        G.nodes['tok'].data['h'] = self.gru_node2tok(gru_input)[0][-1]
+            ent_mask = nodes_in_graphs_with_edges(G, 'tok', 'ent2tok')
+            ent_mask = ent_mask.to(h_tok.device)
+            gru_ent_input = torch.cat((h_srl, h_ent, h_tok), dim=0)
+            gru = self.gru_node2tok
+            if ent_mask.all():
+                G.nodes['tok'].data['h'] = gru(gru_ent_input)[0][-1]
+            else:
+                h = h_tok.new_empty(h_tok.shape[1:])
+                h[ent_mask] = gru(gru_ent_input[:, ent_mask])[0][-1]
+                h[~ent_mask] = gru(gru_input[:, ~ent_mask])[0][-1]
+                G.nodes['tok'].data['h'] = h
+        else:
+            G.nodes['tok'].data['h'] = self.gru_node2tok(gru_input)[0][-1]
 
         out = {ntype : G.nodes[ntype].data.pop('h') for ntype in G.ntypes}
         # return the updated node feature dictionary
@@ -262,8 +545,10 @@ class MultiHeadGATLayer(nn.Module):
         super(MultiHeadGATLayer, self).__init__()
         self.in_size = in_size
         self.node_norm = NodeNorm()
-        self.head1 = HeteroRGCNLayer(in_size, out_size, feat_drop, attn_drop)
-        self.head2 = HeteroRGCNLayer(in_size, out_size, feat_drop, attn_drop)
+        self.head1 = HeteroRGCNLayer(in_size, out_size, feat_drop, attn_drop,
+                                     bert_dim=in_size)
+        self.head2 = HeteroRGCNLayer(in_size, out_size, feat_drop, attn_drop,
+                                     bert_dim=in_size)
 
     def forward(self, G, emb, bert_token_emb):
         h_dict1 = self.head1(G, emb, bert_token_emb)
@@ -280,8 +565,11 @@ class HeteroRGCN(nn.Module):
         self.in_size = in_size
         self.residual = residual
         self.node_norm = NodeNorm()
-        self.layer1 = HeteroRGCNLayer(in_size, hidden_size, feat_drop, attn_drop)
-        self.layer2 = HeteroRGCNLayer(hidden_size, out_size, feat_drop, attn_drop)
+        # the relation embeddings are bert token embeddings (size in_size)
+        self.layer1 = HeteroRGCNLayer(in_size, hidden_size, feat_drop,
+                                      attn_drop, bert_dim=in_size)
+        self.layer2 = HeteroRGCNLayer(hidden_size, out_size, feat_drop,
+                                      attn_drop, bert_dim=in_size)
         self.gru_layer_lvl = nn.GRU(in_size, out_size)
         
         self.init_params()
@@ -289,6 +577,22 @@ class HeteroRGCN(nn.Module):
     def forward(self, G, emb, bert_token_emb):
         #h_tok0 = emb['tok'].view(1,-1,self.in_size) # it's already normalized
         h_dict0 = {k: self.node_norm(h) for k, h in emb.items()}
+        # bert_token_emb shape [batch size, #max len, 768] ->
+        # [batch size * #max len, 768]
+        max_len = bert_token_emb.shape[1]
+        bert_token_emb = bert_token_emb.reshape(-1, bert_token_emb.shape[-1])
+        # the relation embeddings only depend on the bert token embeddings,
+        # so they are shared by all the layers and heads
+        for etype in REL_ETYPES:
+            if etype in G.etypes and G.number_of_edges(etype) > 0:
+                span_idx = G.edges[etype].data['span_idx'].to(
+                    bert_token_emb.device).long().clamp(max=max_len)
+                # the span idx are at context level, so add the offset of the
+                # context of each graph
+                offset = graph_ids(batch_num_edges(G, etype)).to(
+                    bert_token_emb.device).unsqueeze(1) * max_len
+                G.edges[etype].data['rel_emb'] = span_mean(
+                    bert_token_emb, span_idx + offset)
         
         h_dict1 = self.layer1(G, h_dict0, bert_token_emb)
         #h_tok1 = self.node_norm(h_dict['tok'].view(1,-1,self.in_size))
@@ -296,6 +600,9 @@ class HeteroRGCN(nn.Module):
         
         h_dict2 = self.layer2(G, h_dict1, bert_token_emb)
         h_dict2 = {k: F.leaky_relu(self.node_norm(h)) for k, h in h_dict2.items()}
+        for etype in REL_ETYPES:
+            if etype in G.etypes and 'rel_emb' in G.edges[etype].data:
+                del G.edges[etype].data['rel_emb']
         #h_tok2 = self.node_norm(h_dict['tok'].view(1,-1,self.in_size))
         h_final = h_dict2
         if self.residual:
@@ -327,13 +634,26 @@ if 'large' in pretrained_weights:
     bert_dim = 1024
 if 'albert-xxlarge-v2' == pretrained_weights:
     bert_dim = 4096
-dict_params = {'in_feats': bert_dim, 'out_feats': bert_dim, 'feat_drop': 0.2, 'attn_drop': 0.1, 'hidden_size_classifier': bert_dim,
-               'weight_sent_loss': 2, 'weight_srl_loss': 1, 'weight_ent_loss': 1, 'bi_gru_layers': 1,
-               'weight_span_loss': 5, 'weight_ans_type_loss': 1, 'span_drop': 0.2,
-               'gat_layers': 4, 'accumulation_steps': 1, 'residual': True,}
+def get_dict_params(hidden_size):
+    '''
+    Hyperparameters of HGNModel for an encoder with hidden_size (e.g., 1024 for
+    bert-large, 768 for bert-base)
+    '''
+    return {'in_feats': hidden_size, 'out_feats': hidden_size,
+            'feat_drop': 0.2, 'attn_drop': 0.1,
+            'hidden_size_classifier': hidden_size,
+            'weight_sent_loss': 2, 'weight_srl_loss': 1, 'weight_ent_loss': 1,
+            'bi_gru_layers': 1,
+            'weight_span_loss': 5, 'weight_ans_type_loss': 1, 'span_drop': 0.2,
+            'gat_layers': 4, 'accumulation_steps': 1, 'residual': True,}
+dict_params = get_dict_params(bert_dim)
 class HGNModel(BertPreTrainedModel):
     def __init__(self, config):
         super().__init__(config)
+        # the sizes follow the encoder of the checkpoint (bert-large teacher,
+        # bert-base student, ...)
+        dict_params = get_dict_params(config.hidden_size)
+        self.dict_params = dict_params
         if pretrained_weights == 'albert-xxlarge-v2':
             self.bert = AlbertModel(config)
         else:
@@ -427,6 +747,20 @@ class HGNModel(BertPreTrainedModel):
         train=True,
         ans_type_label=None
     ):
+        lengths = None
+        if attention_mask is not None:
+            # the contexts are padded to the longest one of their dataset: trim
+            # the batch to its longest context (and at least to the token nodes
+            # of its graphs: graphs of padded contexts have one per position)
+            lengths = attention_mask.sum(1)
+            seq_len = max(int(lengths.max()),
+                          int(batch_num_nodes(graph, 'tok').max()))
+            attention_mask = attention_mask[:, :seq_len]
+            list_inputs = [input_ids, token_type_ids, position_ids,
+                           inputs_embeds]
+            (input_ids, token_type_ids, position_ids,
+             inputs_embeds) = [None if x is None else x[:, :seq_len]
+                               for x in list_inputs]
         outputs = self.bert(
             input_ids,
             attention_mask=attention_mask,
@@ -436,20 +770,40 @@ class HGNModel(BertPreTrainedModel):
             inputs_embeds=inputs_embeds
         )
         sequence_output = outputs[0]
+        # shape [batch size, #max len, 768]
         assert not torch.isnan(sequence_output).any()
+        batch_size, max_len = sequence_output.shape[:2]
         # Graph forward & node classification
-        graph_out, graph_emb = self.graph_forward(graph, sequence_output, train)
-        sequence_output = graph_emb['tok'].unsqueeze(0)
-         # answer type logits
-        ans_type_logits = self.answer_type_classifier(self.attention(graph_out['sent']['emb'].view(1,-1,dict_params['out_feats']),
-                                                                     graph_out['sent']['logits'][:,1].view(1,-1,1))
-                                                      ).squeeze(1)
+        graph_out, graph_emb = self.graph_forward(graph, sequence_output,
+                                                  train, lengths)
+        # each graph has one token node per token of its context (fewer than
+        # max len for the shorter contexts)
+        tok_graph_ids = graph_ids(batch_num_nodes(graph, 'tok')).to(
+            sequence_output.device)
+        sequence_output = pad_by_graph(graph_emb['tok'], tok_graph_ids,
+                                       batch_size)
+        if sequence_output.shape[1] < max_len:
+            sequence_output = F.pad(
+                sequence_output, (0, 0, 0, max_len - sequence_output.shape[1]))
+         # answer type logits (attention over the sentences of each graph)
+        sent_graph_ids = graph_out['sent']['graph_ids'].to(
+            sequence_output.device)
+        sent_emb = pad_by_graph(graph_out['sent']['emb'], sent_graph_ids,
+                                batch_size)
+        sent_att_logits = pad_by_graph(
+            graph_out['sent']['logits'][:, 1].view(-1, 1), sent_graph_ids,
+            batch_size, torch.finfo(sequence_output.dtype).min)
+        ans_type_logits = self.answer_type_classifier(
+            self.attention(sent_emb, sent_att_logits)).squeeze(1)
+        # shape [batch size, 3]
         span_loss = None
         start_logits = None
         end_logits = None
-        if (train and ans_type_label == 0) or (not train):
+        if (train and (ans_type_label == 0).any()) or (not train):
             # span prediction    
-            span_loss, start_logits, end_logits = self.span_prediction(sequence_output, start_positions, end_positions)
+            span_loss, start_logits, end_logits = self.span_prediction(
+                sequence_output, start_positions, end_positions,
+                attention_mask)
             assert not torch.isnan(start_logits).any()
             assert not torch.isnan(end_logits).any()    
        
@@ -467,9 +821,10 @@ class HGNModel(BertPreTrainedModel):
         output = torch.bmm(att.transpose(1,2), x)
         return output
 
-    def graph_forward(self, graph, bert_context_emb, train):
+    def graph_forward(self, graph, bert_context_emb, train, lengths=None):
         # create graph initial embedding #
-        graph_emb = self.graph_initial_embedding(graph, bert_context_emb)
+        graph_emb = self.graph_initial_embedding(graph, bert_context_emb,
+                                                 lengths)
         for (k,v) in graph_emb.items():
             assert not torch.isnan(v).any()
         # graph_emb shape [num_nodes, in_feats]    
@@ -477,7 +832,7 @@ class HGNModel(BertPreTrainedModel):
         initial_graph_emb = graph_emb # for skip-connection
         
         # update graph embedding #
-        graph_emb = self.rgcn(graph, graph_emb, bert_context_emb[0])
+        graph_emb = self.rgcn(graph, graph_emb, bert_context_emb)
         
         # graph_emb shape [num_nodes, num_heads, in_feats] num_heads = 1
 #         graph_emb = graph_emb.view(-1, dict_params['out_feats'])
@@ -487,138 +842,162 @@ class HGNModel(BertPreTrainedModel):
         sent_labels = None
         srl_labels = None
         ent_labels = None
-        sent_emb = None        
+        # graph (i.e., query) of each node of the batch
+        query_device = graph_emb['query'].device
+        dict_graph_ids = {
+            ntype: graph_ids(batch_num_nodes(graph, ntype)).to(query_device)
+            for ntype in ['sent', 'srl', 'ent'] if ntype in graph.ntypes}
         if train:
             sample_sent_nodes = self.sample_sent_nodes(graph)
             sample_srl_nodes = self.sample_srl_nodes(graph)
             sample_ent_nodes = self.sample_ent_nodes(graph)
-            sent_emb = graph_emb['sent'][sample_sent_nodes]
-            # add skip-connection
-            query_emb = torch.cat([graph_emb['query'] for i in range(len(sample_sent_nodes))], dim=0)
-            logits_sent = self.sent_classifier(torch.cat((query_emb,
-                                                          graph_emb['sent'][sample_sent_nodes]), dim=1))
-            assert not torch.isnan(logits_sent).any() 
-            
-            # contains the indexes of the srl nodes
-            if len(sample_srl_nodes) == 0:
-                logits_srl = None
-                srl_labels = None
-            else:
-                query_emb = torch.cat([graph_emb['query'] for i in range(len(sample_srl_nodes))], dim=0)
-                logits_srl = self.srl_classifier(torch.cat((query_emb,
-                                                            graph_emb['srl'][sample_srl_nodes]), dim=1))
-                # shape [num_ent_nodes, 2] 
-                assert not torch.isnan(logits_srl).any()
-                # shape [num_sampled_srl_nodes, 1]
-            
-            # contains the indexes of the ent nodes
-            if len(sample_ent_nodes) == 0:
-                logits_ent = None
-                ent_labels = None
-            else:
-                query_emb = torch.cat([graph_emb['query'] for i in range(len(sample_ent_nodes))], dim=0)
-                logits_ent = self.ent_classifier(torch.cat((query_emb,
-                                                            graph_emb['ent'][sample_ent_nodes]), dim=1))
-                # shape [num_ent_nodes, 2] 
-                assert not torch.isnan(logits_ent).any()
-                # shape [num_sampled_ent_nodes, 1]    
-            # shape [num_sampled_sent_nodes, 1]
-            
-            # labels to cpu
-            sent_labels = sent_labels.cpu().view(-1)
-            if srl_labels is not None:
-                srl_labels = srl_labels.cpu().view(-1)
-            if ent_labels is not None:
-                ent_labels = ent_labels.cpu().view(-1)
-
+        # nodes to classify of each node type
+        if train:
+            dict_node_idx = {'sent': sample_sent_nodes,
+                             'srl': sample_srl_nodes,
+                             'ent': sample_ent_nodes}
+            list_ntypes = [ntype for ntype in NODE_CLF_TYPES
+                           if ntype == 'sent' or len(dict_node_idx[ntype]) > 0]
+            dict_node_emb = {ntype: graph_emb[ntype][dict_node_idx[ntype]]
+                             for ntype in list_ntypes}
+            dict_node_graph_ids = {
+                ntype: dict_graph_ids[ntype][dict_node_idx[ntype]]
+                for ntype in list_ntypes}
         else:
-            sent_emb = graph_emb['sent']
-            # add skip-connection
-            query_emb = torch.cat([graph_emb['query'] for i in range(graph_emb['sent'].shape[0])], dim=0)
-            logits_sent = self.sent_classifier(torch.cat((query_emb, 
-                                                          graph_emb['sent']), dim=1))
-            assert not torch.isnan(logits_sent).any()
-            query_emb = torch.cat([graph_emb['query'] for i in range(graph_emb['srl'].shape[0])], dim=0)
-            logits_srl = self.srl_classifier(torch.cat((query_emb,
-                                                        graph_emb['srl']), dim=1))
-            # shape [num_ent_nodes, 2] 
-            assert not torch.isnan(logits_srl).any()
-            logits_ent = None
-            ent_labels = None
-            if 'ent' in graph.ntypes:
-                query_emb = torch.cat([graph_emb['query'] for i in range(graph_emb['ent'].shape[0])], dim=0)
-                logits_ent = self.ent_classifier(torch.cat((query_emb,
-                                                            graph_emb['ent']), dim=1))
-                # shape [num_ent_nodes, 2]
-                assert not torch.isnan(logits_ent).any()
-                # shape [num_srl_nodes, 1]
-                
-            # labels
-            # shape [num_sent_nodes, 1]
-            # shape [num_sampled_srl_nodes, 1]
-            
-           
+            list_ntypes = [ntype for ntype in NODE_CLF_TYPES
+                           if ntype == 'sent' or ntype in graph.ntypes]
+            dict_node_emb = {ntype: graph_emb[ntype] for ntype in list_ntypes}
+            dict_node_graph_ids = {ntype: dict_graph_ids[ntype]
+                                   for ntype in list_ntypes}
+        # all the classifiers at once (with skip-connection to the query)
+        list_logits = classify_nodes(
+            [getattr(self, ntype + '_classifier') for ntype in list_ntypes],
+            graph_emb['query'],
+            [dict_node_emb[ntype] for ntype in list_ntypes],
+            [dict_node_graph_ids[ntype] for ntype in list_ntypes])
+        dict_logits = dict(zip(list_ntypes, list_logits))
+        # shape [num_nodes, 2]
+        for logits in list_logits:
+            assert not torch.isnan(logits).any()
+        # labels of the classified nodes (only the processed training/dev
+        # graphs have them)
+        dict_labels = dict()
+        for ntype in list_ntypes:
+            if 'labels' in graph.nodes[ntype].data:
+                labels = graph.nodes[ntype].data['labels'].view(-1)
+                if train:
+                    labels = labels[dict_node_idx[ntype]]
+                dict_labels[ntype] = labels
+        sent_labels = dict_labels.get('sent')
+        srl_labels = dict_labels.get('srl')
+        ent_labels = dict_labels.get('ent')
+        # classified nodes of each node type (None: all the nodes)
+        if not train:
+            dict_node_idx = dict()
+        logits_sent = dict_logits['sent']
+        logits_srl = dict_logits.get('srl')
+        logits_ent = dict_logits.get('ent')
+        sent_emb = dict_node_emb['sent']
+        sent_graph_ids = dict_node_graph_ids['sent']
+        srl_graph_ids = dict_node_graph_ids.get('srl')
+        ent_graph_ids = dict_node_graph_ids.get('ent')
+
         # sent loss
         probs_sent = F.softmax(logits_sent, dim=1).cpu()
         # shape [num_sent_nodes, 2]
         
         # srl loss
         loss_srl = None # not all ans are inside an srl arg
-        probs_ent = torch.tensor([], device=device)
+        probs_ent = torch.tensor([], device=logits_sent.device)
         if logits_srl is None:
             loss_srl = None
             probs_srl = None
+            srl_graph_ids = None
         else:
             probs_srl = F.softmax(logits_srl, dim=1).cpu()
             # shape [num_srl_nodes, 2]
 
         # ent loss
         loss_ent = None # not all ans are an entity
-        probs_ent = torch.tensor([], device=device)
+        probs_ent = torch.tensor([], device=logits_sent.device)
         if logits_ent is None:
             loss_ent = None
             probs_ent = None
+            ent_graph_ids = None
         else:        
             probs_ent = F.softmax(logits_ent, dim=1).cpu()
             # shape [num_ent_nodes, 2]
 
         
-        return ({'sent': {'loss': 0, 'probs': probs_sent, 'logits': logits_sent, 
-                          'emb': sent_emb, 'lbl': sent_labels},
-                'srl': {'loss': 0, 'probs': probs_srl, 'lbl': srl_labels},
-                'ent': {'loss': 0, 'probs': probs_ent, 'lbl': ent_labels},
+        # graph of each classified node
+        sent_graph_ids = sent_graph_ids.cpu()
+        if srl_graph_ids is not None:
+            srl_graph_ids = srl_graph_ids.cpu()
+        if ent_graph_ids is not None:
+            ent_graph_ids = ent_graph_ids.cpu()
+
+        return ({'sent': {'loss': 0, 'probs': probs_sent,
+                          'logits': logits_sent, 'emb': sent_emb,
+                          'lbl': sent_labels, 'graph_ids': sent_graph_ids,
+                          'node_idx': dict_node_idx.get('sent')},
+                'srl': {'loss': 0, 'probs': probs_srl, 'logits': logits_srl,
+                        'lbl': srl_labels, 'graph_ids': srl_graph_ids,
+                        'node_idx': dict_node_idx.get('srl')},
+                'ent': {'loss': 0, 'probs': probs_ent, 'logits': logits_ent,
+                        'lbl': ent_labels, 'graph_ids': ent_graph_ids,
+                        'node_idx': dict_node_idx.get('ent')},
                 },
                 graph_emb)
     
-    def graph_initial_embedding(self, graph, bert_context_emb):
+    def graph_initial_embedding(self, graph, bert_context_emb, lengths=None):
         '''
         Inputs:
             - graph
-            - bert_context_emb shape [1, #max len, 768]
+            - bert_context_emb shape [batch size, #max len, 768]
+            - lengths: number of tokens of each context. If given, the BiGRU
+                only runs over the tokens (the right-to-left direction starts
+                at the last token, not at the padding)
         '''
-        input_gru = bert_context_emb[0].view(-1, 1, dict_params['in_feats'])
-        encoder_output, encoder_hidden = self.bigru(input_gru)
-        encoder_output = encoder_output.view(-1, dict_params['in_feats']*2)
-        graph_emb = {ntype : nn.Parameter(torch.Tensor(graph.number_of_nodes(ntype), dict_params['in_feats']))
-                      for ntype in graph.ntypes if graph.number_of_nodes(ntype) > 0}
+        max_len = bert_context_emb.shape[1]
+        input_gru = bert_context_emb.transpose(0, 1)
+        # shape [#max len, batch size, 768]
+        if lengths is None:
+            encoder_output, encoder_hidden = self.bigru(input_gru)
+        else:
+            packed_input = nn.utils.rnn.pack_padded_sequence(
+                input_gru, lengths.cpu().long(), enforce_sorted=False)
+            encoder_output, encoder_hidden = self.bigru(packed_input)
+            encoder_output, _ = nn.utils.rnn.pad_packed_sequence(
+                encoder_output, total_length=max_len)
+        in_feats = self.dict_params['in_feats']
+        encoder_output = encoder_output.transpose(0, 1).reshape(-1,
+                                                                in_feats * 2)
+        # shape [batch size * #max len, 2*768]
+        graph_emb = dict()
         for ntype in graph.ntypes:
             if graph.number_of_nodes(ntype) == 0:
                 continue
-            list_emb = []
-            for (st, end) in graph.nodes[ntype].data['st_end_idx']:
-                node_token_emb = encoder_output[st:end]
-                left2right = node_token_emb[-1, :dict_params['in_feats']].view(-1, dict_params['in_feats'])
-                right2left = node_token_emb[0, dict_params['in_feats']:].view(-1, dict_params['in_feats'])
-                # concat
-                concat_both_dir = torch.cat((left2right, right2left), dim=1)
-                list_emb.append(concat_both_dir.squeeze(0))
-            list_emb = torch.stack(list_emb, dim=0)
-            graph_emb[ntype] = self.node_norm(self.gru_aggregation(list_emb))
+            st_end_idx = graph.nodes[ntype].data['st_end_idx'].to(
+                encoder_output.device).long()
+            # offset of the context of the graph of each node in encoder_output
+            offset = graph_ids(batch_num_nodes(graph, ntype)).to(
+                encoder_output.device) * max_len
+            # left2right: last token of each node; right2left: first token of
+            # each node
+            end_idx = st_end_idx[:, 1].clamp(max=max_len) - 1 + offset
+            left2right = encoder_output[:, :in_feats].index_select(0, end_idx)
+            right2left = encoder_output[:, in_feats:].index_select(
+                0, st_end_idx[:, 0] + offset)
+            # concat
+            concat_both_dir = torch.cat((left2right, right2left), dim=1)
+            graph_emb[ntype] = self.node_norm(
+                self.gru_aggregation(concat_both_dir))
         return graph_emb
     
     def aggregate_emb(self, encoder_output):      
-        left2right = encoder_output[-1, :dict_params['in_feats']].view(-1, dict_params['in_feats'])
-        right2left = encoder_output[0, dict_params['in_feats']:].view(-1, dict_params['in_feats'])
+        in_feats = self.dict_params['in_feats']
+        left2right = encoder_output[-1, :in_feats].view(-1, in_feats)
+        right2left = encoder_output[0, in_feats:].view(-1, in_feats)
         # concat
         concat_both_dir = torch.cat((left2right, right2left), dim=1)
         # create the emb
@@ -627,60 +1006,91 @@ class HGNModel(BertPreTrainedModel):
 #         return torch.mean(token_emb, dim = 0)
     
     def sample_sent_nodes(self, graph):
-        list_sent_nodes = graph.nodes('sent')
-        sent_nodes_labels = graph.nodes['sent'].data['labels']
-        # shape [num sent nodes x 1]
-        supporting_sent_mask = sent_nodes_labels == torch.ones((sent_nodes_labels.shape))
-        # shape [num sent nodes x 1] with values True or False
-        supporting_sent_idx = [idx for idx, class_ in enumerate(supporting_sent_mask) if class_]
-        # list with the idx of supporting sent
-        non_supp_sent_idx = [i for i, non_supp_sent_node in enumerate(~supporting_sent_mask) if non_supp_sent_node]
-        # list with the idx of non supporting sent
-        num_supp_sent = len(supporting_sent_idx)
-        non_supp_sent_idx_sample = random.sample(non_supp_sent_idx, min(num_supp_sent, 
-                                                                        len(non_supp_sent_idx)))
-        sent_sample_idx = supporting_sent_idx + non_supp_sent_idx_sample
-        sent_sample_idx.sort()
-
+        # balanced sample of the sent nodes of each graph of the batch
+        sent_sample_idx = []
+        offset = 0
+        for num_nodes in batch_num_nodes(graph, 'sent').tolist():
+            sent_nodes_labels = graph.nodes['sent'].data['labels'][
+                offset:offset + num_nodes]
+            # shape [num sent nodes x 1]
+            supporting_sent_mask = sent_nodes_labels == torch.ones(
+                (sent_nodes_labels.shape))
+            # shape [num sent nodes x 1] with values True or False
+            supporting_sent_idx = [idx for idx, class_
+                                   in enumerate(supporting_sent_mask)
+                                   if class_]
+            # list with the idx of supporting sent
+            non_supp_sent_idx = [
+                i for i, non_supp_sent_node in enumerate(~supporting_sent_mask)
+                if non_supp_sent_node]
+            # list with the idx of non supporting sent
+            num_supp_sent = len(supporting_sent_idx)
+            non_supp_sent_idx_sample = random.sample(
+                non_supp_sent_idx, min(num_supp_sent, len(non_supp_sent_idx)))
+            graph_sample_idx = supporting_sent_idx + non_supp_sent_idx_sample
+            graph_sample_idx.sort()
+            sent_sample_idx.extend([offset + idx for idx in graph_sample_idx])
+            offset += num_nodes
         return sent_sample_idx
 
-    def sample_srl_nodes(self, graph):
-        list_srl_nodes = graph.nodes('srl')
-        srl_nodes_labels = graph.nodes['srl'].data['labels']
-        # shape [num labels x 1]
-        supporting_srl_mask = srl_nodes_labels == torch.ones((srl_nodes_labels.shape))
-        # shape [num labels x 1] with values True or False
-        supporting_srl_idx = [idx for idx, class_ in enumerate(supporting_srl_mask) if class_]
-        # list with the idx of supporting srl
-        non_supp_srl_idx = [i for i, non_supp_srl_node in enumerate(~supporting_srl_mask) if non_supp_srl_node]
-        # list with the idx of non supporting srl
-        num_supp_srl = len(supporting_srl_idx)
-        non_supp_srl_idx_sample = random.sample(non_supp_srl_idx, min(num_supp_srl, 
-                                                                        len(non_supp_srl_idx)))
-        srl_sample_idx = supporting_srl_idx + non_supp_srl_idx_sample
-        srl_sample_idx.sort()
 
+    def sample_srl_nodes(self, graph):
+        # balanced sample of the srl nodes of each graph of the batch
+        srl_sample_idx = []
+        offset = 0
+        for num_nodes in batch_num_nodes(graph, 'srl').tolist():
+            srl_nodes_labels = graph.nodes['srl'].data['labels'][
+                offset:offset + num_nodes]
+            # shape [num srl nodes x 1]
+            supporting_srl_mask = srl_nodes_labels == torch.ones(
+                (srl_nodes_labels.shape))
+            # shape [num srl nodes x 1] with values True or False
+            supporting_srl_idx = [idx for idx, class_
+                                  in enumerate(supporting_srl_mask) if class_]
+            # list with the idx of supporting srl
+            non_supp_srl_idx = [
+                i for i, non_supp_srl_node in enumerate(~supporting_srl_mask)
+                if non_supp_srl_node]
+            # list with the idx of non supporting srl
+            num_supp_srl = len(supporting_srl_idx)
+            non_supp_srl_idx_sample = random.sample(
+                non_supp_srl_idx, min(num_supp_srl, len(non_supp_srl_idx)))
+            graph_sample_idx = supporting_srl_idx + non_supp_srl_idx_sample
+            graph_sample_idx.sort()
+            srl_sample_idx.extend([offset + idx for idx in graph_sample_idx])
+            offset += num_nodes
         return srl_sample_idx
+
     
     def sample_ent_nodes(self, graph):
         if 'ent' not in graph.ntypes:
             return []
-        list_ent_nodes = graph.nodes('ent')
-        ent_nodes_labels = graph.nodes['ent'].data['labels']
-        # shape [num labels x 1]
-        supporting_ent_mask = ent_nodes_labels == torch.ones((ent_nodes_labels.shape))
-        # shape [num labels x 1] with values True or False
-        supporting_ent_idx = [idx for idx, class_ in enumerate(supporting_ent_mask) if class_]
-        # list with the idx of supporting srl
-        non_supp_ent_idx = [i for i, non_supp_ent_node in enumerate(~supporting_ent_mask) if non_supp_ent_node]
-        # list with the idx of non supporting srl
-        num_supp_ent = len(supporting_ent_idx)
-        non_supp_ent_idx_sample = random.sample(non_supp_ent_idx, min(num_supp_ent, 
-                                                                      len(non_supp_ent_idx)))
-        ent_sample_idx = supporting_ent_idx + non_supp_ent_idx_sample
-        ent_sample_idx.sort()
-
+        # balanced sample of the ent nodes of each graph of the batch
+        ent_sample_idx = []
+        offset = 0
+        for num_nodes in batch_num_nodes(graph, 'ent').tolist():
+            ent_nodes_labels = graph.nodes['ent'].data['labels'][
+                offset:offset + num_nodes]
+            # shape [num ent nodes x 1]
+            supporting_ent_mask = ent_nodes_labels == torch.ones(
+                (ent_nodes_labels.shape))
+            # shape [num ent nodes x 1] with values True or False
+            supporting_ent_idx = [idx for idx, class_
+                                  in enumerate(supporting_ent_mask) if class_]
+            # list with the idx of supporting ent
+            non_supp_ent_idx = [
+                i for i, non_supp_ent_node in enumerate(~supporting_ent_mask)
+                if non_supp_ent_node]
+            # list with the idx of non supporting ent
+            num_supp_ent = len(supporting_ent_idx)
+            non_supp_ent_idx_sample = random.sample(
+                non_supp_ent_idx, min(num_supp_ent, len(non_supp_ent_idx)))
+            graph_sample_idx = supporting_ent_idx + non_supp_ent_idx_sample
+            graph_sample_idx.sort()
+            ent_sample_idx.extend([offset + idx for idx in graph_sample_idx])
+            offset += num_nodes
         return ent_sample_idx
+
     
     
     def update_sequence_outputs(self, sequence_output, graph, graph_emb):
@@ -700,39 +1110,173 @@ class HGNModel(BertPreTrainedModel):
         g2d_graph_emb = self.graph2token_attention(g2d_graph, g2d_graph_emb)
         return g2d_graph_emb[0:offset_node].unsqueeze(0)
     
-    def span_prediction(self, sequence_output, start_positions, end_positions):
+    def span_prediction(self, sequence_output, start_positions, end_positions,
+                        attention_mask=None):
         logits = self.qa_outputs(sequence_output)
         start_logits, end_logits = logits.split(1, dim=-1)
         start_logits = start_logits.squeeze(-1)
         end_logits = end_logits.squeeze(-1)
+        if attention_mask is not None:
+            # padding tokens cannot be the start/end of the answer
+            start_logits = start_logits.masked_fill(attention_mask == 0,
+                                                    -10000.0)
+            end_logits = end_logits.masked_fill(attention_mask == 0, -10000.0)
 
         total_loss = None
-        if ((start_positions is not None and end_positions is not None) and
-            (start_positions != -1 and end_positions != -1)):
-            loss_fct = nn.CrossEntropyLoss()
-            start_loss = loss_fct(start_logits, start_positions)
-            end_loss = loss_fct(end_logits, end_positions)
-            total_loss = (start_loss + end_loss) / 2
+        if start_positions is not None and end_positions is not None:
+            # instances without answer span have -1 positions
+            valid = (start_positions != -1) & (end_positions != -1)
+            if valid.any():
+                loss_fct = nn.CrossEntropyLoss()
+                start_loss = loss_fct(start_logits[valid],
+                                      start_positions[valid])
+                end_loss = loss_fct(end_logits[valid], end_positions[valid])
+                total_loss = (start_loss + end_loss) / 2
         return (total_loss,  start_logits, end_logits)
 
 
+def inference_mode():
+    '''
+    torch.inference_mode (no autograd tracking nor version counters) when
+    available, otherwise torch.no_grad
+    '''
+    if hasattr(torch, 'inference_mode'):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
 import en_core_web_sm
+import string
+from collections import Counter
+
+# %%
+# Evaluation helpers (HotpotQA official metrics)
+def recall_at_k(prob_pos, k, labels):
+    k = min(k, len(prob_pos))
+    _, idx_topk = torch.topk(prob_pos, k, dim=0)
+    if sum(labels).item() == 0:
+        if sum(labels[idx_topk]).item() == 0:
+            return 1.0
+        else:
+            return 0.0
+    return sum(labels[idx_topk]).item()/sum(labels).item()
+
+def confusion(prediction, truth):
+    '''
+    Returns the number of true positives, false positives, true negatives and
+    false negatives of the binary tensors prediction and truth
+    '''
+    confusion_vector = prediction / truth
+    # 1: true positive, inf: false positive,
+    # nan: true negative, 0: false negative
+    true_positives = torch.sum(confusion_vector == 1).item()
+    false_positives = torch.sum(confusion_vector == float('inf')).item()
+    true_negatives = torch.sum(torch.isnan(confusion_vector)).item()
+    false_negatives = torch.sum(confusion_vector == 0).item()
+    return true_positives, false_positives, true_negatives, false_negatives
+
+def evaluation_metrics(prediction, truth):
+    tp, fp, tn, fn = confusion(prediction, truth)
+    prec = 1.0 * tp / (tp + fp) if tp + fp > 0 else 0.0
+    recall = 1.0 * tp / (tp + fn) if tp + fn > 0 else 0.0
+    f1 = 2 * prec * recall / (prec + recall) if prec + recall > 0 else 0.0
+    em = 1.0 if fp + fn == 0 else 0.0
+    return em, f1, prec, recall
+
+def normalize_answer(s):
+
+    def remove_articles(text):
+        return re.sub(r'\b(a|an|the)\b', ' ', text)
+
+    def white_space_fix(text):
+        return ' '.join(text.split())
+
+    def remove_punc(text):
+        exclude = set(string.punctuation)
+        return ''.join(ch for ch in text if ch not in exclude)
+
+    def lower(text):
+        return text.lower()
+
+    return white_space_fix(remove_articles(remove_punc(lower(s))))
+
+def f1_score(prediction, ground_truth):
+    normalized_prediction = normalize_answer(prediction)
+    normalized_ground_truth = normalize_answer(ground_truth)
+
+    ZERO_METRIC = (0, 0, 0)
+
+    if (normalized_prediction in ['yes', 'no', 'noanswer']
+            and normalized_prediction != normalized_ground_truth):
+        return ZERO_METRIC
+    if (normalized_ground_truth in ['yes', 'no', 'noanswer']
+            and normalized_prediction != normalized_ground_truth):
+        return ZERO_METRIC
+
+    prediction_tokens = normalized_prediction.split()
+    ground_truth_tokens = normalized_ground_truth.split()
+    common = Counter(prediction_tokens) & Counter(ground_truth_tokens)
+    num_same = sum(common.values())
+    if num_same == 0:
+        return ZERO_METRIC
+    precision = 1.0 * num_same / len(prediction_tokens)
+    recall = 1.0 * num_same / len(ground_truth_tokens)
+    f1 = (2 * precision * recall) / (precision + recall)
+    return f1, precision, recall
+
+def exact_match_score(prediction, ground_truth):
+    return (normalize_answer(prediction) == normalize_answer(ground_truth))
+
 
 wh_ans_len = {'which': 25, 'what':25, 'who':20, 'when':10, 'how':15, 'where':15, 'how many': 10, None: 15}
 class Validation():
 
-    def __init__(self, model, dataset, validation_dataloader,
-                 tensor_input_ids, tensor_attention_masks, tensor_token_type_ids):
+    def __init__(self, model, dataset, validation_dataloader, tensor_input_ids,
+                 tensor_attention_masks, tensor_token_type_ids, batch_size=1,
+                 list_span_idx=None):
+        '''
+        Inputs:
+            - validation_dataloader: list of graphs
+            - batch_size: number of instances per forward
+            - list_span_idx: (start, end) token positions of the answer of each
+                instance (-1 if not a span). Only needed by do_validation
+        '''
         self.model = model
         self.model.eval()
-        self.dataset = dataset
+        # the inputs go to the device of the model (cpu or gpu)
+        self.device = next(model.parameters()).device
         self.nlp = en_core_web_sm.load()
+        self.set_data(dataset, validation_dataloader, tensor_input_ids,
+                      tensor_attention_masks, tensor_token_type_ids,
+                      list_span_idx)
+        self.tokenizer = BertTokenizer.from_pretrained(pretrained_weights,
+                                                       do_basic_tokenize=False,
+                                                       clean_text=False)
+        self.batch_size = batch_size
+
+    def set_data(self, dataset, validation_dataloader, tensor_input_ids,
+                 tensor_attention_masks, tensor_token_type_ids,
+                 list_span_idx=None):
+        '''
+        Sets the instances to evaluate (e.g., the next chunk of a streaming
+        prediction, see src/models/pipeline.py) without reloading the tokenizer
+        and the spacy model
+        '''
+        self.dataset = dataset
         self.validation_dataloader = validation_dataloader
         self.tensor_input_ids = tensor_input_ids
         self.tensor_attention_masks = tensor_attention_masks
         self.tensor_token_type_ids = tensor_token_type_ids
-        self.tokenizer = BertTokenizer.from_pretrained(pretrained_weights, 
-                                                       do_basic_tokenize=False, clean_text=False)
+        self.list_span_idx = list_span_idx
+
+    def get_dataloader(self):
+        # batches of contexts of similar length (each batch is trimmed to its
+        # longest context)
+        batch_sampler = LengthBucketBatchSampler(
+            self.tensor_attention_masks.sum(1).tolist(), self.batch_size)
+        return DataLoader(range(len(self.validation_dataloader)),
+                          batch_sampler=batch_sampler,
+                          collate_fn=GraphCollator(self.validation_dataloader))
         
     def do_validation(self):       
         metrics = {'validation_loss': 0, 
@@ -746,53 +1290,78 @@ class Validation():
                    }
         # Evaluate data for one epoch       
         num_valid_examples = 0
-        for step, b_graph in enumerate(tqdm(self.validation_dataloader)):
-            num_valid_examples += 1
-            with torch.no_grad():
-                output = self.model(b_graph,
-                               input_ids=self.tensor_input_ids[step].unsqueeze(0).to(device),
-                               attention_mask=self.tensor_attention_masks[step].unsqueeze(0).to(device),
-                               token_type_ids=self.tensor_token_type_ids[step].unsqueeze(0).to(device), 
-                               start_positions=torch.tensor([self.list_span_idx[step][0]], device='cuda'),
-                               end_positions=torch.tensor([self.list_span_idx[step][1]], device='cuda'), train=False)
-                
-            # Accumulate the validation loss.
-            metrics['validation_loss'] += output['loss'].item()
-            # Sentence evaluation
-            sent_labels = output['sent']['lbl']
-            prediction_sent = torch.argmax(output['sent']['probs'], dim=1)
-            sp_em, sp_prec, sp_recall = self.update_sp_metrics(metrics, prediction_sent, sent_labels)
-            # srl
-            prediction_srl = torch.argmax(output['srl']['probs'], dim=1)
-            srl_labels = output['srl']['lbl']
-            self.update_srl_metrics(metrics, prediction_srl, srl_labels, output['srl']['probs'][:,1])
-            # ent
-            if output['ent']['probs'] is not None:
-                prediction_ent = torch.argmax(output['ent']['probs'], dim=1)
-                ent_labels = output['ent']['lbl']
-                self.update_ent_metrics(metrics, prediction_ent, ent_labels, output['ent']['probs'][:,1])
-            # answer span prediction
-            ## wh type
-            query = self.dataset[step]['question']
-            wh = self.__findWHword(query)
-            max_ans_len = wh_ans_len[wh]
-            golden_ans = self.dataset[step]['answer']
-            ans_type = torch.argmax(output['ans_type']['logits']).item()
-            # answer span prediction
-            predicted_ans = ""
-            if ans_type == 0:
+        for b_graph, list_idx in tqdm(self.get_dataloader()):
+            start_positions, end_positions = None, None
+            if self.list_span_idx is not None:
+                start_positions = torch.tensor(
+                    [self.list_span_idx[step][0] for step in list_idx],
+                    device=self.device)
+                end_positions = torch.tensor(
+                    [self.list_span_idx[step][1] for step in list_idx],
+                    device=self.device)
+            with inference_mode():
+                output = self.model(
+                    b_graph,
+                    input_ids=self.tensor_input_ids[list_idx].to(self.device),
+                    attention_mask=self.tensor_attention_masks[list_idx].to(
+                        self.device),
+                    token_type_ids=self.tensor_token_type_ids[list_idx].to(
+                        self.device), start_positions=start_positions,
+                    end_positions=end_positions, train=False)
+            for step, output in zip(list_idx,
+                                    split_batch_output(output, len(list_idx))):
+                num_valid_examples += 1
+                # Accumulate the validation loss (0 if the model does not
+                # compute it)
+                metrics['validation_loss'] += float(output['loss'])
+                # Sentence evaluation
+                sent_labels = output['sent']['lbl']
+                prediction_sent = torch.argmax(output['sent']['probs'], dim=1)
+                sp_em, sp_prec, sp_recall = self.update_sp_metrics(
+                    metrics, prediction_sent, sent_labels)
+                # srl
+                if output['srl']['probs'] is not None:
+                    prediction_srl = torch.argmax(output['srl']['probs'],
+                                                  dim=1)
+                    srl_labels = output['srl']['lbl']
+                    self.update_srl_metrics(metrics, prediction_srl,
+                                            srl_labels,
+                                            output['srl']['probs'][:, 1])
+                # ent
+                if output['ent']['probs'] is not None:
+                    prediction_ent = torch.argmax(output['ent']['probs'],
+                                                  dim=1)
+                    ent_labels = output['ent']['lbl']
+                    self.update_ent_metrics(metrics, prediction_ent,
+                                            ent_labels,
+                                            output['ent']['probs'][:, 1])
+                # answer span prediction
                 ## wh type
                 query = self.dataset[step]['question']
                 wh = self.__findWHword(query)
                 max_ans_len = wh_ans_len[wh]
-                predicted_ans = self.__get_pred_ans_str(self.tensor_input_ids[step], output, max_ans_len)
-            elif ans_type == 1:
-                predicted_ans = 'yes'
-            elif ans_type == 2:
-                predicted_ans = 'no'
-            ans_em, ans_prec, ans_recall = self.update_answer_metrics(metrics, predicted_ans, golden_ans)
-            # joint
-            self.update_joint_metrics(metrics, ans_em, ans_prec, ans_recall, sp_em, sp_prec, sp_recall)                
+                golden_ans = self.dataset[step]['answer']
+                ans_type = torch.argmax(output['ans_type']['logits']).item()
+                # answer span prediction
+                predicted_ans = ""
+                if ans_type == 0:
+                    ## wh type
+                    query = self.dataset[step]['question']
+                    wh = self.__findWHword(query)
+                    max_ans_len = wh_ans_len[wh]
+                    predicted_ans = self.__get_pred_ans_str(
+                        self.tensor_input_ids[step], output, max_ans_len,
+                        int(self.tensor_attention_masks[step].sum()))
+                elif ans_type == 1:
+                    predicted_ans = 'yes'
+                elif ans_type == 2:
+                    predicted_ans = 'no'
+                ans_em, ans_prec, ans_recall = self.update_answer_metrics(
+                    metrics, predicted_ans, golden_ans)
+                # joint
+                self.update_joint_metrics(metrics, ans_em, ans_prec,
+                                          ans_recall, sp_em, sp_prec,
+                                          sp_recall)
             
         #N = len(self.validation_dataloader)
         N = num_valid_examples
@@ -803,48 +1372,63 @@ class Validation():
     def get_answer_predictions(self, dict_ins2dict_doc2pred):
         output_pred_sp = {}
         output_predictions_ans = {}
-        for step, b_graph in enumerate(tqdm(self.validation_dataloader)): 
-            with torch.no_grad():
-                output = self.model(b_graph,
-                               input_ids=self.tensor_input_ids[step].unsqueeze(0).to(device),
-                               attention_mask=self.tensor_attention_masks[step].unsqueeze(0).to(device),
-                               token_type_ids=self.tensor_token_type_ids[step].unsqueeze(0).to(device), 
-                               train=False)
-            _id = self.dataset[step]['_id']
-            # answer
-            ans_type = torch.argmax(output['ans_type']['logits']).item()
-            # answer span prediction
-            predicted_ans = ""
-            if ans_type == 0:
-                ## wh type
-                query = self.dataset[step]['question']
-                wh = self.__findWHword(query)
-                max_ans_len = wh_ans_len[wh]
-                predicted_ans = self.__get_pred_ans_str(self.tensor_input_ids[step], output, max_ans_len)
-            elif ans_type == 1:
-                predicted_ans = 'yes'
-            elif ans_type == 2:
-                predicted_ans = 'no'
-            output_predictions_ans[_id] = predicted_ans
-            #sp
-            prediction_sent = torch.argmax(output['sent']['probs'], dim=1)
-            sent_num = 0
-            dict_sent_num2str = dict()
-            for doc_idx, (doc_title, doc) in enumerate(self.dataset[step]['context']):
-                if dict_ins2dict_doc2pred[step][doc_idx] == 1:
-                    for i, sent in enumerate(doc):
-                        dict_sent_num2str[sent_num] = {'sent': i, 'doc_title': doc_title}
-                        sent_num += 1
-            output_pred_sp[_id] = []
-            for i, pred in enumerate(prediction_sent):
-                if pred == 1:
-                    output_pred_sp[_id].append([dict_sent_num2str[i]['doc_title'],
-                                                dict_sent_num2str[i]['sent']])
-        return {'answer': output_predictions_ans, 'sp': output_pred_sp}
+        for b_graph, list_idx in tqdm(self.get_dataloader()): 
+            with inference_mode():
+                output = self.model(
+                    b_graph,
+                    input_ids=self.tensor_input_ids[list_idx].to(self.device),
+                    attention_mask=self.tensor_attention_masks[list_idx].to(
+                        self.device),
+                    token_type_ids=self.tensor_token_type_ids[list_idx].to(
+                        self.device), train=False)
+            for step, output in zip(list_idx,
+                                    split_batch_output(output, len(list_idx))):
+                _id = self.dataset[step]['_id']
+                # answer
+                ans_type = torch.argmax(output['ans_type']['logits']).item()
+                # answer span prediction
+                predicted_ans = ""
+                if ans_type == 0:
+                    ## wh type
+                    query = self.dataset[step]['question']
+                    wh = self.__findWHword(query)
+                    max_ans_len = wh_ans_len[wh]
+                    predicted_ans = self.__get_pred_ans_str(
+                        self.tensor_input_ids[step], output, max_ans_len,
+                        int(self.tensor_attention_masks[step].sum()))
+                elif ans_type == 1:
+                    predicted_ans = 'yes'
+                elif ans_type == 2:
+                    predicted_ans = 'no'
+                output_predictions_ans[_id] = predicted_ans
+                #sp
+                prediction_sent = torch.argmax(output['sent']['probs'], dim=1)
+                sent_num = 0
+                dict_sent_num2str = dict()
+                for doc_idx, (doc_title, doc) in enumerate(
+                        self.dataset[step]['context']):
+                    if dict_ins2dict_doc2pred[step][doc_idx] == 1:
+                        for i, sent in enumerate(doc):
+                            dict_sent_num2str[sent_num] = {
+                                'sent': i, 'doc_title': doc_title}
+                            sent_num += 1
+                output_pred_sp[_id] = []
+                for i, pred in enumerate(prediction_sent):
+                    if pred == 1:
+                        output_pred_sp[_id].append(
+                            [dict_sent_num2str[i]['doc_title'],
+                             dict_sent_num2str[i]['sent']])
+        # the batches are sorted by length: the predictions keep the order of
+        # the input
+        list_ids = [hotpot_instance['_id'] for hotpot_instance in self.dataset]
+        return {'answer': {_id: output_predictions_ans[_id]
+                           for _id in list_ids},
+                'sp': {_id: output_pred_sp[_id] for _id in list_ids}}
     
-    def __get_pred_ans_str(self, input_ids, output, max_ans_len):
-        st, end = self.__get_st_end_span_idx(output['span']['start_logits'].squeeze(),
-                                             output['span']['end_logits'].squeeze(), max_ans_len)
+    def __get_pred_ans_str(self, input_ids, output, max_ans_len, context_len):
+        st, end = self.__get_st_end_span_idx(
+            output['span']['start_logits'].squeeze(0),
+            output['span']['end_logits'].squeeze(0), max_ans_len, context_len)
         return self.__get_str_span(input_ids, st, end)
 
     def __get_str_span(self, input_ids, st, end):
@@ -861,7 +1445,13 @@ class Validation():
             best_indexes.append(index_and_score[i][0])
         return best_indexes
     
-    def __get_st_end_span_idx(self, start_logits, end_logits, max_answer_length = 30):
+    def __get_st_end_span_idx(self, start_logits, end_logits,
+                              max_answer_length=30, context_len=None):
+        if context_len is None:
+            context_len = len(start_logits)
+        # only the tokens of the context (not the padding)
+        start_logits = start_logits[:context_len]
+        end_logits = end_logits[:context_len]
         start_indexes = self.__get_best_indexes(start_logits, 10)
         end_indexes = self.__get_best_indexes(end_logits, 10)
         list_candidates = []
@@ -871,9 +1461,9 @@ class Validation():
                 # We could hypothetically create invalid predictions, e.g., predict
                 # that the start of the span is in the question. We throw out all
                 # invalid predictions.
-                if start_index >= 512:
+                if start_index >= context_len:
                     continue
-                if end_index >= 512:
+                if end_index >= context_len:
                     continue
                 if end_index < start_index:
                     continue
@@ -908,4 +1498,62 @@ class Validation():
                     return can
         if 'name' in sentence.lower() or doc[-1].lemma_ == 'be' or doc[-1].pos_ == 'ADP':
             return 'what'
-        return None
\ No newline at end of file
+        return None
+
+    def update_sp_metrics(self, metrics, prediction_sent, sent_labels):
+        em, f1, prec, recall = evaluation_metrics(
+            prediction_sent.type(torch.DoubleTensor),
+            sent_labels.type(torch.DoubleTensor))
+        metrics['sp_em'] += em
+        metrics['sp_f1'] += f1
+        metrics['sp_prec'] += prec
+        metrics['sp_recall'] += recall
+        return em, prec, recall
+
+    def update_srl_metrics(self, metrics, prediction_srl, srl_labels,
+                           positive_probs):
+        srl_eval = evaluation_metrics(prediction_srl.type(torch.DoubleTensor),
+                                      srl_labels.type(torch.DoubleTensor))
+        metrics['srl_em'] += srl_eval[0]
+        metrics['srl_f1'] += srl_eval[1]
+        metrics['srl_prec'] += srl_eval[2]
+        metrics['srl_recall'] += srl_eval[3]
+        metrics['srl_recall@1'] += recall_at_k(positive_probs, 1, srl_labels)
+        metrics['srl_recall@3'] += recall_at_k(positive_probs, 3, srl_labels)
+        metrics['srl_recall@5'] += recall_at_k(positive_probs, 5, srl_labels)
+
+    def update_ent_metrics(self, metrics, prediction_ent, ent_labels,
+                           positive_probs):
+        ent_eval = evaluation_metrics(prediction_ent.type(torch.DoubleTensor),
+                                      ent_labels.type(torch.DoubleTensor))
+        metrics['ent_em'] += ent_eval[0]
+        metrics['ent_f1'] += ent_eval[1]
+        metrics['ent_prec'] += ent_eval[2]
+        metrics['ent_recall'] += ent_eval[3]
+        metrics['ent_recall@1'] += recall_at_k(positive_probs, 1, ent_labels)
+        metrics['ent_recall@3'] += recall_at_k(positive_probs, 3, ent_labels)
+        metrics['ent_recall@5'] += recall_at_k(positive_probs, 5, ent_labels)
+
+    def update_answer_metrics(self, metrics, prediction, gold):
+        em = exact_match_score(prediction, gold)
+        f1, prec, recall = f1_score(prediction, gold)
+        metrics['ans_em'] += float(em)
+        metrics['ans_f1'] += f1
+        metrics['ans_prec'] += prec
+        metrics['ans_recall'] += recall
+        return em, prec, recall
+
+    def update_joint_metrics(self, metrics, ans_em, ans_prec, ans_recall,
+                             sp_em, sp_prec, sp_recall):
+        joint_prec = ans_prec * sp_prec
+        joint_recall = ans_recall * sp_recall
+        if joint_prec + joint_recall > 0:
+            joint_f1 = 2 * joint_prec * joint_recall / (joint_prec +
+                                                        joint_recall)
+        else:
+            joint_f1 = 0.
+        joint_em = ans_em * sp_em
+        metrics['joint_em'] += joint_em
+        metrics['joint_f1'] += joint_f1
+        metrics['joint_prec'] += joint_prec
+        metrics['joint_recall'] += joint_recall
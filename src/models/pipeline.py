@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# coding: utf-8
+'''
+Streaming prediction: the instances go through NER -> SRL -> graph creation ->
+model in chunks. Each stage runs in its own thread and the stages are connected
+by bounded queues, so they overlap (e.g., SRL of a chunk on the gpu while the
+graphs of the previous chunk are built) and only a few chunks are in memory at
+any time, whatever the size of the input.
+'''
+import queue
+import threading
+from src.data.preprocess_dataset import (extract_named_entities, extract_srl,
+                                         create_graphs, context_tensors)
+from src.data.graph_creation import Dataset
+from src.data.preprocessing import NER_stanza
+from src.data.preprocessing import SRL
+from src.data.preprocessing import ParagraphTable
+from src.data.preprocessing import AnnotationCache
+from src.models.model import Validation
+
+# end of the stream of chunks
+_END = object()
+
+
+class _StageError():
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def _run_stage(fn, input_queue, output_queue):
+    while True:
+        item = input_queue.get()
+        if item is _END or isinstance(item, _StageError):
+            output_queue.put(item)
+            return
+        try:
+            output_queue.put(fn(item))
+        except Exception as e:
+            output_queue.put(_StageError(e))
+            # drain the input so that the previous stages are not blocked on a
+            # full queue
+            while item is not _END and not isinstance(item, _StageError):
+                item = input_queue.get()
+            return
+
+
+def run_pipeline(iter_items, list_stages, queue_size=2):
+    '''
+    Generator with the output of the last stage for each item of iter_items
+    (same order).
+    Inputs:
+        - iter_items: iterable of inputs of the first stage
+        - list_stages: list of functions (output of the previous stage ->
+            output). Each one runs in a thread
+        - queue_size: max number of items waiting between two stages
+    Exceptions raised by a stage or by iter_items are raised by the generator
+    '''
+    list_queues = [queue.Queue(maxsize=queue_size)
+                   for _ in range(len(list_stages) + 1)]
+    list_threads = [threading.Thread(target=_run_stage,
+                                     args=(fn, list_queues[i],
+                                           list_queues[i + 1]),
+                                     daemon=True)
+                    for i, fn in enumerate(list_stages)]
+    for thread in list_threads:
+        thread.start()
+
+    def feed():
+        try:
+            for item in iter_items:
+                list_queues[0].put(item)
+        except Exception as e:
+            # forwarded by the stages as an error of the first one
+            list_queues[0].put(_StageError(e))
+            return
+        list_queues[0].put(_END)
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    while True:
+        item = list_queues[-1].get()
+        if item is _END:
+            break
+        if isinstance(item, _StageError):
+            raise item.exception
+        yield item
+    for thread in list_threads + [feeder]:
+        thread.join()
+
+
+class StreamingPrediction():
+    def __init__(self, model, pretrained_weights, chunk_size=256, queue_size=2,
+                 eval_batch_size=8, ner_batch_size=None, srl_batch_size=None,
+                 annotation_cache_path=None, annotation_cache_max_entries=None,
+                 dedup_paragraphs=True, device='cuda'):
+        '''
+        Inputs:
+            - model: HGNModel (on device)
+            - chunk_size: number of instances per chunk. The instances of each
+                chunk are batched by length (LengthBucketBatchSampler) on their
+                own, so the batches are not those of a prediction over the
+                whole input at once (same predictions, up to the floating point
+                differences of batching)
+            - queue_size: max number of chunks waiting between two stages
+            - eval_batch_size: number of instances per forward of the model
+            - ner_batch_size, srl_batch_size: see NER_stanza and SRL
+            - annotation_cache_path: AnnotationCache file shared by NER and SRL
+                (optional)
+            - dedup_paragraphs: annotate the unique paragraphs of each chunk
+                only once (ParagraphTable)
+            - device: 'cuda' or 'cpu', for NER and SRL
+        '''
+        self.pretrained_weights = pretrained_weights
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size
+        self.dedup_paragraphs = dedup_paragraphs
+        self.cache = None
+        if annotation_cache_path is not None:
+            self.cache = AnnotationCache(
+                annotation_cache_path,
+                max_entries=annotation_cache_max_entries)
+        self.ner = NER_stanza(batch_size=ner_batch_size,
+                              use_gpu=(device == 'cuda'), cache=self.cache)
+        self.srl = SRL(device=device, batch_size=srl_batch_size,
+                       cache=self.cache)
+        # graph builder (and its tokenizer) shared by all the chunks
+        self.graph_dataset = Dataset(batch_size=1,
+                                     pretrained_weights=pretrained_weights)
+        self.validation = Validation(model, [], [], None, None, None,
+                                     batch_size=eval_batch_size)
+
+    def chunks(self, hotpot, dict_ins2dict_doc2pred):
+        for st in range(0, len(hotpot), self.chunk_size):
+            hotpot_chunk = hotpot[st:st+self.chunk_size]
+            # instances are indexed from 0 in each chunk
+            dict_doc2pred_chunk = {i: dict_ins2dict_doc2pred[st + i]
+                                   for i in range(len(hotpot_chunk))}
+            yield {'hotpot': hotpot_chunk,
+                   'dict_ins2dict_doc2pred': dict_doc2pred_chunk}
+
+    def ner_stage(self, chunk):
+        chunk['paragraph_table'] = None
+        if self.dedup_paragraphs:
+            chunk['paragraph_table'] = ParagraphTable(
+                chunk['hotpot'], chunk['dict_ins2dict_doc2pred'])
+        chunk['annotations'] = extract_named_entities(
+            chunk['hotpot'], chunk['dict_ins2dict_doc2pred'], self.ner,
+            chunk['paragraph_table'])
+        return chunk
+
+    def srl_stage(self, chunk):
+        chunk['annotations'].update(
+            extract_srl(chunk['hotpot'], chunk['dict_ins2dict_doc2pred'],
+                        self.srl, chunk.pop('paragraph_table')))
+        return chunk
+
+    def graph_stage(self, chunk):
+        chunk.update(
+            create_graphs(chunk['hotpot'], chunk['dict_ins2dict_doc2pred'],
+                          self.pretrained_weights, chunk.pop('annotations'),
+                          train_dataset=self.graph_dataset))
+        # release the instances and annotations of the chunk
+        self.graph_dataset.set_data(None, None, None, None, None)
+        return chunk
+
+    def model_stage(self, chunk):
+        self.validation.set_data(chunk['hotpot'], chunk['list_graphs'],
+                                 *context_tensors(chunk['list_context']))
+        preds = self.validation.get_answer_predictions(
+            chunk['dict_ins2dict_doc2pred'])
+        # release the graphs and tensors of the chunk
+        self.validation.set_data([], [], None, None, None)
+        return preds
+
+    def predict(self, hotpot, dict_ins2dict_doc2pred) -> dict:
+        '''
+        Same output as Validation.get_answer_predictions over the whole input
+        (in the order of the input)
+        '''
+        preds = {'answer': dict(), 'sp': dict()}
+        list_stages = [self.ner_stage, self.srl_stage, self.graph_stage,
+                       self.model_stage]
+        for chunk_preds in run_pipeline(
+                self.chunks(hotpot, dict_ins2dict_doc2pred), list_stages,
+                queue_size=self.queue_size):
+            preds['answer'].update(chunk_preds['answer'])
+            preds['sp'].update(chunk_preds['sp'])
+        if self.cache is not None:
+            print("Annotation cache:", self.cache.stats())
+        return preds
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# coding: utf-8
+'''
+Resident prediction service: the document filter, NER, SRL, tokenizers and HGN
+model are loaded once and the requests are answered by a long-lived process
+(see run_server.py). Concurrent requests are grouped into micro-batches, which
+go through retrieval -> NER -> SRL -> graph creation -> model as the chunks of
+StreamingPrediction (one thread per stage, so the stages of consecutive batches
+overlap).
+'''
+import json
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from src.models.pipeline import StreamingPrediction, run_pipeline
+
+# stops the batcher
+_STOP = object()
+
+
+def select_all_docs(hotpot) -> dict:
+    return {ins_idx: {doc_idx: 1
+                      for doc_idx in range(len(hotpot_instance['context']))}
+            for ins_idx, hotpot_instance in enumerate(hotpot)}
+
+
+def request_ids(hotpot) -> set:
+    return set(hotpot_instance['_id'] for hotpot_instance in hotpot)
+
+
+class PredictionService():
+    def __init__(self, model, pretrained_weights, doc_retrieval=None,
+                 max_batch_size=32, max_wait=0.01, eval_batch_size=8,
+                 queue_size=2, dedup_paragraphs=True, device='cuda'):
+        '''
+        Inputs:
+            - model: HGNModel (on device)
+            - doc_retrieval: object with predict_relevant_docs(hotpot) ->
+                dict_ins2dict_doc2pred (e.g., SAEDocumentRetrieval). If None,
+                all the documents are selected
+            - max_batch_size: max number of instances per micro-batch
+            - max_wait: max time (s) that the first request of a micro-batch
+                waits for other requests
+            - queue_size: max number of micro-batches waiting between two
+                stages
+            - device: 'cuda' or 'cpu', for NER and SRL
+        '''
+        self.doc_retrieval = doc_retrieval
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue_size = queue_size
+        self.streaming = StreamingPrediction(model, pretrained_weights,
+                                             chunk_size=max_batch_size,
+                                             queue_size=queue_size,
+                                             eval_batch_size=eval_batch_size,
+                                             dedup_paragraphs=dedup_paragraphs,
+                                             device=device)
+        self.request_queue = queue.Queue()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.__serve, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.request_queue.put(_STOP)
+        self.thread.join()
+
+    def submit(self, hotpot) -> Future:
+        '''
+        Inputs:
+            - hotpot: list of HotpotQA instances (the context is required, the
+                answer is not)
+        Returns a future with
+            {'answer': {_id: str}, 'sp': {_id: [[title, sent_idx], ...]}}
+        (so the _ids of a request must be unique)
+        '''
+        for hotpot_instance in hotpot:
+            missing = [k for k in ['_id', 'question', 'context']
+                       if k not in hotpot_instance]
+            if len(missing) > 0:
+                raise ValueError("instance without {}".format(
+                    ', '.join(missing)))
+        if len(request_ids(hotpot)) < len(hotpot):
+            raise ValueError("duplicate _id in the request")
+        future = Future()
+        self.request_queue.put((hotpot, future))
+        return future
+
+    def predict(self, hotpot) -> dict:
+        return self.submit(hotpot).result()
+
+    def batches(self):
+        '''
+        Groups the waiting requests into micro-batches of at most
+        max_batch_size instances (a larger request is a micro-batch by itself).
+        The predictions of a micro-batch are keyed by _id, so a request with an
+        _id already in the micro-batch starts the next one
+        '''
+        pending = None
+        while True:
+            first = pending
+            if first is None:
+                first = self.request_queue.get()
+            pending = None
+            if first is _STOP:
+                return
+            list_requests = [first]
+            num_instances = len(first[0])
+            set_ids = request_ids(first[0])
+            deadline = time.perf_counter() + self.max_wait
+            while num_instances < self.max_batch_size:
+                try:
+                    request = self.request_queue.get(
+                        timeout=max(0, deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                if (request is _STOP or num_instances + len(request[0])
+                        > self.max_batch_size
+                        or not set_ids.isdisjoint(request_ids(request[0]))):
+                    pending = request
+                    break
+                list_requests.append(request)
+                num_instances += len(request[0])
+                set_ids.update(request_ids(request[0]))
+            yield {'requests': list_requests,
+                   'hotpot': [hotpot_instance for (hotpot, _) in list_requests
+                              for hotpot_instance in hotpot]}
+
+    def retrieval_stage(self, batch):
+        if self.doc_retrieval is None:
+            batch['dict_ins2dict_doc2pred'] = select_all_docs(batch['hotpot'])
+        else:
+            batch['dict_ins2dict_doc2pred'] = (
+                self.doc_retrieval.predict_relevant_docs(batch['hotpot']))
+        return batch
+
+    def model_stage(self, batch):
+        batch['preds'] = self.streaming.model_stage(batch)
+        return batch
+
+    def __serve(self):
+        list_stages = [self.retrieval_stage, self.streaming.ner_stage,
+                       self.streaming.srl_stage, self.streaming.graph_stage,
+                       self.model_stage]
+        for batch in run_pipeline(self.batches(),
+                                  [_skip_on_error(stage)
+                                   for stage in list_stages],
+                                  queue_size=self.queue_size):
+            for (hotpot, future) in batch['requests']:
+                if 'error' in batch:
+                    future.set_exception(batch['error'])
+                    continue
+                list_ids = [hotpot_instance['_id']
+                            for hotpot_instance in hotpot]
+                future.set_result(
+                    {'answer': {_id: batch['preds']['answer'][_id]
+                                for _id in list_ids},
+                     'sp': {_id: batch['preds']['sp'][_id]
+                            for _id in list_ids}})
+
+
+def _skip_on_error(stage):
+    '''
+    A failing micro-batch keeps its exception (returned to its requests)
+    instead of stopping the pipeline
+    '''
+    def fn(batch):
+        if 'error' in batch:
+            return batch
+        try:
+            return stage(batch)
+        except Exception as e:
+            return {'requests': batch['requests'], 'error': e}
+    return fn
+
+
+def make_http_server(service, host='127.0.0.1',
+                     port=8000) -> ThreadingHTTPServer:
+    '''
+    POST /predict with a HotpotQA instance or a list of instances (json)
+        -> {'answer': {_id: str}, 'sp': {_id: [[title, sent_idx], ...]}}
+    GET /health -> {'status': 'ok'}
+    '''
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, code, obj):
+            body = json.dumps(obj).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != '/health':
+                self.send_json(404, {'error': 'not found'})
+                return
+            self.send_json(200, {'status': 'ok'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self.send_json(404, {'error': 'not found'})
+                return
+            try:
+                hotpot = json.loads(
+                    self.rfile.read(int(self.headers['Content-Length'])))
+            except (TypeError, ValueError) as e:
+                self.send_json(400, {'error': 'invalid json: {}'.format(e)})
+                return
+            if isinstance(hotpot, dict):
+                hotpot = [hotpot]
+            try:
+                future = service.submit(hotpot)
+            except (TypeError, ValueError) as e:
+                self.send_json(400, {'error': str(e)})
+                return
+            try:
+                self.send_json(200, future.result())
+            except Exception as e:
+                self.send_json(500, {'error': repr(e)})
+
+        def log_message(self, format, *args):
+            # one line per request would dominate the output under load
+            pass
+
+    class Server(ThreadingHTTPServer):
+        # the default backlog (5) drops the connections of a burst of
+        # concurrent clients (1s retry)
+        request_queue_size = 128
+
+    return Server((host, port), Handler)
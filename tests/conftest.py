@@ -0,0 +1,18 @@
+import os
+import sys
+import importlib.util
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def load_module(name, relpath):
+    '''
+    Imports a single module of src without running the __init__ of its packages
+    (they import the NLP models: stanza, allennlp, transformers, dgl)
+    '''
+    spec = importlib.util.spec_from_file_location(name,
+                                                  os.path.join(ROOT, relpath))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,69 @@
+import pytest
+from conftest import load_module
+
+annotation_cache = load_module('annotation_cache',
+                               'src/data/preprocessing/annotation_cache.py')
+AnnotationCache = annotation_cache.AnnotationCache
+
+
+class CountingAnnotator():
+    def __init__(self):
+        self.list_calls = []
+
+    def __call__(self, list_text):
+        self.list_calls.append(list(list_text))
+        return [{'text': text, 'len': len(text)} for text in list_text]
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = AnnotationCache(str(tmp_path / 'cache.sqlite'))
+    yield cache
+    cache.close()
+
+
+def test_cached_equals_uncached(cache):
+    list_text = ['a b', 'c', 'a b', 'd e f']
+    annotator = CountingAnnotator()
+    uncached = CountingAnnotator()(list_text)
+    assert cache.annotate('ner', list_text, annotator) == uncached
+    # second run: everything from the cache
+    assert cache.annotate('ner', list_text, annotator) == uncached
+    # the annotator only ran once, on the unique texts
+    assert annotator.list_calls == [['a b', 'c', 'd e f']]
+
+
+def test_only_misses_are_annotated(cache):
+    annotator = CountingAnnotator()
+    cache.annotate('srl', ['x', 'y'], annotator)
+    output = cache.annotate('srl', ['y', 'z', 'x'], annotator)
+    assert output == CountingAnnotator()(['y', 'z', 'x'])
+    assert annotator.list_calls == [['x', 'y'], ['z']]
+    assert cache.stats()['hits'] == 2
+
+
+def test_models_do_not_share_entries(cache):
+    annotator = CountingAnnotator()
+    cache.annotate('ner', ['x'], annotator)
+    cache.annotate('srl', ['x'], annotator)
+    assert annotator.list_calls == [['x'], ['x']]
+
+
+def test_persistent(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    cache = AnnotationCache(path)
+    cache.annotate('ner', ['x', 'y'], CountingAnnotator())
+    cache.close()
+    cache = AnnotationCache(path)
+    annotator = CountingAnnotator()
+    assert cache.annotate('ner', ['x', 'y'], annotator) == \
+        CountingAnnotator()(['x', 'y'])
+    assert annotator.list_calls == []
+    cache.close()
+
+
+def test_eviction(tmp_path):
+    cache = AnnotationCache(str(tmp_path / 'cache.sqlite'), max_entries=2)
+    cache.annotate('ner', ['x', 'y', 'z'], CountingAnnotator())
+    assert len(cache) == 2
+    cache.close()
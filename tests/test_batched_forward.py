@@ -0,0 +1,77 @@
+'''
+The batched forward gives each instance the same output as a batch of size 1
+(requires the full environment: torch, dgl 0.4, transformers and the spacy
+model)
+'''
+import pytest
+
+torch = pytest.importorskip('torch')
+dgl = pytest.importorskip('dgl')
+model = pytest.importorskip('src.models.model')
+
+HIDDEN = 8
+
+
+def make_graph(num_tok, num_srl, num_ent):
+    '''
+    Graph with one srl node per 2 tokens and, if num_ent > 0,
+    entities over the first tokens only (the other tokens have no ent2tok edge)
+    '''
+    srl_src = torch.arange(num_tok) // 2 % num_srl
+    tok = torch.arange(num_tok)
+    dict_edges = {('srl', 'srl2tok', 'tok'): (srl_src, tok),
+                  ('tok', 'tok2srl', 'srl'): (tok, srl_src)}
+    dict_num_nodes = {'tok': num_tok, 'srl': num_srl}
+    if num_ent > 0:
+        ent_tok = torch.arange(num_ent)
+        dict_edges[('ent', 'ent2tok', 'tok')] = (ent_tok, ent_tok)
+        dict_edges[('tok', 'tok2ent', 'ent')] = (ent_tok, ent_tok)
+        dict_num_nodes['ent'] = num_ent
+    return dgl.heterograph(dict_edges, dict_num_nodes)
+
+
+def make_feats(graph):
+    return {ntype: torch.randn(graph.number_of_nodes(ntype), HIDDEN)
+            for ntype in graph.ntypes}
+
+
+def test_nodes_in_graphs_with_edges():
+    list_graphs = [make_graph(5, 2, 2), make_graph(3, 1, 0),
+                   make_graph(4, 2, 1)]
+    mask = model.nodes_in_graphs_with_edges(
+        model.batch_graphs(list_graphs), 'tok', 'ent2tok')
+    assert mask.tolist() == [True] * 5 + [False] * 3 + [True] * 4
+
+
+def test_mixed_batch_equals_per_graph():
+    torch.manual_seed(0)
+    layer = model.HeteroRGCNLayer(HIDDEN, HIDDEN)
+    layer.eval()
+    # the second instance has no entities
+    list_graphs = [make_graph(6, 2, 3), make_graph(5, 2, 0),
+                   make_graph(7, 3, 2)]
+    list_feats = [make_feats(g) for g in list_graphs]
+    with torch.no_grad():
+        list_out = [layer(g, feats, None)
+                    for g, feats in zip(list_graphs, list_feats)]
+        b_graph = model.batch_graphs(list_graphs)
+        b_feats = {ntype: torch.cat([feats[ntype] for feats in list_feats
+                                     if ntype in feats])
+                   for ntype in b_graph.ntypes}
+        b_out = layer(b_graph, b_feats, None)
+    for ntype in ['tok', 'srl', 'ent']:
+        expected = torch.cat([out[ntype] for out in list_out
+                              if ntype in out])
+        assert torch.allclose(b_out[ntype], expected, atol=1e-5)
+
+
+def test_length_bucket_batch_sampler():
+    list_lengths = [30, 10, 50, 20, 40, 60, 5]
+    sampler = model.LengthBucketBatchSampler(list_lengths, 3)
+    list_batches = list(sampler)
+    assert len(list_batches) == len(sampler) == 3
+    assert list_batches[0] == [5, 2, 4]
+    sampler = model.LengthBucketBatchSampler(list_lengths, 2, shuffle=True,
+                                             pool_size=1)
+    list_idx = [idx for batch in sampler for idx in batch]
+    assert sorted(list_idx) == list(range(len(list_lengths)))
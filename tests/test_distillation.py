@@ -0,0 +1,55 @@
+'''
+Distillation losses on hand-made outputs of HGNModel.forward (requires the full
+environment: torch, dgl 0.4, transformers and the spacy model)
+'''
+import pytest
+
+torch = pytest.importorskip('torch')
+distillation = pytest.importorskip('src.models.distillation')
+
+WEIGHTS = {'span': 1., 'ans_type': 1., 'sent': 1., 'srl': 1., 'ent': 1.}
+
+
+def make_output(sent_logits, node_idx=None, span=True, batch_size=2,
+                seq_len=6):
+    span_logits = [torch.randn(batch_size, seq_len) if span else None
+                   for _ in range(2)]
+    sent_lbl = None if node_idx is None else torch.ones(len(node_idx))
+    return {'span': {'start_logits': span_logits[0],
+                     'end_logits': span_logits[1]},
+            'ans_type': {'logits': torch.randn(batch_size, 3)},
+            'sent': {'logits': sent_logits, 'lbl': sent_lbl,
+                     'node_idx': node_idx},
+            'srl': {'logits': None, 'lbl': None, 'node_idx': None},
+            'ent': {'logits': None, 'lbl': None, 'node_idx': None}}
+
+
+def test_student_nodes_are_matched_with_the_teacher_nodes():
+    teacher_sent_logits = torch.randn(5, 2)
+    node_idx = [1, 3, 4]
+    student = make_output(teacher_sent_logits[node_idx].clone(), node_idx)
+    teacher = make_output(teacher_sent_logits)
+    attention_mask = torch.ones(2, 6, dtype=torch.long)
+    _, dict_loss = distillation.distillation_loss(student, teacher,
+                                                  attention_mask, 2.0, WEIGHTS)
+    # same logits for the sampled nodes
+    assert dict_loss['sent'].abs().item() < 1e-6
+
+
+def test_hard_loss_has_the_answer_type_loss():
+    student = make_output(torch.randn(2, 2), [0, 1], span=False)
+    start_positions = torch.tensor([-1, -1])
+    end_positions = torch.tensor([-1, -1])
+    ans_type_labels = torch.tensor([1, 2])
+    loss = distillation.hard_loss(student, start_positions, end_positions,
+                                  ans_type_labels, WEIGHTS)
+    ans_type_loss = torch.nn.functional.cross_entropy(
+        student['ans_type']['logits'], ans_type_labels)
+    sent_loss = torch.nn.functional.cross_entropy(
+        student['sent']['logits'], torch.ones(2, dtype=torch.long))
+    assert torch.allclose(loss, ans_type_loss + sent_loss)
+
+
+def test_ans_type_label():
+    assert [distillation.ans_type_label({'answer': answer})
+            for answer in ['Paris', 'yes', 'no']] == [0, 1, 2]
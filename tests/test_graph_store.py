@@ -0,0 +1,118 @@
+'''
+GraphStore round-trip and reuse of the stored graphs whose inputs did not
+change (requires the full environment: torch, dgl 0.4 and transformers)
+'''
+import pytest
+
+torch = pytest.importorskip('torch')
+dgl = pytest.importorskip('dgl')
+graph_store = pytest.importorskip('src.data.graph_store')
+graph_creation = pytest.importorskip('src.data.graph_creation')
+
+
+def make_graph(num_tok, num_srl):
+    srl_src = torch.arange(num_tok) // 2 % num_srl
+    tok = torch.arange(num_tok)
+    g = dgl.heterograph({('srl', 'srl2tok', 'tok'): (srl_src, tok),
+                         ('tok', 'tok2srl', 'srl'): (tok, srl_src)},
+                        {'tok': num_tok, 'srl': num_srl})
+    g.nodes['srl'].data['st_end_idx'] = torch.stack(
+        [torch.arange(num_srl), torch.arange(num_srl) + 1], dim=1)
+    g.nodes['srl'].data['labels'] = torch.ones(num_srl)
+    g.edges['srl2tok'].data['span_idx'] = torch.arange(num_tok)
+    return g
+
+
+def assert_same_graph(g1, g2):
+    assert g1.canonical_etypes == g2.canonical_etypes
+    for ntype in g1.ntypes:
+        assert g1.number_of_nodes(ntype) == g2.number_of_nodes(ntype)
+        assert set(g1.nodes[ntype].data.keys()) == set(
+            g2.nodes[ntype].data.keys())
+        for k, v in g1.nodes[ntype].data.items():
+            assert g2.nodes[ntype].data[k].dtype == v.dtype
+            assert torch.equal(g2.nodes[ntype].data[k], v)
+    for etype in g1.etypes:
+        for t1, t2 in zip(g1.edges(etype=etype), g2.edges(etype=etype)):
+            assert torch.equal(t1, t2)
+        for k, v in g1.edges[etype].data.items():
+            assert torch.equal(g2.edges[etype].data[k], v)
+
+
+@pytest.mark.parametrize('shard_size', [1, 2, 3])
+def test_round_trip(tmp_path, shard_size):
+    list_graphs = [make_graph(num_tok, num_srl)
+                   for num_tok, num_srl in [(6, 2), (9, 3), (4, 1)]]
+    list_info = [{'fingerprint': str(i), 'span_idx': [i, i + 1]}
+                 for i in range(len(list_graphs))]
+    path = str(tmp_path / 'graph_store')
+    # shards of 1, 2 (+ 1) and 3 graphs
+    assert graph_store.write_graphs(path, list_graphs, list_info,
+                                    shard_size=shard_size) == len(list_graphs)
+    store = graph_store.GraphStore(path)
+    assert len(store) == len(list_graphs)
+    for i, g in enumerate(list_graphs):
+        assert_same_graph(g, store[i])
+        assert store.info(i) == list_info[i]
+    assert_same_graph(list_graphs[-1], store[-1])
+
+
+class CountingDataset(graph_creation.Dataset):
+    '''
+    Dataset with a toy graph per instance that counts the graphs it builds
+    (no tokenizer, so the annotations are empty)
+    '''
+    def __init__(self, dataset):
+        self.tokenizer = None
+        self.tokenizer_id = 'toy:0'
+        self.max_len = 512
+        self.multihop_threshold = 90
+        self.set_data(dataset, [[] for _ in dataset],
+                      [dict() for _ in dataset], [dict() for _ in dataset],
+                      [[] for _ in dataset])
+        self.list_built = []
+
+    def encode_all_sentences(self):
+        return ([{'input_ids': [0] * ins['num_tok']} for ins in self.dataset],
+                [None] * len(self.dataset))
+
+    def create_instance_graph(self, ins_idx, context, dict_idx):
+        self.list_built.append(ins_idx)
+        return make_graph(len(context['input_ids']), 2), (ins_idx, ins_idx + 1)
+
+
+def test_unchanged_instances_are_not_rebuilt(tmp_path):
+    path = str(tmp_path / 'graph_store')
+    hotpot = [{'num_tok': 6}, {'num_tok': 8}, {'num_tok': 10}]
+    dataset = CountingDataset(hotpot)
+    list_graphs, _, list_span_idx = dataset.create_dataloader()
+    assert dataset.list_built == [0, 1, 2]
+    # shard_size=2: the reused graphs are read from both shards
+    graph_store.write_graphs(path, list_graphs, dataset.list_graph_info,
+                             shard_size=2)
+
+    dataset = CountingDataset(hotpot)
+    list_reused_graphs, _, list_reused_span_idx = dataset.create_dataloader(
+        graph_store=graph_store.GraphStore(path))
+    assert dataset.list_built == []
+    assert list_reused_span_idx == list_span_idx
+    for g, reused_g in zip(list_graphs, list_reused_graphs):
+        assert_same_graph(g, reused_g)
+
+    # only the instance whose inputs changed is rebuilt
+    hotpot[1] = {'num_tok': 12}
+    dataset = CountingDataset(hotpot)
+    list_graphs, _, _ = dataset.create_dataloader(
+        graph_store=graph_store.GraphStore(path))
+    assert dataset.list_built == [1]
+    assert list_graphs[1].number_of_nodes('tok') == 12
+
+    # the store written after the rebuild has all the graphs
+    graph_store.write_graphs(path, list_graphs, dataset.list_graph_info,
+                             shard_size=2)
+    dataset = CountingDataset(hotpot)
+    list_reused_graphs, _, _ = dataset.create_dataloader(
+        graph_store=graph_store.GraphStore(path))
+    assert dataset.list_built == []
+    for g, reused_g in zip(list_graphs, list_reused_graphs):
+        assert_same_graph(g, reused_g)
@@ -0,0 +1,74 @@
+import random
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('dgl')
+graph_utils = pytest.importorskip('src.data.graph_utils')
+
+
+def naive_find(x, y, fallback_first_occurrence=True):
+    occ = [i for i, a in enumerate(x) if a == y[0]]
+    for b in occ:
+        if x[b:b+len(y)] == y:
+            return b
+    if occ and fallback_first_occurrence:
+        return occ[0]
+    raise Exception("Sublist not in list")
+
+
+@pytest.mark.parametrize('fallback', [True, False])
+def test_span_aligner_matches_naive_search(fallback):
+    rng = random.Random(0)
+    for _ in range(200):
+        tokens = [rng.randrange(6) for _ in range(rng.randrange(1, 30))]
+        aligner = graph_utils.SpanAligner(
+            tokens, fallback_first_occurrence=fallback)
+        for _ in range(10):
+            span = [rng.randrange(6) for _ in range(rng.randrange(1, 4))]
+            try:
+                expected = naive_find(tokens, span, fallback)
+            except Exception:
+                with pytest.raises(Exception):
+                    aligner.find(span)
+                continue
+            assert aligner.find(span) == expected
+
+
+def test_locate_offsets_and_clamps():
+    aligner = graph_utils.SpanAligner([7, 8, 9, 10], offset=100,
+                                      max_len=102)
+    assert aligner.locate([8]) == (101, 102)
+    assert aligner.locate([8, 9, 10]) == (101, 102)
+    assert graph_utils.SpanAligner([7, 8, 9], offset=5).locate([8, 9]) == \
+        (6, 8)
+
+
+def test_common_entity_edges_sent_lvl():
+    dict_sent_node2metadata = {0: {'doc_idx': 0, 'sent_idx': 0},
+                               1: {'doc_idx': 0, 'sent_idx': 1},
+                               2: {'doc_idx': 1, 'sent_idx': 0},
+                               # sentence without annotations
+                               3: {'doc_idx': 1, 'sent_idx': 5}}
+    list_ner = [[['a', 'b'], ['c']], [['b', 'c', 'a']]]
+    edges = graph_utils.common_entity_edges_sent_lvl(dict_sent_node2metadata,
+                                                     list_ner)
+    assert edges == [(0, 2), (1, 2), (2, 0), (2, 1)]
+
+
+def naive_matching_pairs(list_nodes, list_str, threshold):
+    from fuzzywuzzy import fuzz
+    return [(u, v) for u in list_nodes for v in list_nodes
+            if u < v and fuzz.token_set_ratio(list_str[u], list_str[v])
+            >= threshold]
+
+
+@pytest.mark.parametrize('threshold', [0, 50, 90, 100])
+def test_matching_pairs_matches_nested_loop(threshold):
+    list_str = ['Barack Obama', 'Obama', 'barack h. obama', 'Michelle Obama',
+                'Chicago', 'chicago, illinois', '!!', '', 'Illinois']
+    matcher = graph_utils.FuzzyMatcher()
+    # repeated nodes, not sorted
+    list_nodes = [3, 0, 1, 2, 0, 5, 4, 6, 7, 8, 3]
+    pairs = matcher.matching_pairs(list_nodes, list_str, threshold)
+    assert pairs == naive_matching_pairs(list_nodes, list_str, threshold)
+    assert all(u != v for u, v in pairs)
@@ -0,0 +1,37 @@
+from conftest import load_module
+
+paragraph_table = load_module('paragraph_table',
+                              'src/data/preprocessing/paragraph_table.py')
+ParagraphTable = paragraph_table.ParagraphTable
+
+HOTPOT = [{'context': [['A', ['a0', 'a1']], ['B', ['b0']]]},
+          {'context': [['B', ['b0']], ['A', ['a0', 'a1']], ['C', ['c0']]]},
+          # same title, different content
+          {'context': [['A', ['other']]]}]
+DICT_INS2DICT_DOC2PRED = {0: {0: 1, 1: 1}, 1: {0: 1, 1: 1, 2: 0}, 2: {0: 1}}
+
+
+def test_unique_paragraphs():
+    table = ParagraphTable(HOTPOT, DICT_INS2DICT_DOC2PRED)
+    assert table.list_paragraphs == [('A', ['a0', 'a1']), ('B', ['b0']),
+                                     ('A', ['other'])]
+    assert table.paragraph_idx(1, 1) == table.paragraph_idx(0, 0)
+    assert table.paragraph_idx(1, 0) == table.paragraph_idx(0, 1)
+    # not selected
+    assert (1, 2) not in table.dict_ins_doc2paragraph_idx
+    assert table.dedup_ratio() == 5 / 3
+
+
+def test_annotate_matches_per_paragraph():
+    table = ParagraphTable(HOTPOT, DICT_INS2DICT_DOC2PRED)
+    list_calls = []
+
+    def annotate(list_sent):
+        list_calls.append(list_sent)
+        return [sent.upper() for sent in list_sent]
+
+    list_paragraph_annotations = table.annotate(annotate)
+    assert len(list_calls) == 1
+    for (_, doc), annotations in zip(table.list_paragraphs,
+                                     list_paragraph_annotations):
+        assert annotations == [sent.upper() for sent in doc]
@@ -0,0 +1,50 @@
+'''
+run_pipeline: output order and errors of the stages and of the input
+(requires the full environment: the pipeline imports the NLP models)
+'''
+import threading
+import pytest
+
+pipeline = pytest.importorskip('src.models.pipeline')
+
+
+def collect(iter_items, list_stages, timeout=10):
+    '''
+    Output of run_pipeline, run in a thread so that a hung pipeline fails the
+    test instead of blocking it
+    '''
+    result = dict()
+
+    def run():
+        try:
+            result['items'] = list(
+                pipeline.run_pipeline(iter_items, list_stages, queue_size=1))
+        except Exception as e:
+            result['error'] = e
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "the pipeline did not finish"
+    return result
+
+
+def test_items_keep_their_order():
+    result = collect(range(20), [lambda x: x + 1, lambda x: x * 2])
+    assert result['items'] == [(x + 1) * 2 for x in range(20)]
+
+
+def test_stage_error_is_raised():
+    def fail_on_3(x):
+        if x == 3:
+            raise ValueError("stage")
+        return x
+    result = collect(range(20), [fail_on_3, lambda x: x])
+    assert str(result['error']) == "stage"
+
+
+def test_input_error_is_raised():
+    def items():
+        yield from range(5)
+        raise ValueError("input")
+    result = collect(items(), [lambda x: x, lambda x: x])
+    assert str(result['error']) == "input"
@@ -0,0 +1,42 @@
+'''
+PredictionService micro-batches: requests with the same _id are not merged
+(requires the full environment: the service imports the NLP models)
+'''
+import queue
+import pytest
+
+serving = pytest.importorskip('src.models.serving')
+
+
+def make_service(max_batch_size=32):
+    '''
+    Service without model: only the request queue and the batcher
+    '''
+    service = object.__new__(serving.PredictionService)
+    service.max_batch_size = max_batch_size
+    service.max_wait = 0
+    service.request_queue = queue.Queue()
+    return service
+
+
+def make_instance(_id):
+    return {'_id': _id, 'question': '', 'context': []}
+
+
+def test_requests_with_the_same_id_go_to_different_batches():
+    service = make_service()
+    for name, list_ids in [('r1', ['a']), ('r2', ['b']), ('r3', ['a', 'c']),
+                           ('r4', ['d'])]:
+        service.request_queue.put(([make_instance(_id) for _id in list_ids],
+                                   name))
+    service.request_queue.put(serving._STOP)
+    list_batches = [[name for (_, name) in batch['requests']]
+                    for batch in service.batches()]
+    assert list_batches == [['r1', 'r2'], ['r3', 'r4']]
+
+
+def test_duplicate_ids_in_a_request_are_rejected():
+    service = make_service()
+    with pytest.raises(ValueError):
+        service.submit([make_instance('a'), make_instance('a')])
+    assert service.request_queue.empty()